@@ -1,17 +1,25 @@
+import argparse
+
 from openwpm import CommandSequence, TaskManager
-import csv
+from openwpm.utilities import site_list
+
+parser = argparse.ArgumentParser(description="Crawl the sites of a site list.")
+parser.add_argument(
+    "sources",
+    nargs="*",
+    default=["dataset.csv"],
+    help="rank,domain CSV files or glob patterns, e.g. datasets/tranco_*.csv",
+)
+parser.add_argument(
+    "--shard", type=site_list.parse_shard, help="only crawl shard i of N, as i/N"
+)
+parser.add_argument(
+    "--resume", action="store_true", help="skip the sites visited by an earlier run"
+)
+args = parser.parse_args()
 
 NUM_BROWSERS = 3
-sites = []
-with open("dataset.csv") as csvfile:
-    reader = csv.reader(csvfile, quoting=csv.QUOTE_NONE)
-    for row in reader:
-        element = row[1]
-        if "www" in element:
-            element = "http://" + element
-        else:
-            element = "http://www." + element
-        sites.append(element)
+sites = [site.url for site in site_list.iter_sites(args.sources, args.shard, www=True)]
 
 manager_params, browser_params = TaskManager.load_default_params(NUM_BROWSERS)
 
@@ -39,6 +47,7 @@ manager_params["data_directory"] = "~/Desktop/output/"
 manager_params["log_directory"] = "~/Desktop/output/"
 manager_params["memory_watchdog"] = True
 manager_params["process_watchdog"] = True
+manager_params["resume"] = args.resume
 
 # Instantiates the measurement platform
 # Commands time out by default after 60 seconds
@@ -57,6 +66,7 @@ for site in sites:
     command_sequence.get(sleep=3, timeout=300)
     command_sequence.detect_dark_patterns(sleep=3, timeout=300, languages=["nl"])
     # command_sequence.ping_cmp(sleep=3, timeout=300)
+    # command_sequence.get_tc_data(sleep=3, timeout=300)
     # command_sequence.detect_cookie_dialog(sleep=3, timeout=300)
 
     # Run commands across the three browsers (simple parallelization)
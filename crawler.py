@@ -5,7 +5,7 @@ import signal
 import sys
 import time
 from threading import Lock
-from typing import Any, Callable, List
+from typing import Any, Callable, List, Tuple
 
 import boto3
 import sentry_sdk
@@ -35,6 +35,7 @@ TIMEOUT = int(os.getenv("TIMEOUT", "60"))
 SENTRY_DSN = os.getenv("SENTRY_DSN", None)
 LOGGER_SETTINGS = MPLogger.parse_config_from_env()
 MAX_JOB_RETRIES = int(os.getenv("MAX_JOB_RETRIES", "2"))
+JOBS_PER_BROWSER = int(os.getenv("JOBS_PER_BROWSER", "10"))
 
 JS_INSTRUMENT_SETTINGS = json.loads(JS_INSTRUMENT_SETTINGS)
 
@@ -43,12 +44,17 @@ if CALLSTACK_INSTRUMENT is True:
     JS_INSTRUMENT = True
 
 EXTENDED_LEASE_TIME = 2 * (TIMEOUT + DWELL_TIME + 30)
+# Leases are renewed and expired leases requeued at least this often. A blocking command sequence can take up to
+# TIMEOUT + DWELL_TIME, so the leases never run out in between.
+MAINTENANCE_INTERVAL = EXTENDED_LEASE_TIME / 2
 
 # Loads the default manager params
 # We can't use more than one browser per instance because the job management
 # code below requires blocking commands. For more context see:
 # https://github.com/mozilla/OpenWPM/issues/470
 NUM_BROWSERS = 1
+# Jobs are leased in batches to save round-trips to Redis
+JOB_BATCH_SIZE = NUM_BROWSERS * JOBS_PER_BROWSER
 manager_params, browser_params = TaskManager.load_default_params(NUM_BROWSERS)
 
 # Browser configuration
@@ -124,8 +130,11 @@ job_queue = rediswq.RedisWQ(
     name=REDIS_QUEUE_NAME, host=REDIS_HOST, max_retries=MAX_JOB_RETRIES
 )
 manager.logger.info("Worker with sessionID: %s" % job_queue.sessionID())
-manager.logger.info("Initial queue state: empty=%s" % job_queue.empty())
+manager.logger.info("Initial queue state: %s" % job_queue.progress())
 
+# Jobs that were leased but not visited yet
+leased_jobs: List[Tuple[bytes, int]] = list()
+# Jobs whose command sequence ran but whose data isn't saved yet
 unsaved_jobs: List[bytes] = list()
 unsaved_jobs_lock = Lock()
 
@@ -161,6 +170,7 @@ def get_job_completion_callback(
         with unsaved_jobs_lock:
             if sucess:
                 logger.info("Job %r is done", job)
+                # Release the lease as soon as the visit is saved
                 job_queue.complete(job)
             else:
                 logger.warning("Job %r got interrupted", job)
@@ -169,25 +179,37 @@ def get_job_completion_callback(
     return callback
 
 
-no_job_since = None
+last_maintenance = 0.0
 # Crawl sites specified in job queue until empty
-while not job_queue.empty():
-    job_queue.check_expired_leases()
+while True:
+    if time.time() - last_maintenance >= MAINTENANCE_INTERVAL:
+        job_queue.check_expired_leases()
+        with unsaved_jobs_lock:
+            manager.logger.debug("Currently unfinished jobs are: %s", unsaved_jobs)
+            held_jobs = unsaved_jobs + [job for job, _ in leased_jobs]
+            renewed = job_queue.renew_leases(held_jobs, EXTENDED_LEASE_TIME)
+            for held_job, is_renewed in zip(held_jobs, renewed):
+                if not is_renewed:
+                    manager.logger.error("Unsaved job: %s timed out", held_job)
+        last_maintenance = time.time()
+
+    if not leased_jobs:
+        jobs = job_queue.lease_many(
+            JOB_BATCH_SIZE, lease_secs=EXTENDED_LEASE_TIME, block=True, timeout=5
+        )
+        if not jobs:
+            if job_queue.empty():
+                manager.logger.info("Job queue finished, exiting.")
+                break
+            manager.logger.info("Waiting for work")
+            time.sleep(5)
+            continue
+        leased_jobs = list(zip(jobs, job_queue.get_retry_numbers(jobs)))
+
+    job, retry_number = leased_jobs.pop(0)
     with unsaved_jobs_lock:
-        manager.logger.debug("Currently unfinished jobs are: %s", unsaved_jobs)
-        for unsaved_job in unsaved_jobs:
-            if not job_queue.renew_lease(unsaved_job, EXTENDED_LEASE_TIME):
-                manager.logger.error("Unsaved job: %s timed out", unsaved_job)
-
-    job = job_queue.lease(lease_secs=TIMEOUT + DWELL_TIME + 30, block=True, timeout=5)
-    if job is None:
-        manager.logger.info("Waiting for work")
-        time.sleep(5)
-        continue
-
-    unsaved_jobs.append(job)
-    retry_number = job_queue.get_retry_number(job)
-    site_rank, site = job.decode("utf-8").split(",")
+        unsaved_jobs.append(job)
+    site_rank, site = job.decode("utf-8").split(",", 1)
     if "://" not in site:
         site = "http://" + site
     manager.logger.info("Visiting %s..." % site)
@@ -204,8 +226,6 @@ while not job_queue.empty():
     )
     command_sequence.get(sleep=DWELL_TIME, timeout=TIMEOUT)
     manager.execute_command_sequence(command_sequence)
-else:
-    manager.logger.info("Job queue finished, exiting.")
 manager.close()
 
 if SENTRY_DSN:
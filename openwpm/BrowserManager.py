@@ -20,6 +20,7 @@ from .Commands import command_executor
 from .Commands.Types import ShutdownCommand
 from .DeployBrowsers import deploy_browser
 from .Errors import BrowserConfigError, BrowserCrashError, ProfileLoadError
+from .metrics import REGISTRY
 from .SocketInterface import clientsocket
 from .utilities.multiprocess_utils import (
     Process,
@@ -119,6 +120,7 @@ class Browser:
         # Try to spawn the browser within the timelimit
         unsuccessful_spawns = 0
         success = False
+        start_time = time.time()
 
         def check_queue(launch_status):
             result = self.status_queue.get(True, self._SPAWN_TIMEOUT)
@@ -171,10 +173,12 @@ class Browser:
                         "trying again..." % self.browser_id
                     )
                     unsuccessful_spawns += 1
+                    REGISTRY.inc("openwpm_browser_launch_failures_total")
                     continue
                 success = True
             except (EmptyQueue, BrowserCrashError):
                 unsuccessful_spawns += 1
+                REGISTRY.inc("openwpm_browser_launch_failures_total")
                 error_string = ""
                 status_strings = [
                     "Proxy Ready",
@@ -198,6 +202,8 @@ class Browser:
                 if "Profile Created" in launch_status:
                     shutil.rmtree(spawned_profile_path, ignore_errors=True)
 
+        REGISTRY.observe("openwpm_browser_launch_seconds", time.time() - start_time)
+
         # If the browser spawned successfully, we should update the
         # current profile path class variable and clean up the tempdir
         # and previous profile path.
@@ -230,6 +236,7 @@ class Browser:
             )
             return True
 
+        REGISTRY.inc("openwpm_browser_restarts_total")
         self.close_browser_manager()
 
         # if crawl should be stateless we can clear profile
@@ -13,6 +13,7 @@ from .Commands.Types import (
     SaveScreenshotCommand,
     ScreenshotFullPageCommand,
     PingCmpCommand,
+    GetTCDataCommand,
     DetectCookieDialogCommand,
     DetectDarkPatternsCommand,
     DisableJavaScriptCommand
@@ -158,8 +159,9 @@ class CommandSequence:
         """Dumps rendered source of current page visit to 'sources' dir.
         Unlike `dump_page_source`, this includes iframe sources. Archive is
         stored in `manager_params['source_dump_path']` and is keyed by the
-        current `visit_id` and top-level url. The source dump is a gzipped json
-        file with the following structure:
+        current `visit_id` and top-level url. The source dump is a json file,
+        compressed as set by the `page_source` compression policy (gzip by
+        default), with the following structure:
         {
             'document_url': "http://example.com",
             'source': "<html> ... </html>",
@@ -202,6 +204,16 @@ class CommandSequence:
         command = PingCmpCommand(sleep)
         self._commands_with_timeout.append((command, timeout))
 
+    def get_tc_data(self, sleep=0, timeout=60):
+        """Save the TC string and CMP details returned by the TCF API
+        `getTCData` command of the page to the `tc_data` table"""
+        self.total_timeout += timeout
+        if not self.contains_get_or_browse:
+            raise CommandExecutionError("No get or browse request preceding "
+                                        "the get_tc_data command", self)
+        command = GetTCDataCommand(sleep)
+        self._commands_with_timeout.append((command, timeout))
+
     def detect_dark_patterns(self, sleep=0, timeout=60, languages=["nl"]):
         self.total_timeout += timeout
         if not self.contains_get_or_browse:
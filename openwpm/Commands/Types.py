@@ -118,6 +118,14 @@ class PingCmpCommand(BaseCommand):
         return "PingCmpCommand()"
 
 
+class GetTCDataCommand(BaseCommand):
+    def __init__(self, sleep):
+        self.sleep = sleep
+
+    def __repr__(self):
+        return "GetTCDataCommand()"
+
+
 class DetectDarkPatternsCommand(BaseCommand):
     def __init__(self, sleep, languages):
         self.sleep = sleep
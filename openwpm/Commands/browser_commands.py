@@ -1,4 +1,3 @@
-import gzip
 import json
 import logging
 import os
@@ -24,6 +23,8 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.firefox.options import Options
 
 from ..SocketInterface import clientsocket
+from ..utilities.compression import compress, extension, get_codec
+from ..utilities.vendor_list import get_cmp_name
 from .utils.webdriver_utils import (
     execute_in_all_frames,
     execute_script_with_retry,
@@ -38,6 +39,7 @@ from google_trans_new import google_translator
 NUM_MOUSE_MOVES = 10  # Times to randomly move the mouse
 RANDOM_SLEEP_LOW = 1  # low (in sec) for random sleep between page loads
 RANDOM_SLEEP_HIGH = 7  # high (in sec) for random sleep between page loads
+TC_DATA_TIMEOUT = 10  # seconds to wait for the CMP to answer getTCData
 logger = logging.getLogger("openwpm")
 
 
@@ -218,6 +220,23 @@ def save_screenshot(visit_id, browser_id, driver, manager_params, suffix=""):
         manager_params["screenshot_path"], "%i-%s%s.png" % (visit_id, urlhash, suffix)
     )
     driver.save_screenshot(outname)
+    _recompress_screenshot(outname, manager_params)
+
+
+def _recompress_screenshot(outname, manager_params, image=None):
+    """Save the PNG screenshot `outname` again with the configured deflate
+    level, if any. If `image` is given, it is saved instead of the file."""
+    codec, level = get_codec(manager_params, "screenshots")
+    if codec == "none" and image is None:
+        return
+    if image is None:
+        with Image.open(outname) as img:
+            img.load()
+            image = img.copy()
+    if codec == "none":
+        image.save(outname)
+    else:
+        image.save(outname, compress_level=9 if level is None else level)
 
 
 def check_html_elements(webdriver, buttons, reject=False):
@@ -503,14 +522,7 @@ def ping_cmp(visit_id, webdriver):
         "return result;")
 
     if tc_data is not None:
-        cmp_name = ""
-        if "cmpId" in tc_data.keys():
-            with open("cmplist.json") as json_file:
-                data = json.load(json_file)
-                for key, value in data["cmps"].items():
-                    if int(key) == tc_data["cmpId"]:
-                        cmp_name = value["name"]
-                        break
+        cmp_name = get_cmp_name(tc_data.get("cmpId"))
         openwpm_db = "/home/parallels/Desktop/output/crawl-data.sqlite"
         # openwpm_db = "/opt/Desktop/output/crawl-data.sqlite"
         conn = sqlite3.connect(openwpm_db, timeout=300)
@@ -522,6 +534,59 @@ def ping_cmp(visit_id, webdriver):
         conn.close()
 
 
+def get_tc_data(visit_id, webdriver, browser_params, manager_params):
+    """Save the TC string of the page and the CMP that set it
+
+    Calls the TCF v2 `getTCData` command, whose callback may be invoked
+    asynchronously once the CMP has loaded, and sends a `tc_data` record to
+    the aggregator. Pages without `__tcfapi`, or whose CMP doesn't answer
+    within `TC_DATA_TIMEOUT` seconds, get no record."""
+    tc_data = webdriver.execute_async_script(
+        "const done = arguments[arguments.length - 1]; "
+        "if (typeof window.__tcfapi != 'function') { done(null); return; } "
+        "const timer = setTimeout(() => done(null), arguments[0]); "
+        "try { "
+        "   window.__tcfapi('getTCData', 2, function(tcData, success) { "
+        "       clearTimeout(timer); "
+        "       if (!success || !tcData) { done(null); return; } "
+        "       done({ "
+        "           tcString: tcData.tcString, "
+        "           cmpId: tcData.cmpId, "
+        "           cmpVersion: tcData.cmpVersion, "
+        "           tcfPolicyVersion: tcData.tcfPolicyVersion, "
+        "           gdprApplies: tcData.gdprApplies, "
+        "           eventStatus: tcData.eventStatus, "
+        "           cmpStatus: tcData.cmpStatus, "
+        "           isServiceSpecific: tcData.isServiceSpecific, "
+        "           publisherCC: tcData.publisherCC "
+        "       }); "
+        "   }); "
+        "} catch (e) { clearTimeout(timer); done(null); }",
+        TC_DATA_TIMEOUT * 1000)
+
+    if tc_data is None:
+        return
+
+    record = {
+        "visit_id": visit_id,
+        "browser_id": browser_params["browser_id"],
+        "cmp_id": tc_data.get("cmpId"),
+        "cmp_name": get_cmp_name(tc_data.get("cmpId")),
+        "cmp_version": tc_data.get("cmpVersion"),
+        "tcf_policy_version": tc_data.get("tcfPolicyVersion"),
+        "gdpr_applies": tc_data.get("gdprApplies"),
+        "event_status": tc_data.get("eventStatus"),
+        "cmp_status": tc_data.get("cmpStatus"),
+        "is_service_specific": tc_data.get("isServiceSpecific"),
+        "publisher_cc": tc_data.get("publisherCC"),
+        "tc_string": tc_data.get("tcString"),
+    }
+    sock = clientsocket()
+    sock.connect(*manager_params["aggregator_address"])
+    sock.send(("tc_data", record))
+    sock.close()
+
+
 def detect_cookie_dialog(visit_id, webdriver):
     element = None
     element_type = ""
@@ -646,7 +711,7 @@ def _stitch_screenshot_parts(visit_id, browser_id, manager_params):
         output.paste(im=img["object"], box=(0, img["scroll"]))
         img["object"].close()
     try:
-        output.save(outname)
+        _recompress_screenshot(outname, manager_params, output)
     except SystemError:
         logger.error(
             "BROWSER %i: SystemError while trying to save screenshot %s. \n"
@@ -733,10 +798,11 @@ def recursive_dump_page_source(visit_id, driver, manager_params, suffix=""):
     if suffix != "":
         suffix = "-" + suffix
 
+    codec, level = get_codec(manager_params, "page_source")
     outname = md5(driver.current_url.encode("utf-8")).hexdigest()
     outfile = os.path.join(
         manager_params["source_dump_path"],
-        "%i-%s%s.json.gz" % (visit_id, outname, suffix),
+        "%i-%s%s.json%s" % (visit_id, outname, suffix, extension(codec)),
     )
 
     def collect_source(driver, frame_stack, rv={}):
@@ -766,8 +832,8 @@ def recursive_dump_page_source(visit_id, driver, manager_params, suffix=""):
     page_source = dict()
     execute_in_all_frames(driver, collect_source, {"rv": page_source})
 
-    with gzip.GzipFile(outfile, "wb") as f:
-        f.write(json.dumps(page_source).encode("utf-8"))
+    with open(outfile, "wb") as f:
+        f.write(compress(json.dumps(page_source).encode("utf-8"), codec, level))
 
 
 def finalize(
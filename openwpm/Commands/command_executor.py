@@ -12,6 +12,7 @@ from .Types import (
     SaveScreenshotCommand,
     ScreenshotFullPageCommand,
     PingCmpCommand,
+    GetTCDataCommand,
     DetectCookieDialogCommand,
     DetectDarkPatternsCommand,
     DisableJavaScriptCommand
@@ -44,6 +45,14 @@ def execute_command(
             webdriver=webdriver,
         )
 
+    elif type(command) is GetTCDataCommand:
+        browser_commands.get_tc_data(
+            visit_id=command.visit_id,
+            webdriver=webdriver,
+            browser_params=browser_params,
+            manager_params=manager_params,
+        )
+
     elif type(command) is DetectDarkPatternsCommand:
         browser_commands.detect_dark_patterns(
             visit_id=command.visit_id,
@@ -1,14 +1,19 @@
 import abc
 import logging
+import os
+import pickle
 import queue
 import threading
 import time
+import zlib
 from typing import Any, Dict, List, Optional, Tuple
 
-from multiprocess import Queue
+from multiprocess import Condition, Event, Queue, Value
 
-from ..SocketInterface import serversocket
+from ..metrics import REGISTRY, Snapshot, merge_snapshot, snapshot_changes
+from ..SocketInterface import DRAIN_TIMEOUT, serversocket
 from ..utilities.multiprocess_utils import Process
+from .journal import JOURNAL_DIRECTORY, RecordJournal
 
 RECORD_TYPE_CONTENT = "page_content"
 RECORD_TYPE_SPECIAL = "meta_information"
@@ -19,8 +24,121 @@ STATUS_TIMEOUT = 120  # seconds
 SHUTDOWN_SIGNAL = "SHUTDOWN"
 
 STATUS_UPDATE_INTERVAL = 5  # seconds
+DRAIN_POLL_INTERVAL = 0.1  # seconds between queue flushes while draining
 
-BaseParams = Tuple[Queue, Queue, Queue]
+# Credit is granted again once the queue has drained below this fraction
+# of `aggregator_queue_bytes_limit`
+CREDIT_LOW_WATERMARK = 0.5
+# The listener's socket threads stop reading from their connections once
+# the queue holds this multiple of `aggregator_queue_bytes_limit`
+QUEUE_HARD_LIMIT_FACTOR = 2
+
+
+class FlowControl:
+    """Byte-based credit window between the TaskManager and the listener
+
+    The listener revokes credit as soon as the bytes waiting in its record
+    queue reach `max_bytes` and grants it again once the queue has drained
+    below `CREDIT_LOW_WATERMARK * max_bytes`. The TaskManager blocks on the
+    shared event before submitting a new CommandSequence, so no polling of
+    the status queue is needed. A `max_bytes` of `None` or 0 disables flow
+    control.
+    """
+
+    def __init__(self, max_bytes: Optional[int]) -> None:
+        self.max_bytes = max_bytes or 0
+        self._credit = Event()
+        self._credit.set()
+        self._granted = True  # Local copy to avoid redundant IPC
+
+    @property
+    def hard_limit(self) -> int:
+        """Number of queued bytes at which the socket stops reading"""
+        return self.max_bytes * QUEUE_HARD_LIMIT_FACTOR
+
+    def update(self, queued_bytes: int) -> None:
+        """Grant or revoke credit based on the current queue size in bytes.
+
+        Should only be called from the listener process."""
+        if self.max_bytes <= 0:
+            return
+        if self._granted and queued_bytes >= self.max_bytes:
+            self._credit.clear()
+            self._granted = False
+        elif not self._granted and queued_bytes <= (
+            self.max_bytes * CREDIT_LOW_WATERMARK
+        ):
+            self._credit.set()
+            self._granted = True
+
+    def has_credit(self) -> bool:
+        return self._credit.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until credit is granted or `timeout` passes"""
+        return self._credit.wait(timeout)
+
+
+# Records are routed to a shard queue until it holds this many bytes, then
+# the router blocks, which pushes back on the router's own socket queue
+SHARD_QUEUE_BYTES = 64 * 2 ** 20
+# Shard that saves all page content (only one process can own the store)
+CONTENT_SHARD = 0
+SHARD_BY_TABLE = "table"
+SHARD_BY_VISIT = "visit"
+
+
+class ShardQueue:
+    """A process-safe FIFO queue of records bounded by their size in bytes
+
+    Records are pickled by `put`, so their size is known exactly, and the
+    number of queued bytes is shared between the router and the shard
+    writer. If `max_bytes` is larger than zero, `put` blocks while the
+    queue holds more than `max_bytes` bytes, like `RecordQueue` does.
+    """
+
+    def __init__(self, max_bytes: int = SHARD_QUEUE_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self._queue = Queue()
+        self._bytes = Value("q", 0)
+        self._not_full = Condition(self._bytes.get_lock())
+
+    def put(self, record: Any) -> None:
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self._not_full:
+            while self.max_bytes > 0 and self._bytes.value >= self.max_bytes:
+                self._not_full.wait()
+            self._bytes.value += len(data)
+        self._queue.put(data)
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        data = self._queue.get(block, timeout)
+        with self._not_full:
+            self._bytes.value -= len(data)
+            self._not_full.notify_all()
+        return pickle.loads(data)
+
+    def empty(self) -> bool:
+        return self._queue.empty()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def bytesize(self) -> int:
+        """Return the number of bytes held by the queue"""
+        with self._not_full:
+            return self._bytes.value
+
+
+# Index of a shard and the queue that it receives its records on
+ShardParams = Tuple[int, ShardQueue]
+# Directory and fsync interval of the write-ahead journal
+JournalParams = Tuple[str, Optional[float]]
+BaseParams = Tuple[
+    Queue, Queue, Queue, FlowControl, Optional[ShardParams], Optional[JournalParams]
+]
+# Visit id, whether the visit was interrupted and the time it was saved at
+CompletedVisit = Tuple[int, bool, float]
 
 
 class BaseListener:
@@ -36,7 +154,13 @@ class BaseListener:
     __metaclass = abc.ABCMeta
 
     def __init__(
-        self, status_queue: Queue, completion_queue: Queue, shutdown_queue: Queue
+        self,
+        status_queue: Queue,
+        completion_queue: Queue,
+        shutdown_queue: Queue,
+        flow_control: FlowControl,
+        shard_params: Optional[ShardParams] = None,
+        journal_params: Optional[JournalParams] = None,
     ) -> None:
         """
         Creates a BaseListener instance
@@ -44,17 +168,30 @@ class BaseListener:
         Parameters
         ----------
         status_queue
-            queue that the current amount of records to be processed will
+            queue that status updates (see `get_status_update`) will
             be sent to
             also used for initialization
         completion_queue
             queue containing the visitIDs of saved records
         shutdown_queue
             queue that the main process can use to shut down the listener
+        flow_control
+            credit window shared with the main process
+        shard_params
+            if this listener runs as one of several shard writers, its
+            shard index and the queue that `ShardRouter` sends records to
+        journal_params
+            if set, the received records are written to a `RecordJournal`
+            in the given directory, synced with the given interval
         """
         self.status_queue = status_queue
         self.completion_queue = completion_queue
         self.shutdown_queue = shutdown_queue
+        self.flow_control = flow_control
+        self.shard_index: Optional[int] = None
+        self._shard_queue: Optional[ShardQueue] = None
+        if shard_params is not None:
+            self.shard_index, self._shard_queue = shard_params
         self._shutdown_flag = False
         self._relaxed = False
         self._last_update = time.time()  # last status update time
@@ -62,6 +199,14 @@ class BaseListener:
         self.logger = logging.getLogger("openwpm")
         self.curent_visit_ids: List[int] = list()  # All visit_ids in flight
         self.sock: Optional[serversocket] = None
+        self._journal_params = journal_params
+        self.journal: Optional[RecordJournal] = None
+        self._journal_base = 0  # sequence number of the first queued record
+        # sequence number of the first record that wasn't replayed, while
+        # replayed records are processed
+        self._replay_end: Optional[int] = None
+        # metric samples sent with earlier status updates
+        self._sent_metrics: Dict[Tuple[str, Any], Any] = dict()
 
     @abc.abstractmethod
     def process_record(self, record):
@@ -94,11 +239,38 @@ class BaseListener:
         interrupted
            whether a visit is unfinished"""
 
+    @property
+    def is_primary_shard(self) -> bool:
+        """`True` unless this is a shard writer other than the first one.
+
+        Per visit bookkeeping that must only be written once, such as the
+        `incomplete_visits` table, should be guarded by this property."""
+        return self.shard_index is None or self.shard_index == 0
+
     def startup(self):
         """Run listener startup tasks
 
         Note: Child classes should call this method"""
-        self.sock = serversocket(name=type(self).__name__)
+        # Metrics recorded by the parent before this process was forked
+        REGISTRY.clear()
+        if self._shard_queue is not None:
+            # Shard writers receive their records from the router
+            self.record_queue = self._shard_queue
+            return
+        if self._journal_params is not None:
+            self.journal = RecordJournal(*self._journal_params)
+            self._journal_base = self.journal.first_seq
+            if self.journal.replayable:
+                self._replay_end = self.journal.next_seq
+                self.logger.info(
+                    "Replaying %d records from the journal of a crashed listener",
+                    self.journal.replayable,
+                )
+        self.sock = serversocket(
+            name=type(self).__name__,
+            max_queue_bytes=self.flow_control.hard_limit,
+            journal=self.journal,
+        )
         self.status_queue.put(self.sock.sock.getsockname())
         self.sock.start_accepting()
         self.record_queue = self.sock.queue
@@ -118,15 +290,75 @@ class BaseListener:
             return True
         return False
 
-    def update_status_queue(self):
-        """Send manager process a status update."""
-        if (time.time() - self._last_update) < STATUS_UPDATE_INTERVAL:
+    def update_flow_control(self):
+        """Grant or revoke credit for new visits based on the queue size"""
+        if self.sock is None:
+            return
+        self.flow_control.update(self.record_queue.bytesize())
+
+    def get_status_update(self) -> Dict[str, Any]:
+        """Return the status update that is sent to the manager process.
+
+        Child classes can extend the returned dictionary with their own
+        metrics. The samples of this process' metrics registry that changed
+        since the previous update are sent as `metrics`."""
+        if self.sock is None:
+            # Shard writers only know the records routed to them
+            return {
+                "queue_size": self.record_queue.qsize(),
+                "queue_bytes": self.record_queue.bytesize(),
+                "table_depths": {},
+                "metrics": snapshot_changes(REGISTRY.snapshot(), self._sent_metrics),
+            }
+        table_depths = self.record_queue.table_stats()
+        for table, (depth, size) in table_depths.items():
+            REGISTRY.set("openwpm_record_queue_depth", depth, table=table)
+            REGISTRY.set("openwpm_record_queue_bytes", size, table=table)
+        for table, (count, size) in self.record_queue.received_stats().items():
+            if table not in table_depths:
+                REGISTRY.set("openwpm_record_queue_depth", 0, table=table)
+                REGISTRY.set("openwpm_record_queue_bytes", 0, table=table)
+            REGISTRY.set("openwpm_records_received_total", count, table=table)
+            REGISTRY.set("openwpm_bytes_received_total", size, table=table)
+        REGISTRY.set("openwpm_open_connections", self.sock.open_connections)
+        REGISTRY.set(
+            "openwpm_connections_closed_total",
+            self.sock.ended_connections,
+            status="ended",
+        )
+        REGISTRY.set(
+            "openwpm_connections_closed_total",
+            self.sock.broken_connections,
+            status="broken",
+        )
+        status = {
+            "queue_size": self.record_queue.qsize(),
+            "queue_bytes": self.record_queue.bytesize(),
+            "table_depths": table_depths,
+            "metrics": snapshot_changes(REGISTRY.snapshot(), self._sent_metrics),
+        }
+        if self.journal is not None:
+            status["journal"] = self.journal.stats()
+        return status
+
+    def update_status_queue(self, force: bool = False):
+        """Send manager process a status update.
+
+        Updates are sent every `STATUS_UPDATE_INTERVAL` seconds, or right
+        away if `force` is set, e.g. for the final metrics at shutdown."""
+        if not force and (time.time() - self._last_update) < STATUS_UPDATE_INTERVAL:
             return
-        qsize = self.record_queue.qsize()
-        self.status_queue.put(qsize)
+        status = self.get_status_update()
+        self.status_queue.put(status)
         self.logger.debug(
-            "Status update; current record queue size: %d. "
-            "current number of threads: %d." % (qsize, threading.active_count())
+            "Status update; current record queue size: %d (%d bytes). "
+            "current number of threads: %d. Per table queue depths: %s"
+            % (
+                status["queue_size"],
+                status["queue_bytes"],
+                threading.active_count(),
+                status["table_depths"],
+            )
         )
         self._last_update = time.time()
 
@@ -157,32 +389,232 @@ class BaseListener:
                 "Unexpected meta " "information type: %s" % data["meta_type"]
             )
 
+    @property
+    def journal_seq(self) -> int:
+        """Journal sequence number of the next record taken from the queue,
+        or 0 if the journal is disabled"""
+        if self.journal is None:
+            return 0
+        return self._journal_base + self.record_queue.taken
+
+    def check_replay(self) -> None:
+        """Call `finish_replay` once all records replayed from the journal
+        were processed. Should be called after processing a record."""
+        if self._replay_end is not None and self.journal_seq >= self._replay_end:
+            self._replay_end = None
+            self.finish_replay()
+
+    def finish_replay(self) -> None:
+        """Save the visits that were in flight when the earlier listener died
+        as interrupted.
+
+        Their `Finalize` message never arrives, as the crawl that replaced
+        the earlier one doesn't know their visit ids. Child classes that
+        buffer records per visit should extend this to save those as well.
+        """
+        replayed = self.curent_visit_ids
+        self.curent_visit_ids = list()
+        if replayed:
+            self.logger.warning(
+                "Saving %d visits replayed from the journal as interrupted",
+                len(replayed),
+            )
+        for visit_id in replayed:
+            self.run_visit_completion_tasks(visit_id, interrupted=True)
+
+    def checkpoint_journal(self, seq: Optional[int] = None) -> None:
+        """Mark the journaled records before `seq` as saved.
+
+        By default, these are all records taken from the queue so far.
+        Child classes should call this once records are saved persistently.
+        """
+        if self.journal is None:
+            return
+        self.journal.checkpoint(self.journal_seq if seq is None else seq)
+
+    def close_journal(self) -> None:
+        """Close the journal, which is removed if all records were saved"""
+        if self.journal is not None:
+            self.journal.close()
+
     def mark_visit_complete(self, visit_id: int) -> None:
         """This function should be called to indicate that all records
         relating to a certain visit_id have been saved"""
-        self.completion_queue.put((visit_id, False))
+        self.completion_queue.put((visit_id, False, time.time()))
 
     def mark_visit_incomplete(self, visit_id: int):
         """This function should be called to indicate that a certain visit
         has been interrupted and will forever be incomplete
         """
-        self.completion_queue.put((visit_id, True))
+        self.completion_queue.put((visit_id, True, time.time()))
 
     def shutdown(self):
         """Run shutdown tasks defined in the base listener
 
         Note: Child classes should call this method"""
-        self.sock.close()
+        if self.sock is not None:
+            self.sock.close()
         for visit_id in self.curent_visit_ids:
             self.run_visit_completion_tasks(visit_id, interrupted=not self._relaxed)
 
-    def drain_queue(self):
-        """ Ensures queue is empty before closing """
-        time.sleep(3)  # TODO: the socket needs a better way of closing
-        while not self.record_queue.empty():
-            record = self.record_queue.get()
-            self.process_record(record)
-        self.logger.info("Queue was flushed completely")
+    def drain_queue(self, timeout: float = DRAIN_TIMEOUT) -> int:
+        """Ensures queue is empty before closing
+
+        Once the listener received the shutdown signal, this processes the
+        queued records while waiting up to `timeout` seconds for all senders
+        to close their connection, after which every record they sent is in
+        the queue. Senders that are blocked on a full queue can thus finish.
+        The remaining records are then processed. Returns the number of
+        records that were flushed.
+        """
+        closing = self._shutdown_flag and self.sock is not None
+        deadline = time.time() + timeout
+        flushed = 0
+        while True:
+            while not self.record_queue.empty():
+                record = self.record_queue.get()
+                self.process_record(record)
+                self.check_replay()
+                flushed += 1
+            if not closing:
+                break
+            remaining = deadline - time.time()
+            if self.sock.wait_for_connections(min(DRAIN_POLL_INTERVAL, remaining)):
+                # Flush the records of the connections that just closed
+                closing = False
+            elif remaining <= DRAIN_POLL_INTERVAL:
+                self.logger.warning(
+                    "%d connection(s) to the %s were still open after %d seconds, "
+                    "records they send from now on are lost",
+                    self.sock.open_connections,
+                    type(self).__name__,
+                    timeout,
+                )
+                closing = False
+        if not self._shutdown_flag:
+            # Called during the crawl, e.g. to commit a batch early
+            return flushed
+        REGISTRY.inc("openwpm_records_drained_total", flushed)
+        if self.sock is None:
+            self.logger.info(
+                "Queue was flushed completely, %d records flushed", flushed
+            )
+        else:
+            self.logger.info(
+                "Queue was flushed completely, %d records flushed. "
+                "%d sender(s) ended their stream, %d disconnected without "
+                "ending it",
+                flushed,
+                self.sock.ended_connections,
+                self.sock.broken_connections,
+            )
+        return flushed
+
+
+def router_process_runner(
+    base_params: BaseParams,
+    shard_queues: List[ShardQueue],
+    shard_status_queues: List[Queue],
+    shard_by: str,
+) -> None:
+    """ShardRouter runner. Pass to new process"""
+    router = ShardRouter(base_params, shard_queues, shard_status_queues, shard_by)
+    router.startup()
+
+    while True:
+        router.update_status_queue()
+        router.update_flow_control()
+        if router.should_shutdown():
+            break
+        try:
+            record = router.record_queue.get(block=True, timeout=1)
+            router.process_record(record)
+        except queue.Empty:
+            pass
+
+    router.drain_queue()
+    router.shutdown()
+    router.update_status_queue(force=True)
+
+
+class ShardRouter(BaseListener):
+    """Listener that spreads records across several shard writer processes.
+
+    The router owns the listening socket and forwards every record to one of
+    the shard writers, which run the regular listener of the output format
+    (e.g. `LocalListener`) with their own storage. Records are assigned to
+    shards by table name or, with `shard_by="visit"`, by table name and
+    visit id. Page content is always saved by `CONTENT_SHARD`.
+
+    `Initialize` and `Finalize` messages are sent to every shard. Each
+    shard reports the visit on the completion queue once it has saved its
+    own records for it, and `BaseAggregator` only reports a visit as
+    complete once every shard has done so.
+    """
+
+    def __init__(
+        self,
+        base_params: BaseParams,
+        shard_queues: List[ShardQueue],
+        shard_status_queues: List[Queue],
+        shard_by: str,
+    ) -> None:
+        if shard_by not in (SHARD_BY_TABLE, SHARD_BY_VISIT):
+            raise ValueError("Unsupported aggregator_shard_by: %s" % shard_by)
+        super(ShardRouter, self).__init__(*base_params)
+        self.num_shards = len(shard_queues)
+        self._shard_queues = shard_queues
+        self._shard_status_queues = shard_status_queues
+        self._shard_by = shard_by
+
+    def shard_for(self, table: str, data: Any) -> int:
+        """Return the index of the shard that saves a record of `table`"""
+        key = table
+        if self._shard_by == SHARD_BY_VISIT and isinstance(data, dict):
+            key = "%s-%s" % (table, data.get("visit_id"))
+        return zlib.crc32(key.encode("utf-8")) % self.num_shards
+
+    def process_record(self, record):
+        """Forward `record` to the shard(s) responsible for it"""
+        if len(record) != 2:
+            self.logger.error("Query is not the correct length %s", repr(record))
+            return
+        table, data = record
+        if table in (RECORD_TYPE_CREATE, RECORD_TYPE_SPECIAL):
+            for shard_queue in self._shard_queues:
+                shard_queue.put(record)
+        elif table == RECORD_TYPE_CONTENT:
+            self.process_content(record)
+        else:
+            self._shard_queues[self.shard_for(table, data)].put(record)
+
+    def process_content(self, record):
+        """Forward page content `record` to `CONTENT_SHARD`"""
+        self._shard_queues[CONTENT_SHARD].put(record)
+
+    def run_visit_completion_tasks(self, visit_id: int, interrupted: bool = False):
+        """Visit completion is handled by the shards"""
+
+    def get_status_update(self) -> Dict[str, Any]:
+        """Add the status updates the shards sent since the previous update,
+        with their metric changes combined, as `shards`"""
+        status = super(ShardRouter, self).get_status_update()
+        shard_statuses: Dict[int, Any] = dict()
+        for shard_index, status_queue in enumerate(self._shard_status_queues):
+            while not status_queue.empty():
+                shard_status = status_queue.get()
+                if shard_index in shard_statuses:
+                    metrics = shard_statuses[shard_index]["metrics"]
+                    merge_snapshot(metrics, shard_status["metrics"])
+                    shard_status["metrics"] = metrics
+                shard_statuses[shard_index] = shard_status
+        status["shards"] = shard_statuses
+        return status
+
+    def shutdown(self):
+        # The shards are shut down by `BaseAggregator` once we're done, and
+        # their pending status updates are sent with our final one
+        self.sock.close()
 
 
 class BaseAggregator:
@@ -208,8 +640,21 @@ class BaseAggregator:
         self.status_queue = Queue()
         self.completion_queue = Queue()
         self.shutdown_queue = Queue()
+        self.flow_control = FlowControl(manager_params["aggregator_queue_bytes_limit"])
+        self.num_shards = manager_params["aggregator_shards"]
+        if manager_params["aggregator_journal"] and self.num_shards > 1:
+            raise ValueError(
+                "aggregator_journal can't be combined with aggregator_shards"
+            )
+        self.shard_processes: List[Process] = list()
+        self._shard_shutdown_queues: List[Queue] = list()
+        self._shard_status_queues: List[Queue] = list()
+        # Number of shards that saved a visit and whether any was interrupted
+        self._shard_acks: Dict[int, Tuple[int, bool]] = dict()
         self._last_status = None
         self._last_status_received = None
+        # metrics of the listener processes, merged from the status updates
+        self._listener_metrics: Dict[Tuple[str, ...], Snapshot] = dict()
         self.logger = logging.getLogger("openwpm")
 
     @abc.abstractmethod
@@ -224,34 +669,99 @@ class BaseAggregator:
     def get_next_browser_id(self):
         """Return a unique crawl ID used as a key for a browser instance"""
 
-    def get_most_recent_status(self):
-        """Return the most recent queue size sent from the listener process"""
+    def get_shard_args(
+        self, shard_index: int, args: Tuple[Any, ...]
+    ) -> Tuple[Any, ...]:
+        """Return the listener arguments for the shard `shard_index`.
+
+        `args` are the arguments the listener would be launched with if
+        sharding were disabled. Child classes should override this to give
+        every shard its own storage."""
+        return args
+
+    def get_journal_params(self) -> Optional[JournalParams]:
+        """Return the journal parameters of the listener, if the journal is
+        enabled"""
+        if not self.manager_params["aggregator_journal"]:
+            return None
+        return (
+            os.path.join(self.manager_params["data_directory"], JOURNAL_DIRECTORY),
+            self.manager_params["aggregator_journal_fsync_interval"],
+        )
 
-        # Block until we receive the first status update
-        if self._last_status is None:
-            return self.get_status()
+    def merge_shards(self) -> None:
+        """Run once all shards have shut down. Child classes can override
+        this to combine the output of the shards."""
 
-        # Drain status queue until we receive most recent update
-        while not self.status_queue.empty():
-            self._last_status = self.status_queue.get()
-            self._last_status_received = time.time()
+    def get_visited_sites(self) -> Dict[str, Tuple[bool, int]]:
+        """Return the sites visited by earlier runs of the crawl as a map of
+        `site_url` to whether a visit completed and the number of visits.
+
+        Used by the TaskManager to `resume` a crawl. Child classes whose
+        output can be queried should override this."""
+        raise NotImplementedError(
+            "%s doesn't support resuming crawls" % type(self).__name__
+        )
+
+    def _receive_status(self, status: Dict[str, Any]) -> None:
+        """Keep `status` as the most recent one and merge its metrics"""
+        self._last_status = status
+        self._last_status_received = time.time()
+        self._merge_metrics(status)
+
+    def _merge_metrics(self, status: Dict[str, Any]) -> None:
+        """Merge the metric changes sent with `status`"""
+        merge_snapshot(
+            self._listener_metrics.setdefault(("listener",), dict()),
+            status.get("metrics", {}),
+        )
+        for shard_index, shard_status in status.get("shards", {}).items():
+            merge_snapshot(
+                self._listener_metrics.setdefault(("shard", str(shard_index)), dict()),
+                shard_status.get("metrics", {}),
+            )
 
-        # Check last status signal
-        if (time.time() - self._last_status_received) > STATUS_TIMEOUT:
+    def _read_status_queue(self) -> None:
+        """Take all pending status updates from the status queue"""
+        while not self.status_queue.empty():
+            self._receive_status(self.status_queue.get())
+
+    def drain_status_queue(self) -> Optional[Dict[str, Any]]:
+        """Consume the pending status updates of the listener process and
+        return the most recent one, or `None` if none was received yet.
+
+        This must be called regularly during the crawl: updates that are
+        left in the queue keep the listener process from exiting. Raises a
+        `RuntimeError` if the listener process died or sent no status
+        update for `STATUS_TIMEOUT` seconds."""
+        self._read_status_queue()
+        if self.listener_process is not None and not self.listener_process.is_alive():
+            raise RuntimeError("DataAggregator listener process died")
+        if (
+            self._last_status_received is not None
+            and (time.time() - self._last_status_received) > STATUS_TIMEOUT
+        ):
             raise RuntimeError(
                 "No status update from DataAggregator listener process "
                 "for %d seconds." % (time.time() - self._last_status_received)
             )
-
         return self._last_status
 
+    def get_most_recent_status(self):
+        """Return the most recent status sent from the listener process"""
+
+        # Block until we receive the first status update
+        if self._last_status is None:
+            return self.get_status()
+
+        return self.drain_status_queue()
+
     def get_status(self):
         """Get listener process status. If the status queue is empty, block."""
         try:
-            self._last_status = self.status_queue.get(
-                block=True, timeout=STATUS_TIMEOUT
+            self._receive_status(
+                self.status_queue.get(block=True, timeout=STATUS_TIMEOUT)
             )
-            self._last_status_received = time.time()
         except queue.Empty:
             raise RuntimeError(
                 "No status update from DataAggregator listener process "
@@ -259,6 +769,64 @@ class BaseAggregator:
             )
         return self._last_status
 
+    def get_listener_metrics(self) -> List[Tuple[Dict[str, str], Any]]:
+        """Return the metrics of the listener processes, merged from the
+        status updates received so far and labeled by process.
+
+        Unlike `get_most_recent_status`, this never blocks."""
+        self._read_status_queue()
+        snapshots = list()
+        for key, snapshot in sorted(self._listener_metrics.items()):
+            if key[0] == "listener":
+                snapshots.append(({"process": "listener"}, snapshot))
+            else:
+                snapshots.append(({"process": "shard", "shard": key[1]}, snapshot))
+        return snapshots
+
+    def wait_for_credit(self) -> None:
+        """Block until the listener process grants credit for new visits.
+
+        Also drains the status queue, see `drain_status_queue`. Raises a
+        `RuntimeError` if the listener stops sending status updates."""
+        self.drain_status_queue()
+        if self.flow_control.has_credit():
+            return
+        while not self.flow_control.wait(timeout=STATUS_UPDATE_INTERVAL):
+            status = self.drain_status_queue() or {}
+            self.logger.info(
+                "Blocking command submission until the DataAggregator "
+                "is below the max queue size of %d bytes. Current queue "
+                "size %d bytes. Per table queue depths: %s"
+                % (
+                    self.flow_control.max_bytes,
+                    status.get("queue_bytes", 0),
+                    status.get("table_depths", {}),
+                )
+            )
+
+    def _complete_visit(
+        self, item: Optional[CompletedVisit]
+    ) -> Optional[CompletedVisit]:
+        """Return the completion queue `item` once the visit is complete,
+        or `None` if it isn't complete yet (or `item` is a wake-up sentinel,
+        see `wake_completion_waiters`)"""
+        if item is None:
+            return None
+        visit_id, interrupted, saved = item
+        if self.num_shards > 1:
+            # Wait until every shard saved its records of the visit
+            count, any_interrupted = self._shard_acks.pop(visit_id, (0, False))
+            count += 1
+            interrupted = interrupted or any_interrupted
+            if count < self.num_shards:
+                self._shard_acks[visit_id] = (count, interrupted)
+                return None
+        REGISTRY.inc(
+            "openwpm_visits_completed_total",
+            status="interrupted" if interrupted else "ok",
+        )
+        return visit_id, interrupted, saved
+
     def get_new_completed_visits(self) -> List[Tuple[int, bool]]:
         """
         Returns a list of all visit ids that have been processed since
@@ -270,16 +838,121 @@ class BaseAggregator:
         """
         finished_visit_ids = list()
         while not self.completion_queue.empty():
-            finished_visit_ids.append(self.completion_queue.get())
+            finished = self._complete_visit(self.completion_queue.get())
+            if finished is not None:
+                finished_visit_ids.append(finished[:2])
+        return finished_visit_ids
+
+    def wait_for_completed_visits(
+        self,
+        timeout: Optional[float] = None,
+        batch_size: int = 1,
+        batch_delay: float = 0,
+    ) -> List[CompletedVisit]:
+        """Block until visits have been processed and return their ids,
+        whether they were interrupted and the time the listener saved them.
+
+        Returns as soon as `batch_size` visits are complete or `batch_delay`
+        seconds after the first visit completed, whichever comes first, along
+        with any other visits that are already complete. Returns an empty
+        list if no visit completed within `timeout` seconds, or if
+        `wake_completion_waiters` was called."""
+        finished_visit_ids: List[CompletedVisit] = list()
+        deadline = None if timeout is None else time.time() + timeout
+        batch_start = 0.0
+        while True:
+            if finished_visit_ids:
+                remaining = batch_start + batch_delay - time.time()
+                if len(finished_visit_ids) >= batch_size or remaining <= 0:
+                    break
+            elif deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+            else:
+                remaining = None
+            try:
+                item = self.completion_queue.get(block=True, timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                break
+            finished = self._complete_visit(item)
+            if finished is not None:
+                if not finished_visit_ids:
+                    batch_start = time.time()
+                finished_visit_ids.append(finished)
+        while not self.completion_queue.empty():
+            finished = self._complete_visit(self.completion_queue.get())
+            if finished is not None:
+                finished_visit_ids.append(finished)
         return finished_visit_ids
 
+    def wake_completion_waiters(self) -> None:
+        """Make a blocked `wait_for_completed_visits` call return"""
+        self.completion_queue.put(None)
+
     def launch(self, listener_process_runner, *args):
-        """Launch the aggregator listener process"""
-        args = ((self.status_queue, self.completion_queue, self.shutdown_queue),) + args
+        """Launch the aggregator listener process
+
+        If `aggregator_shards` is larger than one, one
+        `listener_process_runner` process is launched per shard and a
+        `ShardRouter` process forwards the records to them."""
+        if self.num_shards > 1:
+            shard_queues = list()
+            shard_status_queues = list()
+            for shard_index in range(self.num_shards):
+                shard_queue = ShardQueue()
+                shard_status_queue = Queue()
+                shutdown_queue = Queue()
+                shard_params = (
+                    shard_status_queue,
+                    self.completion_queue,
+                    shutdown_queue,
+                    FlowControl(None),
+                    (shard_index, shard_queue),
+                )
+                process = Process(
+                    target=listener_process_runner,
+                    args=(shard_params,) + self.get_shard_args(shard_index, args),
+                )
+                process.daemon = True
+                process.start()
+                self.shard_processes.append(process)
+                self._shard_shutdown_queues.append(shutdown_queue)
+                self._shard_status_queues.append(shard_status_queue)
+                shard_queues.append(shard_queue)
+                shard_status_queues.append(shard_status_queue)
+            listener_process_runner = router_process_runner
+            args = (
+                shard_queues,
+                shard_status_queues,
+                self.manager_params["aggregator_shard_by"],
+            )
+        args = (
+            (
+                self.status_queue,
+                self.completion_queue,
+                self.shutdown_queue,
+                self.flow_control,
+                None,
+                self.get_journal_params(),
+            ),
+        ) + args
         self.listener_process = Process(target=listener_process_runner, args=args)
         self.listener_process.daemon = True
         self.listener_process.start()
         self.listener_address = self.status_queue.get()
+        self._last_status_received = time.time()
+
+    def _join_listener(self, deadline: float) -> None:
+        """Wait until the listener process exits or `deadline` passes.
+
+        The status queue is drained meanwhile, as the listener can't exit
+        before the status updates it sent were read."""
+        while self.listener_process.is_alive() and time.time() < deadline:
+            self.listener_process.join(min(1, max(0, deadline - time.time())))
+            self._read_status_queue()
 
     def shutdown(self, relaxed: bool = True):
         """ Terminate the aggregator listener process"""
@@ -289,7 +962,28 @@ class BaseAggregator:
         )
         self.shutdown_queue.put((SHUTDOWN_SIGNAL, relaxed))
         start_time = time.time()
-        self.listener_process.join(300)
+        self._join_listener(start_time + 300)
+        # Shards are shut down after the router has forwarded all records
+        for shutdown_queue, process in zip(
+            self._shard_shutdown_queues, self.shard_processes
+        ):
+            shutdown_queue.put((SHUTDOWN_SIGNAL, relaxed))
+        # The router no longer reads the shards' status updates
+        deadline = time.time() + 300
+        for shard_index, process in enumerate(self.shard_processes):
+            status_queue = self._shard_status_queues[shard_index]
+            while True:
+                while not status_queue.empty():
+                    shard_status = status_queue.get()
+                    self._merge_metrics({"shards": {shard_index: shard_status}})
+                if not process.is_alive() or time.time() >= deadline:
+                    break
+                process.join(min(1, max(0, deadline - time.time())))
+        if self.shard_processes:
+            self.merge_shards()
+        self.shard_processes = list()
+        self._shard_shutdown_queues = list()
+        self._shard_status_queues = list()
         self.logger.debug(
             "%s took %s seconds to close."
             % (type(self).__name__, str(time.time() - start_time))
@@ -1,26 +1,117 @@
 import base64
+import glob
 import json
+import logging
 import os
 import sqlite3
 import time
 from sqlite3 import IntegrityError, InterfaceError, OperationalError, ProgrammingError
-from typing import Any, Dict, Tuple, Union
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
 
 import plyvel
 
+from ..metrics import REGISTRY
+from ..utilities.compression import get_codec
 from .BaseAggregator import (
+    CONTENT_SHARD,
     RECORD_TYPE_CONTENT,
     RECORD_TYPE_CREATE,
     RECORD_TYPE_SPECIAL,
     BaseAggregator,
     BaseListener,
 )
+from .content_index import ContentHashIndex
+from .content_store import CONTENT_STORE_NAME, ContentStore
 
 SQL_BATCH_SIZE = 1000
 LDB_BATCH_SIZE = 100
 MIN_TIME = 5  # seconds
 SCHEMA_FILE = os.path.join(os.path.dirname(__file__), "schema.sql")
 LDB_NAME = "content.ldb"
+SHARD_DB_SUFFIX = ".shard-%s"
+# A visit completed if all of its commands are `ok` and it wasn't
+# interrupted. Visits that didn't record any command yet are incomplete.
+VISITED_SITES_QUERY = """
+SELECT v.site_url,
+       MAX(h.failed = 0 AND i.visit_id IS NULL),
+       COUNT(DISTINCT v.visit_id)
+FROM site_visits AS v
+LEFT JOIN (
+    SELECT visit_id, SUM(command_status != 'ok') AS failed
+    FROM crawl_history
+    GROUP BY visit_id
+) AS h ON h.visit_id = v.visit_id
+LEFT JOIN incomplete_visits AS i ON i.visit_id = v.visit_id
+GROUP BY v.site_url
+"""
+
+
+def create_tables(db: sqlite3.Connection) -> None:
+    """Create tables (if this is a new database)"""
+    with open(SCHEMA_FILE, "r") as f:
+        db.executescript(f.read())
+    db.commit()
+
+
+def merge_shard_databases(db_path: str) -> None:
+    """Merge all shard databases of `db_path` into it.
+
+    Every shard is merged in a single transaction spanning both databases,
+    which also empties the shard, so a merge that is interrupted can simply
+    be run again. Auto-incremented `id` columns are reassigned by the main
+    database, as the shards count them independently.
+    """
+    logger = logging.getLogger("openwpm")
+    for shard_path in sorted(glob.glob(db_path + SHARD_DB_SUFFIX % "*")):
+        if not shard_path[len(db_path + SHARD_DB_SUFFIX % "") :].isdigit():
+            continue  # e.g. the shard's rollback journal
+        db = sqlite3.connect(db_path, isolation_level=None)
+        db.execute("ATTACH DATABASE ? AS shard", (shard_path,))
+        db.execute("BEGIN")
+        tables = db.execute(
+            "SELECT name, sql FROM shard.sqlite_master "
+            "WHERE type = 'table' AND name != 'sqlite_sequence'"
+        ).fetchall()
+        for table, sql in tables:
+            # Tables might have been created by `create_table` records
+            db.execute(sql.replace("CREATE TABLE ", "CREATE TABLE IF NOT EXISTS ", 1))
+            columns = [
+                name
+                for _, name, _, _, _, pk in db.execute(
+                    "PRAGMA shard.table_info(%s)" % table
+                )
+                if not (name == "id" and pk)
+            ]
+            column_str = ", ".join(columns)
+            db.execute(
+                "INSERT INTO main.%s (%s) SELECT %s FROM shard.%s"
+                % (table, column_str, column_str, table)
+            )
+            db.execute("DELETE FROM shard.%s" % table)
+        db.execute("COMMIT")
+        db.execute("DETACH DATABASE shard")
+        db.close()
+        os.remove(shard_path)
+        logger.info("Merged shard database %s", shard_path)
+
+
+def open_content_db(manager_params: Dict[str, Any]) -> Any:
+    """Open the content database of the configured `content_backend`"""
+    backend = manager_params["content_backend"]
+    if backend == "leveldb":
+        codec, _ = get_codec(manager_params, "leveldb")
+        return plyvel.DB(
+            os.path.join(manager_params["data_directory"], LDB_NAME),
+            create_if_missing=True,
+            write_buffer_size=128 * 10 ** 6,
+            compression=None if codec == "none" else codec,
+        )
+    if backend == "packfile":
+        return ContentStore(
+            os.path.join(manager_params["data_directory"], CONTENT_STORE_NAME),
+            create_if_missing=True,
+        )
+    raise ValueError("Unsupported content_backend: %s" % backend)
 
 
 def listener_process_runner(base_params, manager_params, ldb_enabled):
@@ -30,6 +121,7 @@ def listener_process_runner(base_params, manager_params, ldb_enabled):
 
     while True:
         listener.update_status_queue()
+        listener.update_flow_control()
         if listener.should_shutdown():
             break
 
@@ -41,12 +133,14 @@ def listener_process_runner(base_params, manager_params, ldb_enabled):
         # Process record
         record = listener.record_queue.get()
         listener.process_record(record)
+        listener.check_replay()
 
         # batch commit if necessary
         listener.maybe_commit_records()
 
     listener.drain_queue()
     listener.shutdown()
+    listener.update_status_queue(force=True)
 
 
 class LocalListener(BaseListener):
@@ -58,19 +152,39 @@ class LocalListener(BaseListener):
         self.cur = self.db.cursor()
         self.ldb_enabled = ldb_enabled
         if self.ldb_enabled:
-            self.ldb = plyvel.DB(
-                os.path.join(manager_params["data_directory"], LDB_NAME),
-                create_if_missing=True,
-                write_buffer_size=128 * 10 ** 6,
-                compression="snappy",
-            )
+            self.ldb = open_content_db(manager_params)
             self.content_batch = self.ldb.write_batch()
+            self.content_index = ContentHashIndex()
         self._ldb_counter = 0
         self._ldb_commit_time = 0
         self._sql_counter = 0
         self._sql_commit_time = 0
+        # Journal sequence numbers of the oldest records that aren't
+        # committed to each store, see `_track_journal`
+        self._journal_seen = 0
+        self._sql_unsaved: Optional[int] = None
+        self._ldb_unsaved: Optional[int] = None
 
         super(LocalListener, self).__init__(*base_params)
+        if self.ldb_enabled:
+            start = time.time()
+            count = self.content_index.warm(self._ldb_keys())
+            self.logger.info(
+                "Warmed content index with %d hashes in %.2f seconds"
+                % (count, time.time() - start)
+            )
+
+    def startup(self):
+        super(LocalListener, self).startup()
+        self._journal_seen = self.journal_seq
+
+    def _ldb_keys(self) -> Iterator[str]:
+        with self.ldb.iterator(include_value=False) as it:
+            for key in it:
+                yield key.decode("ascii")
+
+    def _ldb_contains(self, content_hash: str) -> bool:
+        return self.ldb.get(content_hash.encode("ascii")) is not None
 
     def _generate_insert(self, table, data):
         """Generate a SQL query from `record`"""
@@ -146,56 +260,96 @@ class LocalListener(BaseListener):
                 "database is not enabled."
             )
         content, content_hash = data
-        content = base64.b64decode(content)
-        content_hash = str(content_hash).encode("ascii")
-        if self.ldb.get(content_hash) is not None:
+        content_hash = str(content_hash)
+        if self.content_index.lookup(content_hash, self._ldb_contains):
             return
-        self.content_batch.put(content_hash, content)
+        content = base64.b64decode(content)
+        self.content_batch.put(content_hash.encode("ascii"), content)
+        self.content_index.add(content_hash)
         self._ldb_counter += 1
 
+    def get_status_update(self) -> Dict[str, Any]:
+        status = super(LocalListener, self).get_status_update()
+        if self.ldb_enabled:
+            status["content_index"] = self.content_index.stats()
+        return status
+
     def _write_content_batch(self):
         """Write out content batch to LevelDB database"""
         self.content_batch.write()
         self.content_batch = self.ldb.write_batch()
 
+    def _track_journal(self) -> None:
+        """Note which stores have records that aren't committed yet.
+
+        Records taken from the queue since the last call are processed, so
+        the first uncommitted record of a store that has become dirty is not
+        older than the first of them."""
+        seq = self.journal_seq
+        if self._sql_unsaved is None and self.db.in_transaction:
+            self._sql_unsaved = self._journal_seen
+        if self._ldb_unsaved is None and self._ldb_counter > 0:
+            self._ldb_unsaved = self._journal_seen
+        self._journal_seen = seq
+
     def maybe_commit_records(self):
         """Commit records to database if record count or timer is over limit"""
+        if self.journal is not None:
+            self._track_journal()
+        committed = False
 
         # Commit SQLite Database inserts
         sql_over_time = (time.time() - self._sql_commit_time) > MIN_TIME
         if self._sql_counter >= SQL_BATCH_SIZE or (
             self._sql_counter > 0 and sql_over_time
         ):
-            self.db.commit()
+            with REGISTRY.time("openwpm_commit_seconds", store="sqlite"):
+                self.db.commit()
             self._sql_counter = 0
             self._sql_commit_time = time.time()
+            self._sql_unsaved = None
+            committed = True
 
         # Write LevelDB batch to DB
-        if not self.ldb_enabled:
-            return
-        ldb_over_time = (time.time() - self._ldb_commit_time) > MIN_TIME
-        if self._ldb_counter >= LDB_BATCH_SIZE or (
-            self._ldb_counter > 0 and ldb_over_time
-        ):
-            self._write_content_batch()
-            self._ldb_counter = 0
-            self._ldb_commit_time = time.time()
+        if self.ldb_enabled:
+            ldb_over_time = (time.time() - self._ldb_commit_time) > MIN_TIME
+            if self._ldb_counter >= LDB_BATCH_SIZE or (
+                self._ldb_counter > 0 and ldb_over_time
+            ):
+                with REGISTRY.time("openwpm_commit_seconds", store="content"):
+                    self._write_content_batch()
+                self._ldb_counter = 0
+                self._ldb_commit_time = time.time()
+                self._ldb_unsaved = None
+                committed = True
+
+        if committed and self.journal is not None:
+            unsaved = [
+                seq for seq in (self._sql_unsaved, self._ldb_unsaved) if seq is not None
+            ]
+            self.checkpoint_journal(min(unsaved, default=self._journal_seen))
 
     def run_visit_completion_tasks(self, visit_id: int, interrupted: bool = False):
         if interrupted:
             self.logger.warning("Visit with visit_id %d got interrupted", visit_id)
-            self.cur.execute("INSERT INTO incomplete_visits VALUES (?)", (visit_id,))
+            if self.is_primary_shard:
+                self.cur.execute(
+                    "INSERT INTO incomplete_visits VALUES (?)", (visit_id,)
+                )
             self.mark_visit_incomplete(visit_id)
         else:
             self.mark_visit_complete(visit_id)
 
     def shutdown(self):
         super(LocalListener, self).shutdown()
-        self.db.commit()
+        with REGISTRY.time("openwpm_commit_seconds", store="sqlite"):
+            self.db.commit()
         self.db.close()
         if self.ldb_enabled:
             self._write_content_batch()
             self.ldb.close()
+        self.checkpoint_journal()
+        self.close_journal()
 
 
 class LocalAggregator(BaseAggregator):
@@ -212,9 +366,11 @@ class LocalAggregator(BaseAggregator):
         db_path = self.manager_params["database_name"]
         if not os.path.exists(manager_params["data_directory"]):
             os.mkdir(manager_params["data_directory"])
+        # Merge shards left behind by a crawl that didn't shut down cleanly
+        merge_shard_databases(db_path)
         self.db = sqlite3.connect(db_path, check_same_thread=False)
         self.cur = self.db.cursor()
-        self._create_tables()
+        create_tables(self.db)
         self._get_last_used_ids()
 
         # Mark if LDBAggregator is needed
@@ -225,12 +381,6 @@ class LocalAggregator(BaseAggregator):
                 self.ldb_enabled = True
                 break
 
-    def _create_tables(self):
-        """Create tables (if this is a new database)"""
-        with open(SCHEMA_FILE, "r") as f:
-            self.db.executescript(f.read())
-        self.db.commit()
-
     def _get_last_used_ids(self):
         """Query max ids from database"""
         self.cur.execute("SELECT MAX(visit_id) from site_visits")
@@ -281,6 +431,32 @@ class LocalAggregator(BaseAggregator):
         self.current_browser_id += 1
         return self.current_browser_id
 
+    def get_shard_args(
+        self, shard_index: int, args: Tuple[Any, ...]
+    ) -> Tuple[Any, ...]:
+        """Give every shard its own SQLite database. Only `CONTENT_SHARD`
+        opens the LevelDB content database."""
+        manager_params, ldb_enabled = args
+        shard_params = dict(manager_params)
+        shard_params["database_name"] = manager_params["database_name"] + (
+            SHARD_DB_SUFFIX % shard_index
+        )
+        shard_db = sqlite3.connect(shard_params["database_name"])
+        create_tables(shard_db)
+        shard_db.close()
+        return shard_params, ldb_enabled and shard_index == CONTENT_SHARD
+
+    def merge_shards(self) -> None:
+        merge_shard_databases(self.manager_params["database_name"])
+
+    def get_visited_sites(self) -> Dict[str, Tuple[bool, int]]:
+        """Return the sites visited by earlier runs of the crawl, with a
+        single query over the `site_url` and `visit_id` indexes"""
+        return {
+            site_url: (bool(completed), visits)
+            for site_url, completed, visits in self.cur.execute(VISITED_SITES_QUERY)
+        }
+
     def launch(self):
         """Launch the aggregator listener process"""
         super(LocalAggregator, self).launch(
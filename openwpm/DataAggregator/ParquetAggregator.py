@@ -0,0 +1,746 @@
+import base64
+import hashlib
+import json
+import os
+import queue
+import random
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import (
+    Any,
+    DefaultDict,
+    Dict,
+    Iterator,
+    List,
+    MutableSet,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import pyarrow as pa
+
+from ..metrics import REGISTRY
+from ..SocketInterface import DRAIN_TIMEOUT
+from ..utilities.compression import extension, get_codec
+from .BaseAggregator import (
+    ACTION_TYPE_INITIALIZE,
+    RECORD_TYPE_CONTENT,
+    RECORD_TYPE_CREATE,
+    RECORD_TYPE_SPECIAL,
+    BaseAggregator,
+    BaseListener,
+    BaseParams,
+)
+from .content_index import ContentHashIndex
+from .parquet_schema import PQ_SCHEMAS
+from .parquet_writer import RollingParquetWriter
+from .uploader import LocalUploader, Uploader
+
+CACHE_SIZE = 500
+SITE_VISITS_INDEX = "_site_visits_index"
+PARQUET_DIRECTORY = "parquet"
+CONTENT_DIRECTORY = "content"
+CONFIG_DIR = "config"
+STAGING_DIRECTORY = "parquet_staging"
+SPILL_DIRECTORY = "parquet_spill"
+CONTENT_CHECK_BATCH_SIZE = 100  # content files checked with one set of listings
+CONTENT_PREFIX_LENGTH = 1  # hash characters per existence check listing
+BATCH_COMMIT_TIMEOUT = 30  # commit a batch if no new records for N seconds
+
+
+class ColumnBuffer:
+    """Append-only column buffers for the records of one table
+
+    Records are split into one list per column of the table's parquet
+    schema as they arrive, so a record batch can be built directly from
+    the columns without an intermediate DataFrame.
+    """
+
+    def __init__(self, table: str) -> None:
+        self.table = table
+        self.schema = PQ_SCHEMAS[table]
+        self.columns: Dict[str, List[Any]] = {
+            name: list() for name in self.schema.names
+        }
+        self.num_rows = 0
+        # rough size of the buffered values, see `append`
+        self.nbytes = 0
+        self.spill_path: Optional[str] = None
+        self._spill_file: Optional[pa.NativeFile] = None
+        self._spill_writer: Optional[pa.RecordBatchStreamWriter] = None
+
+    def append(self, data: Dict[str, Any]) -> int:
+        """Append a record and return its estimated size in bytes.
+
+        Strings and bytes count with their length and all other values with
+        8 bytes, which is close to their size in a record batch."""
+        size = 0
+        for name, column in self.columns.items():
+            value = data.get(name)
+            column.append(value)
+            if isinstance(value, (str, bytes)):
+                size += len(value)
+            else:
+                size += 8
+        self.num_rows += 1
+        self.nbytes += size
+        return size
+
+    def rows(self) -> List[Dict[str, Any]]:
+        """Return the buffered records as row dictionaries"""
+        names = list(self.columns)
+        return [dict(zip(names, row)) for row in zip(*self.columns.values())]
+
+    def to_batch(self) -> pa.RecordBatch:
+        arrays = list()
+        for field in self.schema:
+            values = self.columns[field.name]
+            try:
+                array = pa.array(values, type=field.type)
+            except (pa.lib.ArrowInvalid, pa.lib.ArrowTypeError):
+                # Let arrow infer the type and cast it afterwards, e.g. for
+                # integers sent for a boolean column
+                array = pa.array(values).cast(field.type)
+            arrays.append(array)
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def spill(self, path: str) -> int:
+        """Append the buffered records to the Arrow IPC stream at `path` and
+        clear the buffers. Returns the number of bytes written.
+
+        The stream is kept open, so later spills of the same buffer are
+        appended to it."""
+        if self._spill_writer is None:
+            self.spill_path = path
+            self._spill_file = pa.OSFile(path, "wb")
+            self._spill_writer = pa.RecordBatchStreamWriter(
+                self._spill_file, self.schema
+            )
+        position = self._spill_file.tell()
+        self._spill_writer.write_batch(self.to_batch())
+        self.columns = {name: list() for name in self.schema.names}
+        self.num_rows = 0
+        self.nbytes = 0
+        return self._spill_file.tell() - position
+
+    def spilled_batches(self) -> Iterator[pa.RecordBatch]:
+        """Stream back the spilled record batches and delete the spill file"""
+        if self._spill_writer is None:
+            return
+        self.close()
+        with pa.OSFile(self.spill_path, "rb") as f:
+            for batch in pa.ipc.open_stream(f):
+                yield batch
+        os.remove(self.spill_path)
+        self.spill_path = None
+
+    def close(self) -> None:
+        """Close the spill file, if any"""
+        if self._spill_writer is not None:
+            self._spill_writer.close()
+            self._spill_file.close()
+            self._spill_writer = None
+            self._spill_file = None
+
+
+def run_listener(listener: "ParquetListener") -> None:
+    """Run the main loop of `listener` until it is shut down"""
+    listener.startup()
+
+    while True:
+        listener.update_status_queue()
+        listener.update_flow_control()
+        listener.save_batch_if_past_timeout()
+        listener.roll_parquet_files()
+        listener.complete_uploaded_visits()
+        if listener.should_shutdown():
+            break
+        try:
+            record = listener.record_queue.get(block=True, timeout=5)
+            listener.process_record(record)
+            listener.check_replay()
+        except queue.Empty:
+            pass
+
+    listener.drain_queue()
+    listener.shutdown()
+    listener.update_status_queue(force=True)
+
+
+def listener_process_runner(
+    base_params: BaseParams, manager_params: Dict[str, Any], instance_id: int
+) -> None:
+    """ParquetListener runner. Pass to new process"""
+    uploader = LocalUploader(
+        manager_params["data_directory"],
+        num_threads=manager_params["s3_upload_threads"],
+    )
+    listener = ParquetListener(
+        base_params, manager_params, instance_id, PARQUET_DIRECTORY, uploader
+    )
+    run_listener(listener)
+
+
+class ParquetListener(BaseListener):
+    """Listener that saves aggregated records as parquet datasets.
+
+    Records for each page visit are stored in memory during a page visit. Once
+    the browser moves to another page, the data is written by `uploader` as
+    part of a parquet dataset below `directory`. The schema for this dataset
+    is given in ./parquet_schema.py
+    """
+
+    def __init__(
+        self,
+        base_params: BaseParams,
+        manager_params: Dict[str, Any],
+        instance_id: int,
+        directory: str,
+        uploader: Uploader,
+    ) -> None:
+        self.dir = directory
+
+        self._records: Dict[int, Dict[str, ColumnBuffer]] = defaultdict(
+            dict
+        )  # maps visit_id and table to buffered records
+        self._batches: DefaultDict[str, List[pa.RecordBatch]] = defaultdict(
+            list
+        )  # maps table_name to a list of batches
+        self._unsaved_visit_ids: MutableSet[int] = set()
+        # estimated size of the records of each visit held in memory
+        self._visit_bytes: DefaultDict[int, int] = defaultdict(int)
+        self._visit_memory_budget = manager_params["visit_memory_budget"]
+        # parquet files spilled records were written to since the last flush
+        self._open_files: Set[str] = set()
+        self._spills = 0
+        self._spilled_bytes = 0
+        self._spilled_visits = 0
+        # visits that failed to spill, they are kept in memory until saved
+        self._unspillable_visits: Set[int] = set()
+        self._failed_spills = 0
+
+        self._instance_id = instance_id
+        # filenames already uploaded
+        self._content_index = ContentHashIndex()
+        self._uploader = uploader
+        # content files that may already be stored
+        self._unchecked_content: Dict[str, bytes] = dict()
+        # uploads since the last flush of the record batches
+        self._uploads: List[Future] = list()
+        # uploads and open parquet files of each flush, the visits that are
+        # saved once all of them are uploaded, and the journal sequence number
+        # of the flush's oldest record
+        self._pending_flushes: List[
+            Tuple[List[Future], Set[int], Set[str], int]
+        ] = list()
+        # Journal sequence numbers of the first record of the visits whose
+        # records are buffered, and of the oldest record since the last flush
+        self._visit_seqs: Dict[int, int] = dict()
+        self._window_seq = 0
+        # journal sequence number of the oldest record of a failed flush
+        self._failed_seq: Optional[int] = None
+        # uploads of rolled parquet files by their staging path
+        self._rolled: Dict[str, Future] = dict()
+        self._parquet_target_size = manager_params["parquet_target_file_size"]
+        self._parquet_max_age = manager_params["parquet_max_file_age"]
+        self._content_codec = get_codec(manager_params, "content")
+        self._site_index_codec = get_codec(manager_params, "site_index")
+        self._staging_directory = os.path.join(
+            manager_params["data_directory"], STAGING_DIRECTORY
+        )
+        # time last record was received
+        self._last_record_received: Optional[float] = None
+        super(ParquetListener, self).__init__(*base_params)
+        start = time.time()
+        count = self._content_index.warm(
+            self._uploader.list_keys("%s/%s/" % (self.dir, CONTENT_DIRECTORY))
+        )
+        self.logger.info(
+            "Warmed content index with %d files in %.2f seconds"
+            % (count, time.time() - start)
+        )
+        if self.is_primary_shard:
+            self._uploader.replay_spool()
+
+        # Files left behind by a crashed listener are incomplete and none of
+        # their visits were marked as complete, so they can be dropped
+        staging_directory = os.path.join(
+            self._staging_directory, str(self.shard_index or 0)
+        )
+        if os.path.isdir(staging_directory):
+            for name in os.listdir(staging_directory):
+                self.logger.warning("Removing unfinished parquet file %s" % name)
+                os.remove(os.path.join(staging_directory, name))
+        self._writer = RollingParquetWriter(
+            staging_directory,
+            self._parquet_target_size,
+            self._parquet_max_age,
+            *get_codec(manager_params, "parquet")
+        )
+        self._spill_directory = os.path.join(
+            manager_params["data_directory"],
+            SPILL_DIRECTORY,
+            str(self.shard_index or 0),
+        )
+        if os.path.isdir(self._spill_directory):
+            for name in os.listdir(self._spill_directory):
+                self.logger.warning("Removing spilled records %s" % name)
+                os.remove(os.path.join(self._spill_directory, name))
+
+    def startup(self):
+        super(ParquetListener, self).startup()
+        self._window_seq = self.journal_seq
+
+    def _write_record(self, table, data, visit_id):
+        """Append data to the column buffers of `visit_id`"""
+        if self.journal is not None:
+            self._visit_seqs.setdefault(visit_id, self.journal_seq - 1)
+        records = self._records[visit_id]
+        if table not in records:
+            records[table] = ColumnBuffer(table)
+        # Add instance_id (for partitioning)
+        data["instance_id"] = self._instance_id
+        self._visit_bytes[visit_id] += records[table].append(data)
+        if (
+            self._visit_memory_budget
+            and self._visit_bytes[visit_id] > self._visit_memory_budget
+            and visit_id not in self._unspillable_visits
+        ):
+            self._spill(visit_id)
+
+    def _spill(self, visit_id: int) -> None:
+        """Move the buffered records of `visit_id` to Arrow IPC files
+
+        If a table can't be spilled, the visit isn't spilled again and its
+        records stay in memory until it is saved, rather than failing again
+        with every further record."""
+        os.makedirs(self._spill_directory, exist_ok=True)
+        records = self._records[visit_id]
+        if not any(data.spill_path for data in records.values()):
+            self._spilled_visits += 1
+        for table_name, data in records.items():
+            # The site visits index is built from the buffered rows, and a
+            # visit only has a single one of them anyway
+            if table_name == "site_visits" or data.num_rows == 0:
+                continue
+            path = os.path.join(
+                self._spill_directory, "%d-%s.arrow" % (visit_id, table_name)
+            )
+            try:
+                self._spilled_bytes += data.spill(path)
+            except (pa.lib.ArrowInvalid, pa.lib.ArrowTypeError, OSError):
+                self.logger.error(
+                    "Error while spilling records for table %s of visit_id %d, "
+                    "keeping the visit in memory\n" % (table_name, visit_id),
+                    exc_info=True,
+                )
+                self._failed_spills += 1
+                self._unspillable_visits.add(visit_id)
+                continue
+            self._spills += 1
+        self.logger.debug(
+            "Spilled records of visit_id %d after reaching %d bytes"
+            % (visit_id, self._visit_bytes[visit_id])
+        )
+        self._visit_bytes[visit_id] = sum(data.nbytes for data in records.values())
+
+    def _create_batch(self, visit_id: int) -> None:
+        """Create record batches for all records from `visit_id`"""
+        if visit_id in self._visit_seqs:
+            # The visit's records are saved with the next flush
+            self._window_seq = min(self._window_seq, self._visit_seqs.pop(visit_id))
+        if visit_id not in self._records:
+            # The batch for this `visit_id` was already created or, if this
+            # listener is a shard, no records of this visit were routed here
+            self._unsaved_visit_ids.add(visit_id)
+            return
+        for table_name, data in self._records[visit_id].items():
+            try:
+                # Spilled records are streamed into the parquet file one
+                # batch at a time instead of being read back into memory
+                for batch in data.spilled_batches():
+                    table = pa.Table.from_batches([batch])
+                    self._open_files.add(
+                        self._writer.write(table_name, table.drop(["instance_id"]))
+                    )
+                if data.num_rows == 0:
+                    continue
+                batch = data.to_batch()
+                self._batches[table_name].append(batch)
+                self.logger.debug(
+                    "Successfully created batch for table %s and "
+                    "visit_id %s" % (table_name, visit_id)
+                )
+            except (pa.lib.ArrowInvalid, pa.lib.ArrowTypeError):
+                self.logger.error(
+                    "Error while creating record batch for table %s\n" % table_name,
+                    exc_info=True,
+                )
+                pass
+            # We construct a special index file from the site_visits data
+            # to make it easier to query the dataset
+            if table_name == "site_visits":
+                if SITE_VISITS_INDEX not in self._batches:
+                    self._batches[SITE_VISITS_INDEX] = list()
+                for item in data.rows():
+                    self._batches[SITE_VISITS_INDEX].append(item)
+
+        del self._records[visit_id]
+        self._visit_bytes.pop(visit_id, None)
+        self._unspillable_visits.discard(visit_id)
+        self._unsaved_visit_ids.add(visit_id)
+
+    def _upload(
+        self, filename: str, body: bytes, codec: Tuple[str, Optional[int]]
+    ) -> None:
+        """Upload `body` with name `filename` in the background, compressed
+        with `codec` and its level"""
+        self._uploads.append(self._uploader.submit(filename, body, *codec))
+
+    def _check_content(self) -> None:
+        """Upload the content files that aren't stored yet.
+
+        Content files the content index can't rule out are checked with one
+        listing per hash prefix instead of one request per file, as long as
+        the listings are short enough to be cheaper."""
+        if not self._unchecked_content:
+            return
+        prefix_length = len("%s/%s/" % (self.dir, CONTENT_DIRECTORY))
+        existing = self._uploader.existing_keys(
+            self._unchecked_content,
+            prefix_length + CONTENT_PREFIX_LENGTH,
+            self._content_index.num_keys / 16 ** CONTENT_PREFIX_LENGTH,
+        )
+        for filename, content in self._unchecked_content.items():
+            self._content_index.resolve(filename, filename in existing)
+            if filename in existing:
+                self.logger.debug("File `%s` already exists, skipping..." % filename)
+                continue
+            self._upload(filename, content, self._content_codec)
+            self._content_index.add(filename)
+        self._unchecked_content = dict()
+
+    def _save_batches(self, force=False):
+        """Write in-memory batches to the parquet files and upload them"""
+        should_send = force
+        for batches in self._batches.values():
+            if len(batches) > CACHE_SIZE:
+                should_send = True
+        if not should_send:
+            return
+
+        start = time.time()
+        self._check_content()
+        open_files = self._open_files
+        self._open_files = set()
+        for table_name, batches in self._batches.items():
+            if len(batches) == 0:
+                continue
+            if table_name == SITE_VISITS_INDEX:
+                out_str = "\n".join([json.dumps(x) for x in batches])
+                out_str = out_str.encode("utf-8")
+                fname = "%s/site_index/instance-%s-%s.json%s" % (
+                    self.dir,
+                    self._instance_id,
+                    hashlib.md5(out_str).hexdigest(),
+                    extension(self._site_index_codec[0]),
+                )
+                self._upload(fname, out_str, self._site_index_codec)
+            else:
+                try:
+                    table = pa.Table.from_batches(batches)
+                    # `instance_id` is encoded in the file's partition path
+                    open_files.add(
+                        self._writer.write(table_name, table.drop(["instance_id"]))
+                    )
+                except pa.lib.ArrowInvalid:
+                    self.logger.error(
+                        "Error while sending records for: %s" % table_name,
+                        exc_info=True,
+                    )
+                    pass
+            # can't del here because that would modify batches
+            self._batches[table_name] = list()
+        visit_ids = self._unsaved_visit_ids
+        if self.journal is not None:
+            # The journal keeps the records of these visits until their files
+            # are uploaded, so they are saved once they are written
+            for visit_id in visit_ids:
+                self.mark_visit_complete(visit_id)
+            visit_ids = set()
+        self._pending_flushes.append(
+            (self._uploads, visit_ids, open_files, self._window_seq)
+        )
+        self._window_seq = self.journal_seq
+        self._uploads = list()
+        self._unsaved_visit_ids = set()
+        REGISTRY.observe("openwpm_commit_seconds", time.time() - start, store="parquet")
+        self.roll_parquet_files(force)
+        self.complete_uploaded_visits()
+
+    def roll_parquet_files(self, force: bool = False) -> None:
+        """Upload the parquet files that reached their target size or age.
+
+        If `force` is set, all open files are uploaded."""
+        for table_name in self._writer.due(force):
+            path = self._writer.roll(table_name)
+            with open(path, "rb") as f:
+                body = f.read()
+            os.remove(path)
+            # Same layout as `pq.write_to_dataset` partitioned by
+            # `instance_id`, which is constant for this listener
+            fname = "%s/visits/%s/instance_id=%d/%s.parquet" % (
+                self.dir,
+                table_name,
+                self._instance_id,
+                uuid.uuid4().hex,
+            )
+            self._rolled[path] = self._uploader.submit(fname, body)
+
+    def complete_uploaded_visits(self, block: bool = False) -> None:
+        """Mark visits as complete once all of their files are uploaded.
+
+        Without the journal, a visit is only saved once the parquet files its
+        records were appended to have been rolled and uploaded. Visits whose
+        files had to be spooled to disk (or failed) are marked incomplete.
+        With the journal, visits are already marked complete by
+        `_save_batches`, and the journal isn't checkpointed past the records
+        of files that failed. If `block` is set, roll all open files and
+        wait for all pending uploads."""
+        if block:
+            self.roll_parquet_files(force=True)
+        pending = list()
+        for uploads, visit_ids, open_files, seq in self._pending_flushes:
+            if any(path not in self._rolled for path in open_files):
+                pending.append((uploads, visit_ids, open_files, seq))
+                continue
+            uploads = uploads + [self._rolled[path] for path in open_files]
+            if not block and not all(upload.done() for upload in uploads):
+                pending.append((uploads, visit_ids, set(), seq))
+                continue
+            if self._uploader.wait(uploads):
+                for visit_id in visit_ids:
+                    self.mark_visit_complete(visit_id)
+            else:
+                self.logger.error(
+                    "Files of %d visits failed to upload" % len(visit_ids)
+                )
+                for visit_id in visit_ids:
+                    self.mark_visit_incomplete(visit_id)
+                if self.journal is not None:
+                    # Keep the records to be replayed by the next listener
+                    if self._failed_seq is None or seq < self._failed_seq:
+                        self._failed_seq = seq
+        self._pending_flushes = pending
+        referenced = set(self._open_files)
+        for _, _, open_files, _ in pending:
+            referenced.update(open_files)
+        for path in list(self._rolled):
+            if path not in referenced:
+                del self._rolled[path]
+        if self.journal is not None:
+            unsaved = [self._window_seq] + list(self._visit_seqs.values())
+            if self._failed_seq is not None:
+                unsaved.append(self._failed_seq)
+            unsaved.extend(seq for _, _, _, seq in pending)
+            self.checkpoint_journal(min(unsaved))
+
+    def save_batch_if_past_timeout(self):
+        """Save the current batch of records if no new data has been received.
+
+        If we aren't receiving new data for this batch we commit early
+        regardless of the current batch size."""
+        if self._last_record_received is None:
+            return
+        if time.time() - self._last_record_received < BATCH_COMMIT_TIMEOUT:
+            return
+        self.logger.debug(
+            "Saving current record batches since no new data has "
+            "been written for %d seconds." % (time.time() - self._last_record_received)
+        )
+        self.drain_queue()
+        self._last_record_received = None
+
+    def process_record(self, record):
+        """Add `record` to database"""
+        if len(record) != 2:
+            self.logger.error("Query is not the correct length %s", repr(record))
+            return
+        self._last_record_received = time.time()
+        table, data = record
+        if table == RECORD_TYPE_CREATE:  # drop these statements
+            return
+        if table == RECORD_TYPE_CONTENT:
+            self.process_content(record)
+            return
+        if table == RECORD_TYPE_SPECIAL:
+            if self.journal is not None and data["action"] == ACTION_TYPE_INITIALIZE:
+                # Replay visits from their start
+                self._visit_seqs.setdefault(data["visit_id"], self.journal_seq - 1)
+            self.handle_special(data)
+            return
+
+        # Convert data to text type
+        for k, v in data.items():
+            if isinstance(v, bytes):
+                data[k] = str(v, errors="ignore")
+            elif callable(v):
+                data[k] = str(v)
+            # TODO: Can we fix this in the extension?
+            elif type(v) == dict:
+                data[k] = json.dumps(v)
+
+        # Save record to disk
+        self._write_record(table, data, data["visit_id"])
+
+    def process_content(self, record):
+        """Upload page content `record`"""
+        if record[0] != RECORD_TYPE_CONTENT:
+            raise ValueError(
+                "Incorrect record type passed to `process_content`. Expected "
+                "record of type `%s`, received `%s`." % (RECORD_TYPE_CONTENT, record[0])
+            )
+        content, content_hash = record[1]
+        fname = "%s/%s/%s%s" % (
+            self.dir,
+            CONTENT_DIRECTORY,
+            content_hash,
+            extension(self._content_codec[0]),
+        )
+        if fname in self._unchecked_content:
+            return
+        exists = self._content_index.check(fname)
+        if exists:
+            self.logger.debug("File `%s` already exists, skipping..." % fname)
+            return
+        content = base64.b64decode(content)
+        if exists is None:
+            self._unchecked_content[fname] = content
+            if len(self._unchecked_content) >= CONTENT_CHECK_BATCH_SIZE:
+                self._check_content()
+            return
+        self._upload(fname, content, self._content_codec)
+        self._content_index.add(fname)
+
+    def get_status_update(self) -> Dict[str, Any]:
+        status = super(ParquetListener, self).get_status_update()
+        status["content_index"] = self._content_index.stats()
+        status["uploads"] = self._uploader.stats()
+        status["spill"] = {
+            "spills": self._spills,
+            "spilled_bytes": self._spilled_bytes,
+            "spilled_visits": self._spilled_visits,
+            "failed_spills": self._failed_spills,
+            "buffered_bytes": sum(self._visit_bytes.values()),
+        }
+        return status
+
+    def drain_queue(self, timeout: float = DRAIN_TIMEOUT) -> int:
+        """Process remaining records in queue and upload the final files"""
+        flushed = super(ParquetListener, self).drain_queue(timeout)
+        self._save_batches(force=True)
+        return flushed
+
+    def run_visit_completion_tasks(self, visit_id: int, interrupted: bool = False):
+        if interrupted:
+            self.logger.error("Visit with visit_id %d got interrupted", visit_id)
+            if self.is_primary_shard:
+                self._write_record(
+                    "incomplete_visits", {"visit_id": visit_id}, visit_id
+                )
+            self._create_batch(visit_id)
+            # Don't mark the visit as complete once the batch is uploaded
+            self._unsaved_visit_ids.discard(visit_id)
+            self.mark_visit_incomplete(visit_id)
+            return
+        self._create_batch(visit_id)
+        self._save_batches()
+
+    def finish_replay(self) -> None:
+        """Save the buffered records of the replayed visits that were in
+        flight, including those whose `Initialize` message was saved before
+        the earlier listener died"""
+        replayed = set(self._records) | set(self._visit_seqs)
+        replayed.difference_update(self.curent_visit_ids)
+        super(ParquetListener, self).finish_replay()
+        for visit_id in replayed:
+            self.run_visit_completion_tasks(visit_id, interrupted=True)
+        self._save_batches(force=True)
+
+    def shutdown(self):
+        # We should only have unsaved records if we are in forced shutdown
+        if self._relaxed and self._records:
+            self.logger.error("Had unfinished records during relaxed shutdown")
+        for records in self._records.values():
+            for data in records.values():
+                data.close()
+        super(ParquetListener, self).shutdown()
+        self._save_batches(force=True)
+        self.complete_uploaded_visits(block=True)
+        self._uploader.shutdown()
+        # `complete_uploaded_visits` checkpointed the journal up to the
+        # records of the visits whose buffers were discarded above, which
+        # are replayed by the next listener
+        self.close_journal()
+
+
+class ParquetAggregator(BaseAggregator):
+    """
+    Receives data records from other processes and aggregates them locally
+    per-site before saving them as a Parquet Dataset below the
+    `data_directory`. The dataset is partitioned by `instance_id`, and has
+    the same layout as the datasets written by `S3Aggregator`.
+
+    Visit and browser ids are randomly generated, as in `S3Aggregator`, so
+    the datasets of several crawls can be combined.
+    """
+
+    def __init__(self, manager_params, browser_params):
+        super(ParquetAggregator, self).__init__(manager_params, browser_params)
+        self.dir = os.path.join(manager_params["data_directory"], PARQUET_DIRECTORY)
+        self._instance_id = random.getrandbits(32)
+
+    def get_configuration(self, openwpm_version, browser_version) -> bytes:
+        """Return the configuration details for this crawl as JSON"""
+        out = dict()
+        out["manager_params"] = self.manager_params
+        out["openwpm_version"] = str(openwpm_version)
+        out["browser_version"] = str(browser_version)
+        out["browser_params"] = self.browser_params
+        return json.dumps(out).encode("utf-8")
+
+    def save_configuration(self, openwpm_version, browser_version):
+        """Save configuration details for this crawl to the dataset"""
+        path = os.path.join(
+            self.dir, CONFIG_DIR, "instance-%s_configuration.json" % self._instance_id
+        )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(self.get_configuration(openwpm_version, browser_version))
+
+    def get_next_visit_id(self):
+        """Generate visit id as randomly generated positive integer less than 2^53.
+
+        Parquet can support integers up to 64 bits, but Javascript can only
+        represent integers up to 53 bits:
+        https://developer.mozilla.org/en-US/docs/Web/JavaScript/Reference/Global_Objects/Number/MAX_SAFE_INTEGER
+        Thus, we cap these values at 53 bits.
+        """
+        return random.getrandbits(53)
+
+    def get_next_browser_id(self):
+        """Generate crawl id as randomly generated positive 32bit integer
+
+        Note: Parquet's partitioned dataset reader only supports integer
+        partition columns up to 32 bits.
+        """
+        return random.getrandbits(32)
+
+    def launch(self):
+        """Launch the aggregator listener process"""
+        super(ParquetAggregator, self).launch(
+            listener_process_runner, self.manager_params, self._instance_id
+        )
@@ -0,0 +1,136 @@
+import hashlib
+import math
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional
+
+BLOOM_CAPACITY = 2000000  # expected number of distinct content hashes
+BLOOM_ERROR_RATE = 0.001
+LRU_SIZE = 50000  # number of recently seen hashes
+
+
+class BloomFilter:
+    """A fixed size Bloom filter over strings
+
+    `k` bit positions are derived from a single 128 bit blake2b digest of
+    the key using double hashing."""
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        self.num_bits = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key: str) -> Iterable[int]:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        for position in self._positions(key):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class ContentHashIndex:
+    """In-memory membership layer in front of a content store
+
+    Listeners use this to skip saving content that is already stored without
+    querying the store for every record. A key is looked up in three steps:
+
+    1. A bounded LRU of recently seen keys. A hit means the key is stored.
+    2. A Bloom filter of all keys stored so far. A miss means the key is
+       not stored (as long as the filter was warmed with the existing
+       store, see `warm`).
+    3. The store itself, through the `exists` callable given to `lookup`.
+
+    A key missing from the filter that is in fact stored (e.g. if the store
+    was written to by another crawl) is saved again, which is harmless as
+    content is addressed by its hash.
+    """
+
+    def __init__(
+        self,
+        capacity: int = BLOOM_CAPACITY,
+        error_rate: float = BLOOM_ERROR_RATE,
+        lru_size: int = LRU_SIZE,
+    ) -> None:
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._lru: "OrderedDict[str, None]" = OrderedDict()
+        self._lru_size = lru_size
+        self.lru_hits = 0
+        self.bloom_misses = 0
+        self.store_hits = 0
+        self.store_misses = 0
+        self.num_keys = 0  # keys added to the index, roughly the store size
+
+    def _touch(self, key: str) -> None:
+        self._lru[key] = None
+        self._lru.move_to_end(key)
+        if len(self._lru) > self._lru_size:
+            self._lru.popitem(last=False)
+
+    def warm(self, keys: Iterable[str]) -> int:
+        """Add the keys of an existing store. Returns the number of keys"""
+        count = 0
+        for key in keys:
+            self._bloom.add(key)
+            count += 1
+        self.num_keys += count
+        return count
+
+    def add(self, key: str) -> None:
+        """Record that `key` has been saved to the store"""
+        self.num_keys += 1
+        self._bloom.add(key)
+        self._touch(key)
+
+    def check(self, key: str) -> Optional[bool]:
+        """Answer a lookup from memory.
+
+        Returns `None` if the store has to be queried, in which case the
+        answer should be reported back with `resolve`."""
+        if key in self._lru:
+            self.lru_hits += 1
+            self._lru.move_to_end(key)
+            return True
+        if key not in self._bloom:
+            self.bloom_misses += 1
+            return False
+        return None
+
+    def resolve(self, key: str, exists: bool) -> None:
+        """Record the answer of the store for a key `check` couldn't answer"""
+        if exists:
+            self.store_hits += 1
+            self._touch(key)
+        else:
+            self.store_misses += 1
+
+    def lookup(self, key: str, exists: Callable[[str], bool]) -> bool:
+        """Return `True` if `key` is already stored"""
+        found = self.check(key)
+        if found is None:
+            found = exists(key)
+            self.resolve(key, found)
+        return found
+
+    def stats(self) -> Dict[str, float]:
+        """Return lookup counters and the share of lookups that were
+        answered without querying the store"""
+        lookups = self.lru_hits + self.bloom_misses + self.store_hits
+        lookups += self.store_misses
+        answered = self.lru_hits + self.bloom_misses
+        return {
+            "lookups": lookups,
+            "lru_hits": self.lru_hits,
+            "bloom_misses": self.bloom_misses,
+            "store_hits": self.store_hits,
+            "store_misses": self.store_misses,
+            "hit_rate": answered / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,420 @@
+"""Content-addressed packfile store for saved page content
+
+Blobs are appended to packfiles as independent zstd frames. Frames are
+compressed with a dictionary that is trained on a sample of the first
+stored blobs, which pays off for the many near-identical scripts (e.g.
+consent management platform bundles) found across sites. An SQLite index
+maps each content hash to its packfile, offset and length so single blobs
+can be read without scanning the packfiles.
+
+The store mimics the subset of the `plyvel.DB` interface that OpenWPM uses
+(`get`, `iterator`, `write_batch` and `close`) so it can stand in for the
+LevelDB content database.
+
+Layout of a store directory::
+
+    index.sqlite        hash -> (pack, offset, length, dictionary)
+    pack-000000.pack    concatenated zstd frames
+    pack-000001.pack
+    ...
+"""
+
+import argparse
+import logging
+import os
+import random
+import sqlite3
+import time
+from typing import BinaryIO, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+import zstandard as zstd
+
+CONTENT_STORE_NAME = "content.store"
+INDEX_NAME = "index.sqlite"
+PACK_NAME = "pack-%06d.pack"
+PACK_SIZE = 256 * 2 ** 20  # roll over to a new packfile after 256 MiB
+COMPRESSION_LEVEL = 9
+DICT_SIZE = 112640  # zstd's default dictionary size
+DICT_TRAINING_SAMPLES = 1000  # train the dictionary after this many blobs
+DICT_MAX_SAMPLE_SIZE = 2 ** 20  # skip larger blobs when sampling
+INDEX_LOOKUP_SIZE = 500  # hashes per query, below SQLite's variable limit
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    pack INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    dictionary INTEGER
+);
+CREATE TABLE IF NOT EXISTS dictionaries (
+    id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+);
+"""
+
+Key = Union[str, bytes]
+
+logger = logging.getLogger("openwpm")
+
+
+def _to_str(key: Key) -> str:
+    if isinstance(key, bytes):
+        return key.decode("ascii")
+    return key
+
+
+class _WriteBatch:
+    """Buffered writes, mirroring `plyvel.WriteBatch`"""
+
+    def __init__(self, store: "ContentStore") -> None:
+        self._store = store
+        self._pending: Dict[str, bytes] = dict()
+
+    def put(self, key: Key, value: bytes) -> None:
+        self._pending[_to_str(key)] = value
+
+    def write(self) -> None:
+        self._store._write(self._pending)
+        self._pending = dict()
+
+
+class _Iterator:
+    """Iterator over the store, mirroring `plyvel.Iterator`"""
+
+    def __init__(self, store: "ContentStore", include_value: bool) -> None:
+        self._store = store
+        self._include_value = include_value
+        # Materialize the key list so writes during iteration are safe
+        self._keys = [
+            row[0]
+            for row in store._index.execute("SELECT hash FROM blobs ORDER BY hash")
+        ]
+
+    def __enter__(self) -> "_Iterator":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._keys = list()
+
+    def __iter__(self) -> Iterator[Union[bytes, Tuple[bytes, bytes]]]:
+        for key in self._keys:
+            if not self._include_value:
+                yield key.encode("ascii")
+                continue
+            value = self._store.get(key)
+            if value is not None:
+                yield key.encode("ascii"), value
+
+
+class ContentStore:
+    """A packfile based store for deduplicated page content
+
+    Parameters
+    ----------
+    path : string
+        directory of the store
+    create_if_missing : bool
+        create the store if `path` doesn't exist yet
+    train_dictionary : bool
+        train a compression dictionary once enough blobs have been written.
+        Set this to `False` when a dictionary is provided with
+        `set_dictionary` (e.g. by the migration tool).
+    """
+
+    def __init__(
+        self,
+        path: str,
+        create_if_missing: bool = False,
+        train_dictionary: bool = True,
+    ) -> None:
+        if not os.path.isdir(path):
+            if not create_if_missing:
+                raise FileNotFoundError("No content store found at %s" % path)
+            os.makedirs(path)
+        self.path = path
+        self._index = sqlite3.connect(
+            os.path.join(path, INDEX_NAME), check_same_thread=False
+        )
+        self._index.executescript(INDEX_SCHEMA)
+        self._train_dictionary = train_dictionary
+        self._samples: List[bytes] = list()
+
+        self._dictionaries: Dict[int, zstd.ZstdCompressionDict] = dict()
+        self._decompressors: Dict[Optional[int], zstd.ZstdDecompressor] = dict()
+        for dict_id, data in self._index.execute("SELECT id, data FROM dictionaries"):
+            self._dictionaries[dict_id] = zstd.ZstdCompressionDict(data)
+        self._dict_id: Optional[int] = (
+            max(self._dictionaries) if self._dictionaries else None
+        )
+        self._compressor = self._make_compressor()
+
+        (last_pack,) = self._index.execute("SELECT MAX(pack) FROM blobs").fetchone()
+        self._pack = last_pack or 0
+        # Opened on the first write, so stores that are only read from
+        # leave their packfiles untouched
+        self._pack_file: Optional[BinaryIO] = None
+        self._readers: Dict[int, BinaryIO] = dict()
+
+    def _make_compressor(self) -> zstd.ZstdCompressor:
+        if self._dict_id is None:
+            return zstd.ZstdCompressor(level=COMPRESSION_LEVEL)
+        return zstd.ZstdCompressor(
+            level=COMPRESSION_LEVEL, dict_data=self._dictionaries[self._dict_id]
+        )
+
+    def _decompressor(self, dict_id: Optional[int]) -> zstd.ZstdDecompressor:
+        if dict_id not in self._decompressors:
+            if dict_id is None:
+                self._decompressors[dict_id] = zstd.ZstdDecompressor()
+            else:
+                self._decompressors[dict_id] = zstd.ZstdDecompressor(
+                    dict_data=self._dictionaries[dict_id]
+                )
+        return self._decompressors[dict_id]
+
+    def set_dictionary(self, data: bytes) -> int:
+        """Use the serialized zstd dictionary `data` for all further writes.
+
+        Returns the id under which the dictionary is stored."""
+        cur = self._index.execute("INSERT INTO dictionaries (data) VALUES (?)", (data,))
+        self._index.commit()
+        dict_id = cur.lastrowid
+        self._dictionaries[dict_id] = zstd.ZstdCompressionDict(data)
+        self._dict_id = dict_id
+        self._compressor = self._make_compressor()
+        self._samples = list()
+        return dict_id
+
+    def _maybe_train_dictionary(self, values: List[bytes]) -> None:
+        if not self._train_dictionary or self._dict_id is not None:
+            return
+        for value in values:
+            if len(self._samples) >= DICT_TRAINING_SAMPLES:
+                break
+            if len(value) <= DICT_MAX_SAMPLE_SIZE:
+                self._samples.append(value)
+        if len(self._samples) < DICT_TRAINING_SAMPLES:
+            return
+        self._train_dictionary = False
+        try:
+            dictionary = train_dictionary(self._samples)
+        except zstd.ZstdError:
+            logger.error("Unable to train content dictionary", exc_info=True)
+            self._samples = list()
+            return
+        dict_id = self.set_dictionary(dictionary)
+        logger.info("Trained content dictionary %d" % dict_id)
+
+    def _existing(self, keys: List[str]) -> Set[str]:
+        """Return the subset of `keys` that is already in the index"""
+        existing = set()
+        for i in range(0, len(keys), INDEX_LOOKUP_SIZE):
+            chunk = keys[i : i + INDEX_LOOKUP_SIZE]
+            existing.update(
+                row[0]
+                for row in self._index.execute(
+                    "SELECT hash FROM blobs WHERE hash IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+            )
+        return existing
+
+    def _write(self, blobs: Dict[str, bytes]) -> None:
+        # Skip stored blobs, their frames would never be referenced
+        existing = self._existing(list(blobs))
+        blobs = {key: value for key, value in blobs.items() if key not in existing}
+        if not blobs:
+            return
+        self._maybe_train_dictionary(list(blobs.values()))
+        if self._pack_file is None:
+            self._pack_file = open(
+                os.path.join(self.path, PACK_NAME % self._pack), "ab"
+            )
+        rows = list()
+        for key, value in blobs.items():
+            if self._pack_file.tell() >= PACK_SIZE:
+                self._pack_file.close()
+                self._pack += 1
+                self._pack_file = open(
+                    os.path.join(self.path, PACK_NAME % self._pack), "ab"
+                )
+            frame = self._compressor.compress(value)
+            offset = self._pack_file.tell()
+            self._pack_file.write(frame)
+            rows.append(
+                (key, self._pack, offset, len(frame), len(value), self._dict_id)
+            )
+        # Packfiles have to be on disk before the index points to them
+        self._pack_file.flush()
+        self._index.executemany(
+            "INSERT OR IGNORE INTO blobs "
+            "(hash, pack, offset, length, size, dictionary) "
+            "VALUES (?,?,?,?,?,?)",
+            rows,
+        )
+        self._index.commit()
+
+    def get(self, key: Key) -> Optional[bytes]:
+        """Return the content stored under `key` or `None`"""
+        row = self._index.execute(
+            "SELECT pack, offset, length, dictionary FROM blobs WHERE hash = ?",
+            (_to_str(key),),
+        ).fetchone()
+        if row is None:
+            return None
+        pack, offset, length, dict_id = row
+        if pack == self._pack and self._pack_file is not None:
+            self._pack_file.flush()
+        if pack not in self._readers:
+            self._readers[pack] = open(os.path.join(self.path, PACK_NAME % pack), "rb")
+        reader = self._readers[pack]
+        reader.seek(offset)
+        return self._decompressor(dict_id).decompress(reader.read(length))
+
+    def __contains__(self, key: Key) -> bool:
+        return (
+            self._index.execute(
+                "SELECT 1 FROM blobs WHERE hash = ?", (_to_str(key),)
+            ).fetchone()
+            is not None
+        )
+
+    def iterator(self, include_value: bool = True) -> _Iterator:
+        return _Iterator(self, include_value)
+
+    def write_batch(self) -> _WriteBatch:
+        return _WriteBatch(self)
+
+    def put(self, key: Key, value: bytes) -> None:
+        self._write({_to_str(key): value})
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of blobs, their total size and the size on disk"""
+        count, size, length = self._index.execute(
+            "SELECT COUNT(*), SUM(size), SUM(length) FROM blobs"
+        ).fetchone()
+        return {"blobs": count, "size": size or 0, "compressed_size": length or 0}
+
+    def close(self) -> None:
+        if self._pack_file is not None:
+            self._pack_file.close()
+        for reader in self._readers.values():
+            reader.close()
+        self._readers = dict()
+        self._index.close()
+
+
+def train_dictionary(samples: List[bytes], dict_size: int = DICT_SIZE) -> bytes:
+    """Train a zstd dictionary on `samples` and return it serialized"""
+    return zstd.train_dictionary(dict_size, samples).as_bytes()
+
+
+def _dir_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path)
+        for name in files
+    )
+
+
+def migrate_leveldb(
+    ldb_path: str, store_path: str, batch_size: int = 1000
+) -> Dict[str, float]:
+    """Copy all content of the LevelDB database at `ldb_path` into a new
+    content store at `store_path`.
+
+    The compression dictionary is trained on a sample of the LevelDB content
+    before anything is written. Returns size and throughput figures of the
+    migration."""
+    import plyvel
+
+    ldb = plyvel.DB(ldb_path, create_if_missing=False, compression="snappy")
+    store = ContentStore(store_path, create_if_missing=True, train_dictionary=False)
+    samples = list()
+    with ldb.iterator(include_key=False) as it:
+        for value in it:
+            if len(samples) >= DICT_TRAINING_SAMPLES:
+                break
+            if len(value) <= DICT_MAX_SAMPLE_SIZE:
+                samples.append(value)
+    if samples:
+        try:
+            store.set_dictionary(train_dictionary(samples))
+        except zstd.ZstdError:
+            logger.error("Unable to train content dictionary", exc_info=True)
+    del samples
+
+    start = time.time()
+    batch = store.write_batch()
+    count = 0
+    with ldb.iterator() as it:
+        for key, value in it:
+            batch.put(key, value)
+            count += 1
+            if count % batch_size == 0:
+                batch.write()
+    batch.write()
+    elapsed = time.time() - start
+    stats = store.stats()
+    store.close()
+    ldb.close()
+    return {
+        "blobs": count,
+        "size": stats["size"],
+        "leveldb_disk_size": _dir_size(ldb_path),
+        "store_disk_size": _dir_size(store_path),
+        "write_mb_per_s": stats["size"] / 2 ** 20 / elapsed if elapsed else 0.0,
+    }
+
+
+def compare_reads(
+    ldb_path: str, store_path: str, reads: int = 10000
+) -> Dict[str, float]:
+    """Time random reads of the same keys from LevelDB and the content store.
+
+    Returns the read throughput of both in MB/s."""
+    import plyvel
+
+    ldb = plyvel.DB(ldb_path, create_if_missing=False, compression="snappy")
+    store = ContentStore(store_path)
+    with store.iterator(include_value=False) as it:
+        keys = list(it)
+    keys = random.sample(keys, min(reads, len(keys)))
+    results = dict()
+    for name, db in (("leveldb", ldb), ("store", store)):
+        start = time.time()
+        size = sum(len(db.get(key)) for key in keys)
+        elapsed = time.time() - start
+        results["%s_read_mb_per_s" % name] = (
+            size / 2 ** 20 / elapsed if elapsed else 0.0
+        )
+    store.close()
+    ldb.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Migrate a content.ldb LevelDB database to a content store "
+        "and compare the size and read throughput of both."
+    )
+    parser.add_argument("leveldb", help="path of the content.ldb database")
+    parser.add_argument("store", help="directory of the new content store")
+    parser.add_argument(
+        "--reads", type=int, default=10000, help="number of random reads to time"
+    )
+    args = parser.parse_args()
+    results = migrate_leveldb(args.leveldb, args.store)
+    results.update(compare_reads(args.leveldb, args.store, args.reads))
+    for name, value in results.items():
+        print("%s: %s" % (name, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""Write-ahead journal of the records received by the aggregator listener.
+
+With `aggregator_journal` enabled, the listener socket appends every frame it
+receives to a segment file below `<data_directory>/journal/` before putting
+the record into the queue. Records are numbered in the order they are
+queued. Once the listener has saved the records up to a sequence number,
+i.e. committed them (`LocalListener`) or uploaded them (`ParquetListener`
+and `S3Listener`), it checkpoints the journal: the sequence number is written
+to the checkpoint file and segments that only hold saved records are
+removed.
+
+A listener that is restarted after its process died replays the records
+that weren't saved before accepting new connections. Records that were saved
+right before the crash, but not checkpointed yet, are replayed as well.
+"""
+import logging
+import os
+import struct
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+JOURNAL_DIRECTORY = "journal"
+SEGMENT_SIZE = 64 * 2 ** 20  # bytes, segments are rolled once they are larger
+SEGMENT_NAME = "segment-%016d.log"
+CHECKPOINT_NAME = "checkpoint"
+FRAME_HEADER = struct.Struct(">Lc")
+
+logger = logging.getLogger("openwpm")
+
+
+def _segment_seq(name: str) -> Optional[int]:
+    """Return the sequence number of the first record in segment `name`"""
+    if not (name.startswith("segment-") and name.endswith(".log")):
+        return None
+    seq = name[len("segment-") : -len(".log")]
+    return int(seq) if seq.isdigit() else None
+
+
+def _scan_segment(path: str) -> Tuple[int, int]:
+    """Return the number of complete frames in the segment at `path` and
+    the number of bytes they take up"""
+    size = os.path.getsize(path)
+    count = 0
+    offset = 0
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                break
+            msglen, _ = FRAME_HEADER.unpack(header)
+            end = offset + FRAME_HEADER.size + msglen
+            if end > size:
+                break
+            f.seek(msglen, os.SEEK_CUR)
+            count += 1
+            offset = end
+    return count, offset
+
+
+class RecordJournal:
+    """Append-only journal of socket frames, split into segment files
+
+    Parameters
+    ----------
+    directory : string
+        directory to store the segments and the checkpoint in
+    fsync_interval : float, optional
+        seconds between fsyncs of the current segment. 0 syncs every frame.
+        If None, frames are only written to the OS, which protects against
+        the listener process dying, but not against the machine crashing.
+    segment_size : int
+        size in bytes after which a new segment is started
+
+    Segments left behind by an earlier listener are scanned when the journal
+    is opened, and frames that were only written partially are cut off.
+    `replay` yields the records of these segments that weren't checkpointed,
+    after which new frames can be appended.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        fsync_interval: Optional[float],
+        segment_size: int = SEGMENT_SIZE,
+    ) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._fsync_interval = fsync_interval
+        self._segment_size = segment_size
+        # Records are appended by the socket threads and checkpointed by the
+        # listener
+        self._lock = threading.Lock()
+        # first sequence number and path of each segment, oldest first
+        self._segments: List[Tuple[int, str]] = list()
+        self._file: Any = None
+        self._file_size = 0
+        self._last_sync = time.time()
+        self.first_seq = self._read_checkpoint()  # first unsaved record
+        self.next_seq = self.first_seq  # number of the next record appended
+        self._recover()
+        self._replay_segments = list(self._segments)
+        self.replayable = self.next_seq - self.first_seq
+
+    def _read_checkpoint(self) -> int:
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_NAME), "r") as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _recover(self) -> None:
+        """Scan the segments of an earlier listener"""
+        segments = list()
+        for name in os.listdir(self.directory):
+            seq = _segment_seq(name)
+            if seq is not None:
+                segments.append((seq, os.path.join(self.directory, name)))
+        for seq, path in sorted(segments):
+            count, valid_bytes = _scan_segment(path)
+            if valid_bytes < os.path.getsize(path):
+                logger.warning(
+                    "Cutting off a partially written record of journal segment %s",
+                    path,
+                )
+                with open(path, "r+b") as f:
+                    f.truncate(valid_bytes)
+            if count == 0 or seq + count <= self.first_seq:
+                os.remove(path)
+                continue
+            if seq > self.next_seq:
+                logger.error(
+                    "Journal segment %s starts at record %d, expected %d",
+                    path,
+                    seq,
+                    self.next_seq,
+                )
+                self.first_seq = seq
+            self._segments.append((seq, path))
+            self.next_seq = seq + count
+
+    def replay(self) -> Iterator[bytes]:
+        """Yield the frames that weren't checkpointed by an earlier listener.
+
+        Must be called before anything is appended."""
+        for seq, path in self._replay_segments:
+            with open(path, "rb") as f:
+                while True:
+                    header = f.read(FRAME_HEADER.size)
+                    if len(header) < FRAME_HEADER.size:
+                        break
+                    msglen, _ = FRAME_HEADER.unpack(header)
+                    if seq >= self.first_seq:
+                        yield header + f.read(msglen)
+                    else:
+                        f.seek(msglen, os.SEEK_CUR)
+                    seq += 1
+        self._replay_segments = list()
+
+    def _sync(self) -> None:
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+        self._last_sync = time.time()
+
+    def _roll(self) -> None:
+        if self._file is not None:
+            if self._fsync_interval is not None:
+                self._sync()
+            self._file.close()
+        path = os.path.join(self.directory, SEGMENT_NAME % self.next_seq)
+        self._file = open(path, "ab", buffering=0)
+        self._file_size = 0
+        self._segments.append((self.next_seq, path))
+
+    def append(self, frame: bytes) -> int:
+        """Write `frame` to the current segment and return its sequence number"""
+        with self._lock:
+            if self._file is None or self._file_size >= self._segment_size:
+                self._roll()
+            self._file.write(frame)
+            self._file_size += len(frame)
+            seq = self.next_seq
+            self.next_seq += 1
+            if self._fsync_interval is not None and (
+                time.time() - self._last_sync >= self._fsync_interval
+            ):
+                self._sync()
+            return seq
+
+    def checkpoint(self, seq: int) -> None:
+        """Mark all records before sequence number `seq` as saved"""
+        if seq <= self.first_seq:
+            return
+        path = os.path.join(self.directory, CHECKPOINT_NAME)
+        with open(path + ".tmp", "w") as f:
+            f.write(str(seq))
+            if self._fsync_interval is not None:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        with self._lock:
+            self.first_seq = seq
+            # The segment that is written to is kept open
+            while len(self._segments) > 1 and self._segments[1][0] <= seq:
+                os.remove(self._segments.pop(0)[1])
+
+    def stats(self) -> Dict[str, int]:
+        """Return the number of segments, their size and unsaved records"""
+        with self._lock:
+            return {
+                "segments": len(self._segments),
+                "bytes": sum(os.path.getsize(path) for _, path in self._segments),
+                "unsaved_records": self.next_seq - self.first_seq,
+            }
+
+    def close(self) -> None:
+        """Close the current segment, and remove it if all records are saved"""
+        with self._lock:
+            self._close()
+
+    def _close(self) -> None:
+        if self._file is not None:
+            if self._fsync_interval is not None:
+                self._sync()
+            self._file.close()
+            self._file = None
+        if self.first_seq >= self.next_seq:
+            for _, path in self._segments:
+                os.remove(path)
+            self._segments = list()
@@ -199,6 +199,24 @@ fields = [
 ]
 PQ_SCHEMAS["callstacks"] = pa.schema(fields)
 
+# tc_data
+fields = [
+    pa.field("visit_id", pa.int64(), nullable=False),
+    pa.field("browser_id", pa.uint32(), nullable=False),
+    pa.field("instance_id", pa.uint32(), nullable=False),
+    pa.field("cmp_id", pa.int32()),
+    pa.field("cmp_name", pa.string()),
+    pa.field("cmp_version", pa.int32()),
+    pa.field("tcf_policy_version", pa.int32()),
+    pa.field("gdpr_applies", pa.bool_()),
+    pa.field("event_status", pa.string()),
+    pa.field("cmp_status", pa.string()),
+    pa.field("is_service_specific", pa.bool_()),
+    pa.field("publisher_cc", pa.string()),
+    pa.field("tc_string", pa.string()),
+]
+PQ_SCHEMAS["tc_data"] = pa.schema(fields)
+
 # incomplete_visits
 fields = [
     pa.field("visit_id", pa.int64(), nullable=False),
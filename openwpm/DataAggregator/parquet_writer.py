@@ -0,0 +1,253 @@
+import argparse
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import fs
+
+PARQUET_COMPRESSION = "snappy"
+TARGET_FILE_SIZE = 128 * 2 ** 20
+MAX_FILE_AGE = 60  # seconds
+COMPACTION_PREFIX = "_compact-"  # hidden from dataset readers
+COMPACTION_SOURCES_KEY = b"openwpm.compacted_from"
+
+logger = logging.getLogger("openwpm")
+
+
+class RollingParquetWriter:
+    """Keeps one open parquet file per table and appends row groups to it
+
+    A file is rolled, i.e. closed and handed back to the caller, once it
+    reaches `target_size` bytes or is older than `max_age` seconds. This
+    produces few, well-sized files instead of one small file per flush.
+
+    Parameters
+    ----------
+    directory : string
+        local directory the open files are written to
+    target_size : int
+        size in bytes after which a file is rolled
+    max_age : float
+        age in seconds after which a file is rolled
+    compression : string
+        parquet compression codec of the files
+    compression_level : int
+        level of `compression`, or None for the codec's default
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        target_size: int = TARGET_FILE_SIZE,
+        max_age: float = MAX_FILE_AGE,
+        compression: str = PARQUET_COMPRESSION,
+        compression_level: Optional[int] = None,
+    ) -> None:
+        self.directory = directory
+        self.target_size = target_size
+        self.max_age = max_age
+        self.compression = compression
+        self.compression_level = compression_level
+        # maps table name to open writer, its path and the time it was opened
+        self._writers: Dict[str, Tuple[pq.ParquetWriter, str, float]] = dict()
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, table_name: str, table: pa.Table) -> str:
+        """Append `table` as a row group to the open file of `table_name`.
+
+        Returns the path of the file, which stays the same until the file is
+        rolled."""
+        if table_name not in self._writers:
+            path = os.path.join(
+                self.directory, "%s-%s.parquet" % (table_name, uuid.uuid4().hex)
+            )
+            writer = pq.ParquetWriter(
+                path,
+                table.schema,
+                compression=self.compression,
+                compression_level=self.compression_level,
+                flavor="spark",
+            )
+            self._writers[table_name] = (writer, path, time.time())
+        writer, path, _ = self._writers[table_name]
+        writer.write_table(table)
+        return path
+
+    def path(self, table_name: str) -> Optional[str]:
+        """Return the path of the open file of `table_name`, if any"""
+        if table_name not in self._writers:
+            return None
+        return self._writers[table_name][1]
+
+    def due(self, force: bool = False) -> List[str]:
+        """Return the tables whose files should be rolled"""
+        if force:
+            return list(self._writers)
+        now = time.time()
+        return [
+            table_name
+            for table_name, (_, path, opened) in self._writers.items()
+            if now - opened >= self.max_age or os.path.getsize(path) >= self.target_size
+        ]
+
+    def roll(self, table_name: str) -> str:
+        """Close the open file of `table_name` and return its path"""
+        writer, path, _ = self._writers.pop(table_name)
+        writer.close()
+        return path
+
+    def close(self) -> List[Tuple[str, str]]:
+        """Close all open files and return their tables and paths"""
+        return [(table_name, self.roll(table_name)) for table_name in self.due(True)]
+
+
+def _parquet_files(
+    filesystem: fs.FileSystem, path: str
+) -> Dict[str, List[fs.FileInfo]]:
+    """Return the parquet files below `path` grouped by directory"""
+    directories: Dict[str, List[fs.FileInfo]] = dict()
+    for info in filesystem.get_file_info(fs.FileSelector(path, recursive=True)):
+        if info.type != fs.FileType.File or not info.base_name.endswith(".parquet"):
+            continue
+        directories.setdefault(os.path.dirname(info.path), list()).append(info)
+    return directories
+
+
+def _finish_compaction(filesystem: fs.FileSystem, path: str) -> str:
+    """Delete the sources of the compacted file at `path` and publish it.
+
+    Returns the published path."""
+    with filesystem.open_input_file(path) as f:
+        metadata = pq.ParquetFile(f).schema_arrow.metadata or dict()
+    for source in json.loads(metadata.get(COMPACTION_SOURCES_KEY, b"[]")):
+        if filesystem.get_file_info(source).type == fs.FileType.File:
+            filesystem.delete_file(source)
+    directory, name = os.path.split(path)
+    published = "%s/%s" % (directory, name[len(COMPACTION_PREFIX) :])
+    filesystem.move(path, published)
+    return published
+
+
+def compact_dataset(
+    uri: str,
+    target_size: int = TARGET_FILE_SIZE,
+    compression: str = PARQUET_COMPRESSION,
+    compression_level: Optional[int] = None,
+) -> Dict[str, int]:
+    """Merge small parquet files below `uri` into files of about
+    `target_size` bytes.
+
+    Files are only merged with other files of the same directory, so
+    partitions are kept. A merged file is first written under a hidden name
+    that records its source files in its metadata. Only once the file is
+    complete are the sources deleted and the file published, and an
+    interrupted compaction is finished by the next run.
+
+    `uri` can be a local path or any URI supported by `pyarrow.fs`, such as
+    `s3://bucket/crawl/visits`. Merged files are written with
+    `compression`, so compaction can also recompress a dataset. Returns the
+    number of files read and written."""
+    filesystem, path = fs.FileSystem.from_uri(uri)
+    results = {"files_read": 0, "files_written": 0, "bytes_written": 0}
+    for info in filesystem.get_file_info(fs.FileSelector(path, recursive=True)):
+        if info.base_name.startswith(COMPACTION_PREFIX) and info.base_name.endswith(
+            ".tmp"
+        ):
+            filesystem.delete_file(info.path)
+    directories = _parquet_files(filesystem, path)
+    for files in directories.values():
+        for info in files:
+            if info.base_name.startswith(COMPACTION_PREFIX):
+                logger.info("Finishing interrupted compaction of %s" % info.path)
+                _finish_compaction(filesystem, info.path)
+    directories = _parquet_files(filesystem, path)
+
+    for directory, files in directories.items():
+        small = sorted(
+            (info for info in files if info.size < target_size // 2),
+            key=lambda info: info.path,
+        )
+        bins: List[List[fs.FileInfo]] = [[]]
+        size = 0
+        for info in small:
+            if size + info.size > target_size and bins[-1]:
+                bins.append(list())
+                size = 0
+            bins[-1].append(info)
+            size += info.size
+        for sources in bins:
+            if len(sources) < 2:
+                continue
+            tables = list()
+            for info in sources:
+                with filesystem.open_input_file(info.path) as f:
+                    tables.append(pq.read_table(f).replace_schema_metadata(None))
+            table = pa.concat_tables(tables)
+            metadata = dict(table.schema.metadata or dict())
+            metadata[COMPACTION_SOURCES_KEY] = json.dumps(
+                [info.path for info in sources]
+            ).encode("utf-8")
+            table = table.replace_schema_metadata(metadata)
+            out_path = "%s/%s%s.parquet" % (
+                directory,
+                COMPACTION_PREFIX,
+                uuid.uuid4().hex,
+            )
+            tmp_path = out_path + ".tmp"
+            with filesystem.open_output_stream(tmp_path) as f:
+                pq.write_table(
+                    table,
+                    f,
+                    compression=compression,
+                    compression_level=compression_level,
+                    flavor="spark",
+                    write_statistics=True,
+                )
+            filesystem.move(tmp_path, out_path)
+            published = _finish_compaction(filesystem, out_path)
+            results["files_read"] += len(sources)
+            results["files_written"] += 1
+            results["bytes_written"] += filesystem.get_file_info(published).size
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge the small parquet files of a crawl into larger files."
+    )
+    parser.add_argument(
+        "uri", help="local path or URI of the dataset, e.g. s3://bucket/crawl/visits"
+    )
+    parser.add_argument(
+        "--target-size",
+        type=int,
+        default=TARGET_FILE_SIZE,
+        help="target size of the merged files in bytes",
+    )
+    parser.add_argument(
+        "--compression",
+        default=PARQUET_COMPRESSION,
+        choices=("zstd", "lz4", "gzip", "snappy", "none"),
+        help="compression codec of the merged files",
+    )
+    parser.add_argument(
+        "--compression-level", type=int, help="compression level of the merged files"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    results = compact_dataset(
+        args.uri, args.target_size, args.compression, args.compression_level
+    )
+    print(
+        "Merged %(files_read)d files into %(files_written)d files "
+        "(%(bytes_written)d bytes)" % results
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+from typing import Any, Iterable
+
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from .uploader import Uploader
+
+
+class S3Uploader(Uploader):
+    """Uploads objects to an S3 bucket
+
+    Parameters
+    ----------
+    client : botocore.client.S3
+        a boto3 S3 client, which can be shared between threads
+    bucket : string
+        the bucket to upload to
+
+    All other arguments are passed to `Uploader`.
+    """
+
+    def __init__(self, client: Any, bucket: str, *args, **kwargs) -> None:
+        super(S3Uploader, self).__init__(*args, **kwargs)
+        self._client = client
+        self._bucket = bucket
+
+    def _put_object(self, key: str, body: bytes) -> None:
+        self._client.put_object(Bucket=self._bucket, Key=key, Body=body)
+
+    def key_exists(self, key: str) -> bool:
+        try:
+            self._client.head_object(Bucket=self._bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                self.logger.error(
+                    "Exception while checking for %s" % key, exc_info=True
+                )
+            return False
+        except EndpointConnectionError:
+            self.logger.error("Exception while checking for %s" % key, exc_info=True)
+            return False
+        return True
+
+    def list_keys(self, prefix: str) -> Iterable[str]:
+        paginator = self._client.get_paginator("list_objects_v2")
+        try:
+            for page in paginator.paginate(Bucket=self._bucket, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    yield obj["Key"]
+        except (ClientError, EndpointConnectionError):
+            self.logger.error(
+                "Exception while listing files under %s" % prefix, exc_info=True
+            )
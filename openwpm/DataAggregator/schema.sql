@@ -24,6 +24,20 @@ CREATE TABLE IF NOT EXISTS ping_cmp (
     tcf_policy_version TEXT,
     gdpr_applies INTEGER);
 
+CREATE TABLE IF NOT EXISTS tc_data (
+    visit_id INTEGER NOT NULL,
+    browser_id INTEGER NOT NULL,
+    cmp_id INTEGER,
+    cmp_name TEXT,
+    cmp_version INTEGER,
+    tcf_policy_version INTEGER,
+    gdpr_applies INTEGER,
+    event_status TEXT,
+    cmp_status TEXT,
+    is_service_specific INTEGER,
+    publisher_cc TEXT,
+    tc_string TEXT);
+
 CREATE TABLE IF NOT EXISTS cookie_dialog (
     visit_id INTEGER PRIMARY KEY,
     has_dialog INTEGER,
@@ -53,6 +67,7 @@ CREATE TABLE IF NOT EXISTS site_visits (
     site_url VARCHAR(500) NOT NULL,
     site_rank INTEGER,
     FOREIGN KEY(browser_id) REFERENCES crawl(id));
+CREATE INDEX IF NOT EXISTS site_visits_site_url ON site_visits(site_url);
 
 /*
 # crawl_history
@@ -69,6 +84,8 @@ CREATE TABLE IF NOT EXISTS crawl_history (
     duration INTEGER,
     dtg DATETIME DEFAULT (CURRENT_TIMESTAMP),
     FOREIGN KEY(browser_id) REFERENCES crawl(id));
+CREATE INDEX IF NOT EXISTS crawl_history_visit_id
+    ON crawl_history(visit_id, command_status);
 
 /*
 # http_requests
@@ -255,6 +272,8 @@ CREATE TABLE IF NOT EXISTS callstacks(
 CREATE TABLE IF NOT EXISTS incomplete_visits (
    visit_id INTEGER NOT NULL
 );
+CREATE INDEX IF NOT EXISTS incomplete_visits_visit_id
+    ON incomplete_visits(visit_id);
 
 /* 
 # DNS Requests
@@ -0,0 +1,244 @@
+import abc
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_for_futures
+from typing import Dict, Iterable, List, Optional, Set
+
+from ..metrics import REGISTRY
+from ..utilities.compression import compress
+
+UPLOAD_THREADS = 8
+PENDING_PER_THREAD = 4  # submitting blocks once this many uploads per thread wait
+UPLOAD_RETRIES = 5
+RETRY_BACKOFF = 0.5  # seconds, doubled after every failed attempt
+SPOOL_SUFFIX = ".tmp"
+LIST_PAGE_SIZE = 1000  # keys returned per listing request
+
+
+class Uploader(metaclass=abc.ABCMeta):
+    """Uploads objects from a bounded pool of threads
+
+    Child classes implement `_put_object` and `list_keys` for a storage
+    backend. Every object is retried `retries` times. Objects that still
+    fail are written to `spool_directory` under their key, so no data is
+    lost if the backend is unreachable for a while. Spooled objects are
+    uploaded again by `replay_spool`.
+
+    Parameters
+    ----------
+    spool_directory : string
+        local directory for objects that couldn't be uploaded. Failed
+        objects are dropped if this is `None`.
+    num_threads : int
+        number of upload threads
+    retries : int
+        number of attempts per object before it is spooled
+    """
+
+    def __init__(
+        self,
+        spool_directory: Optional[str] = None,
+        num_threads: int = UPLOAD_THREADS,
+        retries: int = UPLOAD_RETRIES,
+    ) -> None:
+        self._spool_directory = spool_directory
+        self._retries = retries
+        self._executor = ThreadPoolExecutor(
+            max_workers=num_threads, thread_name_prefix=type(self).__name__
+        )
+        self._slots = threading.BoundedSemaphore(num_threads * PENDING_PER_THREAD)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.retried = 0
+        self.spooled = 0
+        self.logger = logging.getLogger("openwpm")
+
+    def submit(
+        self, key: str, body: bytes, codec: str = "none", level: Optional[int] = None
+    ) -> Future:
+        """Upload `body` to `key` in the background.
+
+        Blocks while the maximum number of uploads is pending. The returned
+        future resolves to `True` once the object is uploaded and to `False`
+        if it failed (and was spooled to disk, if spooling is enabled).
+        `body` is compressed with `codec` at `level` by the upload thread."""
+        self._slots.acquire()
+        with self._lock:
+            self.pending += 1
+        future = self._executor.submit(self._upload, key, body, codec, level)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future: Future) -> None:
+        with self._lock:
+            self.pending -= 1
+        self._slots.release()
+
+    def _upload(
+        self,
+        key: str,
+        body: bytes,
+        codec: str = "none",
+        level: Optional[int] = None,
+        spool_path: Optional[str] = None,
+    ) -> bool:
+        body = compress(body, codec, level)
+        start = time.time()
+        for attempt in range(self._retries):
+            try:
+                self._put_object(key, body)
+            except Exception:
+                self.logger.warning(
+                    "Attempt %d to upload %s failed" % (attempt + 1, key),
+                    exc_info=True,
+                )
+                with self._lock:
+                    self.retried += 1
+                time.sleep(RETRY_BACKOFF * 2 ** attempt)
+                continue
+            REGISTRY.observe("openwpm_upload_seconds", time.time() - start)
+            with self._lock:
+                self.uploaded += 1
+                self.uploaded_bytes += len(body)
+            self.logger.debug("Successfully uploaded file `%s`." % key)
+            if spool_path is not None:
+                os.remove(spool_path)
+            return True
+        self._spool(key, body)
+        return False
+
+    def _spool(self, key: str, body: bytes) -> None:
+        """Write an object that couldn't be uploaded to the spool directory"""
+        if self._spool_directory is None:
+            self.logger.error("Failed to upload %s" % key)
+            return
+        path = os.path.join(self._spool_directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + SPOOL_SUFFIX, "wb") as f:
+            f.write(body)
+        os.replace(path + SPOOL_SUFFIX, path)
+        with self._lock:
+            self.spooled += 1
+        self.logger.error("Failed to upload %s, spooled it to %s" % (key, path))
+
+    def replay_spool(self) -> List[Future]:
+        """Upload all objects found in the spool directory again"""
+        futures: List[Future] = list()
+        if self._spool_directory is None or not os.path.isdir(self._spool_directory):
+            return futures
+        for root, _, files in os.walk(self._spool_directory):
+            for name in files:
+                if name.endswith(SPOOL_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                key = os.path.relpath(path, self._spool_directory)
+                with open(path, "rb") as f:
+                    body = f.read()
+                self._slots.acquire()
+                with self._lock:
+                    self.pending += 1
+                future = self._executor.submit(self._upload, key, body, spool_path=path)
+                future.add_done_callback(self._release)
+                futures.append(future)
+        if futures:
+            self.logger.info("Uploading %d spooled files" % len(futures))
+        return futures
+
+    @abc.abstractmethod
+    def _put_object(self, key: str, body: bytes) -> None:
+        """Store `body` under `key`. Raises on failure."""
+
+    @abc.abstractmethod
+    def list_keys(self, prefix: str) -> Iterable[str]:
+        """List all keys starting with `prefix`"""
+
+    def key_exists(self, key: str) -> bool:
+        """Check whether `key` exists in the store"""
+        return key in self.list_keys(key)
+
+    def existing_keys(
+        self, keys: Iterable[str], prefix_length: int, keys_per_prefix: float = 0
+    ) -> Set[str]:
+        """Return the subset of `keys` that exists in the store.
+
+        Keys are grouped by their first `prefix_length` characters. A group
+        is checked with a single prefix listing if that takes fewer requests
+        than checking its keys one by one, given that about
+        `keys_per_prefix` keys are stored under each prefix."""
+        prefixes: Dict[str, Set[str]] = dict()
+        for key in keys:
+            prefixes.setdefault(key[:prefix_length], set()).add(key)
+        listing_requests = max(1, math.ceil(keys_per_prefix / LIST_PAGE_SIZE))
+        existing = set()
+        for prefix, group in prefixes.items():
+            if len(group) > listing_requests:
+                existing.update(group.intersection(self.list_keys(prefix)))
+            else:
+                existing.update(key for key in group if self.key_exists(key))
+        return existing
+
+    @staticmethod
+    def wait(futures: Iterable[Future]) -> bool:
+        """Wait for `futures` and return `True` if all uploads succeeded"""
+        done, _ = wait_for_futures(list(futures))
+        return all(future.result() for future in done)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "pending": self.pending,
+                "uploaded": self.uploaded,
+                "uploaded_bytes": self.uploaded_bytes,
+                "retried": self.retried,
+                "spooled": self.spooled,
+            }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+class LocalUploader(Uploader):
+    """Writes objects to files below a local directory
+
+    Keys are used as paths relative to `directory`. Files are written under
+    a temporary name and renamed once complete, so readers never see
+    partial files.
+    """
+
+    def __init__(self, directory: str, *args, **kwargs) -> None:
+        super(LocalUploader, self).__init__(*args, **kwargs)
+        self._directory = directory
+
+    def _put_object(self, key: str, body: bytes) -> None:
+        path = os.path.join(self._directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + SPOOL_SUFFIX, "wb") as f:
+            f.write(body)
+        os.replace(path + SPOOL_SUFFIX, path)
+
+    def key_exists(self, key: str) -> bool:
+        return os.path.isfile(os.path.join(self._directory, key))
+
+    def existing_keys(
+        self, keys: Iterable[str], prefix_length: int, keys_per_prefix: float = 0
+    ) -> Set[str]:
+        # A stat per key is cheaper than listing whole directories
+        return {key for key in keys if self.key_exists(key)}
+
+    def list_keys(self, prefix: str) -> Iterable[str]:
+        # Only walk the deepest directory that contains all matching keys
+        root = os.path.join(self._directory, os.path.dirname(prefix))
+        for dirpath, _, files in os.walk(root):
+            for name in files:
+                if name.endswith(SPOOL_SUFFIX):
+                    continue
+                key = os.path.relpath(os.path.join(dirpath, name), self._directory)
+                key = key.replace(os.sep, "/")
+                if key.startswith(prefix):
+                    yield key
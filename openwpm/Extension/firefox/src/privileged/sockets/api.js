@@ -63,7 +63,10 @@ this.sockets = class extends ExtensionAPI {
                   let meta = bufferpack.unpack('>Lc', buff);
                   let string = bis.readBytes(meta[0]);
 
-                  if (['j', 'n'].includes(meta[1])) {
+                  if (meta[1] == 'e') {
+                    // The sender announced the end of its stream
+                    return;
+                  } else if (['j', 'n'].includes(meta[1])) {
                     gManager.onDataReceivedListeners.forEach((listener) => {
                       listener(port, string, meta[1] == 'j');
                     });
@@ -146,7 +149,15 @@ this.sockets = class extends ExtensionAPI {
             return;
           }
 
-          gManager.sendingSocketMap.get(id).stream.close();
+          let socket = gManager.sendingSocketMap.get(id);
+          try {
+            // Announce the end of the stream, see SocketInterface.py
+            let buff = bufferpack.pack('>Lc',[0, 'e']);
+            socket.bOutputStream.writeByteArray(buff, buff.length);
+          } catch (err) {
+            console.error(err,err.message);
+          }
+          socket.stream.close();
         },
       },
     };
@@ -7,7 +7,6 @@ import re
 import struct
 import sys
 import threading
-import time
 from queue import Empty as EmptyQueue
 
 import dill
@@ -17,7 +16,7 @@ from sentry_sdk.integrations.logging import BreadcrumbHandler, EventHandler
 from tblib import pickling_support
 
 from .Commands.utils.webdriver_utils import parse_neterror
-from .SocketInterface import serversocket
+from .SocketInterface import END_OF_STREAM_FRAME, serversocket
 
 pickling_support.install()
 
@@ -92,6 +91,24 @@ class ClientSocketHandler(logging.handlers.SocketHandler):
         s = dill.dumps(d)
         return struct.pack(">Lc", len(s), b"d") + s
 
+    def makeSocket(self, timeout=1):
+        # Forked processes inherit the connection, only the process that
+        # opened it announces the end of the stream
+        self._socket_pid = os.getpid()
+        return super(ClientSocketHandler, self).makeSocket(timeout)
+
+    def close(self):
+        """Announce the end of the stream to MPLogger before closing"""
+        self.acquire()
+        try:
+            if self.sock is not None and self._socket_pid == os.getpid():
+                self.sock.sendall(END_OF_STREAM_FRAME)
+        except OSError:
+            pass
+        finally:
+            self.release()
+        super(ClientSocketHandler, self).close()
+
 
 class MPLogger(object):
     """Configure OpenWPM logging across processes"""
@@ -160,6 +177,7 @@ class MPLogger(object):
         socketHandler = ClientSocketHandler(*self.logger_address)
         socketHandler.setLevel(logging.DEBUG)
         logger.addHandler(socketHandler)
+        self._socket_handler = socketHandler
 
     def _sentry_before_send(self, event, hint):
         """Update sentry events before they are sent
@@ -228,10 +246,19 @@ class MPLogger(object):
             if not self._status_queue.empty():
                 self._status_queue.get()
                 socket.close()
-                time.sleep(3)  # TODO: the socket needs a better way of closing
+                drained = socket.wait_for_connections()
+                flushed = 0
                 while not socket.queue.empty():
                     obj = socket.queue.get()
                     self._process_record(obj)
+                    flushed += 1
+                if not drained:
+                    logging.getLogger("openwpm").warning(
+                        "%d connection(s) to the logging server were still "
+                        "open at shutdown, flushed %d records",
+                        socket.open_connections,
+                        flushed,
+                    )
                 self._status_queue.task_done()
                 break
 
@@ -283,6 +310,9 @@ class MPLogger(object):
                 self._event_handler.handle(record)
 
     def close(self):
+        # Records logged in this process from now on only reach the console
+        logging.getLogger("openwpm").removeHandler(self._socket_handler)
+        self._socket_handler.close()
         self._status_queue.put("SHUTDOWN")
         self._status_queue.join()
         self._listener.join()
@@ -2,13 +2,110 @@ import json
 import socket
 import struct
 import threading
+import time
 import traceback
-from queue import Queue
+from collections import defaultdict
+from queue import Full, Queue
+from typing import Any, DefaultDict, Dict, Optional, Tuple
 
 import dill
 
-# TODO - Implement a cleaner shutdown for server socket
-# see: https://stackoverflow.com/a/1148237
+# Serialization flag of the empty frame a sender writes before closing its
+# connection, announcing that it has sent all of its messages
+END_OF_STREAM = b"e"
+END_OF_STREAM_FRAME = struct.pack(">Lc", 0, END_OF_STREAM)
+DRAIN_TIMEOUT = 30  # seconds to wait for the senders to close
+
+
+class RecordQueue(Queue):
+    """A FIFO queue that keeps track of the serialized size of its items
+
+    Items are put as `(msg, msglen)` pairs and retrieved as `msg`. The total
+    number of queued bytes, as well as the number of items and bytes per
+    record type, are kept up to date under the queue's mutex. Records are
+    keyed by their table name if they are `(table, data)` pairs.
+
+    If `max_bytes` is larger than zero, `put` blocks while the queue holds
+    more than `max_bytes` bytes. As the socket threads stop reading from
+    their connections, this pushes back on the senders through TCP.
+    """
+
+    def __init__(self, max_bytes: int = 0) -> None:
+        super(RecordQueue, self).__init__()
+        self.max_bytes = max_bytes
+
+    def _init(self, maxsize: int) -> None:
+        super(RecordQueue, self)._init(maxsize)
+        self.bytes = 0
+        self.table_depths: DefaultDict[str, int] = defaultdict(int)
+        self.table_bytes: DefaultDict[str, int] = defaultdict(int)
+        # records and bytes ever put, by record type
+        self.received: DefaultDict[str, int] = defaultdict(int)
+        self.received_bytes: DefaultDict[str, int] = defaultdict(int)
+        self.taken = 0  # items ever retrieved
+
+    @staticmethod
+    def _record_type(msg: Any) -> str:
+        if isinstance(msg, (list, tuple)) and len(msg) == 2:
+            if isinstance(msg[0], str):
+                return msg[0]
+        return type(msg).__name__
+
+    def put(self, item: Tuple[Any, int], block=True, timeout=None) -> None:
+        with self.not_full:
+            while self.max_bytes > 0 and self.bytes >= self.max_bytes:
+                if not block:
+                    raise Full
+                if not self.not_full.wait(timeout):
+                    raise Full
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _put(self, item: Tuple[Any, int]) -> None:
+        msg, msglen = item
+        record_type = self._record_type(msg)
+        self.bytes += msglen
+        self.table_depths[record_type] += 1
+        self.table_bytes[record_type] += msglen
+        self.received[record_type] += 1
+        self.received_bytes[record_type] += msglen
+        self.queue.append((msg, msglen, record_type))
+
+    def _get(self) -> Any:
+        msg, msglen, record_type = self.queue.popleft()
+        self.taken += 1
+        self.bytes -= msglen
+        self.table_depths[record_type] -= 1
+        self.table_bytes[record_type] -= msglen
+        if self.table_depths[record_type] == 0:
+            del self.table_depths[record_type]
+            del self.table_bytes[record_type]
+        # Several socket threads may be blocked on a full queue
+        self.not_full.notify_all()
+        return msg
+
+    def bytesize(self) -> int:
+        """Return the approximate number of bytes held by the queue"""
+        with self.mutex:
+            return self.bytes
+
+    def table_stats(self) -> Dict[str, Tuple[int, int]]:
+        """Return a mapping of record type to `(depth, bytes)`"""
+        with self.mutex:
+            return {
+                table: (depth, self.table_bytes[table])
+                for table, depth in self.table_depths.items()
+            }
+
+    def received_stats(self) -> Dict[str, Tuple[int, int]]:
+        """Return a mapping of record type to the `(records, bytes)` put into
+        the queue so far"""
+        with self.mutex:
+            return {
+                table: (count, self.received_bytes[table])
+                for table, count in self.received.items()
+            }
 
 
 class serversocket:
@@ -17,13 +114,29 @@ class serversocket:
     from client sockets to a central queue
     """
 
-    def __init__(self, name=None, verbose=False):
+    def __init__(self, name=None, verbose=False, max_queue_bytes=0, journal=None):
+        """`max_queue_bytes` bounds the size of the receiving queue, see
+        `RecordQueue`. The default of 0 means the queue is unbounded.
+
+        If a `journal` is given (see `DataAggregator.journal.RecordJournal`),
+        every received frame is appended to it before its message is put into
+        the queue, and the frames it replays are queued before any
+        connection is accepted.
+        """
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.bind(("localhost", 0))
         self.sock.listen(10)  # queue a max of n connect requests
         self.verbose = verbose
         self.name = name
-        self.queue = Queue()
+        self.queue = RecordQueue(max_bytes=max_queue_bytes)
+        self.journal = journal
+        # Keeps the order of the journal and the queue the same
+        self._journal_lock = threading.Lock()
+        # Connection bookkeeping for `wait_for_connections`
+        self._connections = threading.Condition()
+        self.open_connections = 0
+        self.ended_connections = 0  # closed after announcing end-of-stream
+        self.broken_connections = 0  # closed without announcing it
         if self.verbose:
             print("Server bound to: " + str(self.sock.getsockname()))
 
@@ -35,11 +148,31 @@ class serversocket:
             thread.name = thread.name + "-" + self.name
         thread.start()
 
+    def _replay(self):
+        """Queue the messages of the frames the journal replays"""
+        replayed = 0
+        for frame in self.journal.replay():
+            msglen, serialization = struct.unpack(">Lc", frame[:5])
+            try:
+                msg = self.deserialize(frame[5:], serialization)
+            except ValueError:
+                # Keep the queue in step with the journal, the listener
+                # rejects the raw message
+                msg = frame[5:]
+            self.queue.put((msg, msglen))
+            replayed += 1
+        if self.verbose:
+            print("Replayed %d messages from the journal" % replayed)
+
     def _accept(self):
         """ Listen for connections and pass handling to a new thread """
+        if self.journal is not None:
+            self._replay()
         while True:
             try:
                 (client, address) = self.sock.accept()
+                with self._connections:
+                    self.open_connections += 1
                 thread = threading.Thread(
                     target=self._handle_conn, args=(client, address)
                 )
@@ -63,40 +196,81 @@ class serversocket:
             'u' : Unicode string in UTF-8
             'd' : dill pickle
             'j' : json
+
+        An empty message with the serialization flag 'e' announces that the
+        client has sent all of its messages and is about to close the
+        connection.
         """
         if self.verbose:
             print("Thread: %s connected to: %s" % (threading.current_thread(), address))
+        ended = False
         try:
             while True:
-                msg = self.receive_msg(client, 5)
-                msglen, serialization = struct.unpack(">Lc", msg)
+                header = self.receive_msg(client, 5)
+                msglen, serialization = struct.unpack(">Lc", header)
                 if self.verbose:
                     print(
                         "Received message, length %d, serialization %r"
                         % (msglen, serialization)
                     )
-                msg = self.receive_msg(client, msglen)
-                if serialization != b"n":
-                    try:
-                        if serialization == b"d":  # dill serialization
-                            msg = dill.loads(msg)
-                        elif serialization == b"j":  # json serialization
-                            msg = json.loads(msg.decode("utf-8"))
-                        elif serialization == b"u":  # utf-8 serialization
-                            msg = msg.decode("utf-8")
-                        else:
-                            print("Unrecognized serialization type: %r" % serialization)
-                            continue
-                    except (UnicodeDecodeError, ValueError) as e:
-                        print(
-                            "Error de-serializing message: %s \n %s"
-                            % (msg, traceback.format_exc(e))
-                        )
-                        continue
-                self.queue.put(msg)
-        except RuntimeError:
+                if serialization == END_OF_STREAM:
+                    ended = True
+                    break
+                payload = self.receive_msg(client, msglen)
+                try:
+                    msg = self.deserialize(payload, serialization)
+                except ValueError:
+                    print(
+                        "Error de-serializing message: %s \n %s"
+                        % (payload, traceback.format_exc())
+                    )
+                    continue
+                if self.journal is None:
+                    self.queue.put((msg, msglen))
+                    continue
+                with self._journal_lock:
+                    self.journal.append(header + payload)
+                    self.queue.put((msg, msglen))
+        except (RuntimeError, OSError):
             if self.verbose:
                 print("Client socket: " + str(address) + " closed")
+        finally:
+            client.close()
+            with self._connections:
+                self.open_connections -= 1
+                if ended:
+                    self.ended_connections += 1
+                else:
+                    self.broken_connections += 1
+                self._connections.notify_all()
+
+    def wait_for_connections(self, timeout: Optional[float] = DRAIN_TIMEOUT) -> bool:
+        """Block until all clients have closed their connection, or until
+        `timeout` seconds have passed. Returns `True` if no connection is
+        left open, at which point all received messages are in `queue`.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._connections:
+            while self.open_connections > 0:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._connections.wait(remaining)
+        return True
+
+    @staticmethod
+    def deserialize(msg: bytes, serialization: bytes) -> Any:
+        """Deserialize the payload `msg` of a frame, raises a `ValueError`
+        if it can't be deserialized"""
+        if serialization == b"n":
+            return msg
+        if serialization == b"d":  # dill serialization
+            return dill.loads(msg)
+        if serialization == b"j":  # json serialization
+            return json.loads(msg.decode("utf-8"))
+        if serialization == b"u":  # utf-8 serialization
+            return msg.decode("utf-8")
+        raise ValueError("Unrecognized serialization type: %r" % serialization)
 
     def receive_msg(self, client, msglen):
         msg = b""
@@ -163,6 +337,11 @@ class clientsocket:
             totalsent = totalsent + sent
 
     def close(self):
+        """Announce the end of the stream to the server and close"""
+        try:
+            self.sock.sendall(END_OF_STREAM_FRAME)
+        except OSError:
+            pass  # never connected, or the server is gone already
         self.sock.close()
 
 
@@ -15,12 +15,14 @@ import tblib
 from .BrowserManager import Browser
 from .Commands.utils.webdriver_utils import parse_neterror
 from .CommandSequence import CommandSequence
-from .DataAggregator import BaseAggregator, LocalAggregator, S3Aggregator
+from .DataAggregator import BaseAggregator, LocalAggregator, ParquetAggregator
 from .DataAggregator.BaseAggregator import ACTION_TYPE_FINALIZE, RECORD_TYPE_SPECIAL
-from .Errors import CommandExecutionError
+from .Errors import CommandExecutionError, ConfigError
 from .js_instrumentation import clean_js_instrumentation_settings
+from .metrics import REGISTRY, MetricsServer
 from .MPLogger import MPLogger
 from .SocketInterface import clientsocket
+from .utilities.compression import validate_policy
 from .utilities.multiprocess_utils import kill_process_and_children
 from .utilities.platform_utils import get_configuration_string, get_version
 
@@ -28,8 +30,10 @@ tblib.pickling_support.install()
 
 SLEEP_CONS = 0.1  # command sleep constant (in seconds)
 BROWSER_MEMORY_LIMIT = 1500  # in MB
+# seconds the completion handler waits for saved visits before it checks
+# whether the TaskManager is closing
+COMPLETION_TIMEOUT = 5
 
-AGGREGATOR_QUEUE_LIMIT = 10000  # number of records in the queue
 MEMORY_WATCHDOG = "memory_watchdog"
 PROCESS_WATCHDOG = "process_watchdog"
 
@@ -107,6 +111,13 @@ class TaskManager:
         manager_params["source_dump_path"] = os.path.join(
             manager_params["data_directory"], "sources"
         )
+        validate_policy(manager_params["compression"])
+        # Only the local aggregator can read the sites of earlier runs
+        if manager_params["resume"] and manager_params["output_format"] != "local":
+            raise ConfigError(
+                "resume is not supported with the %s output format"
+                % manager_params["output_format"]
+            )
         self.manager_params = manager_params
         self.browser_params = browser_params
         self._logger_kwargs = logger_kwargs
@@ -150,6 +161,30 @@ class TaskManager:
 
         # Initialize the data aggregators
         self._launch_aggregators()
+        REGISTRY.set_source("aggregator", self.data_aggregator.get_listener_metrics)
+        self.metrics_server: Optional[MetricsServer] = None
+        if manager_params["metrics_port"] is not None:
+            self.metrics_server = MetricsServer(
+                REGISTRY,
+                manager_params["metrics_address"],
+                manager_params["metrics_port"],
+            )
+            self.logger.info(
+                "Serving metrics on http://%s:%d/metrics" % self.metrics_server.address
+            )
+
+        # Sites visited by earlier runs of this crawl, which are skipped
+        # when `resume` is enabled
+        self.visited_sites: Dict[str, Tuple[bool, int]] = dict()
+        if manager_params["resume"]:
+            self.visited_sites = self.data_aggregator.get_visited_sites()
+            self.logger.info(
+                "Resuming crawl with %d sites visited, %d of them completed"
+                % (
+                    len(self.visited_sites),
+                    sum(completed for completed, _ in self.visited_sites.values()),
+                )
+            )
 
         # Sets up the BrowserManager(s) + associated queues
         self.browsers = self._initialize_browsers(browser_params)
@@ -278,7 +313,14 @@ class TaskManager:
             self.data_aggregator = LocalAggregator.LocalAggregator(
                 self.manager_params, self.browser_params
             )
+        elif self.manager_params["output_format"] == "parquet":
+            self.data_aggregator = ParquetAggregator.ParquetAggregator(
+                self.manager_params, self.browser_params
+            )
         elif self.manager_params["output_format"] == "s3":
+            # Imported here so boto3 is only required for S3 output
+            from .DataAggregator import S3Aggregator
+
             self.data_aggregator = S3Aggregator.S3Aggregator(
                 self.manager_params, self.browser_params
             )
@@ -327,6 +369,16 @@ class TaskManager:
 
         self.sock.close()  # close socket to data aggregator
         self.data_aggregator.shutdown(relaxed=relaxed)
+        self.data_aggregator.wake_completion_waiters()
+        if self.manager_params["metrics_file"] is not None:
+            path = os.path.join(
+                self.manager_params["data_directory"],
+                self.manager_params["metrics_file"],
+            )
+            REGISTRY.dump(path)
+            self.logger.info("Saved metrics to %s" % path)
+        if getattr(self, "metrics_server", None) is not None:
+            self.metrics_server.close()
         self.logging_server.close()
         if hasattr(self, "callback_thread"):
             self.callback_thread.join()
@@ -401,24 +453,32 @@ class TaskManager:
         return thread
 
     def _mark_command_sequences_complete(self) -> None:
-        """Polls the data aggregator for saved records
-        and calls their callbacks
+        """Waits for the data aggregator to save visits and calls the
+        callbacks of their command sequences.
+
+        Callbacks are invoked as soon as the listener reports a visit as
+        saved, or in batches if `callback_batch_size` is larger than one.
         """
+        batch_size = self.manager_params["callback_batch_size"]
+        batch_delay = self.manager_params["callback_batch_delay"]
         while True:
             if self.closing and not self.unsaved_command_sequences:
                 # we're shutting down and have no unprocessed callbacks
                 break
 
-            visit_id_list = self.data_aggregator.get_new_completed_visits()
-            if not visit_id_list:
-                time.sleep(1)
-                continue
-
-            for visit_id, interrupted in visit_id_list:
+            visit_id_list = self.data_aggregator.wait_for_completed_visits(
+                timeout=COMPLETION_TIMEOUT,
+                batch_size=batch_size,
+                batch_delay=batch_delay,
+            )
+            for visit_id, interrupted, saved in visit_id_list:
                 self.logger.debug("Invoking callback of visit_id %d", visit_id)
                 cs = self.unsaved_command_sequences.pop(visit_id, None)
                 if cs:
                     cs.mark_done(not interrupted)
+                    REGISTRY.observe(
+                        "openwpm_callback_latency_seconds", time.time() - saved
+                    )
 
     def _unpack_picked_error(self, pickled_error: bytes) -> Tuple[str, str]:
         """Unpacks `pickled_error` into and error `message` and `tb` string."""
@@ -533,6 +593,16 @@ class TaskManager:
                     },
                 )
             )
+            REGISTRY.observe(
+                "openwpm_command_seconds",
+                (time.time_ns() - t1) / 1e9,
+                command=type(command).__name__,
+            )
+            REGISTRY.inc(
+                "openwpm_commands_total",
+                command=type(command).__name__,
+                status=command_status,
+            )
 
             if command_status == "critical":
                 self.sock.send(
@@ -613,6 +683,32 @@ class TaskManager:
                 return
             browser.restart_required = False
 
+    def _skip_visited(self, command_sequence: CommandSequence) -> bool:
+        """Return True if the site of `command_sequence` was visited by an
+        earlier run of the crawl and shouldn't be visited again.
+
+        Sites without a completed visit are visited again until they have
+        been tried `resume_max_retries` more times, with the number of
+        earlier visits as `retry_number`. The callback of a skipped command
+        sequence is invoked right away with whether the site completed."""
+        status = self.visited_sites.get(command_sequence.url)
+        if status is None:
+            return False
+        completed, visits = status
+        if not completed and visits <= self.manager_params["resume_max_retries"]:
+            if command_sequence.retry_number is None:
+                command_sequence.retry_number = visits
+            return False
+        self.logger.info(
+            "Skipping %s, it was %s before"
+            % (
+                command_sequence.url,
+                "visited" if completed else "tried %d times" % visits,
+            )
+        )
+        command_sequence.mark_done(completed)
+        return True
+
     def execute_command_sequence(
         self, command_sequence: CommandSequence, index: Optional[int] = None
     ) -> None:
@@ -622,17 +718,11 @@ class TaskManager:
         None  -> first come, first serve
         int  -> index of browser to send command to
         """
+        if self._skip_visited(command_sequence):
+            return
 
-        # Block if the aggregator queue is too large
-        agg_queue_size = self.data_aggregator.get_most_recent_status()
-        if agg_queue_size >= AGGREGATOR_QUEUE_LIMIT:
-            while agg_queue_size >= AGGREGATOR_QUEUE_LIMIT:
-                self.logger.info(
-                    "Blocking command submission until the DataAggregator "
-                    "is below the max queue size of %d. Current queue "
-                    "length %d. " % (AGGREGATOR_QUEUE_LIMIT, agg_queue_size)
-                )
-                agg_queue_size = self.data_aggregator.get_status()
+        # Block until the aggregator grants credit for a new visit
+        self.data_aggregator.wait_for_credit()
 
         # Distribute command
         if index is None:
@@ -0,0 +1,399 @@
+"""Runtime metrics of the TaskManager, the browsers and the aggregator
+
+Every process records its metrics in the module level `REGISTRY`. The
+listener processes of the aggregator send the samples of their registry that
+changed since the previous status update (see `snapshot_changes`), and the
+TaskManager process merges them into its own metrics when they are rendered.
+If `metrics_port` is set, the TaskManager serves them in the Prometheus text
+format on `http://<metrics_address>:<metrics_port>/metrics`, and if
+`metrics_file` is set, they are written to that file as JSON at shutdown.
+"""
+import bisect
+import json
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Deque, Dict, Iterator, List, Tuple
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+SUMMARY = "summary"
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+QUANTILES = (0.5, 0.9, 0.99)
+SUMMARY_WINDOW = 1024  # most recent observations summary quantiles cover
+
+METRICS: Dict[str, Tuple[str, str]] = {
+    "openwpm_records_received_total": (
+        COUNTER,
+        "Records received by the aggregator, by table",
+    ),
+    "openwpm_bytes_received_total": (
+        COUNTER,
+        "Serialized bytes of the records received by the aggregator, by table",
+    ),
+    "openwpm_record_queue_depth": (
+        GAUGE,
+        "Records waiting in the aggregator queue, by table",
+    ),
+    "openwpm_record_queue_bytes": (
+        GAUGE,
+        "Bytes waiting in the aggregator queue, by table",
+    ),
+    "openwpm_open_connections": (
+        GAUGE,
+        "Connections of senders to the aggregator that are open",
+    ),
+    "openwpm_connections_closed_total": (
+        COUNTER,
+        "Connections to the aggregator closed, by whether the sender "
+        "announced the end of its stream",
+    ),
+    "openwpm_records_drained_total": (
+        COUNTER,
+        "Records flushed from the aggregator queue at shutdown",
+    ),
+    "openwpm_commit_seconds": (
+        HISTOGRAM,
+        "Time to commit a batch of records to storage",
+    ),
+    "openwpm_upload_seconds": (
+        HISTOGRAM,
+        "Time to upload a file, including retries",
+    ),
+    "openwpm_visits_completed_total": (
+        COUNTER,
+        "Visits whose records were saved, by status",
+    ),
+    "openwpm_callback_latency_seconds": (
+        HISTOGRAM,
+        "Time from the listener saving a visit to its callback being invoked",
+    ),
+    "openwpm_commands_total": (
+        COUNTER,
+        "Browser commands executed, by command and status",
+    ),
+    "openwpm_command_seconds": (
+        SUMMARY,
+        "Execution time of browser commands, by command",
+    ),
+    "openwpm_browser_restarts_total": (
+        COUNTER,
+        "Browser restarts",
+    ),
+    "openwpm_browser_launch_failures_total": (
+        COUNTER,
+        "Failed attempts to launch a browser",
+    ),
+    "openwpm_browser_launch_seconds": (
+        HISTOGRAM,
+        "Time to launch a browser, including failed attempts",
+    ),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+# A JSON serializable snapshot: metric name to list of [labels, value]
+Snapshot = Dict[str, List[Tuple[Dict[str, str], Any]]]
+Source = Callable[[], List[Tuple[Dict[str, str], Snapshot]]]
+
+logger = logging.getLogger("openwpm")
+
+
+class _Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(DEFAULT_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(DEFAULT_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def value(self) -> Dict[str, Any]:
+        buckets = list()
+        total = 0
+        for bound, count in zip(DEFAULT_BUCKETS + (float("inf"),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+class _Summary:
+    def __init__(self) -> None:
+        self.window: Deque[float] = deque(maxlen=SUMMARY_WINDOW)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.window.append(value)
+        self.sum += value
+        self.count += 1
+
+    def value(self) -> Dict[str, Any]:
+        values = sorted(self.window)
+        quantiles = list()
+        for quantile in QUANTILES:
+            if values:
+                index = min(len(values) - 1, int(quantile * len(values)))
+                quantiles.append((quantile, values[index]))
+        return {"quantiles": quantiles, "sum": self.sum, "count": self.count}
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    escaped = [
+        '%s="%s"'
+        % (
+            key,
+            str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'),
+        )
+        for key, value in sorted(labels.items())
+    ]
+    return "{%s}" % ",".join(escaped)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def snapshot_changes(
+    snapshot: Snapshot, sent: Dict[Tuple[str, Labels], Any]
+) -> Snapshot:
+    """Return the samples of `snapshot` that differ from those in `sent`,
+    which maps the metric name and labels of the samples sent before to
+    their value, and add them to `sent`"""
+    changes: Snapshot = dict()
+    for name, samples in snapshot.items():
+        for labels, value in samples:
+            key = (name, _labels(labels))
+            if key in sent and sent[key] == value:
+                continue
+            sent[key] = value
+            changes.setdefault(name, list()).append((labels, value))
+    return changes
+
+
+def merge_snapshot(merged: Snapshot, changes: Snapshot) -> None:
+    """Replace the samples of `merged` by the samples in `changes` that have
+    the same name and labels, and add the others"""
+    for name, samples in changes.items():
+        current = merged.setdefault(name, list())
+        index = {_labels(labels): i for i, (labels, _) in enumerate(current)}
+        for labels, value in samples:
+            i = index.get(_labels(labels))
+            if i is None:
+                index[_labels(labels)] = len(current)
+                current.append((labels, value))
+            else:
+                current[i] = (labels, value)
+
+
+class MetricsRegistry:
+    """Thread-safe store of the metrics of one process
+
+    Metrics are identified by their name in `METRICS` and a set of labels,
+    which are given as keyword arguments, e.g.
+    `registry.inc("openwpm_commands_total", command="GetCommand")`.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._values: Dict[str, Dict[Labels, Any]] = dict()
+        # snapshots of other processes, see `set_source`
+        self._sources: Dict[str, Source] = dict()
+
+    def _get(self, name: str, labels: Dict[str, Any], factory: Callable) -> Any:
+        if name not in METRICS:
+            raise ValueError("Unknown metric: %s" % name)
+        key = _labels(labels)
+        values = self._values.setdefault(name, dict())
+        if key not in values:
+            values[key] = factory()
+        return values[key]
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        """Increment the counter `name`"""
+        if name not in METRICS:
+            raise ValueError("Unknown metric: %s" % name)
+        key = _labels(labels)
+        with self._lock:
+            values = self._values.setdefault(name, dict())
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        """Set the gauge `name`, or a counter that is kept elsewhere"""
+        if name not in METRICS:
+            raise ValueError("Unknown metric: %s" % name)
+        with self._lock:
+            self._values.setdefault(name, dict())[_labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        """Add an observation to the histogram or summary `name`"""
+        factory = _Summary if METRICS.get(name, ("",))[0] == SUMMARY else _Histogram
+        with self._lock:
+            self._get(name, labels, factory).observe(value)
+
+    @contextmanager
+    def time(self, name: str, **labels: Any) -> Iterator[None]:
+        """Observe the time spent in the `with` block"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def set_source(self, name: str, source: Source) -> None:
+        """Merge the snapshots returned by `source` into the rendered metrics.
+
+        `source` returns a list of extra labels and the snapshot of another
+        process, e.g. `[({"process": "listener"}, snapshot)]`."""
+        with self._lock:
+            self._sources[name] = source
+
+    def clear(self) -> None:
+        """Drop all metrics and sources, e.g. in a newly forked process"""
+        with self._lock:
+            self._values = dict()
+            self._sources = dict()
+
+    def snapshot(self) -> Snapshot:
+        """Return the metrics of this process"""
+        with self._lock:
+            snapshot: Snapshot = dict()
+            for name, values in self._values.items():
+                snapshot[name] = [
+                    (
+                        dict(labels),
+                        value
+                        if METRICS[name][0] in (COUNTER, GAUGE)
+                        else value.value(),
+                    )
+                    for labels, value in values.items()
+                ]
+            sources = list(self._sources.values())
+        # Sources are collected outside of the lock, as they may block
+        for source in sources:
+            try:
+                collected = source()
+            except Exception:
+                logger.error("Failed to collect metrics", exc_info=True)
+                continue
+            for extra_labels, other in collected:
+                for name, samples in other.items():
+                    snapshot.setdefault(name, list()).extend(
+                        (dict(labels, **extra_labels), value)
+                        for labels, value in samples
+                    )
+        return snapshot
+
+    def render(self) -> str:
+        """Return all metrics in the Prometheus text format"""
+        lines = list()
+        for name, samples in sorted(self.snapshot().items()):
+            if name not in METRICS:
+                continue
+            kind, description = METRICS[name]
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                if kind in (COUNTER, GAUGE):
+                    lines.append(
+                        "%s%s %s" % (name, _format_labels(labels), _format_value(value))
+                    )
+                    continue
+                if kind == HISTOGRAM:
+                    for bound, count in value["buckets"]:
+                        lines.append(
+                            "%s_bucket%s %d"
+                            % (
+                                name,
+                                _format_labels(dict(labels, le=_format_value(bound))),
+                                count,
+                            )
+                        )
+                else:
+                    for quantile, observed in value["quantiles"]:
+                        lines.append(
+                            "%s%s %s"
+                            % (
+                                name,
+                                _format_labels(dict(labels, quantile=quantile)),
+                                _format_value(observed),
+                            )
+                        )
+                lines.append(
+                    "%s_sum%s %s"
+                    % (name, _format_labels(labels), _format_value(value["sum"]))
+                )
+                lines.append(
+                    "%s_count%s %d" % (name, _format_labels(labels), value["count"])
+                )
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path: str) -> None:
+        """Write all metrics to `path` as JSON"""
+        out = {
+            name: [{"labels": labels, "value": value} for labels, value in samples]
+            for name, samples in self.snapshot().items()
+        }
+        with open(path, "w") as f:
+            json.dump(out, f, indent=2, default=str)
+
+
+REGISTRY = MetricsRegistry()
+
+
+class MetricsServer:
+    """Serves the metrics of `registry` on `/metrics` from a daemon thread
+
+    Parameters
+    ----------
+    registry : MetricsRegistry
+        the registry to serve
+    host : string
+        address to listen on
+    port : int
+        port to listen on, 0 picks a free port (see `address`)
+    """
+
+    def __init__(self, registry: MetricsRegistry, host: str, port: int) -> None:
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics request: " + format % args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.address: Tuple[str, int] = self._server.server_address[:2]
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.name = "OpenWPM-metrics"
+        self._thread.start()
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
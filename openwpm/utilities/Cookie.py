@@ -429,7 +429,12 @@ _Translator = {
 _idmap = "".join(chr(x) for x in range(256))
 
 
-def _quote(s, LegalChars=_LegalChars, idmap=_idmap, translate=string.translate):
+def _translate(s, table, deletechars):
+    # Python 2's string.translate, only `deletechars` is supported
+    return "".join(c for c in s if c not in deletechars)
+
+
+def _quote(s, LegalChars=_LegalChars, idmap=_idmap, translate=_translate):
     #
     # If the string does not need to be double-quoted,
     # then just return the string.  Otherwise, surround
@@ -609,7 +614,7 @@ class Morsel(dict):
         coded_val,
         LegalChars=_LegalChars,
         idmap=_idmap,
-        translate=string.translate,
+        translate=_translate,
     ):
         # First we verify that the key isn't a reserved word
         # Second we make sure it only contains legal characters
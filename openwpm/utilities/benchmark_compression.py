@@ -0,0 +1,215 @@
+"""Compare the compression codecs on the output of a finished crawl.
+
+Samples the parquet files, response bodies, site index files, page sources
+and screenshots below a crawl's data directory and reports the compression
+ratio and CPU time of every codec and level that the `compression` manager
+parameter accepts for them, e.g.
+
+    python -m openwpm.utilities.benchmark_compression ~/Desktop/crawl-data
+"""
+import argparse
+import glob
+import io
+import itertools
+import os
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pyarrow.parquet as pq
+from PIL import Image
+from tabulate import tabulate
+
+from ..DataAggregator.content_store import CONTENT_STORE_NAME
+from .compression import codec_from_name, compress, decompress
+from .db_utils import CONTENT_DB_NAME, get_content
+
+LEVELS: Dict[str, Tuple[Optional[int], ...]] = {
+    "zstd": (1, 3, 10, 19),
+    "lz4": (0, 9),
+    "gzip": (1, 6, 9),
+    "snappy": (None,),
+    "none": (None,),
+}
+SAMPLE_SIZE = 200  # files sampled per output kind
+
+
+def _read_files(pattern: str, sample_size: int) -> Iterator[bytes]:
+    """Yield the uncompressed contents of the files matching `pattern`"""
+    paths = glob.glob(pattern, recursive=True)
+    for path in sorted(paths)[:sample_size]:
+        with open(path, "rb") as f:
+            yield decompress(f.read(), codec_from_name(path))
+
+
+def _content_sample(data_directory: str, sample_size: int) -> List[bytes]:
+    if os.path.isdir(os.path.join(data_directory, CONTENT_DB_NAME)) or os.path.isdir(
+        os.path.join(data_directory, CONTENT_STORE_NAME)
+    ):
+        return [
+            content
+            for _, content in itertools.islice(get_content(data_directory), sample_size)
+        ]
+    pattern = os.path.join(data_directory, "parquet", "content", "*")
+    return list(_read_files(pattern, sample_size))
+
+
+def _bench_bytes(
+    samples: List[bytes], codecs: Iterable[str]
+) -> List[Tuple[str, Optional[int], int, int, float]]:
+    """Compress every sample with every codec and level"""
+    results = list()
+    for codec in codecs:
+        for level in LEVELS[codec]:
+            size = 0
+            start = time.process_time()
+            for sample in samples:
+                size += len(compress(sample, codec, level))
+            results.append(
+                (
+                    codec,
+                    level,
+                    sum(len(s) for s in samples),
+                    size,
+                    time.process_time() - start,
+                )
+            )
+    return results
+
+
+def _bench_parquet(
+    paths: List[str],
+) -> List[Tuple[str, Optional[int], int, int, float]]:
+    tables = [pq.read_table(path) for path in paths]
+    results = list()
+    for codec in ("snappy", "zstd", "lz4", "gzip", "none"):
+        for level in LEVELS[codec]:
+            size = 0
+            start = time.process_time()
+            for table in tables:
+                out = io.BytesIO()
+                pq.write_table(
+                    table,
+                    out,
+                    compression=codec,
+                    compression_level=level,
+                    flavor="spark",
+                )
+                size += out.tell()
+            results.append(
+                (
+                    codec,
+                    level,
+                    sum(table.nbytes for table in tables),
+                    size,
+                    time.process_time() - start,
+                )
+            )
+    return results
+
+
+def _bench_screenshots(
+    paths: List[str],
+) -> List[Tuple[str, Optional[int], int, int, float]]:
+    images = list()
+    stored = 0
+    for path in paths:
+        stored += os.path.getsize(path)
+        with Image.open(path) as img:
+            img.load()
+            images.append(img.copy())
+    raw = sum(len(image.tobytes()) for image in images)
+    results = [("none", None, raw, stored, 0.0)]
+    for level in LEVELS["gzip"]:
+        size = 0
+        start = time.process_time()
+        for image in images:
+            out = io.BytesIO()
+            image.save(out, format="PNG", compress_level=level)
+            size += out.tell()
+        results.append(("gzip", level, raw, size, time.process_time() - start))
+    return results
+
+
+def benchmark(
+    data_directory: str, sample_size: int = SAMPLE_SIZE
+) -> Dict[str, List[Tuple[str, Optional[int], int, int, float]]]:
+    """Return (codec, level, input bytes, output bytes, CPU seconds) for each
+    output kind found below `data_directory`"""
+    results = dict()
+    parquet = sorted(
+        glob.glob(os.path.join(data_directory, "**", "*.parquet"), recursive=True)
+    )[:sample_size]
+    if parquet:
+        results["parquet"] = _bench_parquet(parquet)
+    codecs = ("zstd", "lz4", "gzip", "none")
+    content = _content_sample(data_directory, sample_size)
+    if content:
+        results["content"] = _bench_bytes(content, codecs)
+    site_index = list(
+        _read_files(
+            os.path.join(data_directory, "parquet", "site_index", "*"), sample_size
+        )
+    )
+    if site_index:
+        results["site_index"] = _bench_bytes(site_index, codecs)
+    sources = list(
+        _read_files(os.path.join(data_directory, "sources", "*.json*"), sample_size)
+    )
+    if sources:
+        results["page_source"] = _bench_bytes(sources, codecs)
+    screenshots = sorted(
+        glob.glob(os.path.join(data_directory, "screenshots", "*.png"))
+    )[:sample_size]
+    if screenshots:
+        results["screenshots"] = _bench_screenshots(screenshots)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report compression ratio and CPU time of each codec on the "
+        "output of a crawl."
+    )
+    parser.add_argument("data_directory", help="data directory of the crawl")
+    parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=SAMPLE_SIZE,
+        help="number of files sampled per output kind",
+    )
+    args = parser.parse_args()
+    results = benchmark(os.path.expanduser(args.data_directory), args.sample_size)
+    if not results:
+        print("No crawl output found in %s" % args.data_directory)
+        return
+    for kind, rows in results.items():
+        print("\n%s" % kind)
+        print(
+            tabulate(
+                [
+                    (
+                        codec,
+                        "default" if level is None else level,
+                        size,
+                        out,
+                        "%.2f" % (size / out if out else 0),
+                        "%.3f" % cpu,
+                        "%.1f" % (size / 2 ** 20 / cpu if cpu else 0),
+                    )
+                    for codec, level, size, out, cpu in rows
+                ],
+                headers=(
+                    "codec",
+                    "level",
+                    "input bytes",
+                    "output bytes",
+                    "ratio",
+                    "cpu s",
+                    "MB/s",
+                ),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Compare the `Set-Cookie` parser of `cookie_parser` with the vendored
+`Cookie` module that `build_cookie_table` used before.
+
+The corpus is read from the `http_responses` table of a crawl database
+(sqlite or a parquet dataset), or from a text file with one header value
+per line, e.g.
+
+    python -m openwpm.utilities.benchmark_cookies ~/Desktop/crawl-data.sqlite
+
+Reports the parse rate of each implementation and how many headers they
+disagree on.
+"""
+import argparse
+import itertools
+import os
+import time
+from typing import Any, Callable, Iterator, List, Set, Tuple
+
+from tabulate import tabulate
+
+from . import Cookie
+from .build_cookie_table import get_header_values
+from .cookie_parser import parse_set_cookie_header, parse_set_cookie_headers
+from .db_utils import is_parquet_dataset, stream_table
+
+SAMPLE_SIZE = 100000  # header values read from the corpus
+ROUNDS = 3  # the fastest of these rounds is reported
+
+
+def _iter_database_headers(db: str) -> Iterator[str]:
+    for chunk in stream_table(db, "http_responses", columns=["headers"]):
+        for (header_str,) in chunk:
+            for value in get_header_values(header_str, "Set-Cookie"):
+                yield value
+
+
+def _iter_file_headers(path: str) -> Iterator[str]:
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line:
+                yield line
+
+
+def load_corpus(path: str, sample_size: int = SAMPLE_SIZE) -> List[str]:
+    """Return up to `sample_size` `Set-Cookie` header values"""
+    if is_parquet_dataset(path) or path.endswith(".sqlite"):
+        headers = _iter_database_headers(path)
+    else:
+        headers = _iter_file_headers(path)
+    return list(itertools.islice(headers, sample_size))
+
+
+def _legacy_names(header: str) -> Set[str]:
+    try:
+        cookie = Cookie.BaseCookie(header)
+    except Cookie.CookieError:
+        return set()
+    for key in cookie.keys():
+        # The attributes `build_cookie_table` read from each morsel
+        for attribute in ("domain", "path", "expires", "max-age", "httponly"):
+            cookie[key][attribute]
+    return set(cookie.keys())
+
+
+def _names(header: str) -> Set[str]:
+    return {cookie.name for cookie in parse_set_cookie_header(header)}
+
+
+def _time(
+    function: Callable[[List[str]], Any], headers: List[str]
+) -> Tuple[float, Any]:
+    """Return the fastest of `ROUNDS` runs of `function` and its result"""
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        result = function(headers)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def benchmark(headers: List[str]) -> List[Tuple[str, float, int]]:
+    """Return (implementation, seconds, cookies parsed) of each parser"""
+    seconds, legacy = _time(lambda h: [_legacy_names(header) for header in h], headers)
+    results = [("Cookie.BaseCookie", seconds, sum(len(names) for names in legacy))]
+    for name, function in (
+        (
+            "parse_set_cookie_header",
+            lambda h: [parse_set_cookie_header(header) for header in h],
+        ),
+        ("parse_set_cookie_headers", parse_set_cookie_headers),
+    ):
+        seconds, parsed = _time(function, headers)
+        results.append((name, seconds, sum(len(cookies) for cookies in parsed)))
+    return results
+
+
+def disagreements(headers: List[str]) -> int:
+    """Return the number of headers the parsers find different cookies in"""
+    return sum(1 for header in headers if _legacy_names(header) != _names(header))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the Set-Cookie parsers on a corpus of real headers."
+    )
+    parser.add_argument(
+        "corpus",
+        help="crawl database (.sqlite or parquet directory), or a text file "
+        "with one Set-Cookie header value per line",
+    )
+    parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=SAMPLE_SIZE,
+        help="number of header values read from the corpus",
+    )
+    args = parser.parse_args()
+    headers = load_corpus(os.path.expanduser(args.corpus), args.sample_size)
+    if not headers:
+        print("No Set-Cookie headers found in %s" % args.corpus)
+        return
+    print(
+        "%d headers, %d distinct, %d bytes"
+        % (len(headers), len(set(headers)), sum(len(h) for h in headers))
+    )
+    print(
+        tabulate(
+            [
+                (
+                    name,
+                    "%.3f" % seconds,
+                    "%.0f" % (len(headers) / seconds if seconds else 0),
+                    cookies,
+                )
+                for name, seconds, cookies in benchmark(headers)
+            ],
+            headers=("parser", "seconds", "headers/s", "cookies"),
+        )
+    )
+    print("Headers the parsers disagree on: %d" % disagreements(headers))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,16 @@
+import argparse
+import ast
 import json
 import os
 import sqlite3
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Any, Deque, Iterator, List, Optional, Tuple
 from urllib.parse import urlparse
 
-from netlib.odict import ODictCaseless
-
-# This should be the modified Cookie.py included
-# the standard lib Cookie.py has many bugs
-from . import Cookie
+from .cookie_parser import parse_cookie_headers, parse_set_cookie_headers
 
 # Potential formats for expires timestamps
 DATE_FORMATS = [
@@ -22,12 +24,39 @@ DATE_FORMATS = [
     "%a, %d %m %y %H:%M:%S %Z",
 ]
 
+CHUNK_SIZE = 10000  # header rows parsed per chunk
+# Chunks handed to the worker processes ahead of the chunk being written
+CHUNKS_IN_FLIGHT_PER_WORKER = 2
+# Stores the id of the last header row processed, per source table
+PROGRESS_TABLE = "http_cookie_progress"
+
+RESPONSE_COOKIE_ADDED_COLUMNS = (
+    ("samesite", "VARCHAR(10)"),
+    ("partitioned", "BOOLEAN"),
+    ("priority", "VARCHAR(10)"),
+)
+
+REQUEST_COOKIE_INSERT = (
+    "INSERT INTO http_request_cookies "
+    "(browser_id, header_id, name, value, accessed) "
+    "VALUES (?,?,?,?,?)"
+)
+RESPONSE_COOKIE_INSERT = (
+    "INSERT INTO http_response_cookies "
+    "(browser_id, header_id, name, value, domain, path, expires, max_age, "
+    "httponly, secure, comment, version, samesite, partitioned, priority, "
+    "accessed) "
+    "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
+)
+
 
 def encode_to_unicode(string):
     """
     Encode from UTF-8/ISO-8859-1 to Unicode.
     Ignore errors if both of these don't work
     """
+    if isinstance(string, str):
+        return string
     try:
         encoded = str(string, "UTF-8")
     except UnicodeDecodeError:
@@ -38,6 +67,7 @@ def encode_to_unicode(string):
     return encoded
 
 
+@lru_cache(maxsize=4096)
 def select_date_format(date_string):
     """ Try different formats for date and output sqlite format """
     if date_string == "" or date_string == "0":
@@ -96,22 +126,29 @@ def get_domain(domain_string, url):
     return domain_string
 
 
-def parse_cookie_attributes(cookie, key, url):
+def parse_cookie_attributes(cookie, url):
     """
-    Extract/Format each attribute of cookie
+    Extract/Format each attribute of a `SetCookie`
     path is set according to RFC2109 when blank
     See: http://tools.ietf.org/html/rfc2109#section-4.3.1
     domain is set according to Firefox spec
     """
-    domain = get_domain(cookie[key]["domain"], url)
-    path = get_path(cookie[key]["path"], url)
-    expires = select_date_format(cookie[key]["expires"])
-    max_age = cookie[key]["max-age"] if cookie[key]["max-age"] != "" else None
-    httponly = True if cookie[key]["httponly"] is True else False
-    secure = True if cookie[key]["secure"] is True else False
-    comment = cookie[key]["comment"] if cookie[key]["comment"] != "" else None
-    version = cookie[key]["version"] if cookie[key]["version"] != "" else None
-    return (domain, path, expires, max_age, httponly, secure, comment, version)
+    domain = get_domain(cookie.domain or "", url)
+    path = get_path(cookie.path or "", url)
+    expires = select_date_format(cookie.expires or "")
+    return (
+        domain,
+        path,
+        expires,
+        cookie.max_age,
+        cookie.httponly,
+        cookie.secure,
+        cookie.comment or None,
+        cookie.version or None,
+        cookie.samesite,
+        cookie.partitioned,
+        cookie.priority,
+    )
 
 
 def parse_cookies(cookie_string, verbose, url=None, response_cookie=False):
@@ -121,39 +158,87 @@ def parse_cookies(cookie_string, verbose, url=None, response_cookie=False):
         query=(name, value)
     * Response 'Set-Cookie'
         query=(name, value, domain, path, expires, max-age, httponly,
-               secure, comment, version)
+               secure, comment, version, samesite, partitioned, priority)
     """
-    queries = list()
-    attrs = ()
+    cookie_string = encode_to_unicode(cookie_string)
+    if not response_cookie:
+        return parse_cookie_headers([cookie_string])[0]
+    return [
+        (cookie.name, cookie.value) + parse_cookie_attributes(cookie, url)
+        for cookie in parse_set_cookie_headers([cookie_string])[0]
+    ]
+
+
+def get_header_values(header_str, name):
+    """Return the values of header `name` in the serialized `headers` column.
+
+    Headers are stored as a JSON list of [name, value] pairs. Names are
+    matched case-insensitively, and pairs that aren't valid JSON (written
+    by old versions of the instrumentation) are read as Python literals."""
+    if not header_str:
+        return list()
     try:
-        if type(cookie_string) == str:
-            cookie_string = cookie_string.encode("utf-8")
-        cookie = Cookie.BaseCookie(cookie_string)
-        for key in cookie.keys():
-            name = encode_to_unicode(key)
-            value = encode_to_unicode(cookie[key].coded_value)
-            if response_cookie:
-                attrs = parse_cookie_attributes(cookie, key, url)
-            query = (name, value) + attrs
-            queries.append(query)
-    except Cookie.CookieError as e:
-        if verbose:
-            print("[ERROR] - Malformed cookie string")
-        if verbose:
-            print("--------- " + cookie_string)
-        if verbose:
-            print(e)
-        pass
-    return queries
-
+        headers = json.loads(header_str)
+    except ValueError:
+        try:
+            headers = ast.literal_eval(header_str)
+        except (ValueError, SyntaxError):
+            return list()
+    name = name.lower()
+    values = list()
+    for header in headers:
+        if (
+            isinstance(header, (list, tuple))
+            and len(header) == 2
+            and isinstance(header[0], str)
+            and header[0].lower() == name
+        ):
+            values.append(header[1])
+    return values
+
+
+def _parse_request_chunk(args):
+    """Return the http_request_cookies rows of a chunk of http_requests rows"""
+    rows, verbose = args
+    keys = list()
+    headers = list()
+    for req_id, browser_id, header_str, time_stamp in rows:
+        for cookie_str in get_header_values(header_str, "Cookie"):
+            keys.append((browser_id, req_id, time_stamp))
+            headers.append(encode_to_unicode(cookie_str))
+    cookies = list()
+    for (browser_id, req_id, time_stamp), pairs in zip(
+        keys, parse_cookie_headers(headers)
+    ):
+        for name, value in pairs:
+            cookies.append((browser_id, req_id, name, value, time_stamp))
+    return cookies
+
+
+def _parse_response_chunk(args):
+    """Return the http_response_cookies rows of a chunk of http_responses rows"""
+    rows, verbose = args
+    keys = list()
+    headers = list()
+    for resp_id, browser_id, req_url, header_str, time_stamp in rows:
+        for cookie_str in get_header_values(header_str, "Set-Cookie"):
+            keys.append((browser_id, resp_id, req_url, time_stamp))
+            headers.append(encode_to_unicode(cookie_str))
+    cookies = list()
+    for (browser_id, resp_id, req_url, time_stamp), parsed in zip(
+        keys, parse_set_cookie_headers(headers)
+    ):
+        for cookie in parsed:
+            cookies.append(
+                (browser_id, resp_id, cookie.name, cookie.value)
+                + parse_cookie_attributes(cookie, req_url)
+                + (time_stamp,)
+            )
+    return cookies
 
-def build_http_cookie_table(database, verbose=False):
-    """ Extracts all http-cookie data from headers and builds a new table """
-    con = sqlite3.connect(database)
-    cur1 = con.cursor()
-    cur2 = con.cursor()
 
-    cur1.execute(
+def _create_tables(con: sqlite3.Connection) -> None:
+    con.execute(
         "CREATE TABLE IF NOT EXISTS http_request_cookies ( \
                     id INTEGER PRIMARY KEY AUTOINCREMENT, \
                     browser_id INTEGER NOT NULL, \
@@ -162,7 +247,7 @@ def build_http_cookie_table(database, verbose=False):
                     value TEXT NOT NULL, \
                     accessed DATETIME);"
     )
-    cur1.execute(
+    con.execute(
         "CREATE TABLE IF NOT EXISTS http_response_cookies ( \
                     id INTEGER PRIMARY KEY AUTOINCREMENT, \
                     browser_id INTEGER NOT NULL, \
@@ -177,101 +262,182 @@ def build_http_cookie_table(database, verbose=False):
                     secure BOOLEAN, \
                     comment VARCHAR(200), \
                     version VARCHAR(100), \
+                    samesite VARCHAR(10), \
+                    partitioned BOOLEAN, \
+                    priority VARCHAR(10), \
                     accessed DATETIME);"
     )
+    # Tables built by earlier versions lack the newer cookie attributes
+    columns = [
+        row[1] for row in con.execute("PRAGMA table_info(http_response_cookies)")
+    ]
+    for column, column_type in RESPONSE_COOKIE_ADDED_COLUMNS:
+        if column not in columns:
+            con.execute(
+                "ALTER TABLE http_response_cookies ADD COLUMN %s %s"
+                % (column, column_type)
+            )
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS %s ( \
+                    source TEXT PRIMARY KEY, \
+                    last_id INTEGER NOT NULL);"
+        % PROGRESS_TABLE
+    )
     con.commit()
 
-    # Parse http request cookies
-    commit = 0
-    last_commit = 0
 
-    cur1.execute(
-        """SELECT id, browser_id, headers, time_stamp
-                    FROM http_requests
-                    WHERE id NOT IN (SELECT header_id FROM
-                    http_request_cookies)"""
-    )
-
-    row = cur1.fetchone()
-    if row is None:
-        raise Exception("Database error: No HTTP request to process")
+def _get_last_id(con: sqlite3.Connection, source: str, cookie_table: str) -> int:
+    """Return the id of the last `source` row that was processed.
+
+    Tables built before the high-water mark was recorded resume after the
+    last header that had cookies."""
+    row = con.execute(
+        "SELECT last_id FROM %s WHERE source = ?" % PROGRESS_TABLE, (source,)
+    ).fetchone()
+    if row is not None:
+        return row[0]
+    (last_id,) = con.execute("SELECT MAX(header_id) FROM %s" % cookie_table).fetchone()
+    return last_id or 0
+
+
+def _iter_chunks(
+    con: sqlite3.Connection, query: str, last_id: int, chunk_size: int
+) -> Iterator[List[Tuple[Any, ...]]]:
+    """Yield the rows of `query` in chunks, paging on the `id` primary key.
+
+    `query` selects `id` as its first column and takes the last id seen and
+    the chunk size as parameters."""
+    while True:
+        rows = con.execute(query, (last_id, chunk_size)).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield rows
+
+
+def _process_table(
+    con: sqlite3.Connection,
+    executor: Optional[ProcessPoolExecutor],
+    workers: int,
+    source: str,
+    cookie_table: str,
+    select: str,
+    insert: str,
+    parse,
+    chunk_size: int,
+    verbose: bool,
+) -> int:
+    """Parse the cookies of the `source` rows after the high-water mark and
+    write them to `cookie_table`. Returns the number of cookies written."""
+    last_id = _get_last_id(con, source, cookie_table)
+    chunks = _iter_chunks(con, select, last_id, chunk_size)
+    # Chunks are written in order, each in its own transaction together
+    # with the new high-water mark, so an interrupted run resumes after
+    # the last chunk that was written.
+    pending: Deque[Tuple[int, Any]] = deque()
+    max_pending = max(1, workers * CHUNKS_IN_FLIGHT_PER_WORKER)
+    total = 0
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < max_pending:
+            try:
+                rows = next(chunks)
+            except StopIteration:
+                exhausted = True
+                break
+            if executor is None:
+                pending.append((rows[-1][0], parse((rows, verbose))))
+            else:
+                pending.append((rows[-1][0], executor.submit(parse, (rows, verbose))))
+        if not pending:
+            break
+        chunk_last_id, result = pending.popleft()
+        cookies = result if executor is None else result.result()
+        with con:
+            con.executemany(insert, cookies)
+            con.execute(
+                "INSERT OR REPLACE INTO %s (source, last_id) VALUES (?, ?)"
+                % PROGRESS_TABLE,
+                (source, chunk_last_id),
+            )
+        total += len(cookies)
+        if verbose:
+            print("%d Cookies Processed (%s id %d)" % (total, source, chunk_last_id))
+    return total
 
-    while row is not None:
-        req_id, browser_id, header_str, time_stamp = row
-        header = ODictCaseless()
-        try:
-            header.load_state(json.loads(header_str))
-        except ValueError:  # XXX temporary shim -- should be removed
-            header.load_state(eval(header_str))
-        for cookie_str in header["Cookie"]:
-            queries = parse_cookies(cookie_str, verbose)
-            for query in queries:
-                cur2.execute(
-                    "INSERT INTO http_request_cookies \
-                            (browser_id, header_id, name, value, accessed) \
-                            VALUES (?,?,?,?,?)",
-                    (browser_id, req_id) + query + (time_stamp,),
-                )
-                commit += 1
-        if commit % 10000 == 0 and commit != 0 and commit != last_commit:
-            last_commit = commit
-            con.commit()
-            if verbose:
-                print("%d Cookies Processed" % commit)
-        row = cur1.fetchone()
-    con.commit()
-    print("Processing HTTP Request Cookies Complete")
-
-    # Parse http response cookies
-    commit = 0
-    last_commit = 0
-    cur1.execute(
-        """SELECT id, browser_id, url, headers, time_stamp
-                    FROM http_responses
-                    WHERE id NOT IN (SELECT header_id
-                    FROM http_response_cookies)"""
-    )
 
-    row = cur1.fetchone()
-    if row is None:
-        raise Exception("Database error: No HTTP response to process")
+def build_http_cookie_table(
+    database, verbose=False, workers=None, chunk_size=CHUNK_SIZE
+):
+    """Extracts all http-cookie data from headers and builds a new table
 
-    while row is not None:
-        resp_id, browser_id, req_url, header_str, time_stamp = row
-        header = ODictCaseless()
-        try:
-            header.load_state(json.loads(header_str))
-        except ValueError:  # XXX temporary shim -- should be removed
-            header.load_state(eval(header_str))
-        for cookie_str in header["Set-Cookie"]:
-            queries = parse_cookies(
-                cookie_str, verbose, url=req_url, response_cookie=True
-            )
-            for query in queries:
-                cur2.execute(
-                    "INSERT INTO http_response_cookies \
-                            (browser_id, header_id, name, \
-                            value, domain, path, expires, max_age, \
-                            httponly, secure, comment, version, accessed) \
-                            VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                    (browser_id, resp_id) + query + (time_stamp,),
-                )
-                commit += 1
-        if commit % 10000 == 0 and commit != 0 and commit != last_commit:
-            last_commit = commit
-            con.commit()
-            if verbose:
-                print("%d Cookies Processed" % commit)
-        row = cur1.fetchone()
-    con.commit()
-    print("Processing HTTP Response Cookies Complete")
-    con.close()
+    Only the http_requests and http_responses rows added since the last run
+    are processed. Rows are read in chunks of `chunk_size` and parsed by
+    `workers` processes (defaults to the number of CPUs, 1 parses in this
+    process). Returns the number of request and response cookies added.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    con = sqlite3.connect(database)
+    _create_tables(con)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        request_cookies = _process_table(
+            con,
+            executor,
+            workers,
+            "http_requests",
+            "http_request_cookies",
+            "SELECT id, browser_id, headers, time_stamp FROM http_requests "
+            "WHERE id > ? ORDER BY id LIMIT ?",
+            REQUEST_COOKIE_INSERT,
+            _parse_request_chunk,
+            chunk_size,
+            verbose,
+        )
+        print("Processing HTTP Request Cookies Complete")
+        response_cookies = _process_table(
+            con,
+            executor,
+            workers,
+            "http_responses",
+            "http_response_cookies",
+            "SELECT id, browser_id, url, headers, time_stamp FROM http_responses "
+            "WHERE id > ? ORDER BY id LIMIT ?",
+            RESPONSE_COOKIE_INSERT,
+            _parse_response_chunk,
+            chunk_size,
+            verbose,
+        )
+        print("Processing HTTP Response Cookies Complete")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        con.close()
+    return request_cookies, response_cookies
 
 
 def main():
-    import sys
-
-    build_http_cookie_table(sys.argv[1], verbose=True)
+    parser = argparse.ArgumentParser(
+        description="Extract the cookies of the HTTP headers of a crawl database"
+    )
+    parser.add_argument("database", help="path to the crawl sqlite database")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of parsing processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=CHUNK_SIZE,
+        help="header rows parsed per chunk (default: %(default)s)",
+    )
+    args = parser.parse_args()
+    build_http_cookie_table(
+        args.database, verbose=True, workers=args.workers, chunk_size=args.chunk_size
+    )
 
 
 if __name__ == "__main__":
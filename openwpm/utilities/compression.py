@@ -0,0 +1,117 @@
+"""Compression policy for the files written by a crawl.
+
+The `compression` manager parameter picks a codec and an optional level for
+each kind of output, e.g.
+
+    "compression": {
+        "parquet": {"codec": "zstd", "level": 3},
+        "content": {"codec": "gzip", "level": 6},
+        ...
+    }
+
+Kinds that are left out use the codec of `DEFAULT_POLICY`, which matches what
+earlier versions wrote. Not every codec fits every kind: LevelDB only
+supports snappy, and screenshots are PNG files whose deflate level can be
+set with the `gzip` codec.
+"""
+import gzip
+from typing import Any, Dict, Optional, Tuple
+
+import lz4.frame
+import zstandard
+
+DEFAULT_POLICY: Dict[str, Dict[str, Any]] = {
+    # record tables in parquet files (S3 and parquet output)
+    "parquet": {"codec": "snappy", "level": None},
+    # response bodies uploaded by the S3 and parquet output
+    "content": {"codec": "gzip", "level": None},
+    # site visits index files of the S3 and parquet output
+    "site_index": {"codec": "gzip", "level": None},
+    # page sources dumped by `recursive_dump_page_source`
+    "page_source": {"codec": "gzip", "level": None},
+    # blocks of the LevelDB content database
+    "leveldb": {"codec": "snappy", "level": None},
+    # PNG screenshots, `gzip` re-encodes them with the given deflate level
+    "screenshots": {"codec": "none", "level": None},
+}
+CODECS: Dict[str, Tuple[str, ...]] = {
+    "parquet": ("zstd", "lz4", "gzip", "snappy", "none"),
+    "content": ("zstd", "lz4", "gzip", "none"),
+    "site_index": ("zstd", "lz4", "gzip", "none"),
+    "page_source": ("zstd", "lz4", "gzip", "none"),
+    "leveldb": ("snappy", "none"),
+    "screenshots": ("gzip", "none"),
+}
+EXTENSIONS = {"zstd": ".zst", "lz4": ".lz4", "gzip": ".gz", "none": ""}
+DEFAULT_LEVELS = {"zstd": 3, "lz4": 0, "gzip": 9}
+
+
+def validate_policy(policy: Dict[str, Dict[str, Any]]) -> None:
+    """Raise a `ValueError` if `policy` has unknown kinds or codecs, or a
+    level for a codec without levels"""
+    for kind, settings in policy.items():
+        if kind not in CODECS:
+            raise ValueError("Unknown compression output kind: %s" % kind)
+        codec = settings.get("codec")
+        if codec not in CODECS[kind]:
+            raise ValueError(
+                "Unsupported compression codec %s for %s, expected one of %s"
+                % (codec, kind, ", ".join(CODECS[kind]))
+            )
+        level = settings.get("level")
+        if level is not None and not isinstance(level, int):
+            raise ValueError("Compression level for %s must be an integer" % kind)
+        if level is not None and codec not in DEFAULT_LEVELS:
+            raise ValueError(
+                "Compression codec %s for %s doesn't support a level" % (codec, kind)
+            )
+
+
+def get_codec(manager_params: Dict[str, Any], kind: str) -> Tuple[str, Optional[int]]:
+    """Return the codec and level configured for the output `kind`"""
+    settings = manager_params.get("compression", dict()).get(kind)
+    if settings is None:
+        settings = DEFAULT_POLICY[kind]
+    return settings["codec"], settings.get("level")
+
+
+def extension(codec: str) -> str:
+    """Return the file name extension of files compressed with `codec`"""
+    return EXTENSIONS[codec]
+
+
+def compress(data: bytes, codec: str, level: Optional[int] = None) -> bytes:
+    """Compress `data` with `codec`, at its default level if `level` is None"""
+    if codec == "none":
+        return data
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    if codec == "gzip":
+        return gzip.compress(data, compresslevel=level)
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == "lz4":
+        return lz4.frame.compress(data, compression_level=level)
+    raise ValueError("Unsupported compression codec: %s" % codec)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    """Decompress `data` that was compressed with `codec`"""
+    if codec == "none":
+        return data
+    if codec == "gzip":
+        return gzip.decompress(data)
+    if codec == "zstd":
+        # Frames written by `compress` always store their content size
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "lz4":
+        return lz4.frame.decompress(data)
+    raise ValueError("Unsupported compression codec: %s" % codec)
+
+
+def codec_from_name(name: str) -> str:
+    """Guess the codec of a file from the extension of its `name`"""
+    for codec, suffix in EXTENSIONS.items():
+        if suffix and name.endswith(suffix):
+            return codec
+    return "none"
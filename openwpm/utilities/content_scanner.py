@@ -0,0 +1,409 @@
+"""Scan the saved response bodies of a crawl for consent management signatures.
+
+Iterates the content database of a crawl once (see `db_utils.get_content`),
+hands batches of bodies to a pool of worker processes and matches each body
+against a set of signatures, e.g. the IAB TCF and CCPA APIs (`__tcfapi`,
+`__cmp`, `__uspapi`) and script fingerprints of CMP vendors. A signature is
+a name and a list of literal patterns. All patterns are compiled into one
+regular expression shaped like a trie, so every body is scanned in a single
+pass, no matter how many signatures there are.
+
+Matches are written to the `content_signatures` table of the crawl database,
+which joins with `http_responses` on `content_hash`, e.g.
+
+    SELECT DISTINCT r.top_level_url FROM http_responses AS r
+    JOIN content_signatures AS s ON r.content_hash = s.content_hash
+    WHERE s.signature = 'tcfapi'
+
+Usage:
+
+    python -m openwpm.utilities.content_scanner ~/Desktop/crawl-data
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from .db_utils import get_content
+
+# Signature name to the literal patterns that identify it. Patterns are
+# matched case-insensitively unless `case_sensitive` is set.
+DEFAULT_SIGNATURES: Dict[str, List[str]] = {
+    "tcfapi": ["__tcfapi"],
+    "tcfapi_locator": ["__tcfapiLocator"],
+    "cmp": ["__cmp"],
+    "cmp_locator": ["__cmpLocator"],
+    "uspapi": ["__uspapi"],
+    "gpp": ["__gpp"],
+    "onetrust": ["otSDKStub", "optanon", "cdn.cookielaw.org"],
+    "cookiebot": ["consent.cookiebot.com", "Cookiebot"],
+    "quantcast": ["quantcast.mgr.consensu.org", "cmp.quantcast.com"],
+    "didomi": ["sdk.privacy-center.org", "didomi"],
+    "trustarc": ["consent.trustarc.com", "consent.truste.com"],
+    "sourcepoint": ["sourcepoint.mgr.consensu.org", "sourcepoint"],
+    "usercentrics": ["usercentrics"],
+    "iubenda": ["iubenda"],
+    "cookieyes": ["cookieyes"],
+    "consentmanager": ["consentmanager.net"],
+    "cookie_information": ["cookieinformation.com"],
+    "civic": ["cc.cdn.civiccomputing.com"],
+    "osano": ["cmp.osano.com"],
+}
+BATCH_BYTES = 8 * 2 ** 20  # body bytes handed to a worker at once
+BATCHES_IN_FLIGHT_PER_WORKER = 2
+REPORT_INTERVAL = 10  # seconds between progress reports
+
+# content_hash, signature, pattern, number of matches, offset of the first
+ResultRow = Tuple[str, str, str, int, int]
+
+
+def _trie_pattern(patterns: Iterable[bytes]) -> bytes:
+    """Return a regular expression matching any of `patterns`, with common
+    prefixes factored out so the engine never backtracks across patterns"""
+    trie: Dict[Any, Any] = dict()
+    for pattern in patterns:
+        node = trie
+        for byte in pattern:
+            node = node.setdefault(byte, dict())
+        node[None] = dict()
+
+    def build(node: Dict[Any, Any]) -> bytes:
+        branches = [
+            re.escape(bytes([byte])) + build(child)
+            for byte, child in sorted(
+                (byte, child) for byte, child in node.items() if byte is not None
+            )
+        ]
+        if not branches:
+            return b""
+        if len(branches) == 1 and None not in node:
+            return branches[0]
+        group = b"(?:" + b"|".join(branches) + b")"
+        # A pattern ends here, longer ones continue
+        return group + b"?" if None in node else group
+
+    return build(trie)
+
+
+class SignatureMatcher:
+    """Finds the signatures whose patterns occur in a body
+
+    Parameters
+    ----------
+    signatures : dict
+        signature name to a list of literal patterns
+    case_sensitive : bool
+        whether patterns only match with the same case
+    """
+
+    def __init__(
+        self, signatures: Dict[str, List[str]], case_sensitive: bool = False
+    ) -> None:
+        self.case_sensitive = case_sensitive
+        # pattern to the signatures and the original spellings it belongs to
+        self._signatures: Dict[bytes, List[Tuple[str, str]]] = dict()
+        for name, patterns in signatures.items():
+            for pattern in patterns:
+                key = pattern.encode("utf-8")
+                if not case_sensitive:
+                    key = key.lower()
+                if key:
+                    self._signatures.setdefault(key, list()).append((name, pattern))
+        if not self._signatures:
+            raise ValueError("No signature patterns given")
+        # The regex finds the longest pattern starting at a position, so
+        # shorter patterns that are a prefix of it match there as well
+        self._prefixes: Dict[bytes, List[bytes]] = {
+            key: [
+                other
+                for other in self._signatures
+                if other != key and key.startswith(other)
+            ]
+            for key in self._signatures
+        }
+        # Matching in a lookahead finds a pattern at every position, also
+        # where it overlaps with another match
+        self._regex = re.compile(
+            b"(?=(" + _trie_pattern(sorted(self._signatures)) + b"))"
+        )
+
+    def match(self, content: bytes) -> List[Tuple[str, str, int, int]]:
+        """Return (signature, pattern, matches, first offset) of each pattern
+        that occurs in `content`"""
+        if not self.case_sensitive:
+            content = content.lower()
+        counts: Dict[bytes, List[int]] = dict()
+        for match in self._regex.finditer(content):
+            offset = match.start()
+            key = match.group(1)
+            for found in [key] + self._prefixes[key]:
+                if found in counts:
+                    counts[found][0] += 1
+                else:
+                    counts[found] = [1, offset]
+        results = list()
+        for key, (matches, offset) in counts.items():
+            for name, pattern in self._signatures[key]:
+                results.append((name, pattern, matches, offset))
+        return results
+
+
+_matcher: Optional[SignatureMatcher] = None
+
+
+def _init_worker(signatures: Dict[str, List[str]], case_sensitive: bool) -> None:
+    global _matcher
+    _matcher = SignatureMatcher(signatures, case_sensitive)
+
+
+def _scan_batch(batch: List[Tuple[str, bytes]]) -> List[ResultRow]:
+    """Return the result rows of a batch of (content_hash, content)"""
+    assert _matcher is not None
+    rows = list()
+    for content_hash, content in batch:
+        for name, pattern, matches, offset in _matcher.match(content):
+            rows.append((content_hash, name, pattern, matches, offset))
+    return rows
+
+
+def _create_table(con: sqlite3.Connection) -> None:
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS content_signatures ( \
+                    content_hash TEXT NOT NULL, \
+                    signature TEXT NOT NULL, \
+                    pattern TEXT NOT NULL, \
+                    matches INTEGER NOT NULL, \
+                    first_offset INTEGER NOT NULL, \
+                    PRIMARY KEY (content_hash, signature, pattern));"
+    )
+    con.execute(
+        "CREATE INDEX IF NOT EXISTS content_signatures_signature "
+        "ON content_signatures (signature)"
+    )
+    con.commit()
+
+
+def _iter_batches(
+    data_directory: str, hashes: Optional[Set[str]], batch_bytes: int
+) -> Iterable[List[Tuple[str, bytes]]]:
+    batch: List[Tuple[str, bytes]] = list()
+    size = 0
+    for content_hash, content in get_content(data_directory):
+        if isinstance(content_hash, bytes):
+            content_hash = content_hash.decode("ascii")
+        if hashes is not None and content_hash not in hashes:
+            continue
+        batch.append((content_hash, content))
+        size += len(content)
+        if size >= batch_bytes:
+            yield batch
+            batch = list()
+            size = 0
+    if batch:
+        yield batch
+
+
+def _dump(
+    directory: str, batch: List[Tuple[str, bytes]], rows: List[ResultRow]
+) -> None:
+    """Write the bodies that matched a signature to `directory`"""
+    matched = {row[0] for row in rows}
+    for content_hash, content in batch:
+        if content_hash in matched:
+            with open(os.path.join(directory, content_hash), "wb") as f:
+                f.write(content)
+
+
+def scan_content(
+    data_directory: str,
+    database: str,
+    signatures: Optional[Dict[str, List[str]]] = None,
+    workers: Optional[int] = None,
+    hashes: Optional[Iterable[str]] = None,
+    case_sensitive: bool = False,
+    dump_directory: Optional[str] = None,
+    batch_bytes: int = BATCH_BYTES,
+    verbose: bool = False,
+) -> Dict[str, float]:
+    """Match the bodies in the content database of `data_directory` against
+    `signatures` and write the matches to `content_signatures` in `database`.
+
+    Parameters
+    ----------
+    data_directory : string
+        root directory of the crawl files containing the content database
+    database : string
+        sqlite database the results are written to, usually the crawl's
+    signatures : dict, optional
+        signature name to a list of literal patterns, `DEFAULT_SIGNATURES`
+        if not given
+    workers : int, optional
+        number of scanning processes, defaults to the number of CPUs. With 1
+        the bodies are scanned in this process.
+    hashes : iterable of string, optional
+        only scan the bodies with these content hashes
+    case_sensitive : bool
+        whether patterns only match with the same case
+    dump_directory : string, optional
+        directory to write the bodies that matched a signature to
+    batch_bytes : int
+        body bytes handed to a worker at once
+    verbose : bool
+        print the progress every `REPORT_INTERVAL` seconds
+
+    Returns
+    -------
+    dict
+        number of bodies and bytes scanned, bodies matched, rows written,
+        seconds taken and throughput in MB/s
+    """
+    if signatures is None:
+        signatures = DEFAULT_SIGNATURES
+    if workers is None:
+        workers = os.cpu_count() or 1
+    hash_set = set(hashes) if hashes is not None else None
+    if dump_directory is not None:
+        os.makedirs(dump_directory, exist_ok=True)
+    con = sqlite3.connect(database)
+    _create_table(con)
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(signatures, case_sensitive),
+        )
+    else:
+        _init_worker(signatures, case_sensitive)
+
+    stats = {"contents": 0, "bytes": 0, "matched": 0, "rows": 0}
+    start = last_report = time.time()
+    batches = _iter_batches(data_directory, hash_set, batch_bytes)
+    pending: Deque[Tuple[List[Tuple[str, bytes]], Any]] = deque()
+    max_pending = max(1, workers * BATCHES_IN_FLIGHT_PER_WORKER)
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                batch = next(batches, None)
+                if batch is None:
+                    exhausted = True
+                    break
+                if executor is None:
+                    pending.append((batch, _scan_batch(batch)))
+                else:
+                    pending.append((batch, executor.submit(_scan_batch, batch)))
+            if not pending:
+                break
+            batch, result = pending.popleft()
+            rows = result if executor is None else result.result()
+            with con:
+                con.executemany(
+                    "INSERT OR REPLACE INTO content_signatures "
+                    "(content_hash, signature, pattern, matches, first_offset) "
+                    "VALUES (?,?,?,?,?)",
+                    rows,
+                )
+            if dump_directory is not None:
+                _dump(dump_directory, batch, rows)
+            stats["contents"] += len(batch)
+            stats["bytes"] += sum(len(content) for _, content in batch)
+            stats["matched"] += len({row[0] for row in rows})
+            stats["rows"] += len(rows)
+            if verbose and time.time() - last_report >= REPORT_INTERVAL:
+                last_report = time.time()
+                print(
+                    "%d bodies scanned, %.1f MB/s"
+                    % (stats["contents"], _throughput(stats["bytes"], start))
+                )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        con.close()
+    result: Dict[str, float] = dict(stats)
+    result["seconds"] = time.time() - start
+    result["mb_per_s"] = _throughput(stats["bytes"], start)
+    return result
+
+
+def _throughput(size: int, start: float) -> float:
+    elapsed = time.time() - start
+    return size / 2 ** 20 / elapsed if elapsed > 0 else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Match the saved response bodies of a crawl against CMP and "
+        "TCF API signatures."
+    )
+    parser.add_argument("data_directory", help="data directory of the crawl")
+    parser.add_argument(
+        "--database",
+        help="sqlite database to write content_signatures to "
+        "(default: crawl-data.sqlite in the data directory)",
+    )
+    parser.add_argument(
+        "--signatures",
+        help="JSON file mapping signature names to lists of patterns, "
+        "replaces the default signatures",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of scanning processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--hashes", help="file with one content hash per line to restrict the scan"
+    )
+    parser.add_argument(
+        "--case-sensitive",
+        action="store_true",
+        help="only match patterns with the same case",
+    )
+    parser.add_argument(
+        "--dump-directory", help="write the bodies that matched to this directory"
+    )
+    args = parser.parse_args()
+
+    data_directory = os.path.expanduser(args.data_directory)
+    database = args.database or os.path.join(data_directory, "crawl-data.sqlite")
+    signatures = None
+    if args.signatures:
+        with open(args.signatures, "r") as f:
+            signatures = json.load(f)
+    hashes = None
+    if args.hashes:
+        with open(args.hashes, "r") as f:
+            hashes = [line.strip() for line in f if line.strip()]
+    stats = scan_content(
+        data_directory,
+        database,
+        signatures=signatures,
+        workers=args.workers,
+        hashes=hashes,
+        case_sensitive=args.case_sensitive,
+        dump_directory=args.dump_directory,
+        verbose=True,
+    )
+    print(
+        "Scanned %d bodies (%.1f MB) in %.1f s, %.1f MB/s. %d bodies matched, "
+        "%d rows written to content_signatures."
+        % (
+            stats["contents"],
+            stats["bytes"] / 2 ** 20,
+            stats["seconds"],
+            stats["mb_per_s"],
+            stats["matched"],
+            stats["rows"],
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Parser for the `Cookie` and `Set-Cookie` HTTP headers.
+
+Headers are parsed the way browsers do (RFC 6265bis, section 5.4) rather
+than the strict grammar of the old `Cookie` module: the name-value pair is
+everything up to the first `;`, a pair without `=` is a nameless cookie,
+unknown attributes are ignored and the last occurrence of an attribute wins.
+Firefox joins the `Set-Cookie` headers of a response with newlines, so each
+line of a header value is a separate cookie.
+
+`parse_set_cookie_headers` and `parse_cookie_headers` parse a list of header
+values at once. Crawls repeat the same header values many times (trackers
+set the same cookie on every page), so identical values are only parsed
+once per batch.
+"""
+import re
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# Matches one `key[=value]` attribute and the `;` that ends it
+_ATTRIBUTE = re.compile(r"\s*([^;=]*?)\s*(?:=\s*([^;]*?)\s*)?(?:;|$)")
+_LINES = re.compile(r"[\r\n]+")
+_MAX_AGE = re.compile(r"-?[0-9]+$")
+
+SAME_SITE_VALUES = {"strict": "Strict", "lax": "Lax", "none": "None"}
+PRIORITY_VALUES = {"low": "Low", "medium": "Medium", "high": "High"}
+
+
+class SetCookie(NamedTuple):
+    """A cookie set by a `Set-Cookie` header.
+
+    Attributes that weren't given are None, or False for flags. `expires`
+    is the date string as sent, `samesite` and `priority` are normalized
+    to their canonical capitalization."""
+
+    name: str
+    value: str
+    domain: Optional[str] = None
+    path: Optional[str] = None
+    expires: Optional[str] = None
+    max_age: Optional[int] = None
+    secure: bool = False
+    httponly: bool = False
+    samesite: Optional[str] = None
+    partitioned: bool = False
+    priority: Optional[str] = None
+    comment: Optional[str] = None
+    version: Optional[str] = None
+
+
+def _split_pair(pair: str) -> Tuple[str, str]:
+    name, eq, value = pair.partition("=")
+    if not eq:
+        # A pair without `=` sets a cookie with an empty name
+        return "", name.strip()
+    return name.strip(), value.strip()
+
+
+def parse_set_cookie(line: str) -> Optional[SetCookie]:
+    """Parse a single `Set-Cookie` line, returns None if it sets no cookie"""
+    pair, _, attributes = line.partition(";")
+    name, value = _split_pair(pair)
+    if not name and not value:
+        return None
+    values: Dict[str, object] = dict()
+    for key, attr_value in _ATTRIBUTE.findall(attributes):
+        if not key:
+            continue
+        key = key.lower()
+        if key == "secure":
+            values["secure"] = True
+        elif key == "httponly":
+            values["httponly"] = True
+        elif key == "partitioned":
+            values["partitioned"] = True
+        elif key in ("domain", "path", "expires", "comment", "version"):
+            values[key] = attr_value
+        elif key == "max-age":
+            if _MAX_AGE.match(attr_value):
+                values["max_age"] = int(attr_value)
+        elif key == "samesite":
+            values["samesite"] = SAME_SITE_VALUES.get(attr_value.lower())
+        elif key == "priority":
+            values["priority"] = PRIORITY_VALUES.get(attr_value.lower())
+    return SetCookie(name, value, **values)  # type: ignore
+
+
+def parse_set_cookie_header(header: str) -> List[SetCookie]:
+    """Parse the value of a `Set-Cookie` header, which may hold several
+    cookies separated by newlines"""
+    cookies = list()
+    for line in _LINES.split(header):
+        cookie = parse_set_cookie(line)
+        if cookie is not None:
+            cookies.append(cookie)
+    return cookies
+
+
+def parse_cookie_header(header: str) -> List[Tuple[str, str]]:
+    """Parse the value of a `Cookie` request header into (name, value) pairs"""
+    pairs = list()
+    for pair in header.split(";"):
+        name, value = _split_pair(pair)
+        if name or value:
+            pairs.append((name, value))
+    return pairs
+
+
+def parse_set_cookie_headers(headers: Iterable[str]) -> List[List[SetCookie]]:
+    """Parse a batch of `Set-Cookie` header values.
+
+    Returns the cookies of each header, in the order of `headers`. The
+    returned lists are shared between identical header values."""
+    parsed: Dict[str, List[SetCookie]] = dict()
+    results = list()
+    for header in headers:
+        cookies = parsed.get(header)
+        if cookies is None:
+            cookies = parsed[header] = parse_set_cookie_header(header)
+        results.append(cookies)
+    return results
+
+
+def parse_cookie_headers(headers: Iterable[str]) -> List[List[Tuple[str, str]]]:
+    """Parse a batch of `Cookie` header values, see `parse_set_cookie_headers`"""
+    parsed: Dict[str, List[Tuple[str, str]]] = dict()
+    results = list()
+    for header in headers:
+        pairs = parsed.get(header)
+        if pairs is None:
+            pairs = parsed[header] = parse_cookie_header(header)
+        results.append(pairs)
+    return results
@@ -1,9 +1,26 @@
+import logging
 import os
 import sqlite3
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
 
+import numpy as np
 import plyvel
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from openwpm.DataAggregator.content_store import CONTENT_STORE_NAME, ContentStore
 
 CONTENT_DB_NAME = "content.ldb"
+CHUNK_SIZE = 10000  # rows per chunk of the streaming queries
+# Chunks can be lists of tuples or dicts, Arrow record batches or NumPy
+# structured arrays
+OUTPUT_FORMATS = ("tuples", "dicts", "arrow", "numpy")
+# Longer `IN (...)` predicates are matched against a temporary table, as
+# SQLite limits the number of query parameters
+MAX_IN_PARAMS = 500
+JAVASCRIPT_COLUMNS = ["script_url", "symbol", "operation", "value", "arguments"]
+
+logger = logging.getLogger("openwpm")
 
 
 def query_db(db, query, params=None, as_tuple=False):
@@ -23,33 +40,355 @@ def query_db(db, query, params=None, as_tuple=False):
 
 
 def get_content(data_directory):
-    """Yield key, value pairs from the deduplicated leveldb content database
+    """Yield key, value pairs from the deduplicated content database
+
+    Reads the packfile content store if the crawl used it and the leveldb
+    content database otherwise.
 
     Parameters
     ----------
     data_directory : string
         root directory of the crawl files containing the content database
     """
-    db_path = os.path.join(data_directory, CONTENT_DB_NAME)
-    db = plyvel.DB(db_path, create_if_missing=False, compression="snappy")
+    store_path = os.path.join(data_directory, CONTENT_STORE_NAME)
+    if os.path.isdir(store_path):
+        db = ContentStore(store_path)
+    else:
+        db_path = os.path.join(data_directory, CONTENT_DB_NAME)
+        db = plyvel.DB(db_path, create_if_missing=False, compression="snappy")
     for content_hash, content in db.iterator():
         yield content_hash, content
     db.close()
 
 
+def _declared_type(declared: str) -> pa.DataType:
+    """Return the Arrow type of a column of the declared SQLite type.
+
+    Follows SQLite's type affinity rules. Columns whose values can't be
+    typed from the declaration, e.g. DATETIME or no type, are strings."""
+    declared = declared.upper()
+    if "INT" in declared or "BOOL" in declared:
+        return pa.int64()
+    if "REAL" in declared or "FLOA" in declared or "DOUB" in declared:
+        return pa.float64()
+    if "BLOB" in declared:
+        return pa.binary()
+    return pa.string()
+
+
+def _infer_schema(rows: List[Sequence[Any]], columns: List[str]) -> pa.Schema:
+    """Infer a schema from the first chunk of a query without declared
+    column types. Columns that are all NULL or hold several types are
+    strings."""
+    fields = list()
+    for name, values in zip(columns, zip(*rows) if rows else [()] * len(columns)):
+        try:
+            data_type = pa.array(values).type
+        except (pa.lib.ArrowInvalid, pa.lib.ArrowTypeError, OverflowError):
+            data_type = pa.string()
+        if pa.types.is_null(data_type):
+            data_type = pa.string()
+        fields.append(pa.field(name, data_type))
+    return pa.schema(fields)
+
+
+def _coerce(value: Any, data_type: pa.DataType) -> Any:
+    if value is None:
+        return None
+    if pa.types.is_string(data_type):
+        if isinstance(value, bytes):
+            return value.decode("utf-8", "replace")
+        return str(value)
+    if pa.types.is_binary(data_type):
+        return value if isinstance(value, bytes) else str(value).encode("utf-8")
+    try:
+        return int(value) if pa.types.is_integer(data_type) else float(value)
+    except (TypeError, ValueError, OverflowError):
+        logger.warning("Dropping value %r that isn't a %s", value, data_type)
+        return None
+
+
+def _to_array(values: Sequence[Any], data_type: pa.DataType) -> pa.Array:
+    try:
+        return pa.array(values, type=data_type)
+    except (pa.lib.ArrowInvalid, pa.lib.ArrowTypeError, OverflowError):
+        # SQLite columns can hold values of any type
+        return pa.array([_coerce(v, data_type) for v in values], type=data_type)
+
+
+def _rows_to_batch(rows: List[Sequence[Any]], schema: pa.Schema) -> pa.RecordBatch:
+    """Convert `rows` to a record batch of `schema`, so all chunks of a
+    query have the same schema"""
+    columns = zip(*rows) if rows else [()] * len(schema)
+    arrays = [_to_array(values, field.type) for values, field in zip(columns, schema)]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _batch_to_numpy(batch: pa.RecordBatch) -> np.ndarray:
+    arrays = [column.to_numpy(zero_copy_only=False) for column in batch.columns]
+    out = np.empty(
+        batch.num_rows,
+        dtype=[(name, array.dtype) for name, array in zip(batch.schema.names, arrays)],
+    )
+    for name, array in zip(batch.schema.names, arrays):
+        out[name] = array
+    return out
+
+
+def _convert_rows(
+    rows: List[Sequence[Any]],
+    columns: List[str],
+    output: str,
+    schema: Optional[pa.Schema] = None,
+) -> Any:
+    if output == "tuples":
+        return rows
+    if output == "dicts":
+        return [dict(zip(columns, row)) for row in rows]
+    if schema is None:
+        schema = _infer_schema(rows, columns)
+    batch = _rows_to_batch(rows, schema)
+    return batch if output == "arrow" else _batch_to_numpy(batch)
+
+
+def _convert_batch(batch: pa.RecordBatch, output: str) -> Any:
+    if output == "arrow":
+        return batch
+    if output == "numpy":
+        return _batch_to_numpy(batch)
+    rows = list(zip(*[column.to_pylist() for column in batch.columns]))
+    return _convert_rows(rows, batch.schema.names, output)
+
+
+def _check_output(output: str) -> None:
+    if output not in OUTPUT_FORMATS:
+        raise ValueError(
+            "Unsupported output %s, expected one of %s"
+            % (output, ", ".join(OUTPUT_FORMATS))
+        )
+
+
+def _iter_cursor(
+    cur: sqlite3.Cursor,
+    chunk_size: int,
+    output: str,
+    schema: Optional[pa.Schema] = None,
+) -> Iterator[Any]:
+    """Yield the results of `cur` in chunks. Arrow and NumPy chunks have
+    `schema` or, by default, the schema inferred from the first chunk."""
+    columns = [description[0] for description in cur.description]
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            return
+        if schema is None and output in ("arrow", "numpy"):
+            schema = _infer_schema(rows, columns)
+        yield _convert_rows(rows, columns, output, schema)
+
+
+def iter_query(db, query, params=None, chunk_size=CHUNK_SIZE, output="tuples"):
+    """Run a query against the given db and yield its results in chunks.
+
+    Chunks hold `chunk_size` rows (the last one may hold fewer), in the
+    format given by `output`, see `OUTPUT_FORMATS`.
+    """
+    _check_output(output)
+    con = sqlite3.connect(db)
+    try:
+        cur = con.execute(query, () if params is None else params)
+        yield from _iter_cursor(cur, chunk_size, output)
+    finally:
+        con.close()
+
+
+def _is_list(value: Any) -> bool:
+    return isinstance(value, (list, tuple, set, frozenset, np.ndarray))
+
+
+def _stream_sqlite(
+    db: str,
+    table: str,
+    columns: Optional[List[str]],
+    where: Dict[str, Any],
+    chunk_size: int,
+    output: str,
+) -> Iterator[Any]:
+    con = sqlite3.connect(db)
+    try:
+        # Names can't be passed as parameters, so they are checked instead
+        declared = {
+            row[1]: row[2] for row in con.execute("PRAGMA table_info(%s)" % table)
+        }
+        known = set(declared)
+        if not known:
+            raise ValueError("Unknown table: %s" % table)
+        for column in list(columns or []) + list(where):
+            if column not in known:
+                raise ValueError("Unknown column %s of table %s" % (column, table))
+        clauses = list()
+        params: List[Any] = list()
+        for column, value in where.items():
+            if value is None:
+                clauses.append("%s IS NULL" % column)
+            elif not _is_list(value):
+                clauses.append("%s = ?" % column)
+                params.append(value)
+            elif len(value) <= MAX_IN_PARAMS:
+                clauses.append("%s IN (%s)" % (column, ", ".join("?" * len(value))))
+                params.extend(value)
+            else:
+                temp_table = "temp.in_%s" % column
+                con.execute("CREATE TABLE %s (value PRIMARY KEY)" % temp_table)
+                con.executemany(
+                    "INSERT OR IGNORE INTO %s VALUES (?)" % temp_table,
+                    ((v,) for v in value),
+                )
+                clauses.append("%s IN (SELECT value FROM %s)" % (column, temp_table))
+        query = "SELECT %s FROM %s" % (", ".join(columns) if columns else "*", table)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        schema = pa.schema(
+            [(name, _declared_type(declared[name])) for name in columns or declared]
+        )
+        yield from _iter_cursor(con.execute(query, params), chunk_size, output, schema)
+    finally:
+        con.close()
+
+
+def _rechunk(
+    batches: Iterable[pa.RecordBatch], chunk_size: int
+) -> Iterator[pa.RecordBatch]:
+    """Combine and split `batches` into batches of `chunk_size` rows"""
+    pending: List[pa.RecordBatch] = list()
+    rows = 0
+    for batch in batches:
+        if batch.num_rows == 0:
+            continue
+        pending.append(batch)
+        rows += batch.num_rows
+        while rows >= chunk_size:
+            table = pa.Table.from_batches(pending)
+            yield table.slice(0, chunk_size).combine_chunks().to_batches()[0]
+            rest = table.slice(chunk_size)
+            pending = rest.to_batches()
+            rows = rest.num_rows
+    if rows:
+        yield pa.Table.from_batches(pending).combine_chunks().to_batches()[0]
+
+
+def _stream_parquet(
+    location: str,
+    table: str,
+    columns: Optional[List[str]],
+    where: Dict[str, Any],
+    chunk_size: int,
+    output: str,
+    filesystem: Any,
+) -> Iterator[Any]:
+    dataset = ds.dataset(
+        "%s/visits/%s" % (location.rstrip("/"), table),
+        format="parquet",
+        partitioning="hive",
+        filesystem=filesystem,
+    )
+    expression = None
+    for column, value in where.items():
+        if value is None:
+            raise ValueError("NULL predicates are only supported for SQLite")
+        if _is_list(value):
+            condition = ds.field(column).isin(list(value))
+        else:
+            condition = ds.field(column) == value
+        expression = condition if expression is None else expression & condition
+    batches = dataset.to_batches(
+        columns=columns, filter=expression, batch_size=chunk_size
+    )
+    for batch in _rechunk(batches, chunk_size):
+        yield _convert_batch(batch, output)
+
+
+def is_parquet_dataset(db: str) -> bool:
+    """Return True if `db` is the parquet output of a crawl rather than a
+    SQLite database, i.e. a local directory or an S3 URI that holds the
+    `visits` dataset"""
+    return db.startswith("s3://") or os.path.isdir(db)
+
+
+def stream_table(
+    db: str,
+    table: str,
+    columns: Optional[List[str]] = None,
+    where: Optional[Dict[str, Any]] = None,
+    chunk_size: int = CHUNK_SIZE,
+    output: str = "tuples",
+    filesystem: Any = None,
+) -> Iterator[Any]:
+    """Yield the rows of `table` in chunks of `chunk_size` rows
+
+    Parameters
+    ----------
+    db : string
+        path of a SQLite crawl database, or the directory of a parquet crawl
+        (e.g. `<data_directory>/parquet` or `s3://<bucket>/<s3_directory>`)
+    table : string
+        table to read
+    columns : list of string, optional
+        columns to read, all by default
+    where : dict, optional
+        maps column names to a value they must equal, or to a list of values
+        one of which they must equal, e.g. `{"visit_id": [1, 2, 3]}`. The
+        predicates are evaluated by SQLite or while scanning the parquet
+        files, so non-matching rows are never loaded.
+    chunk_size : int
+        rows per chunk, the last chunk may hold fewer
+    output : string
+        format of the chunks, one of `OUTPUT_FORMATS`: lists of `tuples` or
+        `dicts`, `arrow` record batches or `numpy` structured arrays
+    filesystem : pyarrow.fs.FileSystem, optional
+        filesystem of a parquet crawl, inferred from `db` by default
+    """
+    _check_output(output)
+    where = dict() if where is None else where
+    if is_parquet_dataset(db):
+        return _stream_parquet(
+            db, table, columns, where, chunk_size, output, filesystem
+        )
+    return _stream_sqlite(db, table, columns, where, chunk_size, output)
+
+
 def get_javascript_entries(db, all_columns=False, as_tuple=False):
     if all_columns:
         select_columns = "*"
     else:
-        select_columns = "script_url, symbol, operation, value, arguments"
+        select_columns = ", ".join(JAVASCRIPT_COLUMNS)
 
     return query_db(db, "SELECT %s FROM javascript" % select_columns, as_tuple=as_tuple)
 
 
+def iter_javascript_entries(
+    db, all_columns=False, visit_ids=None, chunk_size=CHUNK_SIZE, output="tuples"
+):
+    """Streaming variant of `get_javascript_entries`, optionally limited to
+    the records of `visit_ids`. See `stream_table`."""
+    return stream_table(
+        db,
+        "javascript",
+        columns=None if all_columns else JAVASCRIPT_COLUMNS,
+        where=None if visit_ids is None else {"visit_id": visit_ids},
+        chunk_size=chunk_size,
+        output=output,
+    )
+
+
 def any_command_failed(db):
     """Returns True if any command in a given database failed"""
-    rows = query_db(db, "SELECT * FROM crawl_history;")
-    for row in rows:
-        if row["command_status"] != "ok":
-            return True
-    return False
+    if is_parquet_dataset(db):
+        for chunk in stream_table(db, "crawl_history", columns=["command_status"]):
+            if any(status != "ok" for (status,) in chunk):
+                return True
+        return False
+    rows = query_db(
+        db,
+        "SELECT 1 FROM crawl_history WHERE command_status IS NOT 'ok' LIMIT 1",
+    )
+    return len(rows) > 0
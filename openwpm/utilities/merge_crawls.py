@@ -0,0 +1,544 @@
+"""Merge the databases of crawls that were split over several machines.
+
+Every crawl counts `visit_id`, `browser_id`, `task_id` and the `id` of its
+tables from 1, so the ids of the sources are shifted by per-source offsets
+when they are copied into the merged database. The offsets are chosen when
+a source is first merged, reserving the whole id range of the source in
+`merge_reserved_ids` even if it is only copied partially, and recorded in
+the `merge_sources` and `merge_id_offsets` provenance tables, e.g. to find
+the source of a visit:
+
+    SELECT path FROM merge_sources
+    WHERE visit_id_offset < ? ORDER BY visit_id_offset DESC LIMIT 1
+
+Tables are copied with `INSERT ... SELECT` from the attached source
+database in chunks of consecutive rowids, so memory use doesn't depend on
+the size of the inputs. The last rowid copied from each table is committed
+together with its chunk, and the last content hash together with each batch
+of content, so an interrupted merge continues where it stopped when it is
+run again. Content is only copied if its hash isn't stored yet.
+
+    python -m openwpm.utilities.merge_crawls merged/ vm1/ vm2/crawl-data.sqlite
+"""
+import argparse
+import glob
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import plyvel
+
+from openwpm.DataAggregator.content_index import ContentHashIndex
+from openwpm.DataAggregator.content_store import CONTENT_STORE_NAME, ContentStore
+from openwpm.DataAggregator.LocalAggregator import SHARD_DB_SUFFIX, create_tables
+
+from .db_utils import CONTENT_DB_NAME
+
+DATABASE_NAME = "crawl-data.sqlite"
+CHUNK_ROWS = 50000  # source rowids copied per transaction
+CONTENT_BATCH_BYTES = 64 * 2 ** 20  # content buffered before a write
+CACHE_SIZE_KB = 256 * 1024  # SQLite page cache of the merged database
+# Id columns that are shifted by the offset of the source
+ID_COLUMNS = ("visit_id", "browser_id", "task_id")
+# Columns that refer to the `id` of another table
+REFERENCES = {
+    ("http_request_cookies", "header_id"): "http_requests",
+    ("http_response_cookies", "header_id"): "http_responses",
+}
+# Bookkeeping tables of other tools that are only valid for their own
+# database, they are rebuilt on the merged database if needed
+SKIPPED_TABLES = ("http_cookie_progress",)
+PROVENANCE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS merge_sources (
+    source_id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    visit_id_offset INTEGER NOT NULL,
+    browser_id_offset INTEGER NOT NULL,
+    task_id_offset INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    start_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+    finish_time DATETIME);
+CREATE TABLE IF NOT EXISTS merge_id_offsets (
+    source_id INTEGER NOT NULL,
+    table_name TEXT NOT NULL,
+    id_offset INTEGER NOT NULL,
+    PRIMARY KEY(source_id, table_name));
+CREATE TABLE IF NOT EXISTS merge_progress (
+    source_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    last_rowid INTEGER,
+    last_key TEXT,
+    PRIMARY KEY(source_id, name));
+CREATE TABLE IF NOT EXISTS merge_reserved_ids (
+    name TEXT PRIMARY KEY,
+    next_offset INTEGER NOT NULL);
+"""
+MERGE_TABLES = (
+    "merge_sources",
+    "merge_id_offsets",
+    "merge_progress",
+    "merge_reserved_ids",
+)
+
+logger = logging.getLogger("openwpm")
+
+
+def _database_path(path: str) -> str:
+    path = os.path.expanduser(path)
+    if os.path.isdir(path):
+        path = os.path.join(path, DATABASE_NAME)
+    if not os.path.isfile(path):
+        raise FileNotFoundError("No crawl database found at %s" % path)
+    return os.path.realpath(path)
+
+
+def _max(con: sqlite3.Connection, table: str, column: str, schema="main") -> int:
+    (value,) = con.execute(
+        "SELECT MAX(%s) FROM %s.%s" % (column, schema, table)
+    ).fetchone()
+    return value or 0
+
+
+def _tables(con: sqlite3.Connection, schema: str) -> List[Tuple[str, str]]:
+    return [
+        (name, sql)
+        for name, sql in con.execute(
+            "SELECT name, sql FROM %s.sqlite_master WHERE type = 'table' "
+            "ORDER BY rowid" % schema
+        )
+        if not name.startswith("sqlite_")
+        and name not in SKIPPED_TABLES
+        and name not in MERGE_TABLES
+    ]
+
+
+def _columns(con: sqlite3.Connection, table: str, schema: str) -> List[Tuple]:
+    """Return (name, type, is_primary_key) of the columns of `table`"""
+    return [
+        (name, column_type, bool(pk))
+        for _, name, column_type, _, _, pk in con.execute(
+            "PRAGMA %s.table_info(%s)" % (schema, table)
+        )
+    ]
+
+
+def _has_id_key(con: sqlite3.Connection, table: str, schema: str) -> bool:
+    """True if `id` is the INTEGER PRIMARY KEY of `table`"""
+    return any(
+        name == "id" and pk and column_type.upper() == "INTEGER"
+        for name, column_type, pk in _columns(con, table, schema)
+    )
+
+
+def _reserve(
+    con: sqlite3.Connection, name: str, merged_max: int, source_max: int
+) -> int:
+    """Reserve `source_max` ids of `name` for a source and return its offset.
+
+    The offset is past both the largest id merged so far and the ranges
+    reserved for the sources before, which may not be copied completely."""
+    row = con.execute(
+        "SELECT next_offset FROM merge_reserved_ids WHERE name = ?", (name,)
+    ).fetchone()
+    offset = max(merged_max, row[0] if row is not None else 0)
+    con.execute(
+        "INSERT OR REPLACE INTO merge_reserved_ids VALUES (?,?)",
+        (name, offset + source_max),
+    )
+    return offset
+
+
+def _register_source(con: sqlite3.Connection, path: str) -> int:
+    """Return the id of source `path`, choosing its offsets if it is new.
+
+    The largest ids merged so far are all in indexed primary key columns."""
+    row = con.execute(
+        "SELECT source_id FROM merge_sources WHERE path = ?", (path,)
+    ).fetchone()
+    if row is not None:
+        return row[0]
+    con.execute("BEGIN")
+    cur = con.execute(
+        "INSERT INTO merge_sources (path, visit_id_offset, browser_id_offset, "
+        "task_id_offset, status) VALUES (?,?,?,?,?)",
+        (
+            path,
+            _reserve(
+                con,
+                "visit_id",
+                _max(con, "site_visits", "visit_id"),
+                _max(con, "site_visits", "visit_id", "source"),
+            ),
+            _reserve(
+                con,
+                "browser_id",
+                _max(con, "crawl", "browser_id"),
+                _max(con, "crawl", "browser_id", "source"),
+            ),
+            _reserve(
+                con,
+                "task_id",
+                _max(con, "task", "task_id"),
+                _max(con, "task", "task_id", "source"),
+            ),
+            "pending",
+        ),
+    )
+    source_id = cur.lastrowid
+    existing = {name for name, _ in _tables(con, "main")}
+    for table, _ in _tables(con, "source"):
+        if not _has_id_key(con, table, "source"):
+            continue
+        offset = _reserve(
+            con,
+            "%s.id" % table,
+            _max(con, table, "id") if table in existing else 0,
+            _max(con, table, "id", "source"),
+        )
+        con.execute(
+            "INSERT INTO merge_id_offsets VALUES (?,?,?)", (source_id, table, offset)
+        )
+    con.execute("COMMIT")
+    return source_id
+
+
+def _offsets(con: sqlite3.Connection, source_id: int) -> Dict[str, Any]:
+    visit, browser, task = con.execute(
+        "SELECT visit_id_offset, browser_id_offset, task_id_offset "
+        "FROM merge_sources WHERE source_id = ?",
+        (source_id,),
+    ).fetchone()
+    offsets: Dict[str, Any] = {"visit_id": visit, "browser_id": browser}
+    offsets["task_id"] = task
+    offsets["id"] = dict(
+        con.execute(
+            "SELECT table_name, id_offset FROM merge_id_offsets WHERE source_id = ?",
+            (source_id,),
+        ).fetchall()
+    )
+    return offsets
+
+
+def _select_expressions(
+    con: sqlite3.Connection, table: str, offsets: Dict[str, Any]
+) -> Tuple[List[str], List[str]]:
+    """Return the columns of source `table` and the expressions that select
+    them with their ids shifted"""
+    columns = list()
+    expressions = list()
+    for name, _, pk in _columns(con, table, "source"):
+        offset = 0
+        if name in ID_COLUMNS:
+            offset = offsets[name]
+        elif name == "id" and pk:
+            offset = offsets["id"].get(table, 0)
+        elif (table, name) in REFERENCES:
+            offset = offsets["id"].get(REFERENCES[(table, name)], 0)
+        columns.append(name)
+        expressions.append("%s + %d" % (name, offset) if offset else name)
+    return columns, expressions
+
+
+def _prepare_table(con: sqlite3.Connection, table: str, sql: str) -> None:
+    """Create `table` in the merged database, or add the columns it lacks"""
+    con.execute(sql.replace("CREATE TABLE ", "CREATE TABLE IF NOT EXISTS ", 1))
+    existing = {name for name, _, _ in _columns(con, table, "main")}
+    for name, column_type, _ in _columns(con, table, "source"):
+        if name not in existing:
+            con.execute(
+                "ALTER TABLE main.%s ADD COLUMN %s %s" % (table, name, column_type)
+            )
+
+
+def _get_progress(
+    con: sqlite3.Connection, source_id: int, name: str
+) -> Tuple[Optional[int], Optional[str]]:
+    row = con.execute(
+        "SELECT last_rowid, last_key FROM merge_progress "
+        "WHERE source_id = ? AND name = ?",
+        (source_id, name),
+    ).fetchone()
+    return (row[0], row[1]) if row is not None else (None, None)
+
+
+def _set_progress(
+    con: sqlite3.Connection,
+    source_id: int,
+    name: str,
+    last_rowid: Optional[int] = None,
+    last_key: Optional[str] = None,
+) -> None:
+    con.execute(
+        "INSERT OR REPLACE INTO merge_progress VALUES (?,?,?,?)",
+        (source_id, name, last_rowid, last_key),
+    )
+
+
+def _copy_table(
+    con: sqlite3.Connection,
+    source_id: int,
+    table: str,
+    offsets: Dict[str, Any],
+    chunk_rows: int,
+) -> int:
+    """Copy the rows of source `table` that weren't copied yet. Returns the
+    number of rows copied.
+
+    Raises an `sqlite3.IntegrityError` if a shifted id is already taken,
+    rather than dropping the row."""
+    columns, expressions = _select_expressions(con, table, offsets)
+    statement = "INSERT INTO main.%s (%s) SELECT %s FROM source.%s " % (
+        table,
+        ", ".join(columns),
+        ", ".join(expressions),
+        table,
+    )
+    statement += "WHERE rowid > ? AND rowid <= ?"
+    last_rowid, _ = _get_progress(con, source_id, table)
+    last_rowid = last_rowid or 0
+    max_rowid = _max(con, table, "rowid", "source")
+    copied = 0
+    while last_rowid < max_rowid:
+        end = last_rowid + chunk_rows
+        con.execute("BEGIN")
+        try:
+            copied += con.execute(statement, (last_rowid, end)).rowcount
+        except sqlite3.IntegrityError:
+            con.execute("ROLLBACK")
+            logger.error(
+                "Rows %d to %d of %s collide with merged rows", last_rowid, end, table
+            )
+            raise
+        _set_progress(con, source_id, table, last_rowid=min(end, max_rowid))
+        con.execute("COMMIT")
+        last_rowid = end
+    return copied
+
+
+def _content_path(database: str) -> Optional[str]:
+    directory = os.path.dirname(database)
+    for name in (CONTENT_STORE_NAME, CONTENT_DB_NAME):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path):
+            return path
+    return None
+
+
+def _open_content(path: str, create_if_missing: bool = False) -> Any:
+    """Open a content store directory or a LevelDB content database"""
+    if os.path.basename(path) == CONTENT_STORE_NAME:
+        return ContentStore(path, create_if_missing=create_if_missing)
+    return plyvel.DB(path, create_if_missing=create_if_missing, compression="snappy")
+
+
+def _iter_keys(content: Any, after: Optional[str]) -> Iterator[str]:
+    """Yield the keys of `content` in order, starting after `after`"""
+    with content.iterator(include_value=False) as it:
+        for key in it:
+            key = key.decode("ascii")
+            if after is None or key > after:
+                yield key
+
+
+def _copy_content(
+    con: sqlite3.Connection,
+    source_id: int,
+    source: Any,
+    target: Any,
+    index: ContentHashIndex,
+    batch_bytes: int,
+) -> int:
+    """Copy the content of `source` whose hash isn't in `target`. Returns
+    the number of blobs copied."""
+
+    def exists(key: str) -> bool:
+        return target.get(key.encode("ascii")) is not None
+
+    _, last_key = _get_progress(con, source_id, "content")
+    batch = target.write_batch()
+    pending = 0
+    copied = 0
+    key = None
+    for key in _iter_keys(source, last_key):
+        if index.lookup(key, exists):
+            continue
+        value = source.get(key.encode("ascii"))
+        if value is None:
+            continue
+        batch.put(key.encode("ascii"), value)
+        index.add(key)
+        pending += len(value)
+        copied += 1
+        if pending >= batch_bytes:
+            batch.write()
+            batch = target.write_batch()
+            pending = 0
+            # The content is written before it is marked as copied
+            _set_progress(con, source_id, "content", last_key=key)
+    batch.write()
+    if key is not None:
+        _set_progress(con, source_id, "content", last_key=key)
+    return copied
+
+
+def merge_crawls(
+    output: str,
+    sources: List[str],
+    content_backend: str = "leveldb",
+    chunk_rows: int = CHUNK_ROWS,
+    batch_bytes: int = CONTENT_BATCH_BYTES,
+    verbose: bool = False,
+) -> Dict[str, Dict[str, int]]:
+    """Merge the crawl databases and content of `sources` into `output`.
+
+    Parameters
+    ----------
+    output : str
+        directory of the merged crawl, created if it doesn't exist
+    sources : list of str
+        crawl data directories or the paths of their crawl databases. The
+        content database of a source is read from the same directory.
+    content_backend : str
+        `leveldb` to merge content into a `content.ldb` database, or
+        `packfile` for a content store (see `content_store`)
+    chunk_rows : int
+        number of source rowids that are copied per transaction
+    batch_bytes : int
+        size of the content that is buffered before it is written
+    verbose : bool
+        log the progress of every table
+
+    Returns
+    -------
+    dict
+        the number of rows copied per table and `content` blobs, by source
+    """
+    output = os.path.expanduser(output)
+    os.makedirs(output, exist_ok=True)
+    database = os.path.join(output, DATABASE_NAME)
+    paths = [_database_path(source) for source in sources]
+    if os.path.realpath(database) in paths:
+        raise ValueError("The merged database can't also be a source")
+    con = sqlite3.connect(database, isolation_level=None)
+    con.execute("PRAGMA journal_mode = WAL")
+    con.execute("PRAGMA synchronous = NORMAL")
+    con.execute("PRAGMA cache_size = -%d" % CACHE_SIZE_KB)
+    create_tables(con)
+    con.executescript(PROVENANCE_SCHEMA)
+
+    if content_backend == "packfile":
+        content_path = os.path.join(output, CONTENT_STORE_NAME)
+    elif content_backend == "leveldb":
+        content_path = os.path.join(output, CONTENT_DB_NAME)
+    else:
+        raise ValueError("Unsupported content_backend: %s" % content_backend)
+    target = None
+    index = ContentHashIndex()
+
+    results = dict()
+    for path in paths:
+        if glob.glob(path + SHARD_DB_SUFFIX % "*"):
+            logger.warning(
+                "%s has unmerged shard databases, open it with OpenWPM once "
+                "to merge them first",
+                path,
+            )
+        con.execute("ATTACH DATABASE ? AS source", (path,))
+        source_id = _register_source(con, path)
+        (status,) = con.execute(
+            "SELECT status FROM merge_sources WHERE source_id = ?", (source_id,)
+        ).fetchone()
+        counts: Dict[str, int] = dict()
+        if status == "done":
+            logger.info("Skipping %s, it was already merged", path)
+            con.execute("DETACH DATABASE source")
+            results[path] = counts
+            continue
+        start = time.time()
+        offsets = _offsets(con, source_id)
+        for table, sql in _tables(con, "source"):
+            _prepare_table(con, table, sql)
+            counts[table] = _copy_table(con, source_id, table, offsets, chunk_rows)
+            if verbose:
+                logger.info("Copied %d rows of %s from %s", counts[table], table, path)
+        con.execute("DETACH DATABASE source")
+
+        source_content = _content_path(path)
+        if source_content is not None:
+            if target is None:
+                target = _open_content(content_path, create_if_missing=True)
+                with target.iterator(include_value=False) as it:
+                    index.warm(key.decode("ascii") for key in it)
+            content = _open_content(source_content)
+            try:
+                counts["content"] = _copy_content(
+                    con, source_id, content, target, index, batch_bytes
+                )
+            finally:
+                content.close()
+        con.execute(
+            "UPDATE merge_sources SET status = 'done', "
+            "finish_time = CURRENT_TIMESTAMP WHERE source_id = ?",
+            (source_id,),
+        )
+        logger.info(
+            "Merged %s in %.1f s: %d rows, %d blobs",
+            path,
+            time.time() - start,
+            sum(n for table, n in counts.items() if table != "content"),
+            counts.get("content", 0),
+        )
+        results[path] = counts
+    if target is not None:
+        target.close()
+    con.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge the databases and content of several crawls."
+    )
+    parser.add_argument("output", help="directory of the merged crawl")
+    parser.add_argument(
+        "sources",
+        nargs="+",
+        help="crawl data directories or crawl-data.sqlite files to merge",
+    )
+    parser.add_argument(
+        "--content-backend",
+        choices=("leveldb", "packfile"),
+        default="leveldb",
+        help="format of the merged content database",
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        type=int,
+        default=CHUNK_ROWS,
+        help="rows copied per transaction",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    results = merge_crawls(
+        args.output,
+        args.sources,
+        content_backend=args.content_backend,
+        chunk_rows=args.chunk_rows,
+        verbose=args.verbose,
+    )
+    for path, counts in results.items():
+        print(
+            "%s: %d rows, %d blobs"
+            % (
+                path,
+                sum(n for table, n in counts.items() if table != "content"),
+                counts.get("content", 0),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Fill the Redis job queue that `crawler.py` consumes from site lists.
+
+Sites are read with `site_list` and added as `rank,url` jobs in chunks,
+each a single round-trip. Jobs are deduplicated by URL against every job
+that was ever added to the queue (see `RedisWQ.add_many`), so a list can be
+loaded again, e.g. after it was extended, without crawling sites twice.
+
+Sites can be split into priority classes by rank, e.g. to crawl the top 1k
+sites of every list before the top 10k and before the long tail:
+
+    python -m openwpm.utilities.queue_loader --priority 1000 \\
+        --priority 10000 datasets/tranco_*.csv
+"""
+import argparse
+import bisect
+import os
+import time
+from typing import Dict, Iterable, List, Optional, TextIO, Tuple
+
+from . import site_list
+from .rediswq import DEDUPE_MODES, RedisWQ
+
+CHUNK_SIZE = 10000  # jobs added per round-trip
+
+
+def priority_class(rank: int, thresholds: List[int]) -> int:
+    """Return the priority class of `rank`: 0 for ranks up to the first
+    threshold, 1 up to the second and so on"""
+    return bisect.bisect_left(thresholds, rank)
+
+
+def load_queue(
+    queue: RedisWQ,
+    sites: Iterable[site_list.Site],
+    thresholds: Optional[List[int]] = None,
+    dedupe: str = "set",
+    chunk_size: int = CHUNK_SIZE,
+    skipped_file: Optional[TextIO] = None,
+) -> Dict[str, int]:
+    """Add `sites` to `queue`.
+
+    Parameters
+    ----------
+    queue : RedisWQ
+        the queue, with `len(thresholds) + 1` priority classes
+    sites : iterable of Site
+        the sites to add
+    thresholds : list of int, optional
+        the largest rank of each priority class but the last
+    dedupe : str
+        how jobs that were added before are skipped, see `DEDUPE_MODES`
+    chunk_size : int
+        number of jobs added per round-trip
+    skipped_file : file, optional
+        the skipped jobs are written to this file, one per line
+
+    Returns
+    -------
+    dict
+        the number of `added` and `skipped` jobs, and of the jobs added to
+        each priority class as `class_<i>`
+    """
+    thresholds = sorted(thresholds or list())
+    stats = {"added": 0, "skipped": 0}
+    for i in range(len(thresholds) + 1):
+        stats["class_%d" % i] = 0
+    chunks: Dict[int, List[Tuple[str, str]]] = dict()
+
+    def flush(cls: int) -> None:
+        chunk = chunks.pop(cls)
+        for (_, job), added in zip(chunk, queue.add_many(chunk, cls, dedupe)):
+            if added:
+                stats["added"] += 1
+                stats["class_%d" % cls] += 1
+            else:
+                stats["skipped"] += 1
+                if skipped_file is not None:
+                    skipped_file.write(job + "\n")
+
+    for site in sites:
+        cls = priority_class(site.rank, thresholds)
+        chunk = chunks.setdefault(cls, list())
+        chunk.append((site.url, "%d,%s" % (site.rank, site.url)))
+        if len(chunk) >= chunk_size:
+            flush(cls)
+    for cls in list(chunks):
+        flush(cls)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Add the sites of site lists to the Redis job queue."
+    )
+    parser.add_argument(
+        "sources",
+        nargs="*",
+        default=list(site_list.DEFAULT_SOURCES),
+        help="rank,domain CSV files or glob patterns (default: %s)"
+        % " ".join(site_list.DEFAULT_SOURCES),
+    )
+    parser.add_argument(
+        "--host", default=os.getenv("REDIS_HOST", "localhost"), help="Redis host"
+    )
+    parser.add_argument("--port", type=int, default=6379, help="Redis port")
+    parser.add_argument(
+        "--queue",
+        default=os.getenv("REDIS_QUEUE_NAME", "crawl-queue"),
+        help="name of the queue",
+    )
+    parser.add_argument(
+        "--priority",
+        type=int,
+        action="append",
+        default=list(),
+        metavar="RANK",
+        help="queue sites up to this rank before the sites ranked lower, "
+        "can be given several times",
+    )
+    parser.add_argument(
+        "--dedupe",
+        choices=DEDUPE_MODES,
+        default="set",
+        help="skip sites that were added before (using a Redis set) or not",
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=CHUNK_SIZE, help="jobs per round-trip"
+    )
+    parser.add_argument(
+        "--www", action="store_true", help="prefix registrable domains with www."
+    )
+    parser.add_argument(
+        "--skipped", type=argparse.FileType("w"), help="write skipped jobs here"
+    )
+    args = parser.parse_args()
+    queue = RedisWQ(
+        name=args.queue,
+        priority_classes=len(args.priority) + 1,
+        host=args.host,
+        port=args.port,
+    )
+    start = time.time()
+    stats = load_queue(
+        queue,
+        site_list.iter_sites(args.sources, www=args.www),
+        args.priority,
+        args.dedupe,
+        args.chunk_size,
+        args.skipped,
+    )
+    elapsed = time.time() - start
+    print(
+        "Added %d jobs and skipped %d in %.1f s"
+        % (stats["added"], stats["skipped"], elapsed)
+    )
+    for i in range(len(args.priority) + 1):
+        print("  priority class %d: %d jobs" % (i, stats["class_%d" % i]))
+    print("Queue state: %s" % queue.progress())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,148 @@
 import hashlib
 import logging
+import math
 import uuid
-from typing import Any
+from typing import Any, Dict, Iterable, List, Tuple
 
 import redis
 
+EXPIRED_BATCH_SIZE = 100  # expired leases requeued per script call
+# How `add_many` skips jobs that were added before: `set` keeps the keys of
+# all jobs in a Redis set, `none` adds every job
+DEDUPE_MODES = ("set", "none")
+
+# Every script reads the clock of the Redis server, so the lease deadlines
+# of all workers are comparable. Scripts that write after reading the clock
+# need effects replication, which is the default since Redis 5.
+_NOW = """
+if redis.replicate_commands then redis.replicate_commands() end
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+"""
+
+# Jobs are pushed to the left of a queue and popped from its right, the
+# direction of the BRPOPLPUSH of earlier versions, so queues filled by
+# loaders written for them keep their order.
+
+# KEYS: leases, owners, queues by priority... ARGV: lease seconds, session,
+# count, optionally a job already popped by a blocking pop
+_LEASE_SCRIPT = (
+    _NOW
+    + """
+local jobs = {}
+local function lease(job)
+    redis.call("ZADD", KEYS[1], now + tonumber(ARGV[1]), job)
+    redis.call("HSET", KEYS[2], job, ARGV[2])
+    jobs[#jobs + 1] = job
+end
+if ARGV[4] then
+    lease(ARGV[4])
+end
+local queue = 3
+while #jobs < tonumber(ARGV[3]) and queue <= #KEYS do
+    local job = redis.call("RPOP", KEYS[queue])
+    if job then
+        lease(job)
+    else
+        queue = queue + 1
+    end
+end
+return jobs
+"""
+)
+
+# KEYS: leases, owners. ARGV: lease seconds, session, jobs...
+_RENEW_SCRIPT = (
+    _NOW
+    + """
+local renewed = {}
+for i = 3, #ARGV do
+    local job = ARGV[i]
+    renewed[i - 2] = 0
+    if redis.call("HGET", KEYS[2], job) == ARGV[2] then
+        local deadline = redis.call("ZSCORE", KEYS[1], job)
+        if deadline and tonumber(deadline) >= now then
+            redis.call("ZADD", KEYS[1], now + tonumber(ARGV[1]), job)
+            renewed[i - 2] = 1
+        end
+    end
+end
+return renewed
+"""
+)
+
+# KEYS: leases, owners, retries. ARGV: jobs...
+_COMPLETE_SCRIPT = """
+for _, job in ipairs(ARGV) do
+    redis.call("ZREM", KEYS[1], job)
+    redis.call("HDEL", KEYS[2], job)
+    redis.call("HDEL", KEYS[3], job)
+end
+return #ARGV
+"""
+
+# KEYS: seen jobs, queue. ARGV: dedupe mode, (key, job)...
+_ADD_SCRIPT = """
+local added = {}
+for i = 2, #ARGV, 2 do
+    local new = 1
+    if ARGV[1] == "set" then
+        new = redis.call("SADD", KEYS[1], ARGV[i])
+    end
+    if new == 1 then
+        redis.call("LPUSH", KEYS[2], ARGV[i + 1])
+    end
+    added[#added + 1] = new
+end
+return added
+"""
+
+# KEYS: leases, owners, retries, main queue. ARGV: max retries, batch size
+_REQUEUE_EXPIRED_SCRIPT = (
+    _NOW
+    + """
+local expired = redis.call(
+    "ZRANGEBYSCORE", KEYS[1], "-inf", now, "LIMIT", 0, tonumber(ARGV[2]))
+local requeued = 0
+local removed = 0
+for _, job in ipairs(expired) do
+    redis.call("ZREM", KEYS[1], job)
+    redis.call("HDEL", KEYS[2], job)
+    if redis.call("HINCRBY", KEYS[3], job, 1) > tonumber(ARGV[1]) then
+        redis.call("HDEL", KEYS[3], job)
+        removed = removed + 1
+    else
+        redis.call("LPUSH", KEYS[4], job)
+        requeued = requeued + 1
+    end
+end
+return {requeued, removed}
+"""
+)
+
+# Requeues the jobs that workers of earlier versions left in their
+# processing list once their lease key expired.
+# KEYS: processing list, retries, main queue, lease keys... ARGV: max
+# retries, jobs...
+_REQUEUE_LEGACY_SCRIPT = """
+local requeued = 0
+local removed = 0
+for i = 2, #ARGV do
+    local job = ARGV[i]
+    if redis.call("EXISTS", KEYS[i + 2]) == 0
+            and redis.call("LREM", KEYS[1], 0, job) > 0 then
+        if redis.call("HINCRBY", KEYS[2], job, 1) > tonumber(ARGV[1]) then
+            redis.call("HDEL", KEYS[2], job)
+            removed = removed + 1
+        else
+            redis.call("LPUSH", KEYS[3], job)
+            requeued = requeued + 1
+        end
+    end
+end
+return {requeued, removed}
+"""
+
 
 class RedisWQ(object):
     """Simple Finite Work Queue with Redis Backend
@@ -18,11 +156,23 @@ class RedisWQ(object):
     This object is not intended to be used by multiple threads
     concurrently.
 
-    From:
+    Leased jobs are kept in a sorted set scored by the deadline of their
+    lease, so only the jobs whose lease expired are looked at when leases
+    are checked. Leasing, renewing, completing and requeueing jobs are Lua
+    scripts, each a single atomic round-trip.
+
+    Jobs can be queued in several priority classes. Jobs are leased from
+    the queue of class 0 (`name`) first, then from the queue of class 1
+    (`name`:priority-1) and so on, in the order they were added. Jobs whose
+    lease expired are retried after the jobs queued in class 0. Jobs left
+    in the `name`:processing list by workers of earlier versions are
+    requeued the same way once their lease expired.
+
+    Adapted from:
     https://kubernetes.io/docs/tasks/job/fine-parallel-processing-work-queue
     """
 
-    def __init__(self, name, max_retries=2, **redis_kwargs):
+    def __init__(self, name, max_retries=2, priority_classes=None, **redis_kwargs):
         """Redis worker queue instance
 
         The default connection parameters are:
@@ -35,35 +185,59 @@ class RedisWQ(object):
         name : string
             A prefix that identified all of the objects associated with this
             worker queue. e.g., the main work queue is identified by `name`,
-            and the processesing queue is identified by `name`:processing.
+            and the sorted set of leased jobs is identified by `name`:leases.
         max_retries : int, optional
             Number of times to retry a job before removing it from the queue.
             If you don't wish to retry jobs, set the limit to 0.
+        priority_classes : int, optional
+            Number of priority classes of the queue. The number of classes
+            is stored in Redis, so workers don't have to set this if the
+            queue was filled before they start.
         """
         self._db = redis.Redis(**redis_kwargs)
         # The session ID will uniquely identify this "worker".
         self._session = str(uuid.uuid4())
-        # Work queue is implemented as two queues: main, and processing.
-        # Work is initially in main, and moved to processing when a client
-        # picks it up.
+        # Work is initially in the main queue, and moved to the leases when
+        # a client picks it up. The leases map each job to the deadline of
+        # its lease, the owners to the session that holds it.
         self._main_q_key = name
-        self._processing_q_key = name + ":processing"
+        self._lease_key = name + ":leases"
+        self._owner_key = name + ":lease_owners"
         self._retry_hash_map_key = name + ":retries"
-        self._lease_key_prefix = name + ":leased_by_session:"
+        self._seen_key = name + ":seen"
+        self._classes_key = name + ":priority_classes"
+        self._legacy_processing_key = name + ":processing"
+        self._legacy_lease_key_prefix = name + ":leased_by_session:"
+        stored_classes = int(self._db.get(self._classes_key) or 1)
+        if priority_classes is not None and priority_classes > stored_classes:
+            self._db.set(self._classes_key, priority_classes)
+        priority_classes = max(priority_classes or 1, stored_classes)
+        self._queue_keys = [self._main_q_key] + [
+            "%s:priority-%d" % (name, i) for i in range(1, priority_classes)
+        ]
         self._logger = logging.getLogger("openwpm")
         self._max_retries = max_retries
+        self._lease_script = self._db.register_script(_LEASE_SCRIPT)
+        self._renew_script = self._db.register_script(_RENEW_SCRIPT)
+        self._complete_script = self._db.register_script(_COMPLETE_SCRIPT)
+        self._requeue_expired_script = self._db.register_script(_REQUEUE_EXPIRED_SCRIPT)
+        self._add_script = self._db.register_script(_ADD_SCRIPT)
+        self._requeue_legacy_script = self._db.register_script(_REQUEUE_LEGACY_SCRIPT)
 
     def sessionID(self):
         """Return the ID for this session."""
         return self._session
 
-    def _main_qsize(self):
-        """Return the size of the main queue."""
-        return self._db.llen(self._main_q_key)
-
-    def _processing_qsize(self):
-        """Return the size of the main queue."""
-        return self._db.llen(self._processing_q_key)
+    def progress(self) -> Dict[str, int]:
+        """Return the number of `queued` and `leased` jobs and the number of
+        jobs that are being `retried`, in a single round-trip."""
+        pipe = self._db.pipeline(transaction=False)
+        for key in self._queue_keys:
+            pipe.llen(key)
+        pipe.zcard(self._lease_key)
+        pipe.hlen(self._retry_hash_map_key)
+        *queued, leased, retried = pipe.execute()
+        return {"queued": sum(queued), "leased": leased, "retried": retried}
 
     def empty(self):
         """Return True if the queue is empty, including work being done,
@@ -72,125 +246,89 @@ class RedisWQ(object):
         False does not necessarily mean that there is work available to work
         on right now,
         """
-        return self._main_qsize() == 0 and self._processing_qsize() == 0
+        progress = self.progress()
+        return progress["queued"] == 0 and progress["leased"] == 0
 
-    def _maybe_renew_job(self, job):
-        """Transactionally move job from the processing to the work queue.
+    def check_expired_leases(self):
+        """Return jobs whose lease expired to the work queue
 
-        A job will not be renewed if it appears that another worker is
-        changing the processing queue or if the job has exceeded the
-        maximum number of retries.
+        A job's lease expires if the client that leased it crashed or
+        stalled. The job is moved back to the main queue so others can
+        work on it, unless it exceeded the maximum number of retries, in
+        which case it is removed from the queue entirely.
         """
-        self._logger.debug(
-            "Lease expired for job %s. Attempting to move from processing "
-            "queue to work queue...[session %s]" % (job, self.sessionID())
-        )
-        # A pipeline executes a set of commands as a transaction, but
-        # does not support rollback in the event any individual
-        # command fails.
-        pipe = self._db.pipeline(transaction=True)
-
-        # First, watch the processing queue and retry count hash map for
-        # changes. The pipeline transaction won't execute if changes occur
-        # after this point. This allows us to prevent duplicate updates from
-        # different workers.
-        pipe.watch(self._processing_q_key)
-        pipe.watch(self._retry_hash_map_key)
-
-        # Next, ensure that the job is still in the processing queue.
-        # The processing queue is relatively small, so this shouldn't
-        # be an expensive operation.
-        if job not in self._db.lrange(self._processing_q_key, 0, -1):
-            pipe.reset()
-            self._logger.debug(
-                "Job %s no longer in the processing queue, there is no need "
-                "to renew..." % job
+        self._requeue_legacy_jobs()
+        while True:
+            requeued, removed = self._requeue_expired_script(
+                keys=[
+                    self._lease_key,
+                    self._owner_key,
+                    self._retry_hash_map_key,
+                    self._main_q_key,
+                ],
+                args=[self._max_retries, EXPIRED_BATCH_SIZE],
             )
-            return
-
-        # Next, check that we haven't exceeded the retry limit for this job
-        # If we have, remove the job from the queue entirely and don't add it
-        # back to the main work queue
-        retry_count = self.get_retry_number(job)
-        if retry_count + 1 > self._max_retries:
-            self._logger.debug(
-                "Job %s exceeded maximum retry count, attempting to remove "
-                "from the processing queue. [session %s]" % (job, self.sessionID())
-            )
-            pipe.multi()
-            pipe = pipe.lrem(self._processing_q_key, 0, job).hdel(
-                self._retry_hash_map_key, job
-            )
-            results = pipe.execute()
-            if results:
-                self._logger.debug(
-                    "Job %s successfully removed from the processing "
-                    "queue due to too many retries. [session %s]"
-                    % (job, self.sessionID())
-                )
-            else:
+            if requeued or removed:
                 self._logger.debug(
-                    "Removing job %s was interrupted due to a change by a "
-                    "concurrent worker. [session %s]" % (job, self.sessionID())
+                    "Moved %d jobs with an expired lease back to the work "
+                    "queue and removed %d jobs that exceeded the maximum "
+                    "retry count. [session %s]" % (requeued, removed, self.sessionID())
                 )
+            if requeued + removed < EXPIRED_BATCH_SIZE:
+                return
+
+    def _requeue_legacy_jobs(self):
+        """Requeue the jobs in the processing list of earlier versions
+        whose lease expired, see `check_expired_leases`"""
+        jobs = self._db.lrange(self._legacy_processing_key, 0, -1)
+        if not jobs:
             return
-
-        # Finally, execute the transaction to move the expired job
-        # back to the main queue and increment the retry counter by 1
-        pipe.multi()
-        pipe = (
-            pipe.lrem(self._processing_q_key, 0, job)
-            .rpush(self._main_q_key, job)
-            .hincrby(self._retry_hash_map_key, job, 1)
+        lease_keys = [
+            self._legacy_lease_key_prefix + hashlib.sha224(job).hexdigest()
+            for job in jobs
+        ]
+        requeued, removed = self._requeue_legacy_script(
+            keys=[
+                self._legacy_processing_key,
+                self._retry_hash_map_key,
+                self._main_q_key,
+            ]
+            + lease_keys,
+            args=[self._max_retries] + jobs,
         )
-        results = pipe.execute()
-        if results:
-            self._logger.debug(
-                "Job %s successfully moved from processing queue to "
-                "work queue for retry attempt %d. [session %s]"
-                % (job, retry_count + 1, self.sessionID())
-            )
-        else:
-            self._logger.debug(
-                "Moving job %s was interrupted due to a change by a "
-                "concurrent worker. [session %s]" % (job, self.sessionID())
+        if requeued or removed:
+            self._logger.info(
+                "Moved %d jobs left by an earlier version back to the work "
+                "queue and removed %d jobs that exceeded the maximum retry "
+                "count. [session %s]" % (requeued, removed, self.sessionID())
             )
-        return
 
-    def check_expired_leases(self):
-        """Return to the work queue
-
-        If the lease key is not present for an item (it expired or was
-        never created because the client crashed before creating it)
-        then move the item back to the main queue so others can work on
-        it.
-        """
-        processing = self._db.lrange(self._processing_q_key, 0, -1)
-        for job in processing:
-            if not self._lease_exists(job):
-                try:
-                    self._maybe_renew_job(job)
-                except redis.exceptions.WatchError:
-                    self._logger.debug(
-                        "Watched variable changed while trying to renew lease "
-                        "for job %s. Skipping lease renew for now... "
-                        "[session %s]" % (job, self.sessionID())
-                    )
-                except Exception:
-                    self._logger.error(
-                        "Exception while renewing job %s. [session %s]"
-                        % (job, self.sessionID()),
-                        exc_info=True,
-                    )
-        return
-
-    def _itemkey(self, item):
-        """Returns a string that uniquely identifies an item (bytes)."""
-        return hashlib.sha224(item).hexdigest()
-
-    def _lease_exists(self, item):
-        """True if a lease on 'item' exists."""
-        return self._db.exists(self._lease_key_prefix + self._itemkey(item))
+    def lease_many(
+        self, count: int, lease_secs=60, block=True, timeout=None
+    ) -> List[bytes]:
+        """Lease up to `count` items of the work queue at once.
+
+        Returns fewer items if the queue holds fewer, and blocks like
+        `lease` if it is empty."""
+        keys = [self._lease_key, self._owner_key] + self._queue_keys
+        items = self._lease_script(keys=keys, args=[lease_secs, self._session, count])
+        if items or not block or (timeout is not None and timeout <= 0):
+            return items
+        # BRPOP takes whole seconds and blocks forever on 0
+        popped = self._db.brpop(
+            self._queue_keys, timeout=0 if timeout is None else math.ceil(timeout)
+        )
+        if popped is None:
+            return items
+        _, job = popped
+        try:
+            return self._lease_script(
+                keys=keys, args=[lease_secs, self._session, count, job]
+            )
+        except redis.RedisError:
+            # Put the job back where it was popped from before giving up
+            self._db.rpush(popped[0], job)
+            raise
 
     def lease(self, lease_secs=60, block=True, timeout=None):
         """Begin working on an item the work queue.
@@ -201,32 +339,28 @@ class RedisWQ(object):
 
         If optional args block is true and timeout is None (the default), block
         if necessary until an item is available."""
-        if block:
-            item = self._db.brpoplpush(
-                self._main_q_key, self._processing_q_key, timeout=timeout
-            )
-        else:
-            item = self._db.rpoplpush(self._main_q_key, self._processing_q_key)
-        if item:
-            # Record that we (this session id) are working on a key. Expire
-            # that note after the lease timeout.
-            # Note: if we crash at this line of the program, then GC will see
-            # no lease for this item a later return it to the main queue.
-            itemkey = self._itemkey(item)
-            self._db.setex(self._lease_key_prefix + itemkey, lease_secs, self._session)
-        return item
+        items = self.lease_many(1, lease_secs, block, timeout)
+        return items[0] if items else None
+
+    def renew_leases(self, jobs: Iterable[Any], lease_secs=60) -> List[bool]:
+        """Renew the leases this client holds on `jobs` by `lease_secs`.
+
+        Returns for every job whether its lease was renewed, which it isn't
+        if it already expired."""
+        jobs = list(jobs)
+        if not jobs:
+            return list()
+        renewed = self._renew_script(
+            keys=[self._lease_key, self._owner_key],
+            args=[lease_secs, self._session] + jobs,
+        )
+        return [bool(r) for r in renewed]
 
     def renew_lease(self, job: Any, lease_secs=60) -> bool:
         """Checks if the item is currently leased by this client
         and if so renews that lease by `lease_secs`
         Return false if the lease was already expired"""
-
-        key = self._lease_key_prefix + self._itemkey(job)
-        if self._db.get(key):
-            self._db.setex(key, lease_secs, self._session)
-            return True
-        else:
-            return False
+        return self.renew_leases([job], lease_secs)[0]
 
     def get_retry_number(self, job):
         """Return the number of retries for the given `job`.
@@ -244,6 +378,54 @@ class RedisWQ(object):
             num_retries = int(num_retries)
         return num_retries
 
+    def add_many(
+        self, jobs: Iterable[Tuple[Any, Any]], priority_class=0, dedupe="set"
+    ) -> List[bool]:
+        """Add `jobs`, pairs of a key that identifies the job and the job,
+        to the end of the queue of `priority_class` in one round-trip.
+
+        With a `dedupe` mode (see `DEDUPE_MODES`) other than `none`, jobs
+        whose key was added before are skipped, even if they were already
+        completed. Returns for every job whether it was added."""
+        if dedupe not in DEDUPE_MODES:
+            raise ValueError("Unsupported dedupe mode: %s" % dedupe)
+        if not 0 <= priority_class < len(self._queue_keys):
+            raise ValueError(
+                "Priority class %d out of range, the queue has %d classes"
+                % (priority_class, len(self._queue_keys))
+            )
+        args = [dedupe]
+        for key, job in jobs:
+            args.extend((key, job))
+        if len(args) == 1:
+            return list()
+        added = self._add_script(
+            keys=[self._seen_key, self._queue_keys[priority_class]],
+            args=args,
+        )
+        return [bool(a) for a in added]
+
+    def get_retry_numbers(self, jobs: Iterable[Any]) -> List[int]:
+        """Return the number of retries of each of `jobs`, see
+        `get_retry_number`"""
+        jobs = list(jobs)
+        if not jobs:
+            return list()
+        return [
+            0 if retries is None else int(retries)
+            for retries in self._db.hmget(self._retry_hash_map_key, jobs)
+        ]
+
+    def complete_many(self, jobs: Iterable[Any]) -> None:
+        """Complete working on all of `jobs` at once, see `complete`"""
+        jobs = list(jobs)
+        if not jobs:
+            return
+        self._complete_script(
+            keys=[self._lease_key, self._owner_key, self._retry_hash_map_key],
+            args=jobs,
+        )
+
     def complete(self, job):
         """Complete working on the `job`.
 
@@ -251,10 +433,4 @@ class RedisWQ(object):
         other worker may have picked it up.  There is no indication
         of what happened.
         """
-        self._db.lrem(self._processing_q_key, 0, job)
-        self._db.hdel(self._retry_hash_map_key, job)
-        # If we crash here, then the GC code will try to move the value, but
-        # it will not be here, which is fine.  So this does not need to be a
-        # transaction.
-        itemkey = self._itemkey(job)
-        self._db.delete(self._lease_key_prefix + itemkey, self._session)
+        self.complete_many([job])
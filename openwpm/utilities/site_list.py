@@ -0,0 +1,225 @@
+"""Site lists for crawls, read from Tranco-style `rank,domain` CSV files.
+
+Sites are read lazily, normalized to URLs and deduplicated across all
+files, so a domain that is listed in several country lists is only crawled
+once, at the first place it appears.
+
+Crawls that are split over several machines take a shard of the list with
+`--shard i/N` (1 <= i <= N). Every machine reads the same files and
+computes the same assignment, so the lists no longer have to be split by
+hand. Sites are assigned by a stable hash of their registrable domain
+(`bbc.co.uk` for `www.bbc.co.uk`) within buckets of `bucket_size`
+consecutive ranks of each file. Within a bucket, the domains are dealt out
+over the shards in hash order, so each shard gets the same share of the top
+ranked (and heaviest) sites, and all sites of a registrable domain that
+fall in the same bucket are crawled by the same machine. With a
+`bucket_size` of 0 the shard is only `hash % N`, which keeps domains on the
+same shard when the lists change, at the cost of less even shards.
+
+The command line prints the sites of a shard as `rank,url` lines, the job
+format of the Redis queue that `crawler.py` reads, e.g.
+
+    python -m openwpm.utilities.site_list --shard 2/4 datasets/tranco_*.csv
+"""
+import argparse
+import csv
+import glob
+import hashlib
+import os
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+import domain_utils as du
+
+DEFAULT_SOURCES = ("datasets/tranco_*.csv", "tranco_*_top500.csv")
+BUCKET_SIZE = 100  # consecutive ranks that are balanced over the shards
+
+
+class Site(NamedTuple):
+    rank: int
+    url: str
+    domain: str  # registrable domain of `url`
+    source: str  # the file the site was read from
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse a `i/N` shard specification into (i, N)"""
+    index, sep, count = value.partition("/")
+    if not sep:
+        raise ValueError("Shard %r is not of the form i/N" % value)
+    shard = (int(index), int(count))
+    if not 1 <= shard[0] <= shard[1]:
+        raise ValueError("Shard %r is out of range" % value)
+    return shard
+
+
+def expand_sources(patterns: Iterable[str]) -> List[str]:
+    """Return the files matched by `patterns`, in order and without
+    duplicates. The files matched by each glob pattern are sorted."""
+    paths: List[str] = list()
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.expanduser(pattern)))
+        if not matches and not glob.has_magic(pattern):
+            raise FileNotFoundError("Site list %s does not exist" % pattern)
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+
+def registrable_domain(url: str) -> str:
+    """Return the registrable domain (public suffix + 1) of `url`"""
+    return du.get_ps_plus_1(url)
+
+
+def normalize_url(entry: str, www: bool = False, scheme: str = "http") -> Optional[str]:
+    """Normalize a site list entry to a URL, returns None if it has no host.
+
+    Entries without a scheme get `scheme`. The host is lowercased and the
+    port and path are kept. With `www`, a host that is a registrable domain
+    gets a `www.` prefix."""
+    entry = entry.strip().lstrip("\ufeff")
+    if not entry:
+        return None
+    if "://" not in entry:
+        entry = "%s://%s" % (scheme, entry)
+    try:
+        parts = urlsplit(entry)
+        port = parts.port
+    except ValueError:
+        return None
+    host = (parts.hostname or "").rstrip(".")
+    if not host:
+        return None
+    if www and host == registrable_domain("%s://%s" % (parts.scheme, host)):
+        host = "www." + host
+    netloc = host if port is None else "%s:%d" % (host, port)
+    return "%s://%s%s" % (parts.scheme.lower(), netloc, parts.path)
+
+
+def read_sites(
+    paths: Iterable[str], www: bool = False, scheme: str = "http"
+) -> Iterator[Site]:
+    """Read the sites of the `rank,domain` CSV files at `paths`.
+
+    Rows without an integer rank (e.g. headers) are skipped, as are URLs
+    that were already read from this or an earlier file."""
+    seen: Set[str] = set()
+    for path in paths:
+        with open(path, "r", newline="", encoding="utf-8-sig") as f:
+            for row in csv.reader(f):
+                if len(row) < 2:
+                    continue
+                try:
+                    rank = int(row[0])
+                except ValueError:
+                    continue
+                url = normalize_url(row[1], www, scheme)
+                if url is None or url in seen:
+                    continue
+                seen.add(url)
+                yield Site(rank, url, registrable_domain(url), path)
+
+
+def stable_hash(domain: str) -> int:
+    """Return a hash of `domain` that is the same in every process"""
+    return int.from_bytes(hashlib.sha1(domain.encode("utf-8")).digest()[:8], "big")
+
+
+def _deal(bucket: List[Site], shards: int) -> Iterator[Tuple[int, Site]]:
+    """Deal the registrable domains of `bucket` out over the shards"""
+    groups: Dict[str, List[Site]] = dict()
+    for site in bucket:
+        groups.setdefault(site.domain, list()).append(site)
+    domains = sorted(groups, key=lambda domain: (stable_hash(domain), domain))
+    # Start each bucket at a different shard, so the shards that get one
+    # domain more than the others differ between buckets
+    start = stable_hash("%s:%d" % (bucket[0].source, bucket[0].rank)) % shards
+    assignment = {domain: (start + i) % shards for i, domain in enumerate(domains)}
+    for site in bucket:
+        yield assignment[site.domain], site
+
+
+def assign_shards(
+    sites: Iterable[Site], shards: int, bucket_size: int = BUCKET_SIZE
+) -> Iterator[Tuple[int, Site]]:
+    """Assign each site to one of `shards` shards (0-based), in order of
+    `sites`. Only one bucket of sites is held in memory at a time."""
+    if bucket_size <= 0:
+        for site in sites:
+            yield stable_hash(site.domain) % shards, site
+        return
+    bucket: List[Site] = list()
+    for site in sites:
+        if bucket and (
+            site.source != bucket[0].source
+            or (site.rank - 1) // bucket_size != (bucket[0].rank - 1) // bucket_size
+        ):
+            yield from _deal(bucket, shards)
+            bucket = list()
+        bucket.append(site)
+    if bucket:
+        yield from _deal(bucket, shards)
+
+
+def iter_sites(
+    sources: Iterable[str] = DEFAULT_SOURCES,
+    shard: Optional[Tuple[int, int]] = None,
+    bucket_size: int = BUCKET_SIZE,
+    www: bool = False,
+    scheme: str = "http",
+) -> Iterator[Site]:
+    """Yield the sites of the site lists matched by `sources`.
+
+    Parameters
+    ----------
+    sources : iterable of str
+        paths or glob patterns of `rank,domain` CSV files
+    shard : (int, int), optional
+        only yield shard i of N (see `parse_shard`), default all sites
+    bucket_size : int
+        number of consecutive ranks balanced over the shards, 0 to assign
+        sites by the hash of their registrable domain only
+    www : bool
+        prefix hosts that are a registrable domain with `www.`
+    scheme : str
+        scheme of the entries that don't have one
+    """
+    sites = read_sites(expand_sources(sources), www, scheme)
+    if shard is None:
+        yield from sites
+        return
+    index, count = shard
+    for site_shard, site in assign_shards(sites, count, bucket_size):
+        if site_shard == index - 1:
+            yield site
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print the sites of a shard of the site lists as rank,url."
+    )
+    parser.add_argument(
+        "sources",
+        nargs="*",
+        default=list(DEFAULT_SOURCES),
+        help="rank,domain CSV files or glob patterns (default: %s)"
+        % " ".join(DEFAULT_SOURCES),
+    )
+    parser.add_argument(
+        "--shard", type=parse_shard, help="only print shard i of N, as i/N"
+    )
+    parser.add_argument(
+        "--bucket-size",
+        type=int,
+        default=BUCKET_SIZE,
+        help="consecutive ranks balanced over the shards, 0 to only hash",
+    )
+    parser.add_argument(
+        "--www", action="store_true", help="prefix registrable domains with www."
+    )
+    args = parser.parse_args()
+    for site in iter_sites(args.sources, args.shard, args.bucket_size, args.www):
+        print("%d,%s" % (site.rank, site.url))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,453 @@
+"""Decoder for IAB TCF v2 consent strings (TC strings).
+
+A TC string is the base64url encoding (without padding) of a bit string,
+optionally followed by more `.` separated segments. Only the core segment
+is decoded, as it holds the purpose, vendor and legitimate interest
+signals. See the "Consent string and vendor list formats" specification of
+the IAB Transparency and Consent Framework for the layout.
+
+`decode` returns a `TCString` for a single string. `decode_batch` decodes
+many strings at once with NumPy into a `TCBatch`, which holds the fields in
+arrays and the purpose and vendor bitsets as packed bit arrays, so that
+aggregates over millions of strings are a few vectorized operations, e.g.
+the share of strings consenting to vendor 755 per publisher country:
+
+    batch = decode_batch(tc_strings)
+    consents = batch.has_vendor_consent(755)
+    pandas.Series(consents[batch.valid]).groupby(
+        batch.publisher_cc[batch.valid]).mean()
+"""
+import base64
+import binascii
+import datetime
+import re
+from typing import FrozenSet, Iterable, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+SUPPORTED_VERSION = 2
+NUM_PURPOSES = 24
+NUM_SPECIAL_FEATURES = 12
+# Vendor ids above this are dropped by `decode_batch` unless a larger
+# `max_vendor_id` is given. Registered vendor ids are well below it.
+DEFAULT_MAX_VENDOR_ID = 2048
+BATCH_CHUNK_SIZE = 32768  # strings unpacked to bits at once by `decode_batch`
+
+# Bit offset and length of the fixed fields of the core segment
+_FIELDS = {
+    "version": (0, 6),
+    "created": (6, 36),
+    "last_updated": (42, 36),
+    "cmp_id": (78, 12),
+    "cmp_version": (90, 12),
+    "consent_screen": (102, 6),
+    "consent_language": (108, 12),
+    "vendor_list_version": (120, 12),
+    "tcf_policy_version": (132, 6),
+    "is_service_specific": (138, 1),
+    "use_non_standard_stacks": (139, 1),
+    "special_feature_opt_ins": (140, NUM_SPECIAL_FEATURES),
+    "purpose_consents": (152, NUM_PURPOSES),
+    "purpose_legitimate_interests": (176, NUM_PURPOSES),
+    "purpose_one_treatment": (200, 1),
+    "publisher_cc": (201, 12),
+}
+_VENDOR_SECTION = 213  # offset of the vendor consent section
+_VENDOR_SECTION_HEADER = 17  # MaxVendorId (16 bits) and IsRangeEncoding
+_MIN_BITS = _VENDOR_SECTION + _VENDOR_SECTION_HEADER
+_DECISECONDS_EPOCH = datetime.datetime(1970, 1, 1)
+_BASE64URL = re.compile(r"[A-Za-z0-9_-]*$")
+_TO_STANDARD_BASE64 = str.maketrans("-_", "+/")
+
+
+class PublisherRestriction(NamedTuple):
+    purpose_id: int
+    restriction_type: int
+    vendor_ids: FrozenSet[int]
+
+
+class TCString(NamedTuple):
+    """The core segment of a TC string. Bitsets are sets of the ids whose
+    bit is set, e.g. `purpose_consents` holds the purposes consented to."""
+
+    version: int
+    created: datetime.datetime
+    last_updated: datetime.datetime
+    cmp_id: int
+    cmp_version: int
+    consent_screen: int
+    consent_language: str
+    vendor_list_version: int
+    tcf_policy_version: int
+    is_service_specific: bool
+    use_non_standard_stacks: bool
+    special_feature_opt_ins: FrozenSet[int]
+    purpose_consents: FrozenSet[int]
+    purpose_legitimate_interests: FrozenSet[int]
+    purpose_one_treatment: bool
+    publisher_cc: str
+    vendor_consents: FrozenSet[int]
+    vendor_legitimate_interests: FrozenSet[int]
+    publisher_restrictions: Tuple[PublisherRestriction, ...]
+
+
+def _decode_base64(segment: str) -> bytes:
+    try:
+        return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+    except (binascii.Error, ValueError) as e:
+        raise ValueError("TC string is not valid base64url: %s" % e)
+
+
+def _core_bytes(tc_string: str) -> bytes:
+    return _decode_base64(tc_string.strip().split(".", 1)[0])
+
+
+def _letters(value: int) -> str:
+    """Decode two 6 bit letters, 0 being 'A'"""
+    return chr(ord("A") + (value >> 6)) + chr(ord("A") + (value & 0x3F))
+
+
+class _BitReader:
+    def __init__(self, data: bytes) -> None:
+        self._bits = int.from_bytes(data, "big")
+        self.length = len(data) * 8
+        self.offset = 0
+
+    def read(self, length: int) -> int:
+        if self.offset + length > self.length:
+            raise ValueError("TC string is truncated")
+        self.offset += length
+        return (self._bits >> (self.length - self.offset)) & ((1 << length) - 1)
+
+    def read_bitset(self, length: int) -> FrozenSet[int]:
+        """Read a bit field, bit i (from 0) being id i + 1"""
+        value = self.read(length)
+        return frozenset(length - i for i in range(length) if value >> i & 1)
+
+    def read_ranges(self) -> FrozenSet[int]:
+        ids = set()
+        for _ in range(self.read(12)):
+            is_range = self.read(1)
+            start = self.read(16)
+            end = self.read(16) if is_range else start
+            ids.update(range(start, end + 1))
+        return frozenset(ids)
+
+    def read_vendor_section(self) -> FrozenSet[int]:
+        max_vendor_id = self.read(16)
+        if self.read(1):
+            return self.read_ranges()
+        return self.read_bitset(max_vendor_id)
+
+
+def decode(tc_string: str) -> TCString:
+    """Decode the core segment of `tc_string`.
+
+    Raises a `ValueError` if it isn't a valid version 2 TC string."""
+    reader = _BitReader(_core_bytes(tc_string))
+    version = reader.read(6)
+    if version != SUPPORTED_VERSION:
+        raise ValueError("Unsupported TC string version %d" % version)
+    created = _DECISECONDS_EPOCH + datetime.timedelta(seconds=reader.read(36) / 10)
+    last_updated = _DECISECONDS_EPOCH + datetime.timedelta(seconds=reader.read(36) / 10)
+    cmp_id = reader.read(12)
+    cmp_version = reader.read(12)
+    consent_screen = reader.read(6)
+    consent_language = _letters(reader.read(12))
+    vendor_list_version = reader.read(12)
+    tcf_policy_version = reader.read(6)
+    is_service_specific = bool(reader.read(1))
+    use_non_standard_stacks = bool(reader.read(1))
+    special_feature_opt_ins = reader.read_bitset(NUM_SPECIAL_FEATURES)
+    purpose_consents = reader.read_bitset(NUM_PURPOSES)
+    purpose_legitimate_interests = reader.read_bitset(NUM_PURPOSES)
+    purpose_one_treatment = bool(reader.read(1))
+    publisher_cc = _letters(reader.read(12))
+    vendor_consents = reader.read_vendor_section()
+    vendor_legitimate_interests = reader.read_vendor_section()
+    restrictions = list()
+    for _ in range(reader.read(12)):
+        purpose_id = reader.read(6)
+        restriction_type = reader.read(2)
+        restrictions.append(
+            PublisherRestriction(purpose_id, restriction_type, reader.read_ranges())
+        )
+    return TCString(
+        version,
+        created,
+        last_updated,
+        cmp_id,
+        cmp_version,
+        consent_screen,
+        consent_language,
+        vendor_list_version,
+        tcf_policy_version,
+        is_service_specific,
+        use_non_standard_stacks,
+        special_feature_opt_ins,
+        purpose_consents,
+        purpose_legitimate_interests,
+        purpose_one_treatment,
+        publisher_cc,
+        vendor_consents,
+        vendor_legitimate_interests,
+        tuple(restrictions),
+    )
+
+
+class TCBatch(NamedTuple):
+    """Decoded TC strings, one row per string
+
+    Integer fields are arrays of shape (n,), `consent_language` and
+    `publisher_cc` are arrays of 2 character strings. Bitsets are packed bit
+    arrays of shape (n, ceil(bits / 8)) where id i is bit i - 1, counted from
+    the most significant bit of the first byte (see `numpy.packbits`). Rows
+    of strings that couldn't be decoded are zero and False in `valid`.
+    """
+
+    valid: np.ndarray
+    version: np.ndarray
+    created: np.ndarray  # deciseconds since the epoch
+    last_updated: np.ndarray
+    cmp_id: np.ndarray
+    cmp_version: np.ndarray
+    consent_screen: np.ndarray
+    consent_language: np.ndarray
+    vendor_list_version: np.ndarray
+    tcf_policy_version: np.ndarray
+    is_service_specific: np.ndarray
+    use_non_standard_stacks: np.ndarray
+    purpose_one_treatment: np.ndarray
+    publisher_cc: np.ndarray
+    special_feature_opt_ins: np.ndarray
+    purpose_consents: np.ndarray
+    purpose_legitimate_interests: np.ndarray
+    vendor_consents: np.ndarray
+    vendor_legitimate_interests: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.valid)
+
+    @staticmethod
+    def _bit(packed: np.ndarray, bit_id: int) -> np.ndarray:
+        if bit_id < 1 or bit_id > packed.shape[1] * 8:
+            return np.zeros(packed.shape[0], dtype=bool)
+        index = bit_id - 1
+        return (packed[:, index // 8] >> (7 - index % 8) & 1).astype(bool)
+
+    def has_purpose_consent(self, purpose_id: int) -> np.ndarray:
+        """Return whether each string consents to purpose `purpose_id`"""
+        return self._bit(self.purpose_consents, purpose_id)
+
+    def has_vendor_consent(self, vendor_id: int) -> np.ndarray:
+        """Return whether each string consents to vendor `vendor_id`"""
+        return self._bit(self.vendor_consents, vendor_id)
+
+    def has_vendor_legitimate_interest(self, vendor_id: int) -> np.ndarray:
+        """Return whether each string establishes transparency for the
+        legitimate interest of vendor `vendor_id`"""
+        return self._bit(self.vendor_legitimate_interests, vendor_id)
+
+    def vendor_consent_counts(self) -> np.ndarray:
+        """Return the number of valid strings consenting to each vendor,
+        index i being vendor i + 1"""
+        return _count_bits(self.vendor_consents[self.valid])
+
+    def purpose_consent_counts(self) -> np.ndarray:
+        """Return the number of valid strings consenting to each purpose,
+        index i being purpose i + 1"""
+        return _count_bits(self.purpose_consents[self.valid])
+
+
+def _count_bits(packed: np.ndarray) -> np.ndarray:
+    counts = np.zeros(packed.shape[1] * 8, dtype=np.int64)
+    # Unpack in slices to bound the memory of the bit matrix
+    for start in range(0, packed.shape[0], BATCH_CHUNK_SIZE):
+        chunk = packed[start : start + BATCH_CHUNK_SIZE]
+        counts += np.unpackbits(chunk, axis=1).sum(axis=0, dtype=np.int64)
+    return counts
+
+
+def _read_uint(bits: np.ndarray, offset: int, length: int) -> np.ndarray:
+    """Read the unsigned integer at a fixed offset of each row of `bits`"""
+    weights = np.left_shift(np.int64(1), np.arange(length - 1, -1, -1, dtype=np.int64))
+    return bits[:, offset : offset + length].astype(np.int64) @ weights
+
+
+def _read_uint_at(bits: np.ndarray, offsets: np.ndarray, length: int) -> np.ndarray:
+    """Read the unsigned integer at a per row offset of each row of `bits`"""
+    index = np.minimum(offsets[:, None] + np.arange(length), bits.shape[1] - 1)
+    weights = np.left_shift(np.int64(1), np.arange(length - 1, -1, -1, dtype=np.int64))
+    return np.take_along_axis(bits, index, axis=1).astype(np.int64) @ weights
+
+
+def _letters_array(values: np.ndarray) -> np.ndarray:
+    """Decode arrays of two 6 bit letters, see `_letters`"""
+    codes = np.stack([(values >> 6) & 0x3F, values & 0x3F], axis=1) + ord("A")
+    return codes.astype(np.uint8).view("S2").ravel().astype("U2")
+
+
+def _bitset_at(
+    bits: np.ndarray, offsets: np.ndarray, lengths: np.ndarray, width: int
+) -> np.ndarray:
+    """Read bit fields of per row offset and length into a bool matrix of up
+    to `width` columns, dropping bits beyond `width`.
+
+    Rows are grouped by offset, which only takes a handful of values as it
+    depends on the vendor list version, and each group is sliced at once."""
+    width = int(min(width, lengths.max(initial=0)))
+    out = np.zeros((len(offsets), width), dtype=bool)
+    if len(offsets) and (offsets == offsets[0]).all():
+        window = bits[:, offsets[0] : offsets[0] + width]
+        out[:, : window.shape[1]] = window
+    else:
+        order = np.argsort(offsets, kind="stable")
+        values, starts = np.unique(offsets[order], return_index=True)
+        for offset, rows in zip(values, np.split(order, starts[1:])):
+            window = bits[rows, offset : offset + width]
+            out[rows, : window.shape[1]] = window
+    out &= np.arange(width) < lengths[:, None]
+    return out
+
+
+def _pack(bitset: np.ndarray, width: int) -> np.ndarray:
+    """Pack a bool matrix into `ceil(width / 8)` bytes per row"""
+    packed = np.zeros((bitset.shape[0], -(-width // 8)), dtype=np.uint8)
+    if bitset.shape[1]:
+        packed[:, : -(-bitset.shape[1] // 8)] = np.packbits(bitset, axis=1)
+    return packed
+
+
+def _widen(bitset: np.ndarray, width: int) -> np.ndarray:
+    if bitset.shape[1] >= width:
+        return bitset
+    return np.pad(bitset, ((0, 0), (0, width - bitset.shape[1])))
+
+
+def _set_ids(row: np.ndarray, ids: Iterable[int]) -> None:
+    for i in ids:
+        if 0 < i <= len(row):
+            row[i - 1] = True
+
+
+def _decode_chunk(
+    tc_strings: Sequence[str], max_vendor_id: int
+) -> Tuple[np.ndarray, ...]:
+    n = len(tc_strings)
+    segments = list()
+    lengths = np.zeros(n, dtype=np.int64)
+    for i, tc_string in enumerate(tc_strings):
+        segment = tc_string.strip().split(".", 1)[0] if tc_string else ""
+        if len(segment) % 4 == 1 or not _BASE64URL.match(segment):
+            segment = ""
+        segments.append(segment)
+        lengths[i] = len(segment) * 6 // 8 * 8
+    # Padding every core segment with "A", i.e. zero bits, to the same
+    # length lets all of them be decoded with a single call
+    width = max([len(segment) for segment in segments] + [-(-_MIN_BITS // 6)])
+    width += -width % 4
+    joined = "".join(segment.ljust(width, "A") for segment in segments)
+    data = np.frombuffer(
+        binascii.a2b_base64(joined.translate(_TO_STANDARD_BASE64)), dtype=np.uint8
+    ).reshape(n, width * 3 // 4)
+    bits = np.unpackbits(data, axis=1)
+    del data
+
+    fields = {name: _read_uint(bits, *_FIELDS[name]) for name in _FIELDS}
+    valid = (fields["version"] == SUPPORTED_VERSION) & (lengths >= _MIN_BITS)
+
+    # Vendor consents, in the common bit field encoding
+    max_consent = _read_uint(bits, _VENDOR_SECTION, 16)
+    consent_ranges = bits[:, _VENDOR_SECTION + 16].astype(bool)
+    consent_start = np.full(n, _VENDOR_SECTION + _VENDOR_SECTION_HEADER)
+    vendor_consents = _bitset_at(bits, consent_start, max_consent, max_vendor_id)
+    # The legitimate interest section follows the consent bit field
+    li_section = consent_start + max_consent
+    max_li = _read_uint_at(bits, li_section, 16)
+    li_ranges = _read_uint_at(bits, li_section + 16, 1).astype(bool)
+    vendor_li = _bitset_at(
+        bits, li_section + _VENDOR_SECTION_HEADER, max_li, max_vendor_id
+    )
+    valid &= (
+        consent_ranges
+        | li_ranges
+        | (li_section + _VENDOR_SECTION_HEADER + max_li <= lengths)
+    )
+
+    # Range encoded sections are decoded one string at a time
+    decoded_rows = list()
+    for i in np.flatnonzero(valid & (consent_ranges | li_ranges)):
+        try:
+            decoded_rows.append((i, decode(tc_strings[i])))
+        except ValueError:
+            valid[i] = False
+    if decoded_rows:
+        needed = max(
+            max(
+                decoded.vendor_consents | decoded.vendor_legitimate_interests, default=0
+            )
+            for _, decoded in decoded_rows
+        )
+        vendor_consents = _widen(vendor_consents, min(needed, max_vendor_id))
+        vendor_li = _widen(vendor_li, min(needed, max_vendor_id))
+    for i, decoded in decoded_rows:
+        vendor_consents[i] = False
+        vendor_li[i] = False
+        _set_ids(vendor_consents[i], decoded.vendor_consents)
+        _set_ids(vendor_li[i], decoded.vendor_legitimate_interests)
+
+    def bitset(name: str) -> np.ndarray:
+        offset, length = _FIELDS[name]
+        return np.packbits(bits[:, offset : offset + length], axis=1)
+
+    packed = (
+        bitset("special_feature_opt_ins"),
+        bitset("purpose_consents"),
+        bitset("purpose_legitimate_interests"),
+        _pack(vendor_consents, max_vendor_id),
+        _pack(vendor_li, max_vendor_id),
+    )
+    del bits
+    invalid = ~valid
+    for array in packed:
+        array[invalid] = 0
+    for name in fields:
+        fields[name][invalid] = 0
+    return (
+        valid,
+        fields["version"].astype(np.uint8),
+        fields["created"],
+        fields["last_updated"],
+        fields["cmp_id"].astype(np.uint16),
+        fields["cmp_version"].astype(np.uint16),
+        fields["consent_screen"].astype(np.uint8),
+        np.where(valid, _letters_array(fields["consent_language"]), ""),
+        fields["vendor_list_version"].astype(np.uint16),
+        fields["tcf_policy_version"].astype(np.uint8),
+        fields["is_service_specific"].astype(bool),
+        fields["use_non_standard_stacks"].astype(bool),
+        fields["purpose_one_treatment"].astype(bool),
+        np.where(valid, _letters_array(fields["publisher_cc"]), ""),
+    ) + packed
+
+
+def decode_batch(
+    tc_strings: Sequence[str],
+    max_vendor_id: int = DEFAULT_MAX_VENDOR_ID,
+    chunk_size: int = BATCH_CHUNK_SIZE,
+) -> TCBatch:
+    """Decode `tc_strings` into a `TCBatch`.
+
+    Strings are unpacked into bit matrices `chunk_size` at a time. Vendor
+    bit fields are read from these matrices for all strings at once, only
+    strings that use the range encoding for their vendors are decoded one
+    by one. Vendors with an id above `max_vendor_id` are dropped. Empty and
+    invalid strings are marked in `TCBatch.valid` instead of raising.
+    """
+    chunks = [
+        _decode_chunk(tc_strings[start : start + chunk_size], max_vendor_id)
+        for start in range(0, len(tc_strings), chunk_size)
+    ]
+    if not chunks:
+        chunks = [_decode_chunk([], max_vendor_id)]
+    return TCBatch(*(np.concatenate(arrays) for arrays in zip(*chunks)))
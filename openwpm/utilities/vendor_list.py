@@ -0,0 +1,147 @@
+"""Indexes of the IAB Global Vendor List and CMP list.
+
+Both lists are read from local JSON files, so crawls and analyses don't
+depend on the IAB servers and are reproducible with the list version that
+was current at crawl time. `cmplist.json` is shipped in the repository
+root, where it is found independently of the working directory. The Global
+Vendor List is fetched separately, e.g.
+
+    curl -o vendor-list.json https://vendor-list.consensu.org/v2/vendor-list.json
+"""
+import json
+import logging
+import os
+from functools import lru_cache
+from typing import Any, Dict, FrozenSet, Iterable, List, NamedTuple, Optional
+
+import numpy as np
+
+CMP_LIST = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "cmplist.json",
+)
+VENDOR_LIST = "vendor-list.json"
+
+logger = logging.getLogger("openwpm")
+
+
+@lru_cache(maxsize=None)
+def load_cmp_names(path: str = CMP_LIST) -> Dict[int, str]:
+    """Return the names of the CMPs in the CMP list at `path` by id"""
+    with open(path, "r") as f:
+        data = json.load(f)
+    return {int(cmp_id): cmp["name"] for cmp_id, cmp in data["cmps"].items()}
+
+
+def get_cmp_name(cmp_id: Any, path: str = CMP_LIST) -> Optional[str]:
+    """Return the name of CMP `cmp_id`, or "" if it isn't registered.
+
+    Returns `None` if the CMP list can't be read, so the name is stored as
+    NULL instead of failing the command that records the TC data."""
+    try:
+        return load_cmp_names(path).get(int(cmp_id), "")
+    except (TypeError, ValueError):
+        return ""
+    except OSError:
+        logger.warning("Failed to read the CMP list at %s", path, exc_info=True)
+        return None
+
+
+class Vendor(NamedTuple):
+    id: int
+    name: str
+    purposes: FrozenSet[int]
+    legitimate_interest_purposes: FrozenSet[int]
+    flexible_purposes: FrozenSet[int]
+    special_purposes: FrozenSet[int]
+    features: FrozenSet[int]
+    special_features: FrozenSet[int]
+    policy_url: str
+    deleted_date: Optional[str]
+
+
+class GlobalVendorList:
+    """Index of a version of the Global Vendor List
+
+    Parameters
+    ----------
+    data : dict
+        the parsed vendor list JSON
+    """
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self.version: int = data.get("vendorListVersion", 0)
+        self.tcf_policy_version: int = data.get("tcfPolicyVersion", 0)
+        self.last_updated: str = data.get("lastUpdated", "")
+
+        def names(section: str) -> Dict[int, str]:
+            return {
+                int(key): value.get("name", "")
+                for key, value in data.get(section, dict()).items()
+            }
+
+        self.purposes = names("purposes")
+        self.special_purposes = names("specialPurposes")
+        self.features = names("features")
+        self.special_features = names("specialFeatures")
+        self.vendors: Dict[int, Vendor] = dict()
+        for key, vendor in data.get("vendors", dict()).items():
+            self.vendors[int(key)] = Vendor(
+                int(key),
+                vendor.get("name", ""),
+                frozenset(vendor.get("purposes", ())),
+                frozenset(vendor.get("legIntPurposes", ())),
+                frozenset(vendor.get("flexiblePurposes", ())),
+                frozenset(vendor.get("specialPurposes", ())),
+                frozenset(vendor.get("features", ())),
+                frozenset(vendor.get("specialFeatures", ())),
+                vendor.get("policyUrl", ""),
+                vendor.get("deletedDate"),
+            )
+        self.max_vendor_id = max(self.vendors, default=0)
+        # purpose id to the vendors that declare it, for consent or for
+        # legitimate interest
+        self._by_purpose: Dict[int, List[int]] = dict()
+        self._by_li_purpose: Dict[int, List[int]] = dict()
+        for vendor_id in sorted(self.vendors):
+            vendor = self.vendors[vendor_id]
+            for purpose_id in vendor.purposes:
+                self._by_purpose.setdefault(purpose_id, list()).append(vendor_id)
+            for purpose_id in vendor.legitimate_interest_purposes:
+                self._by_li_purpose.setdefault(purpose_id, list()).append(vendor_id)
+
+    @classmethod
+    def from_file(cls, path: str = VENDOR_LIST) -> "GlobalVendorList":
+        with open(path, "r") as f:
+            return cls(json.load(f))
+
+    def vendor_name(self, vendor_id: int) -> str:
+        """Return the name of vendor `vendor_id`, or "" if it isn't listed"""
+        vendor = self.vendors.get(vendor_id)
+        return vendor.name if vendor is not None else ""
+
+    def vendors_for_purpose(
+        self, purpose_id: int, legitimate_interest: bool = False
+    ) -> List[int]:
+        """Return the ids of the vendors that declare `purpose_id`, based on
+        consent or, with `legitimate_interest`, on legitimate interest"""
+        index = self._by_li_purpose if legitimate_interest else self._by_purpose
+        return list(index.get(purpose_id, ()))
+
+    def vendor_mask(
+        self, vendor_ids: Iterable[int], width: Optional[int] = None
+    ) -> np.ndarray:
+        """Return `vendor_ids` as a packed bit array laid out like the vendor
+        bitsets of `tcstring.TCBatch`, `width` (default `max_vendor_id`)
+        bits long, e.g. to count the consents given to the vendors that
+        declare a purpose:
+
+            mask = gvl.vendor_mask(gvl.vendors_for_purpose(1), width)
+            np.unpackbits(batch.vendor_consents & mask, axis=1).sum(axis=1)
+        """
+        if width is None:
+            width = self.max_vendor_id
+        bits = np.zeros(-(-width // 8) * 8, dtype=bool)
+        ids = np.fromiter((i for i in vendor_ids if 0 < i <= width), dtype=np.int64)
+        bits[ids - 1] = True
+        return np.packbits(bits)
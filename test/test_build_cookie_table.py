@@ -0,0 +1,129 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from openwpm.utilities import build_cookie_table
+
+pytestmark = pytest.mark.pyonly
+
+
+def headers(*pairs):
+    return json.dumps([list(pair) for pair in pairs])
+
+
+def add_headers(db, start, count):
+    con = sqlite3.connect(db)
+    for i in range(start, start + count):
+        con.execute(
+            "INSERT INTO http_requests (id, browser_id, headers, time_stamp) "
+            "VALUES (?, 1, ?, 't')",
+            (i, headers(("Accept", "*/*"), ("cookie", "a=%d; b=x" % i))),
+        )
+        con.execute(
+            "INSERT INTO http_responses (id, browser_id, url, headers, time_stamp) "
+            "VALUES (?, 1, 'https://example.test/dir/page.html', ?, 't')",
+            (
+                i,
+                headers(
+                    (
+                        "Set-Cookie",
+                        "id=%d; Domain=example.test; HttpOnly; SameSite=Lax; "
+                        "Expires=Wed, 21 Oct 2037 07:28:00 GMT" % i,
+                    )
+                ),
+            ),
+        )
+    # Headers without cookies still advance the high-water mark
+    con.execute(
+        "INSERT INTO http_requests (id, browser_id, headers, time_stamp) "
+        "VALUES (?, 1, '[]', 't')",
+        (start + count,),
+    )
+    con.commit()
+    con.close()
+
+
+@pytest.fixture
+def db(tmpdir):
+    db = os.path.join(str(tmpdir), "crawl-data.sqlite")
+    con = sqlite3.connect(db)
+    con.execute(
+        "CREATE TABLE http_requests (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "browser_id INTEGER, headers TEXT, time_stamp TEXT)"
+    )
+    con.execute(
+        "CREATE TABLE http_responses (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "browser_id INTEGER, url TEXT, headers TEXT, time_stamp TEXT)"
+    )
+    con.commit()
+    con.close()
+    return db
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_build_http_cookie_table(db, workers):
+    add_headers(db, 1, 25)
+    assert build_cookie_table.build_http_cookie_table(
+        db, workers=workers, chunk_size=4
+    ) == (50, 25)
+
+    con = sqlite3.connect(db)
+    rows = con.execute(
+        "SELECT header_id, name, value FROM http_request_cookies ORDER BY id"
+    ).fetchall()
+    assert rows[:2] == [(1, "a", "1"), (1, "b", "x")]
+    row = con.execute(
+        "SELECT name, value, domain, path, expires, httponly, secure, samesite "
+        "FROM http_response_cookies WHERE header_id = 3"
+    ).fetchone()
+    assert row == (
+        "id",
+        "3",
+        ".example.test",
+        "/dir",
+        "2037-10-21 07:28:00",
+        1,
+        0,
+        "Lax",
+    )
+    con.close()
+
+    # A second run only processes the rows added in the meantime
+    assert build_cookie_table.build_http_cookie_table(
+        db, workers=workers, chunk_size=4
+    ) == (0, 0)
+    add_headers(db, 100, 5)
+    assert build_cookie_table.build_http_cookie_table(
+        db, workers=workers, chunk_size=4
+    ) == (10, 5)
+    con = sqlite3.connect(db)
+    (count,) = con.execute(
+        "SELECT COUNT(DISTINCT header_id) FROM http_response_cookies"
+    ).fetchone()
+    con.close()
+    assert count == 30
+
+
+def test_get_header_values():
+    assert build_cookie_table.get_header_values(
+        "[['Cookie', 'a=1'], ['COOKIE', 'b=2']]", "cookie"
+    ) == ["a=1", "b=2"]
+    assert build_cookie_table.get_header_values("not headers", "Cookie") == []
+
+
+def test_upgrade_response_cookie_table(db):
+    con = sqlite3.connect(db)
+    con.execute(
+        "CREATE TABLE http_response_cookies (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "browser_id INTEGER NOT NULL, header_id INTEGER NOT NULL, "
+        "name VARCHAR(200) NOT NULL, value TEXT NOT NULL, domain VARCHAR(500), "
+        "path VARCHAR(500), expires DATETIME, max_age REAL, httponly BOOLEAN, "
+        "secure BOOLEAN, comment VARCHAR(200), version VARCHAR(100), "
+        "accessed DATETIME)"
+    )
+    con.commit()
+    con.close()
+    add_headers(db, 1, 2)
+    assert build_cookie_table.build_http_cookie_table(db, workers=1) == (4, 2)
@@ -0,0 +1,54 @@
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from openwpm.DataAggregator.parquet_schema import PQ_SCHEMAS
+from openwpm.DataAggregator.ParquetAggregator import ColumnBuffer
+
+pytestmark = pytest.mark.pyonly
+
+
+def make_request(i):
+    return {
+        "browser_id": 1,
+        "visit_id": 2,
+        "instance_id": 1,
+        "url": "https://example.com/%d.js" % i,
+        "method": "GET",
+        "referrer": "",
+        "headers": "[]",
+        "request_id": i,
+        "is_XHR": i % 2,  # integers instead of booleans
+        "resource_type": "script",
+        "time_stamp": "2020-01-01T00:00:00.000Z",
+        "unknown_column": "dropped",
+    }
+
+
+def test_matches_pandas_conversion():
+    records = [make_request(i) for i in range(10)]
+    buffer = ColumnBuffer("http_requests")
+    for record in records:
+        buffer.append(record)
+    assert buffer.num_rows == 10
+
+    schema = PQ_SCHEMAS["http_requests"]
+    padded = [{name: r.get(name) for name in schema.names} for r in records]
+    expected = pa.RecordBatch.from_pandas(
+        pd.DataFrame(padded), schema=schema, preserve_index=False
+    )
+    assert buffer.to_batch().equals(expected)
+
+
+def test_rows():
+    buffer = ColumnBuffer("site_visits")
+    buffer.append({"visit_id": 1, "browser_id": 2, "site_url": "https://a.com"})
+    assert buffer.rows() == [
+        {
+            "visit_id": 1,
+            "browser_id": 2,
+            "instance_id": None,
+            "site_url": "https://a.com",
+            "site_rank": None,
+        }
+    ]
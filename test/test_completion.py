@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+
+import pytest
+
+from openwpm import TaskManager
+from openwpm.DataAggregator.BaseAggregator import (
+    ACTION_TYPE_FINALIZE,
+    ACTION_TYPE_INITIALIZE,
+    RECORD_TYPE_SPECIAL,
+)
+from openwpm.DataAggregator.LocalAggregator import LocalAggregator
+from openwpm.DataAggregator.ParquetAggregator import CACHE_SIZE, ParquetAggregator
+from openwpm.SocketInterface import clientsocket
+
+pytestmark = pytest.mark.pyonly
+
+
+@pytest.fixture
+def aggregator(tmpdir):
+    manager_params, browser_params = TaskManager.load_default_params(1)
+    manager_params["data_directory"] = str(tmpdir)
+    manager_params["database_name"] = os.path.join(str(tmpdir), "crawl-data.sqlite")
+    browser_params[0]["browser_id"] = 1
+    aggregator = LocalAggregator(manager_params, browser_params)
+    aggregator.launch()
+    yield aggregator
+    aggregator.shutdown()
+
+
+def send_visit(sock, visit_id, success=True):
+    sock.send(
+        (RECORD_TYPE_SPECIAL, {"action": ACTION_TYPE_INITIALIZE, "visit_id": visit_id})
+    )
+    sock.send(("site_visits", {"visit_id": visit_id, "browser_id": 1}))
+    sock.send(
+        (
+            RECORD_TYPE_SPECIAL,
+            {"action": ACTION_TYPE_FINALIZE, "visit_id": visit_id, "success": success},
+        )
+    )
+
+
+def test_wait_for_completed_visits(aggregator):
+    sock = clientsocket(serialization="dill")
+    sock.connect(*aggregator.listener_address)
+    assert aggregator.wait_for_completed_visits(timeout=0.1) == []
+
+    send_visit(sock, 1)
+    (completed,) = aggregator.wait_for_completed_visits(timeout=10)
+    assert completed[:2] == (1, False)
+    # The visit is reported right after the listener saved it
+    assert time.time() - completed[2] < 1
+
+    for visit_id in (2, 3, 4):
+        send_visit(sock, visit_id, success=visit_id != 4)
+    completed = list()
+    while len(completed) < 3:
+        completed.extend(
+            aggregator.wait_for_completed_visits(
+                timeout=10, batch_size=3, batch_delay=5
+            )
+        )
+    assert [visit[:2] for visit in completed] == [(2, False), (3, False), (4, True)]
+    sock.close()
+
+
+def test_wake_completion_waiters(aggregator):
+    results = list()
+    thread = threading.Thread(
+        target=lambda: results.append(aggregator.wait_for_completed_visits())
+    )
+    thread.start()
+    time.sleep(0.2)
+    aggregator.wake_completion_waiters()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert results == [[]]
+
+
+def test_parquet_completion_with_journal(tmpdir):
+    manager_params, browser_params = TaskManager.load_default_params(1)
+    manager_params["data_directory"] = str(tmpdir)
+    manager_params["output_format"] = "parquet"
+    manager_params["aggregator_journal"] = True
+    manager_params["parquet_max_file_age"] = 3600
+    aggregator = ParquetAggregator(manager_params, browser_params)
+    aggregator.launch()
+    sock = clientsocket(serialization="dill")
+    sock.connect(*aggregator.listener_address)
+    # Enough visits to fill a batch, which is written to the open files
+    for visit_id in range(CACHE_SIZE + 1):
+        send_visit(sock, visit_id)
+    completed = list()
+    deadline = time.time() + 10
+    while len(completed) <= CACHE_SIZE and time.time() < deadline:
+        completed.extend(aggregator.wait_for_completed_visits(timeout=1))
+    # The visits are complete before their files are rolled
+    assert len(completed) == CACHE_SIZE + 1
+    assert not any(interrupted for _, interrupted, _ in completed)
+    sock.close()
+    aggregator.shutdown()
@@ -0,0 +1,130 @@
+import gzip
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from multiprocess import Queue
+
+from openwpm.DataAggregator import ParquetAggregator
+from openwpm.DataAggregator.BaseAggregator import FlowControl
+from openwpm.DataAggregator.ParquetAggregator import PARQUET_DIRECTORY, ParquetListener
+from openwpm.DataAggregator.uploader import LocalUploader
+from openwpm.utilities.benchmark_compression import benchmark
+from openwpm.utilities.compression import (
+    CODECS,
+    DEFAULT_POLICY,
+    codec_from_name,
+    compress,
+    decompress,
+    extension,
+    get_codec,
+    validate_policy,
+)
+
+pytestmark = pytest.mark.pyonly
+
+DATA = b"<html><body>" + b"openwpm " * 1000 + b"</body></html>"
+
+
+@pytest.mark.parametrize("codec", ["zstd", "lz4", "gzip", "none"])
+@pytest.mark.parametrize("level", [None, 1])
+def test_roundtrip(codec, level):
+    compressed = compress(DATA, codec, level)
+    if codec != "none":
+        assert len(compressed) < len(DATA)
+    assert decompress(compressed, codec) == DATA
+    assert codec_from_name("file.json" + extension(codec)) == codec
+
+
+def test_policy():
+    validate_policy(DEFAULT_POLICY)
+    assert get_codec({}, "content") == ("gzip", None)
+    params = {"compression": {"content": {"codec": "zstd", "level": 10}}}
+    assert get_codec(params, "content") == ("zstd", 10)
+    assert get_codec(params, "parquet") == ("snappy", None)
+    for policy in (
+        {"videos": {"codec": "gzip"}},
+        {"leveldb": {"codec": "zstd"}},
+        {"content": {"codec": "brotli"}},
+        {"content": {"codec": "gzip", "level": "high"}},
+        {"parquet": {"codec": "snappy", "level": 3}},
+        {"leveldb": {"codec": "none", "level": 1}},
+    ):
+        with pytest.raises(ValueError):
+            validate_policy(policy)
+    assert set(CODECS) == set(DEFAULT_POLICY)
+
+
+def test_listener_uses_policy(tmpdir, monkeypatch):
+    monkeypatch.setattr(ParquetAggregator, "CACHE_SIZE", 0)
+    manager_params = {
+        "data_directory": str(tmpdir),
+        "s3_upload_threads": 2,
+        "parquet_target_file_size": 2 ** 20,
+        "parquet_max_file_age": 3600,
+        "visit_memory_budget": 0,
+        "compression": {
+            "parquet": {"codec": "zstd", "level": 5},
+            "content": {"codec": "zstd", "level": None},
+            "site_index": {"codec": "none", "level": None},
+        },
+    }
+    completion_queue = Queue()
+    base_params = (Queue(), completion_queue, Queue(), FlowControl(None), None)
+    uploader = LocalUploader(str(tmpdir), num_threads=2)
+    listener = ParquetListener(
+        base_params, manager_params, 1, PARQUET_DIRECTORY, uploader
+    )
+    listener.startup()
+    listener.process_record(
+        (
+            "site_visits",
+            {"visit_id": 5, "browser_id": 1, "site_url": "https://example.com"},
+        )
+    )
+    listener.process_record(("page_content", ("Y29udGVudA==", "abc")))
+    listener.run_visit_completion_tasks(5)
+    listener.complete_uploaded_visits(block=True)
+    assert completion_queue.get(timeout=5)[:2] == (5, False)
+    listener.shutdown()
+
+    root = str(tmpdir.join(PARQUET_DIRECTORY))
+    with open(os.path.join(root, "content", "abc.zst"), "rb") as f:
+        assert decompress(f.read(), "zstd") == b"content"
+    (index,) = os.listdir(os.path.join(root, "site_index"))
+    assert index.endswith(".json")
+    with open(os.path.join(root, "site_index", index)) as f:
+        assert json.loads(f.read())["site_url"] == "https://example.com"
+    (directory,) = os.listdir(os.path.join(root, "visits", "site_visits"))
+    (name,) = os.listdir(os.path.join(root, "visits", "site_visits", directory))
+    metadata = pq.ParquetFile(
+        os.path.join(root, "visits", "site_visits", directory, name)
+    ).metadata
+    assert metadata.row_group(0).column(0).compression == "ZSTD"
+
+
+def test_benchmark(tmpdir):
+    os.makedirs(str(tmpdir.join("sources")))
+    for i in range(3):
+        with gzip.open(str(tmpdir.join("sources", "%d-abc.json.gz" % i)), "wb") as f:
+            f.write(DATA)
+    pq.write_table(
+        pa.table({"value": ["x" * 100] * 100}), str(tmpdir.join("table.parquet"))
+    )
+    results = benchmark(str(tmpdir))
+    assert set(results) == {"parquet", "page_source"}
+    for codec, level, size, out, cpu in results["page_source"]:
+        assert size == 3 * len(DATA)
+        if codec != "none":
+            assert out < size
+
+
+def test_local_uploader_existing_keys(tmpdir):
+    uploader = LocalUploader(str(tmpdir), num_threads=2)
+    futures = [uploader.submit("dir/content/%02x.gz" % i, b"x") for i in range(3)]
+    assert uploader.wait(futures)
+    uploader.shutdown()
+    keys = ["dir/content/%02x.gz" % i for i in range(6)]
+    assert uploader.existing_keys(keys, len("dir/content/")) == set(keys[:3])
@@ -0,0 +1,53 @@
+import pytest
+
+from openwpm.DataAggregator.content_index import BloomFilter, ContentHashIndex
+
+pytestmark = pytest.mark.pyonly
+
+
+def test_bloom_filter_membership():
+    bloom = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom.add("hash-%d" % i)
+    assert all("hash-%d" % i in bloom for i in range(1000))
+    false_positives = sum("other-%d" % i in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_lookup_order():
+    store = {"stored"}
+    queried = list()
+
+    def exists(key):
+        queried.append(key)
+        return key in store
+
+    index = ContentHashIndex(capacity=100, lru_size=2)
+    index.warm(store)
+    # Not in the filter: the store is never queried
+    assert not index.lookup("new", exists)
+    assert queried == []
+    # In the filter but not the LRU: the store answers
+    assert index.lookup("stored", exists)
+    assert queried == ["stored"]
+    # Now in the LRU
+    assert index.lookup("stored", exists)
+    assert queried == ["stored"]
+    index.add("new")
+    assert index.lookup("new", exists)
+    stats = index.stats()
+    assert stats["lookups"] == 4
+    assert stats["lru_hits"] == 2
+    assert stats["bloom_misses"] == 1
+    assert stats["store_hits"] == 1
+    assert stats["hit_rate"] == 0.75
+
+
+def test_lru_is_bounded():
+    index = ContentHashIndex(capacity=100, lru_size=2)
+    for key in ("a", "b", "c"):
+        index.add(key)
+    # "a" was evicted from the LRU but is still in the filter
+    assert index.lookup("a", lambda key: True)
+    assert index.stats()["store_hits"] == 1
+    assert len(index._lru) == 2
@@ -0,0 +1,77 @@
+import os
+import sqlite3
+
+import plyvel
+import pytest
+
+from openwpm.utilities import content_scanner
+from openwpm.utilities.content_scanner import SignatureMatcher
+
+pytestmark = pytest.mark.pyonly
+
+CONTENT = {
+    b"a" * 64: b"window.__tcfapiLocator || (window.__tcfapi = function() {})",
+    b"b" * 64: b"<script src='https://cdn.cookielaw.org/scripttemplates/otSDKStub.js'>",
+    b"c" * 64: b"function __CMP(command) { __uspapi('getUSPData', 1); }",
+    b"d" * 64: b"console.log('nothing to see here')",
+}
+
+
+def test_matcher():
+    matcher = SignatureMatcher({"a": ["abc"], "b": ["bcd"], "c": ["ab"]})
+    assert sorted(matcher.match(b"xABcd abc")) == [
+        ("a", "abc", 2, 1),
+        ("b", "bcd", 1, 2),
+        ("c", "ab", 2, 1),
+    ]
+    matcher = SignatureMatcher({"a": ["abc"]}, case_sensitive=True)
+    assert matcher.match(b"ABC") == []
+    with pytest.raises(ValueError):
+        SignatureMatcher({"a": [""]})
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_scan_content(tmpdir, workers):
+    data_directory = str(tmpdir)
+    db = plyvel.DB(
+        os.path.join(data_directory, "content.ldb"),
+        create_if_missing=True,
+        compression="snappy",
+    )
+    for content_hash, content in CONTENT.items():
+        db.put(content_hash, content)
+    db.close()
+    database = os.path.join(data_directory, "crawl-data.sqlite")
+
+    stats = content_scanner.scan_content(
+        data_directory, database, workers=workers, batch_bytes=100
+    )
+    assert stats["contents"] == 4
+    assert stats["bytes"] == sum(len(content) for content in CONTENT.values())
+    assert stats["matched"] == 3
+
+    con = sqlite3.connect(database)
+    rows = con.execute(
+        "SELECT content_hash, signature, matches FROM content_signatures"
+    ).fetchall()
+    con.close()
+    assert sorted((h[0], s, m) for h, s, m in rows) == [
+        ("a", "tcfapi", 2),
+        ("a", "tcfapi_locator", 1),
+        ("b", "onetrust", 1),
+        ("b", "onetrust", 1),
+        ("c", "cmp", 1),
+        ("c", "uspapi", 1),
+    ]
+
+    # Scanning only some hashes, dumping the bodies that match
+    dump = os.path.join(data_directory, "dump")
+    stats = content_scanner.scan_content(
+        data_directory,
+        database,
+        workers=workers,
+        hashes=[(b"c" * 64).decode(), (b"d" * 64).decode()],
+        dump_directory=dump,
+    )
+    assert stats["contents"] == 2
+    assert os.listdir(dump) == [(b"c" * 64).decode()]
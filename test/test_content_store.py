@@ -0,0 +1,99 @@
+import os
+
+import plyvel
+import pytest
+
+from openwpm.DataAggregator import content_store
+from openwpm.DataAggregator.content_store import (
+    CONTENT_STORE_NAME,
+    ContentStore,
+    migrate_leveldb,
+)
+from openwpm.utilities import db_utils
+
+pytestmark = pytest.mark.pyonly
+
+
+def make_script(i):
+    return (
+        "window.__tcfapi = function(command, version, callback) {"
+        "  var vendor = %d; callback({cmpId: vendor, gdprApplies: true}); };" % i
+    ).encode("utf-8") * 5
+
+
+def test_roundtrip_and_dictionary(tmpdir, monkeypatch):
+    monkeypatch.setattr(content_store, "DICT_TRAINING_SAMPLES", 100)
+    monkeypatch.setattr(content_store, "PACK_SIZE", 4096)
+    path = str(tmpdir.join(CONTENT_STORE_NAME))
+    store = ContentStore(path, create_if_missing=True)
+    for start in range(0, 300, 50):
+        batch = store.write_batch()
+        for i in range(start, start + 50):
+            batch.put(b"hash%d" % i, make_script(i))
+        batch.write()
+    assert store.get("hash0") == make_script(0)
+    assert store.get(b"hash299") == make_script(299)
+    assert store.get("missing") is None
+    assert "hash42" in store
+    store.close()
+
+    store = ContentStore(path)
+    dictionaries = store._index.execute(
+        "SELECT dictionary, COUNT(*) FROM blobs GROUP BY dictionary"
+    ).fetchall()
+    # The dictionary is trained before writing the batch that completes the
+    # sample, so only the first batch is compressed without it
+    assert dict(dictionaries) == {None: 50, 1: 250}
+    assert len([name for name in os.listdir(path) if name.endswith(".pack")]) > 1
+    with store.iterator() as it:
+        items = dict(it)
+    assert len(items) == 300
+    assert items[b"hash150"] == make_script(150)
+    store.put("hash300", b"new")
+    assert store.get("hash300") == b"new"
+    store.close()
+
+
+def test_reads_and_duplicates_leave_packs_alone(tmpdir):
+    path = str(tmpdir.join(CONTENT_STORE_NAME))
+    store = ContentStore(path, create_if_missing=True)
+    store.put("hash0", make_script(0))
+    store.close()
+    pack = os.path.join(path, content_store.PACK_NAME % 0)
+    size = os.path.getsize(pack)
+
+    store = ContentStore(path)
+    assert store.get("hash0") == make_script(0)
+    # Reading doesn't open a packfile for writing
+    assert store._pack_file is None
+    store.close()
+
+    # Blobs that are already stored don't append orphan frames
+    store = ContentStore(path)
+    batch = store.write_batch()
+    batch.put("hash0", make_script(0))
+    batch.put("hash1", make_script(1))
+    batch.write()
+    store.put("hash1", make_script(1))
+    assert store.get("hash1") == make_script(1)
+    assert store.stats()["compressed_size"] == os.path.getsize(pack)
+    assert os.path.getsize(pack) > size
+    store.close()
+
+
+def test_migrate_leveldb(tmpdir, monkeypatch):
+    monkeypatch.setattr(content_store, "DICT_TRAINING_SAMPLES", 100)
+    ldb_path = str(tmpdir.join(db_utils.CONTENT_DB_NAME))
+    ldb = plyvel.DB(ldb_path, create_if_missing=True, compression="snappy")
+    for i in range(200):
+        ldb.put(b"hash%d" % i, make_script(i))
+    ldb.close()
+
+    store_path = str(tmpdir.join(CONTENT_STORE_NAME))
+    results = migrate_leveldb(ldb_path, store_path, batch_size=64)
+    assert results["blobs"] == 200
+    assert results["size"] == sum(len(make_script(i)) for i in range(200))
+
+    content = dict(db_utils.get_content(str(tmpdir)))
+    assert len(content) == 200
+    assert content[b"hash7"] == make_script(7)
@@ -0,0 +1,54 @@
+import pytest
+
+from openwpm.utilities import Cookie
+from openwpm.utilities.cookie_parser import (
+    SetCookie,
+    parse_cookie_header,
+    parse_cookie_headers,
+    parse_set_cookie_header,
+    parse_set_cookie_headers,
+)
+
+pytestmark = pytest.mark.pyonly
+
+
+def test_set_cookie_attributes():
+    (cookie,) = parse_set_cookie_header(
+        "id=a1; Domain=example.test; Path=/a=b; Max-Age=60; secure; HTTPONLY; "
+        "SameSite=none; Partitioned; Priority=HIGH; Unknown=1"
+    )
+    assert cookie == SetCookie(
+        "id",
+        "a1",
+        domain="example.test",
+        path="/a=b",
+        max_age=60,
+        secure=True,
+        httponly=True,
+        samesite="None",
+        partitioned=True,
+        priority="High",
+    )
+    # The vendored Cookie module reads unknown attributes as more cookies
+    assert "SameSite" in Cookie.BaseCookie("id=a1; SameSite=Lax")
+
+
+def test_set_cookie_lines():
+    cookies = parse_set_cookie_header(
+        'uid="a,b"; expires=Thu, 01-Jan-1970 00:00:01 GMT; Max-Age=soon\n'
+        "nameless; path=/\n"
+        " ; SameSite=Lax"
+    )
+    assert [(c.name, c.value) for c in cookies] == [("uid", '"a,b"'), ("", "nameless")]
+    assert cookies[0].expires == "Thu, 01-Jan-1970 00:00:01 GMT"
+    assert cookies[0].max_age is None
+    assert cookies[1].path == "/"
+
+
+def test_batches():
+    headers = ["a=1; Secure", "b=2", "a=1; Secure"]
+    parsed = parse_set_cookie_headers(headers)
+    assert [[c.name for c in cookies] for cookies in parsed] == [["a"], ["b"], ["a"]]
+    assert parsed[0] is parsed[2]
+    assert parse_cookie_headers(["a=1; b = 2 ;", ""]) == [[("a", "1"), ("b", "2")], []]
+    assert parse_cookie_header("c") == [("", "c")]
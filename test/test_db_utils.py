@@ -0,0 +1,154 @@
+import os
+import sqlite3
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from openwpm.utilities import db_utils
+
+pytestmark = pytest.mark.pyonly
+
+ROWS = [
+    (visit_id, "https://example.test/%d.js" % i, "window.name", "get", str(i), "")
+    for visit_id in range(10)
+    for i in range(25)
+]
+
+
+@pytest.fixture
+def sqlite_db(tmpdir):
+    db = os.path.join(str(tmpdir), "crawl-data.sqlite")
+    con = sqlite3.connect(db)
+    con.execute(
+        "CREATE TABLE javascript (visit_id INTEGER, script_url TEXT, "
+        "symbol TEXT, operation TEXT, value TEXT, arguments TEXT)"
+    )
+    con.executemany("INSERT INTO javascript VALUES (?, ?, ?, ?, ?, ?)", ROWS)
+    con.execute("CREATE TABLE crawl_history (command TEXT, command_status TEXT)")
+    con.executemany(
+        "INSERT INTO crawl_history VALUES (?, ?)",
+        [("GetCommand", "ok"), ("BrowseCommand", "ok")],
+    )
+    con.commit()
+    con.close()
+    return db
+
+
+@pytest.fixture
+def parquet_dir(tmpdir):
+    root = os.path.join(str(tmpdir), "parquet")
+    columns = list(zip(*ROWS))
+    for instance_id in (1, 2):
+        half = [
+            column[(instance_id - 1) * 125 : instance_id * 125] for column in columns
+        ]
+        table = pa.Table.from_arrays(
+            [pa.array(half[0], pa.int64())]
+            + [pa.array(c, pa.string()) for c in half[1:]],
+            names=["visit_id"] + db_utils.JAVASCRIPT_COLUMNS,
+        )
+        directory = os.path.join(
+            root, "visits", "javascript", "instance_id=%d" % instance_id
+        )
+        os.makedirs(directory)
+        # Several small row groups, to check that chunks are recombined
+        pq.write_table(table, os.path.join(directory, "a.parquet"), row_group_size=7)
+    history = pa.Table.from_arrays(
+        [
+            pa.array(["GetCommand", "BrowseCommand"], pa.string()),
+            pa.array(["ok", None], pa.string()),
+        ],
+        names=["command", "command_status"],
+    )
+    directory = os.path.join(root, "visits", "crawl_history", "instance_id=1")
+    os.makedirs(directory)
+    pq.write_table(history, os.path.join(directory, "a.parquet"))
+    return root
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "parquet"])
+def test_stream_table(backend, sqlite_db, parquet_dir):
+    db = sqlite_db if backend == "sqlite" else parquet_dir
+    chunks = list(db_utils.iter_javascript_entries(db, chunk_size=60))
+    assert [len(chunk) for chunk in chunks] == [60, 60, 60, 60, 10]
+    assert sorted(row for chunk in chunks for row in chunk) == sorted(
+        row[1:] for row in ROWS
+    )
+
+    visit_ids = [2, 5]
+    batches = list(
+        db_utils.stream_table(
+            db,
+            "javascript",
+            columns=["visit_id", "value"],
+            where={"visit_id": visit_ids},
+            output="arrow",
+        )
+    )
+    assert all(isinstance(batch, pa.RecordBatch) for batch in batches)
+    values = pa.Table.from_batches(batches).to_pydict()
+    assert sorted(set(values["visit_id"])) == visit_ids
+    assert len(values["value"]) == 50
+
+    (array,) = db_utils.stream_table(
+        db, "javascript", where={"visit_id": 3, "value": "7"}, output="numpy"
+    )
+    assert array.shape == (1,)
+    assert array["script_url"][0] == "https://example.test/7.js"
+
+    (chunk,) = db_utils.stream_table(
+        db, "javascript", columns=["symbol"], where={"visit_id": 1}, output="dicts"
+    )
+    assert chunk[0] == {"symbol": "window.name"}
+
+
+def test_long_in_predicate(sqlite_db):
+    visit_ids = list(range(1, db_utils.MAX_IN_PARAMS + 100))
+    rows = [
+        row
+        for chunk in db_utils.stream_table(
+            sqlite_db, "javascript", columns=["visit_id"], where={"visit_id": visit_ids}
+        )
+        for row in chunk
+    ]
+    assert len(rows) == 9 * 25
+
+
+def test_unknown_column(sqlite_db):
+    with pytest.raises(ValueError):
+        list(db_utils.stream_table(sqlite_db, "javascript", columns=["x; DROP"]))
+
+
+def test_any_command_failed(sqlite_db, parquet_dir):
+    assert not db_utils.any_command_failed(sqlite_db)
+    con = sqlite3.connect(sqlite_db)
+    con.execute("INSERT INTO crawl_history VALUES ('GetCommand', NULL)")
+    con.commit()
+    con.close()
+    assert db_utils.any_command_failed(sqlite_db)
+    assert db_utils.any_command_failed(parquet_dir)
+
+
+def test_arrow_chunks_share_a_schema(tmpdir):
+    db = os.path.join(str(tmpdir), "crawl-data.sqlite")
+    con = sqlite3.connect(db)
+    con.execute("CREATE TABLE javascript (visit_id INTEGER, value TEXT, extra)")
+    # `value` is NULL in the first chunk, `visit_id` holds text later on
+    con.executemany(
+        "INSERT INTO javascript VALUES (?, ?, ?)",
+        [(1, None, None), (2, None, 1), (3, "x", "y"), ("4", 5, 2.5)],
+    )
+    con.commit()
+    con.close()
+    for chunks in (
+        db_utils.stream_table(db, "javascript", chunk_size=2, output="arrow"),
+        db_utils.iter_query(
+            db, "SELECT * FROM javascript", chunk_size=2, output="arrow"
+        ),
+    ):
+        table = pa.Table.from_batches(list(chunks))
+        assert table.schema.field("visit_id").type == pa.int64()
+        assert table.schema.field("value").type == pa.string()
+        assert table.column("visit_id").to_pylist() == [1, 2, 3, 4]
+        assert table.column("value").to_pylist() == [None, None, "x", "5"]
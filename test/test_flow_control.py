@@ -0,0 +1,140 @@
+import threading
+import time
+
+import pytest
+
+from openwpm.DataAggregator.BaseAggregator import (
+    STATUS_TIMEOUT,
+    BaseAggregator,
+    FlowControl,
+    ShardQueue,
+)
+from openwpm.SocketInterface import RecordQueue, clientsocket, serversocket
+
+pytestmark = pytest.mark.pyonly
+
+
+def test_record_queue_accounting():
+    queue = RecordQueue()
+    queue.put((("http_requests", {"a": 1}), 100))
+    queue.put((("http_requests", {"a": 2}), 50))
+    queue.put((("page_content", ("x", "y")), 1000))
+    assert queue.qsize() == 3
+    assert queue.bytesize() == 1150
+    assert queue.table_stats() == {
+        "http_requests": (2, 150),
+        "page_content": (1, 1000),
+    }
+    assert queue.get() == ("http_requests", {"a": 1})
+    queue.get()
+    assert queue.table_stats() == {"page_content": (1, 1000)}
+    queue.get()
+    assert queue.bytesize() == 0
+    assert queue.empty()
+
+
+def test_record_queue_blocks_when_full():
+    queue = RecordQueue(max_bytes=100)
+    queue.put((("javascript", {}), 150))
+    put_done = threading.Event()
+
+    def producer():
+        queue.put((("javascript", {}), 10))
+        put_done.set()
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    assert not put_done.wait(0.2)
+    queue.get()
+    assert put_done.wait(5)
+    thread.join()
+    assert queue.bytesize() == 10
+
+
+def test_shard_queue_blocks_when_full():
+    queue = ShardQueue(max_bytes=100)
+    queue.put(("javascript", {"data": "x" * 150}))
+    assert queue.bytesize() > 150
+    put_done = threading.Event()
+
+    def producer():
+        queue.put(("javascript", {}))
+        put_done.set()
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    assert not put_done.wait(0.2)
+    assert queue.get(timeout=5) == ("javascript", {"data": "x" * 150})
+    assert put_done.wait(5)
+    thread.join()
+    assert queue.get(timeout=5) == ("javascript", {})
+    assert queue.bytesize() == 0
+
+
+def test_flow_control_hysteresis():
+    flow_control = FlowControl(1000)
+    assert flow_control.has_credit()
+    flow_control.update(999)
+    assert flow_control.has_credit()
+    flow_control.update(1000)
+    assert not flow_control.has_credit()
+    assert not flow_control.wait(timeout=0.01)
+    flow_control.update(501)
+    assert not flow_control.has_credit()
+    flow_control.update(500)
+    assert flow_control.has_credit()
+    assert flow_control.wait(timeout=0.01)
+
+
+def test_flow_control_disabled():
+    flow_control = FlowControl(None)
+    flow_control.update(10 ** 12)
+    assert flow_control.has_credit()
+    assert flow_control.hard_limit == 0
+
+
+def test_serversocket_tracks_bytes():
+    server = serversocket(name="test")
+    server.start_accepting()
+    client = clientsocket(serialization="json")
+    client.connect(*server.sock.getsockname())
+    client.send(["site_visits", {"visit_id": 1}])
+    client.send(["site_visits", {"visit_id": 2}])
+    deadline = time.time() + 5
+    while server.queue.qsize() < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    depth, size = server.queue.table_stats()["site_visits"]
+    assert depth == 2
+    assert size == server.queue.bytesize() > 0
+    assert server.queue.get() == ["site_visits", {"visit_id": 1}]
+    client.close()
+    server.close()
+
+
+def make_aggregator():
+    manager_params = {
+        "aggregator_queue_bytes_limit": 1000,
+        "aggregator_shards": 1,
+        "aggregator_journal": False,
+    }
+    aggregator = BaseAggregator(manager_params, [])
+    aggregator._last_status_received = time.time()
+    return aggregator
+
+
+def test_wait_for_credit_drains_status_queue():
+    aggregator = make_aggregator()
+    for queue_size in range(3):
+        aggregator.status_queue.put({"queue_size": queue_size})
+    # Items put on a multiprocess queue become visible asynchronously
+    time.sleep(0.1)
+    aggregator.wait_for_credit()
+    assert aggregator.status_queue.empty()
+    assert aggregator._last_status == {"queue_size": 2}
+
+
+def test_wait_for_credit_detects_stalled_listener():
+    aggregator = make_aggregator()
+    aggregator._last_status_received = time.time() - STATUS_TIMEOUT - 1
+    with pytest.raises(RuntimeError):
+        aggregator.wait_for_credit()
@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import struct
+import time
+
+import pyarrow.parquet as pq
+import pytest
+
+from openwpm import TaskManager
+from openwpm.DataAggregator.BaseAggregator import (
+    ACTION_TYPE_FINALIZE,
+    ACTION_TYPE_INITIALIZE,
+    RECORD_TYPE_SPECIAL,
+)
+from openwpm.DataAggregator.journal import JOURNAL_DIRECTORY, RecordJournal
+from openwpm.DataAggregator.LocalAggregator import LocalAggregator
+from openwpm.DataAggregator.ParquetAggregator import (
+    PARQUET_DIRECTORY,
+    ParquetAggregator,
+)
+from openwpm.SocketInterface import clientsocket
+
+pytestmark = pytest.mark.pyonly
+
+
+def frame(payload):
+    return struct.pack(">Lc", len(payload), b"u") + payload
+
+
+def test_journal_replay(tmpdir):
+    directory = str(tmpdir)
+    journal = RecordJournal(directory, fsync_interval=0, segment_size=20)
+    assert list(journal.replay()) == []
+    for i in range(10):
+        assert journal.append(frame(b"record-%d" % i)) == i
+    journal.checkpoint(4)
+    # Segments that only hold saved records are removed
+    assert journal.stats()["segments"] == 3  # two records each
+    assert journal.stats()["unsaved_records"] == 6
+    journal.close()
+    # A record that was only written partially is cut off
+    segments = sorted(name for name in os.listdir(directory) if name.endswith(".log"))
+    with open(os.path.join(directory, segments[-1]), "ab") as f:
+        f.write(frame(b"partial")[:6])
+
+    journal = RecordJournal(directory, fsync_interval=None)
+    assert journal.replayable == 6
+    assert list(journal.replay()) == [frame(b"record-%d" % i) for i in range(4, 10)]
+    assert journal.append(frame(b"record-10")) == 10
+    journal.checkpoint(11)
+    journal.close()
+    assert sorted(os.listdir(directory)) == ["checkpoint"]
+
+
+def send_visits(sock, visit_ids):
+    for visit_id in visit_ids:
+        sock.send(
+            (
+                "site_visits",
+                {"visit_id": visit_id, "browser_id": 1, "site_url": "http://a.test"},
+            )
+        )
+
+
+def test_replay_after_crash(tmpdir):
+    manager_params, browser_params = TaskManager.load_default_params(1)
+    manager_params["data_directory"] = str(tmpdir)
+    manager_params["database_name"] = os.path.join(str(tmpdir), "crawl-data.sqlite")
+    manager_params["aggregator_journal"] = True
+
+    aggregator = LocalAggregator(manager_params, browser_params)
+    aggregator.launch()
+    sock = clientsocket(serialization="dill")
+    sock.connect(*aggregator.listener_address)
+    send_visits(sock, range(50))
+    time.sleep(0.5)
+    # Records are only committed after `MIN_TIME` seconds
+    aggregator.listener_process.kill()
+    aggregator.listener_process.join()
+    sock.close()
+
+    aggregator = LocalAggregator(manager_params, browser_params)
+    aggregator.launch()
+    sock = clientsocket(serialization="dill")
+    sock.connect(*aggregator.listener_address)
+    send_visits(sock, range(50, 60))
+    sock.close()
+    aggregator.shutdown()
+
+    db = sqlite3.connect(manager_params["database_name"])
+    visit_ids = [row[0] for row in db.execute("SELECT visit_id FROM site_visits")]
+    db.close()
+    assert sorted(visit_ids) == list(range(60))
+    journal_directory = os.path.join(str(tmpdir), JOURNAL_DIRECTORY)
+    assert os.listdir(journal_directory) == ["checkpoint"]
+
+
+def send_parquet_visit(sock, visit_id, finalize=True):
+    sock.send(
+        (RECORD_TYPE_SPECIAL, {"action": ACTION_TYPE_INITIALIZE, "visit_id": visit_id})
+    )
+    sock.send(("site_visits", {"visit_id": visit_id, "browser_id": 1, "site_url": "a"}))
+    sock.send(
+        (
+            "javascript",
+            {"visit_id": visit_id, "browser_id": 1, "symbol": "s", "time_stamp": ""},
+        )
+    )
+    if finalize:
+        sock.send(
+            (
+                RECORD_TYPE_SPECIAL,
+                {"action": ACTION_TYPE_FINALIZE, "visit_id": visit_id, "success": True},
+            )
+        )
+
+
+def test_parquet_replay_after_crash(tmpdir):
+    manager_params, browser_params = TaskManager.load_default_params(1)
+    manager_params["data_directory"] = str(tmpdir)
+    manager_params["output_format"] = "parquet"
+    manager_params["aggregator_journal"] = True
+
+    aggregator = ParquetAggregator(manager_params, browser_params)
+    aggregator.launch()
+    sock = clientsocket(serialization="dill")
+    sock.connect(*aggregator.listener_address)
+    send_parquet_visit(sock, 1)
+    # Visits 2 and 3 are still in flight when the listener dies
+    send_parquet_visit(sock, 2, finalize=False)
+    send_parquet_visit(sock, 3, finalize=False)
+    time.sleep(0.5)
+    aggregator.listener_process.kill()
+    aggregator.listener_process.join()
+    sock.close()
+
+    aggregator = ParquetAggregator(manager_params, browser_params)
+    aggregator.launch()
+    sock = clientsocket(serialization="dill")
+    sock.connect(*aggregator.listener_address)
+    send_parquet_visit(sock, 4)
+    sock.close()
+    aggregator.shutdown()
+
+    root = os.path.join(str(tmpdir), PARQUET_DIRECTORY, "visits")
+    javascript = pq.ParquetDataset(os.path.join(root, "javascript")).read()
+    assert sorted(javascript.column("visit_id").to_pylist()) == [1, 2, 3, 4]
+    incomplete = pq.ParquetDataset(os.path.join(root, "incomplete_visits")).read()
+    assert sorted(incomplete.column("visit_id").to_pylist()) == [2, 3]
+    journal_directory = os.path.join(str(tmpdir), JOURNAL_DIRECTORY)
+    assert os.listdir(journal_directory) == ["checkpoint"]
@@ -0,0 +1,215 @@
+import os
+import sqlite3
+
+import plyvel
+import pytest
+
+from openwpm.DataAggregator.content_store import CONTENT_STORE_NAME, ContentStore
+from openwpm.DataAggregator.LocalAggregator import create_tables
+from openwpm.utilities import merge_crawls
+
+pytestmark = pytest.mark.pyonly
+
+
+def make_crawl(directory, visits, content):
+    """Create a crawl with browser 1 of task 1 visiting `visits` sites,
+    with one request per visit and a cookie of each request"""
+    os.makedirs(directory)
+    con = sqlite3.connect(os.path.join(directory, merge_crawls.DATABASE_NAME))
+    create_tables(con)
+    con.execute(
+        "INSERT INTO task (manager_params, openwpm_version, browser_version) "
+        "VALUES ('{}', '0', '0')"
+    )
+    con.execute(
+        "INSERT INTO crawl (browser_id, task_id, browser_params) VALUES (1, 1, '{}')"
+    )
+    for visit_id, site in enumerate(visits, 1):
+        con.execute(
+            "INSERT INTO site_visits (visit_id, browser_id, site_url) VALUES (?,1,?)",
+            (visit_id, site),
+        )
+        con.execute(
+            "INSERT INTO http_requests (browser_id, visit_id, url, method, "
+            "referrer, headers, request_id, resource_type, time_stamp) "
+            "VALUES (1, ?, ?, 'GET', '', '[]', 1, 'main_frame', '')",
+            (visit_id, site),
+        )
+    con.execute(
+        "CREATE TABLE http_request_cookies (id INTEGER PRIMARY KEY, "
+        "browser_id INTEGER, header_id INTEGER, name TEXT)"
+    )
+    con.execute(
+        "INSERT INTO http_request_cookies (browser_id, header_id, name) "
+        "SELECT browser_id, id, url FROM http_requests"
+    )
+    con.commit()
+    con.close()
+    ldb = plyvel.DB(
+        os.path.join(directory, "content.ldb"),
+        create_if_missing=True,
+        compression="snappy",
+    )
+    for key, value in content.items():
+        ldb.put(key.encode("ascii"), value)
+    ldb.close()
+
+
+def rows(database, query):
+    con = sqlite3.connect(database)
+    result = con.execute(query).fetchall()
+    con.close()
+    return result
+
+
+@pytest.mark.parametrize("content_backend", ["leveldb", "packfile"])
+def test_merge_crawls(tmpdir, content_backend):
+    first = os.path.join(str(tmpdir), "vm1")
+    second = os.path.join(str(tmpdir), "vm2")
+    make_crawl(first, ["http://a.com", "http://b.com"], {"h1": b"one", "h2": b"two"})
+    make_crawl(second, ["http://c.com"], {"h2": b"two", "h3": b"three"})
+    output = os.path.join(str(tmpdir), "merged")
+
+    results = merge_crawls.merge_crawls(
+        output, [first, second], content_backend=content_backend, chunk_rows=1
+    )
+    database = os.path.join(output, merge_crawls.DATABASE_NAME)
+    assert [counts["content"] for counts in results.values()] == [2, 1]
+    assert rows(database, "SELECT task_id FROM task") == [(1,), (2,)]
+    assert rows(database, "SELECT browser_id, task_id FROM crawl") == [(1, 1), (2, 2)]
+    assert rows(database, "SELECT visit_id, browser_id, site_url FROM site_visits") == [
+        (1, 1, "http://a.com"),
+        (2, 1, "http://b.com"),
+        (3, 2, "http://c.com"),
+    ]
+    # References between tables still match after the ids were shifted
+    assert (
+        rows(
+            database,
+            "SELECT r.visit_id, c.name FROM http_request_cookies AS c "
+            "JOIN http_requests AS r ON c.header_id = r.id ORDER BY r.id",
+        )
+        == [(1, "http://a.com"), (2, "http://b.com"), (3, "http://c.com")]
+    )
+    assert (
+        rows(
+            database,
+            "SELECT visit_id_offset, browser_id_offset, task_id_offset, status "
+            "FROM merge_sources ORDER BY source_id",
+        )
+        == [(0, 0, 0, "done"), (2, 1, 1, "done")]
+    )
+
+    if content_backend == "packfile":
+        content = ContentStore(os.path.join(output, CONTENT_STORE_NAME))
+    else:
+        content = plyvel.DB(os.path.join(output, "content.ldb"))
+    assert sorted(content.iterator()) == [
+        (b"h1", b"one"),
+        (b"h2", b"two"),
+        (b"h3", b"three"),
+    ]
+    content.close()
+
+    # Merging again doesn't copy anything twice
+    results = merge_crawls.merge_crawls(
+        output, [first, second], content_backend=content_backend
+    )
+    assert results == {path: dict() for path in results}
+    assert rows(database, "SELECT COUNT(*) FROM http_requests") == [(3,)]
+
+
+def test_resume(tmpdir):
+    first = os.path.join(str(tmpdir), "vm1")
+    second = os.path.join(str(tmpdir), "vm2")
+    make_crawl(first, ["http://a.com", "http://b.com"], {"h1": b"one"})
+    make_crawl(second, ["http://c.com", "http://d.com"], {"h2": b"two"})
+    output = os.path.join(str(tmpdir), "merged")
+    merge_crawls.merge_crawls(output, [first])
+
+    # Simulate a merge of the second crawl that stopped after one chunk
+    database = os.path.join(output, merge_crawls.DATABASE_NAME)
+    con = sqlite3.connect(database, isolation_level=None)
+    con.execute(
+        "ATTACH DATABASE ? AS source",
+        (os.path.realpath(second + "/crawl-data.sqlite"),),
+    )
+    source_id = merge_crawls._register_source(
+        con, os.path.realpath(second + "/crawl-data.sqlite")
+    )
+    offsets = merge_crawls._offsets(con, source_id)
+    con.execute("BEGIN")
+    con.execute(
+        "INSERT INTO site_visits SELECT visit_id + 2, browser_id + 1, site_url, "
+        "site_rank FROM source.site_visits WHERE rowid <= 1"
+    )
+    merge_crawls._set_progress(con, source_id, "site_visits", last_rowid=1)
+    con.execute("COMMIT")
+    con.close()
+    assert offsets["visit_id"] == 2
+
+    results = merge_crawls.merge_crawls(output, [first, second])
+    assert results[os.path.realpath(second + "/crawl-data.sqlite")]["site_visits"] == 1
+    assert rows(database, "SELECT visit_id, site_url FROM site_visits") == [
+        (1, "http://a.com"),
+        (2, "http://b.com"),
+        (3, "http://c.com"),
+        (4, "http://d.com"),
+    ]
+
+
+def test_partial_source_keeps_its_ids(tmpdir):
+    first = os.path.join(str(tmpdir), "vm1")
+    second = os.path.join(str(tmpdir), "vm2")
+    make_crawl(first, ["http://a.com", "http://b.com"], dict())
+    make_crawl(second, ["http://c.com"], dict())
+    output = os.path.join(str(tmpdir), "merged")
+    merge_crawls.merge_crawls(output, list())
+
+    # Copy the first visit of the first crawl only, then merge the second
+    database = os.path.join(output, merge_crawls.DATABASE_NAME)
+    path = os.path.realpath(first + "/crawl-data.sqlite")
+    con = sqlite3.connect(database, isolation_level=None)
+    con.execute("ATTACH DATABASE ? AS source", (path,))
+    source_id = merge_crawls._register_source(con, path)
+    con.execute("BEGIN")
+    con.execute(
+        "INSERT INTO site_visits SELECT visit_id, browser_id, site_url, "
+        "site_rank FROM source.site_visits WHERE rowid <= 1"
+    )
+    merge_crawls._set_progress(con, source_id, "site_visits", last_rowid=1)
+    con.execute("COMMIT")
+    con.close()
+    merge_crawls.merge_crawls(output, [second])
+
+    merge_crawls.merge_crawls(output, [first])
+    assert rows(database, "SELECT visit_id, site_url FROM site_visits") == [
+        (1, "http://a.com"),
+        (2, "http://b.com"),
+        (3, "http://c.com"),
+    ]
+
+
+def test_colliding_rows_fail(tmpdir):
+    first = os.path.join(str(tmpdir), "vm1")
+    make_crawl(first, ["http://a.com"], dict())
+    output = os.path.join(str(tmpdir), "merged")
+    merge_crawls.merge_crawls(output, [first])
+
+    database = os.path.join(output, merge_crawls.DATABASE_NAME)
+    path = os.path.realpath(first + "/crawl-data.sqlite")
+    con = sqlite3.connect(database, isolation_level=None)
+    con.execute("ATTACH DATABASE ? AS source", (path,))
+    offsets = merge_crawls._offsets(con, 1)
+    con.execute("DELETE FROM merge_progress")
+    with pytest.raises(sqlite3.IntegrityError):
+        merge_crawls._copy_table(con, 1, "site_visits", offsets, 1)
+    assert rows(database, "SELECT COUNT(*) FROM site_visits") == [(1,)]
+    con.close()
+
+
+def test_output_is_not_a_source(tmpdir):
+    first = os.path.join(str(tmpdir), "vm1")
+    make_crawl(first, ["http://a.com"], dict())
+    with pytest.raises(ValueError):
+        merge_crawls.merge_crawls(first, [first])
@@ -0,0 +1,146 @@
+import json
+import os
+import urllib.error
+import urllib.request
+
+import pytest
+
+from openwpm import TaskManager
+from openwpm.DataAggregator.BaseAggregator import (
+    ACTION_TYPE_FINALIZE,
+    ACTION_TYPE_INITIALIZE,
+    RECORD_TYPE_SPECIAL,
+)
+from openwpm.DataAggregator.LocalAggregator import LocalAggregator
+from openwpm.metrics import (
+    MetricsRegistry,
+    MetricsServer,
+    merge_snapshot,
+    snapshot_changes,
+)
+from openwpm.SocketInterface import clientsocket
+
+from .test_sharded_aggregator import wait_for_completed_visits
+
+pytestmark = pytest.mark.pyonly
+
+
+def test_registry_render():
+    registry = MetricsRegistry()
+    registry.inc("openwpm_commands_total", command="GetCommand", status="ok")
+    registry.inc("openwpm_commands_total", command="GetCommand", status="ok")
+    registry.set("openwpm_record_queue_depth", 3, table='java"script')
+    for i in range(100):
+        registry.observe("openwpm_command_seconds", i / 100, command="GetCommand")
+    registry.observe("openwpm_upload_seconds", 0.2)
+    registry.observe("openwpm_upload_seconds", 100)
+    with pytest.raises(ValueError):
+        registry.inc("openwpm_unknown_total")
+
+    other = MetricsRegistry()
+    other.set("openwpm_records_received_total", 7, table="javascript")
+    registry.set_source(
+        "listener", lambda: [({"process": "listener"}, other.snapshot())]
+    )
+
+    text = registry.render()
+    assert "# TYPE openwpm_commands_total counter" in text
+    assert 'openwpm_commands_total{command="GetCommand",status="ok"} 2.0' in text
+    assert 'openwpm_record_queue_depth{table="java\\"script"} 3.0' in text
+    assert 'openwpm_command_seconds{command="GetCommand",quantile="0.5"} 0.5' in text
+    assert 'openwpm_command_seconds{command="GetCommand",quantile="0.99"} 0.99' in text
+    assert 'openwpm_command_seconds_count{command="GetCommand"} 100' in text
+    assert 'openwpm_upload_seconds_bucket{le="0.25"} 1' in text
+    assert 'openwpm_upload_seconds_bucket{le="+Inf"} 2' in text
+    assert "openwpm_upload_seconds_sum 100.2" in text
+    assert (
+        'openwpm_records_received_total{process="listener",table="javascript"} 7.0'
+        in text
+    )
+
+
+def test_snapshot_changes():
+    registry = MetricsRegistry()
+    registry.set("openwpm_records_received_total", 1, table="javascript")
+    registry.set("openwpm_records_received_total", 1, table="http_requests")
+    sent = dict()
+    merged = dict()
+    changes = snapshot_changes(registry.snapshot(), sent)
+    assert len(changes["openwpm_records_received_total"]) == 2
+    merge_snapshot(merged, changes)
+
+    registry.set("openwpm_records_received_total", 5, table="javascript")
+    registry.observe("openwpm_upload_seconds", 0.2)
+    changes = snapshot_changes(registry.snapshot(), sent)
+    # Only the samples that changed are sent again
+    assert changes["openwpm_records_received_total"] == [({"table": "javascript"}, 5)]
+    assert snapshot_changes(registry.snapshot(), sent) == {}
+    merge_snapshot(merged, changes)
+    assert sorted(
+        (labels["table"], value)
+        for labels, value in merged["openwpm_records_received_total"]
+    ) == [("http_requests", 1), ("javascript", 5)]
+    assert merged["openwpm_upload_seconds"][0][1]["count"] == 1
+
+
+def test_server_and_dump(tmpdir):
+    registry = MetricsRegistry()
+    registry.inc("openwpm_browser_restarts_total")
+    server = MetricsServer(registry, "127.0.0.1", 0)
+    url = "http://%s:%d" % server.address
+    with urllib.request.urlopen(url + "/metrics") as response:
+        assert b"openwpm_browser_restarts_total 1.0" in response.read()
+    with pytest.raises(urllib.error.HTTPError):
+        urllib.request.urlopen(url + "/other")
+    server.close()
+
+    path = str(tmpdir.join("metrics.json"))
+    registry.dump(path)
+    with open(path) as f:
+        dumped = json.load(f)
+    assert dumped["openwpm_browser_restarts_total"] == [{"labels": {}, "value": 1}]
+
+
+def test_listener_metrics(tmpdir):
+    manager_params, browser_params = TaskManager.load_default_params(1)
+    manager_params["data_directory"] = str(tmpdir)
+    manager_params["database_name"] = os.path.join(str(tmpdir), "crawl-data.sqlite")
+    browser_params[0]["browser_id"] = 1
+    aggregator = LocalAggregator(manager_params, browser_params)
+    aggregator.launch()
+    sock = clientsocket(serialization="dill")
+    sock.connect(*aggregator.listener_address)
+    visit_id = aggregator.get_next_visit_id()
+    sock.send(
+        (RECORD_TYPE_SPECIAL, {"action": ACTION_TYPE_INITIALIZE, "visit_id": visit_id})
+    )
+    for i in range(10):
+        sock.send(
+            (
+                "javascript",
+                {"visit_id": visit_id, "browser_id": 1, "symbol": str(i)},
+            )
+        )
+    sock.send(
+        (
+            RECORD_TYPE_SPECIAL,
+            {"action": ACTION_TYPE_FINALIZE, "visit_id": visit_id, "success": True},
+        )
+    )
+    sock.close()
+    assert wait_for_completed_visits(aggregator, 1) == [(visit_id, False)]
+    aggregator.shutdown()
+
+    ((labels, snapshot),) = aggregator.get_listener_metrics()
+    assert labels == {"process": "listener"}
+    received = dict(
+        (sample_labels["table"], value)
+        for sample_labels, value in snapshot["openwpm_records_received_total"]
+    )
+    assert received["javascript"] == 10
+    ((_, commits),) = [
+        sample
+        for sample in snapshot["openwpm_commit_seconds"]
+        if sample[0] == {"store": "sqlite"}
+    ]
+    assert commits["count"] >= 1
@@ -0,0 +1,98 @@
+import gzip
+import json
+import os
+
+import pyarrow.parquet as pq
+import pytest
+
+from openwpm import TaskManager
+from openwpm.DataAggregator.BaseAggregator import (
+    ACTION_TYPE_FINALIZE,
+    ACTION_TYPE_INITIALIZE,
+    RECORD_TYPE_CONTENT,
+    RECORD_TYPE_SPECIAL,
+)
+from openwpm.DataAggregator.ParquetAggregator import (
+    CONTENT_DIRECTORY,
+    PARQUET_DIRECTORY,
+    ParquetAggregator,
+)
+from openwpm.SocketInterface import clientsocket
+
+from .test_sharded_aggregator import wait_for_completed_visits
+
+pytestmark = pytest.mark.pyonly
+
+
+def test_parquet_aggregator(tmpdir):
+    manager_params, browser_params = TaskManager.load_default_params(1)
+    manager_params["data_directory"] = str(tmpdir)
+    manager_params["output_format"] = "parquet"
+    aggregator = ParquetAggregator(manager_params, browser_params)
+    aggregator.save_configuration("v0.0.0", "Firefox")
+    aggregator.launch()
+    sock = clientsocket(serialization="dill")
+    sock.connect(*aggregator.listener_address)
+
+    visit_ids = [aggregator.get_next_visit_id() for _ in range(3)]
+    for visit_id in visit_ids:
+        sock.send(
+            (
+                RECORD_TYPE_SPECIAL,
+                {"action": ACTION_TYPE_INITIALIZE, "visit_id": visit_id},
+            )
+        )
+        sock.send(
+            (
+                "site_visits",
+                {"visit_id": visit_id, "browser_id": 1, "site_url": "a"},
+            )
+        )
+        for i in range(5):
+            sock.send(
+                (
+                    "javascript",
+                    {
+                        "visit_id": visit_id,
+                        "browser_id": 1,
+                        "symbol": str(i),
+                        "time_stamp": "",
+                    },
+                )
+            )
+        sock.send((RECORD_TYPE_CONTENT, ("Y29udGVudA==", "hash")))
+        sock.send(
+            (
+                RECORD_TYPE_SPECIAL,
+                {
+                    "action": ACTION_TYPE_FINALIZE,
+                    "visit_id": visit_id,
+                    "success": visit_id != visit_ids[-1],
+                },
+            )
+        )
+    sock.close()
+    aggregator.shutdown()
+    completed = wait_for_completed_visits(aggregator, len(visit_ids))
+    assert sorted(completed) == sorted(
+        [(visit_id, visit_id == visit_ids[-1]) for visit_id in visit_ids]
+    )
+
+    root = os.path.join(str(tmpdir), PARQUET_DIRECTORY)
+    javascript = pq.ParquetDataset(os.path.join(root, "visits", "javascript")).read()
+    assert javascript.num_rows == 15
+    assert set(javascript.column("visit_id").to_pylist()) == set(visit_ids)
+    incomplete = pq.ParquetDataset(
+        os.path.join(root, "visits", "incomplete_visits")
+    ).read()
+    assert incomplete.column("visit_id").to_pylist() == [visit_ids[-1]]
+
+    with open(os.path.join(root, CONTENT_DIRECTORY, "hash.gz"), "rb") as f:
+        assert gzip.decompress(f.read()) == b"content"
+    (index_file,) = os.listdir(os.path.join(root, "site_index"))
+    with open(os.path.join(root, "site_index", index_file), "rb") as f:
+        index = [json.loads(line) for line in gzip.decompress(f.read()).splitlines()]
+    assert sorted(row["visit_id"] for row in index) == sorted(visit_ids)
+    (config_file,) = os.listdir(os.path.join(root, "config"))
+    with open(os.path.join(root, "config", config_file)) as f:
+        assert json.load(f)["openwpm_version"] == "v0.0.0"
@@ -0,0 +1,135 @@
+import os
+
+import pyarrow.parquet as pq
+import pytest
+from multiprocess import Queue
+
+from openwpm.DataAggregator import ParquetAggregator
+from openwpm.DataAggregator.BaseAggregator import FlowControl
+from openwpm.DataAggregator.ParquetAggregator import (
+    PARQUET_DIRECTORY,
+    SPILL_DIRECTORY,
+    ColumnBuffer,
+    ParquetListener,
+)
+from openwpm.DataAggregator.uploader import LocalUploader
+
+pytestmark = pytest.mark.pyonly
+
+
+def javascript_record(visit_id, i):
+    return {
+        "visit_id": visit_id,
+        "browser_id": 1,
+        "script_url": "https://example.com/script-%d.js" % i,
+        "symbol": "window.navigator.userAgent",
+        "operation": "get",
+        "value": "x" * 100,
+        "time_stamp": "2021-01-01T00:00:00.000Z",
+    }
+
+
+def test_column_buffer_spill(tmpdir):
+    buffer = ColumnBuffer("javascript")
+    for i in range(10):
+        buffer.append(javascript_record(1, i))
+    assert buffer.nbytes > 10 * 100
+    path = str(tmpdir.join("spill.arrow"))
+    assert buffer.spill(path) > 0
+    assert buffer.num_rows == buffer.nbytes == 0
+    buffer.append(javascript_record(1, 10))
+    buffer.spill(path)
+    buffer.append(javascript_record(1, 11))
+    batches = list(buffer.spilled_batches())
+    assert [batch.num_rows for batch in batches] == [10, 1]
+    assert batches[1].column(batches[1].schema.get_field_index("script_url"))[
+        0
+    ].as_py() == ("https://example.com/script-10.js")
+    assert not os.path.exists(path)
+    assert buffer.num_rows == 1
+
+
+def test_listener_spills_large_visits(tmpdir, monkeypatch):
+    monkeypatch.setattr(ParquetAggregator, "CACHE_SIZE", 0)
+    manager_params = {
+        "data_directory": str(tmpdir),
+        "s3_upload_threads": 2,
+        "parquet_target_file_size": 2 ** 20,
+        "parquet_max_file_age": 3600,
+        "visit_memory_budget": 10000,
+    }
+    completion_queue = Queue()
+    base_params = (Queue(), completion_queue, Queue(), FlowControl(None), None)
+    uploader = LocalUploader(str(tmpdir), num_threads=2)
+    listener = ParquetListener(
+        base_params, manager_params, 1, PARQUET_DIRECTORY, uploader
+    )
+    listener.startup()
+    listener.process_record(
+        (
+            "site_visits",
+            {"visit_id": 5, "browser_id": 1, "site_url": "https://example.com"},
+        )
+    )
+    for i in range(1000):
+        listener.process_record(("javascript", javascript_record(5, i)))
+    status = listener.get_status_update()["spill"]
+    assert status["spills"] > 1
+    assert status["spilled_visits"] == 1
+    assert status["buffered_bytes"] <= 10000
+    spill_directory = str(tmpdir.join(SPILL_DIRECTORY, "0"))
+    assert os.listdir(spill_directory) == ["5-javascript.arrow"]
+
+    listener.run_visit_completion_tasks(5)
+    assert os.listdir(spill_directory) == []
+    listener.complete_uploaded_visits(block=True)
+    assert completion_queue.get(timeout=5)[:2] == (5, False)
+    listener.shutdown()
+
+    table = pq.read_table(
+        str(tmpdir.join(PARQUET_DIRECTORY, "visits", "javascript"))
+    ).to_pandas()
+    assert len(table) == 1000
+    assert sorted(table["script_url"]) == sorted(
+        "https://example.com/script-%d.js" % i for i in range(1000)
+    )
+    site_visits = pq.read_table(
+        str(tmpdir.join(PARQUET_DIRECTORY, "visits", "site_visits"))
+    )
+    assert site_visits.num_rows == 1
+
+
+def test_failed_spill_is_not_retried(tmpdir, monkeypatch):
+    monkeypatch.setattr(ParquetAggregator, "CACHE_SIZE", 0)
+    attempts = list()
+
+    def failing_spill(self, path):
+        attempts.append(path)
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(ColumnBuffer, "spill", failing_spill)
+    manager_params = {
+        "data_directory": str(tmpdir),
+        "s3_upload_threads": 2,
+        "parquet_target_file_size": 2 ** 20,
+        "parquet_max_file_age": 3600,
+        "visit_memory_budget": 10000,
+    }
+    completion_queue = Queue()
+    base_params = (Queue(), completion_queue, Queue(), FlowControl(None), None)
+    uploader = LocalUploader(str(tmpdir), num_threads=2)
+    listener = ParquetListener(
+        base_params, manager_params, 1, PARQUET_DIRECTORY, uploader
+    )
+    listener.startup()
+    for i in range(100):
+        listener.process_record(("javascript", javascript_record(5, i)))
+    assert len(attempts) == 1
+    assert listener.get_status_update()["spill"]["failed_spills"] == 1
+
+    listener.run_visit_completion_tasks(5)
+    listener.complete_uploaded_visits(block=True)
+    assert completion_queue.get(timeout=5)[:2] == (5, False)
+    listener.shutdown()
+    table = pq.read_table(str(tmpdir.join(PARQUET_DIRECTORY, "visits", "javascript")))
+    assert table.num_rows == 100
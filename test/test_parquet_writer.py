@@ -0,0 +1,96 @@
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from openwpm.DataAggregator import parquet_writer
+from openwpm.DataAggregator.parquet_writer import (
+    COMPACTION_PREFIX,
+    RollingParquetWriter,
+    compact_dataset,
+)
+
+pytestmark = pytest.mark.pyonly
+
+
+def make_table(start, rows=10):
+    return pa.table(
+        {
+            "visit_id": pa.array(range(start, start + rows), pa.int64()),
+            "url": ["https://example.com/%d" % i for i in range(start, start + rows)],
+        }
+    )
+
+
+def test_rolling_writer_rolls_on_size(tmpdir):
+    writer = RollingParquetWriter(str(tmpdir), target_size=2000, max_age=3600)
+    path = writer.write("javascript", make_table(0))
+    assert writer.write("javascript", make_table(10)) == path
+    assert writer.due() == []
+    while writer.due() == []:
+        writer.write("javascript", make_table(20, rows=100))
+    assert writer.roll("javascript") == path
+    assert pq.ParquetFile(path).num_row_groups > 2
+    assert writer.path("javascript") is None
+    assert writer.write("javascript", make_table(0)) != path
+
+
+def test_rolling_writer_rolls_on_age(tmpdir):
+    writer = RollingParquetWriter(str(tmpdir), max_age=0)
+    writer.write("http_requests", make_table(0))
+    assert writer.due() == ["http_requests"]
+    assert [table for table, _ in writer.close()] == ["http_requests"]
+
+
+def write_small_files(directory, count):
+    os.makedirs(directory)
+    for i in range(count):
+        pq.write_table(
+            make_table(i * 10), os.path.join(directory, "file-%d.parquet" % i)
+        )
+
+
+def test_compaction(tmpdir):
+    root = str(tmpdir.join("visits"))
+    partition = os.path.join(root, "javascript", "instance_id=1")
+    write_small_files(partition, 20)
+    write_small_files(os.path.join(root, "http_requests", "instance_id=1"), 1)
+    before = pq.ParquetDataset(root + "/javascript").read()
+
+    results = compact_dataset(root, target_size=2 ** 20)
+    assert results["files_read"] == 20
+    assert results["files_written"] == 1
+    files = os.listdir(partition)
+    assert len(files) == 1
+    after = pq.ParquetDataset(root + "/javascript").read()
+    assert sorted(after.column("visit_id").to_pylist()) == sorted(
+        before.column("visit_id").to_pylist()
+    )
+    metadata = pq.ParquetFile(os.path.join(partition, files[0])).metadata
+    assert metadata.row_group(0).column(0).statistics.min == 0
+    # The single file of the other table is left alone
+    assert os.listdir(os.path.join(root, "http_requests", "instance_id=1")) == [
+        "file-0.parquet"
+    ]
+
+
+def test_interrupted_compaction_is_finished(tmpdir, monkeypatch):
+    partition = str(tmpdir.join("javascript"))
+    write_small_files(partition, 3)
+
+    def interrupt(filesystem, path):
+        raise KeyboardInterrupt
+
+    finish = parquet_writer._finish_compaction
+    monkeypatch.setattr(parquet_writer, "_finish_compaction", interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        compact_dataset(str(tmpdir))
+    assert any(name.startswith(COMPACTION_PREFIX) for name in os.listdir(partition))
+
+    monkeypatch.setattr(parquet_writer, "_finish_compaction", finish)
+    compact_dataset(str(tmpdir))
+    files = os.listdir(partition)
+    assert len(files) == 1
+    assert not files[0].startswith(COMPACTION_PREFIX)
+    assert pq.read_table(os.path.join(partition, files[0])).num_rows == 30
@@ -0,0 +1,86 @@
+import pytest
+
+from openwpm.utilities import queue_loader, rediswq, site_list
+
+fakeredis = pytest.importorskip("fakeredis")
+# fakeredis runs Lua scripts with lupa
+pytest.importorskip("lupa")
+
+pytestmark = pytest.mark.pyonly
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        rediswq.redis,
+        "Redis",
+        lambda **kwargs: fakeredis.FakeRedis(server=server, **kwargs),
+    )
+    return server
+
+
+def write_list(path, ranks):
+    path.write_text("".join("%d,site%d.com\n" % (rank, rank) for rank in ranks))
+    return str(path)
+
+
+def drain(queue):
+    jobs = list()
+    while True:
+        job = queue.lease(lease_secs=60, block=False)
+        if job is None:
+            return jobs
+        jobs.append(job.decode("utf-8"))
+        queue.complete(job)
+
+
+def test_priority_class():
+    assert queue_loader.priority_class(1, [10, 100]) == 0
+    assert queue_loader.priority_class(10, [10, 100]) == 0
+    assert queue_loader.priority_class(11, [10, 100]) == 1
+    assert queue_loader.priority_class(101, [10, 100]) == 2
+    assert queue_loader.priority_class(5, []) == 0
+
+
+def test_load_queue(server, tmp_path):
+    first = write_list(tmp_path / "first.csv", range(1, 7))
+    queue = rediswq.RedisWQ(name="queue", priority_classes=2)
+    stats = queue_loader.load_queue(
+        queue, site_list.iter_sites([first]), [2], chunk_size=2
+    )
+    assert stats == {"added": 6, "skipped": 0, "class_0": 2, "class_1": 4}
+    assert queue.progress()["queued"] == 6
+
+    # Sites that were added before are skipped, even after they were crawled
+    assert drain(queue)[:2] == ["1,http://site1.com", "2,http://site2.com"]
+    second = write_list(tmp_path / "second.csv", range(5, 9))
+    skipped = tmp_path / "skipped.txt"
+    with open(skipped, "w") as f:
+        stats = queue_loader.load_queue(
+            queue, site_list.iter_sites([second]), [2], skipped_file=f
+        )
+    assert stats == {"added": 2, "skipped": 2, "class_0": 0, "class_1": 2}
+    assert skipped.read_text().splitlines() == [
+        "5,http://site5.com",
+        "6,http://site6.com",
+    ]
+    assert drain(queue) == ["7,http://site7.com", "8,http://site8.com"]
+
+
+def test_load_queue_without_dedupe(server, tmp_path):
+    path = write_list(tmp_path / "list.csv", [3, 1, 2])
+    queue = rediswq.RedisWQ(name="queue", priority_classes=3)
+    for _ in range(2):
+        queue_loader.load_queue(
+            queue, site_list.iter_sites([path]), [1, 2], "none", chunk_size=1
+        )
+    # Higher priority classes are leased first, in order within a class
+    assert drain(queue) == [
+        "1,http://site1.com",
+        "1,http://site1.com",
+        "2,http://site2.com",
+        "2,http://site2.com",
+        "3,http://site3.com",
+        "3,http://site3.com",
+    ]
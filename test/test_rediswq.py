@@ -0,0 +1,160 @@
+import hashlib
+import time
+
+import pytest
+
+from openwpm.utilities import rediswq
+
+fakeredis = pytest.importorskip("fakeredis")
+# fakeredis runs Lua scripts with lupa
+pytest.importorskip("lupa")
+
+pytestmark = pytest.mark.pyonly
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        rediswq.redis,
+        "Redis",
+        lambda **kwargs: fakeredis.FakeRedis(server=server, **kwargs),
+    )
+    return server
+
+
+def make_queue(jobs, max_retries=2):
+    queue = rediswq.RedisWQ(name="queue", max_retries=max_retries)
+    if jobs:
+        # Loaders push to the left, workers pop from the right
+        queue._db.lpush("queue", *jobs)
+    return queue
+
+
+def test_lease_and_complete(server):
+    queue = make_queue([b"1,a.com", b"2,b.com"])
+    other = make_queue([])
+    assert not queue.empty()
+
+    job = queue.lease(lease_secs=60, block=False)
+    assert job == b"1,a.com"
+    assert queue.progress()["leased"] == 1
+    assert queue.renew_lease(job, 60)
+    # Only the worker holding the lease can renew it
+    assert not other.renew_lease(job, 60)
+    queue.complete(job)
+    assert not queue.renew_lease(job, 60)
+
+    assert other.lease(block=False) == b"2,b.com"
+    assert other.lease(block=False) is None
+    start = time.time()
+    assert other.lease(block=True, timeout=0.1) is None
+    # BRPOP rounds the timeout up to a whole second
+    assert time.time() - start < 2
+    other.complete(b"2,b.com")
+    assert queue.empty()
+
+
+def test_expired_leases(server):
+    queue = make_queue([b"1,a.com", b"2,b.com"], max_retries=1)
+    job = queue.lease(lease_secs=0, block=False)
+    kept = queue.lease(lease_secs=60, block=False)
+    assert not queue.renew_lease(job, 60)
+
+    queue.check_expired_leases()
+    assert queue.progress()["leased"] == 1
+    assert queue.get_retry_number(job) == 1
+    assert queue.get_retry_number(kept) == 0
+
+    # The job is removed once it exceeds the maximum retry count
+    assert queue.lease(lease_secs=0, block=False) == job
+    queue.check_expired_leases()
+    assert queue.progress()["queued"] == 0
+    assert queue.get_retry_number(job) == 0
+    queue.complete(kept)
+    assert queue.empty()
+
+
+def test_many_expired_leases(server):
+    jobs = [b"%d" % i for i in range(rediswq.EXPIRED_BATCH_SIZE * 2 + 5)]
+    queue = make_queue(jobs)
+    while queue.lease(lease_secs=0, block=False) is not None:
+        pass
+    queue.check_expired_leases()
+    assert queue.progress() == {"queued": len(jobs), "leased": 0, "retried": len(jobs)}
+
+
+def test_batches(server):
+    queue = make_queue([b"%d" % i for i in range(5)])
+    other = make_queue([])
+    jobs = queue.lease_many(3, lease_secs=60, block=False)
+    assert jobs == [b"0", b"1", b"2"]
+    assert queue.progress() == {"queued": 2, "leased": 3, "retried": 0}
+    assert queue.get_retry_numbers(jobs) == [0, 0, 0]
+
+    expired = other.lease_many(3, lease_secs=0, block=False)
+    assert expired == [b"3", b"4"]
+    assert other.renew_leases(expired + jobs, 60) == [False] * 5
+    assert queue.renew_leases(jobs + expired, 60) == [True] * 3 + [False] * 2
+    assert queue.renew_leases([]) == []
+
+    queue.complete_many(jobs)
+    other.check_expired_leases()
+    assert queue.progress() == {"queued": 2, "leased": 0, "retried": 2}
+    assert queue.get_retry_numbers(expired) == [1, 1]
+    assert queue.lease_many(3, block=True, timeout=0) == [b"3", b"4"]
+    assert queue.lease_many(3, block=False) == []
+
+
+def test_blocking_lease(server):
+    queue = make_queue([], max_retries=1)
+    loader = make_queue([])
+
+    def add_job(*args, **kwargs):
+        loader.add_many([("a.com", "1,a.com"), ("b.com", "2,b.com")])
+        return original(*args, **kwargs)
+
+    # The job arrives while the worker blocks in BRPOP
+    original = queue._db.brpop
+    queue._db.brpop = add_job
+    assert queue.lease_many(3, block=True, timeout=5) == [b"1,a.com", b"2,b.com"]
+    assert queue.progress() == {"queued": 0, "leased": 2, "retried": 0}
+
+
+def test_legacy_processing_list(server):
+    queue = make_queue([b"3,c.com"], max_retries=1)
+    # Jobs an earlier version leased, one of them still in its lease
+    queue._db.lpush("queue:processing", b"1,a.com", b"2,b.com")
+    lease_key = "queue:leased_by_session:" + hashlib.sha224(b"2,b.com").hexdigest()
+    queue._db.set(lease_key, "old-session", ex=60)
+    queue.check_expired_leases()
+    assert queue._db.lrange("queue:processing", 0, -1) == [b"2,b.com"]
+    assert queue.get_retry_number(b"1,a.com") == 1
+    assert queue.lease_many(3, block=False) == [b"3,c.com", b"1,a.com"]
+
+
+@pytest.mark.parametrize("dedupe", rediswq.DEDUPE_MODES)
+def test_add_many(server, dedupe):
+    loader = rediswq.RedisWQ(name="queue", priority_classes=2)
+    jobs = [("a.com", "1,a.com"), ("b.com", "2,b.com")]
+    assert loader.add_many(jobs, priority_class=1, dedupe=dedupe) == [True, True]
+    assert loader.add_many([("c.com", "3,c.com")], dedupe=dedupe) == [True]
+    assert loader.add_many([], dedupe=dedupe) == []
+    with pytest.raises(ValueError):
+        loader.add_many(jobs, priority_class=2)
+    with pytest.raises(ValueError):
+        loader.add_many(jobs, dedupe="bloom")
+
+    # Workers find the priority classes in Redis
+    worker = rediswq.RedisWQ(name="queue")
+    assert worker.progress()["queued"] == 3
+    job = worker.lease(block=False)
+    assert job == b"3,c.com"
+    worker.complete(job)
+    again = loader.add_many(jobs + [("c.com", "3,c.com")], dedupe=dedupe)
+    if dedupe == "none":
+        assert again == [True, True, True]
+    else:
+        # Queued and completed jobs are skipped
+        assert again == [False, False, False]
+    assert worker.lease_many(2, block=False) == [b"1,a.com", b"2,b.com"]
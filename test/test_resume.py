@@ -0,0 +1,94 @@
+import logging
+import os
+import sqlite3
+
+import pytest
+
+from openwpm import TaskManager
+from openwpm.CommandSequence import CommandSequence
+from openwpm.DataAggregator.LocalAggregator import LocalAggregator, create_tables
+from openwpm.Errors import ConfigError
+
+pytestmark = pytest.mark.pyonly
+
+# site_url -> the command statuses of each visit, None for interrupted visits
+VISITS = [
+    ("http://a.com", ["ok", "ok"]),
+    ("http://b.com", ["ok", "neterror"]),
+    ("http://b.com", ["ok", "ok"]),
+    ("http://c.com", None),
+    ("http://d.com", []),
+    ("http://e.com", ["error"]),
+    ("http://e.com", ["timeout"]),
+]
+
+
+def test_get_visited_sites(tmpdir):
+    manager_params, browser_params = TaskManager.load_default_params(1)
+    manager_params["data_directory"] = str(tmpdir)
+    manager_params["database_name"] = os.path.join(str(tmpdir), "crawl-data.sqlite")
+    con = sqlite3.connect(manager_params["database_name"])
+    create_tables(con)
+    for visit_id, (site_url, statuses) in enumerate(VISITS, 1):
+        con.execute(
+            "INSERT INTO site_visits (visit_id, browser_id, site_url) VALUES (?,1,?)",
+            (visit_id, site_url),
+        )
+        if statuses is None:
+            statuses = ["ok"]
+            con.execute("INSERT INTO incomplete_visits VALUES (?)", (visit_id,))
+        for status in statuses:
+            con.execute(
+                "INSERT INTO crawl_history (browser_id, visit_id, command_status) "
+                "VALUES (1,?,?)",
+                (visit_id, status),
+            )
+    con.commit()
+    con.close()
+
+    aggregator = LocalAggregator(manager_params, browser_params)
+    assert aggregator.get_visited_sites() == {
+        "http://a.com": (True, 1),
+        "http://b.com": (True, 2),
+        "http://c.com": (False, 1),
+        "http://d.com": (False, 1),
+        "http://e.com": (False, 2),
+    }
+    aggregator.db.close()
+
+
+@pytest.mark.parametrize("max_retries", [0, 1, 2])
+def test_skip_visited(max_retries):
+    manager = TaskManager.TaskManager.__new__(TaskManager.TaskManager)
+    manager.manager_params = {"resume_max_retries": max_retries}
+    manager.logger = logging.getLogger("openwpm")
+    manager.visited_sites = {
+        "http://a.com": (True, 1),
+        "http://e.com": (False, 2),
+    }
+    callbacks = list()
+
+    def sequence(url):
+        return CommandSequence(url, callback=lambda success: callbacks.append(success))
+
+    assert manager._skip_visited(sequence("http://a.com"))
+    assert not manager._skip_visited(sequence("http://new.com"))
+    retried = sequence("http://e.com")
+    if max_retries < 2:
+        assert manager._skip_visited(retried)
+        assert callbacks == [True, False]
+    else:
+        assert not manager._skip_visited(retried)
+        assert retried.retry_number == 2
+        assert callbacks == [True]
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "s3"])
+def test_resume_requires_local_output(tmpdir, output_format):
+    manager_params, browser_params = TaskManager.load_default_params(1)
+    manager_params["data_directory"] = str(tmpdir)
+    manager_params["log_directory"] = str(tmpdir)
+    manager_params["output_format"] = output_format
+    manager_params["resume"] = True
+    with pytest.raises(ConfigError):
+        TaskManager.TaskManager(manager_params, browser_params)
@@ -0,0 +1,134 @@
+import gzip
+import io
+import os
+
+import boto3
+import pyarrow.parquet as pq
+import pytest
+from multiprocess import Queue
+
+from openwpm.DataAggregator import ParquetAggregator
+from openwpm.DataAggregator.BaseAggregator import FlowControl
+from openwpm.DataAggregator.s3_uploader import S3Uploader
+from openwpm.DataAggregator.S3Aggregator import SPOOL_DIRECTORY, S3Listener
+
+moto = pytest.importorskip("moto")
+
+pytestmark = pytest.mark.pyonly
+
+BUCKET = "openwpm-test-bucket"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr("openwpm.DataAggregator.uploader.RETRY_BACKOFF", 0)
+    with moto.mock_s3():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def get_object(client, key):
+    return client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+
+
+def test_upload_and_existing_keys(s3, tmpdir):
+    uploader = S3Uploader(s3, BUCKET, str(tmpdir))
+    futures = [uploader.submit("dir/content/%02x.gz" % i, b"x") for i in range(20)]
+    futures.append(uploader.submit("dir/index.json.gz", b"index", "gzip"))
+    assert uploader.wait(futures)
+    assert gzip.decompress(get_object(s3, "dir/index.json.gz")) == b"index"
+    keys = ["dir/content/%02x.gz" % i for i in (0, 1, 0x11, 0xFF)]
+    assert uploader.existing_keys(keys, len("dir/content/") + 1) == set(keys[:3])
+    assert uploader.stats()["uploaded"] == 21
+    uploader.shutdown()
+
+
+def test_existing_keys_lists_only_when_cheaper(s3, tmpdir):
+    uploader = S3Uploader(s3, BUCKET, str(tmpdir))
+    large = ["dir/content/a%d.gz" % i for i in range(3)]
+    small = ["dir/content/b0.gz", "dir/content/c0.gz"]
+    assert uploader.wait([uploader.submit(key, b"x") for key in large + small[:1]])
+    listed = list()
+    list_keys = uploader.list_keys
+
+    def counting_list_keys(prefix):
+        listed.append(prefix)
+        return list_keys(prefix)
+
+    uploader.list_keys = counting_list_keys
+    keys = large + small + ["dir/content/a9.gz"]
+    prefix_length = len("dir/content/") + 1
+    existing = set(large + small[:1])
+    assert uploader.existing_keys(keys, prefix_length) == existing
+    assert listed == ["dir/content/a"]
+    # Listings that take more requests than the group has keys aren't used
+    listed.clear()
+    assert uploader.existing_keys(keys, prefix_length, 4000) == existing
+    assert listed == []
+    uploader.shutdown()
+
+
+def test_failed_uploads_are_spooled_and_replayed(s3, tmpdir):
+    spool = str(tmpdir.join("spool"))
+    uploader = S3Uploader(s3, "missing-bucket", spool, retries=2)
+    assert not uploader.wait([uploader.submit("dir/a.parquet", b"data")])
+    assert uploader.stats()["spooled"] == 1
+    assert uploader.stats()["retried"] == 2
+    with open(os.path.join(spool, "dir", "a.parquet"), "rb") as f:
+        assert f.read() == b"data"
+    uploader.shutdown()
+
+    uploader = S3Uploader(s3, BUCKET, spool)
+    assert uploader.wait(uploader.replay_spool())
+    assert get_object(s3, "dir/a.parquet") == b"data"
+    assert not os.path.exists(os.path.join(spool, "dir", "a.parquet"))
+    uploader.shutdown()
+
+
+def test_listener_marks_visits_after_upload(s3, tmpdir, monkeypatch):
+    monkeypatch.setattr(ParquetAggregator, "CACHE_SIZE", 0)
+    manager_params = {
+        "s3_directory": "crawl",
+        "s3_bucket": BUCKET,
+        "data_directory": str(tmpdir),
+        "s3_upload_threads": 2,
+        "parquet_target_file_size": 2 ** 20,
+        "parquet_max_file_age": 3600,
+        "visit_memory_budget": 0,
+    }
+    s3.put_object(Bucket=BUCKET, Key="crawl/content/known.gz", Body=b"")
+    completion_queue = Queue()
+    base_params = (Queue(), completion_queue, Queue(), FlowControl(None), None)
+    listener = S3Listener(base_params, manager_params, 1)
+    listener.startup()
+    listener.process_record(
+        (
+            "site_visits",
+            {"visit_id": 5, "browser_id": 1, "site_url": "https://example.com"},
+        )
+    )
+    listener.process_record(("page_content", ("Y29udGVudA==", "abc")))
+    listener.process_record(("page_content", ("Y29udGVudA==", "known")))
+    listener.run_visit_completion_tasks(5)
+    # The visit's records were appended to a parquet file that is still open
+    listener.complete_uploaded_visits()
+    assert completion_queue.empty()
+    listener.complete_uploaded_visits(block=True)
+    assert completion_queue.get(timeout=5)[:2] == (5, False)
+
+    assert gzip.decompress(get_object(s3, "crawl/content/abc.gz")) == b"content"
+    assert get_object(s3, "crawl/content/known.gz") == b""
+    keys = [
+        obj["Key"]
+        for obj in s3.list_objects_v2(Bucket=BUCKET, Prefix="crawl/visits/")["Contents"]
+    ]
+    assert len(keys) == 1
+    assert keys[0].startswith("crawl/visits/site_visits/instance_id=1/")
+    table = pq.read_table(io.BytesIO(get_object(s3, keys[0])))
+    assert table.column("site_url").to_pylist() == ["https://example.com"]
+    listener.shutdown()
+    assert not os.path.exists(str(tmpdir.join(SPOOL_DIRECTORY)))
@@ -0,0 +1,124 @@
+import os
+import sqlite3
+import time
+
+import pytest
+
+from openwpm import TaskManager
+from openwpm.DataAggregator.BaseAggregator import (
+    ACTION_TYPE_FINALIZE,
+    ACTION_TYPE_INITIALIZE,
+    RECORD_TYPE_SPECIAL,
+)
+from openwpm.DataAggregator.LocalAggregator import (
+    SHARD_DB_SUFFIX,
+    LocalAggregator,
+    create_tables,
+    merge_shard_databases,
+)
+from openwpm.SocketInterface import clientsocket
+
+pytestmark = pytest.mark.pyonly
+
+
+def get_config(tmpdir, shard_by="table"):
+    manager_params, browser_params = TaskManager.load_default_params(1)
+    manager_params["data_directory"] = str(tmpdir)
+    manager_params["database_name"] = os.path.join(str(tmpdir), "crawl-data.sqlite")
+    manager_params["aggregator_shards"] = 3
+    manager_params["aggregator_shard_by"] = shard_by
+    browser_params[0]["browser_id"] = 1
+    return manager_params, browser_params
+
+
+def wait_for_completed_visits(aggregator, count, timeout=30):
+    completed = list()
+    deadline = time.time() + timeout
+    while len(completed) < count and time.time() < deadline:
+        completed.extend(aggregator.get_new_completed_visits())
+        time.sleep(0.1)
+    return completed
+
+
+@pytest.mark.parametrize("shard_by", ["table", "visit"])
+def test_sharded_local_aggregator(tmpdir, shard_by):
+    manager_params, browser_params = get_config(tmpdir, shard_by)
+    aggregator = LocalAggregator(manager_params, browser_params)
+    aggregator.launch()
+    sock = clientsocket(serialization="dill")
+    sock.connect(*aggregator.listener_address)
+
+    visit_ids = [aggregator.get_next_visit_id() for _ in range(4)]
+    for visit_id in visit_ids:
+        sock.send(
+            (
+                RECORD_TYPE_SPECIAL,
+                {"action": ACTION_TYPE_INITIALIZE, "visit_id": visit_id},
+            )
+        )
+        sock.send(
+            (
+                "site_visits",
+                {"visit_id": visit_id, "browser_id": 1, "site_url": "a"},
+            )
+        )
+        for i in range(10):
+            sock.send(
+                (
+                    "javascript",
+                    {
+                        "visit_id": visit_id,
+                        "browser_id": 1,
+                        "symbol": str(i),
+                        "time_stamp": "",
+                    },
+                )
+            )
+        sock.send(
+            (
+                RECORD_TYPE_SPECIAL,
+                {
+                    "action": ACTION_TYPE_FINALIZE,
+                    "visit_id": visit_id,
+                    "success": visit_id != visit_ids[-1],
+                },
+            )
+        )
+
+    completed = wait_for_completed_visits(aggregator, len(visit_ids))
+    assert sorted(completed) == sorted(
+        [(visit_id, visit_id == visit_ids[-1]) for visit_id in visit_ids]
+    )
+    sock.close()
+    aggregator.shutdown()
+
+    db_path = manager_params["database_name"]
+    assert not os.path.exists(db_path + SHARD_DB_SUFFIX % 0)
+    db = sqlite3.connect(db_path)
+    assert db.execute("SELECT COUNT(*) FROM site_visits").fetchone()[0] == 4
+    rows = db.execute("SELECT id, visit_id FROM javascript").fetchall()
+    assert len(rows) == 40
+    assert len(set(row[0] for row in rows)) == 40
+    assert db.execute("SELECT visit_id FROM incomplete_visits").fetchall() == [
+        (visit_ids[-1],)
+    ]
+    db.close()
+
+
+def test_merge_shard_databases_is_idempotent(tmpdir):
+    db_path = os.path.join(str(tmpdir), "crawl-data.sqlite")
+    for path in [db_path, db_path + SHARD_DB_SUFFIX % 0]:
+        db = sqlite3.connect(path)
+        create_tables(db)
+        db.execute(
+            "INSERT INTO javascript (browser_id, visit_id, time_stamp) "
+            "VALUES (1, 1, '')"
+        )
+        db.commit()
+        db.close()
+    merge_shard_databases(db_path)
+    merge_shard_databases(db_path)
+    db = sqlite3.connect(db_path)
+    ids = db.execute("SELECT id FROM javascript").fetchall()
+    assert sorted(ids) == [(1,), (2,)]
+    db.close()
@@ -0,0 +1,91 @@
+import collections
+
+import pytest
+
+from openwpm.utilities import site_list
+from openwpm.utilities.site_list import Site
+
+pytestmark = pytest.mark.pyonly
+
+
+def write_list(path, domains, start=1):
+    path.write_text(
+        "".join("%d,%s\n" % (start + i, domain) for i, domain in enumerate(domains))
+    )
+    return str(path)
+
+
+def test_parse_shard():
+    assert site_list.parse_shard("2/4") == (2, 4)
+    for value in ("4", "0/4", "5/4", "a/4"):
+        with pytest.raises(ValueError):
+            site_list.parse_shard(value)
+
+
+def test_normalize_url():
+    assert site_list.normalize_url("Example.COM") == "http://example.com"
+    assert site_list.normalize_url(" https://a.example.com./x ") == (
+        "https://a.example.com/x"
+    )
+    assert site_list.normalize_url("example.com:8080") == "http://example.com:8080"
+    assert (
+        site_list.normalize_url("\ufeffbbc.co.uk", www=True) == "http://www.bbc.co.uk"
+    )
+    # Only registrable domains get a www. prefix, unlike the old `"www" in`
+    # check of cookie_crawler.py
+    assert site_list.normalize_url("news.bbc.co.uk", www=True) == (
+        "http://news.bbc.co.uk"
+    )
+    assert site_list.normalize_url("wwwf.org", www=True) == "http://www.wwwf.org"
+    assert site_list.normalize_url("") is None
+    assert site_list.normalize_url("http://") is None
+
+
+def test_read_sites(tmp_path):
+    first = write_list(
+        tmp_path / "tranco_a.csv", ["example.com", "www.bbc.co.uk", "EXAMPLE.com"]
+    )
+    (tmp_path / "tranco_b.csv").write_text(
+        "rank,domain\n1,example.com\n2,example.org\n"
+    )
+    second = str(tmp_path / "tranco_b.csv")
+
+    sites = list(site_list.iter_sites([str(tmp_path / "tranco_*.csv"), first]))
+    assert sites == [
+        Site(1, "http://example.com", "example.com", first),
+        Site(2, "http://www.bbc.co.uk", "bbc.co.uk", first),
+        Site(2, "http://example.org", "example.org", second),
+    ]
+    with pytest.raises(FileNotFoundError):
+        list(site_list.iter_sites([str(tmp_path / "missing.csv")]))
+
+
+@pytest.mark.parametrize("bucket_size", [0, 10])
+def test_shards(tmp_path, bucket_size):
+    domains = ["site%d.com" % i for i in range(95)]
+    # Subdomains of a registrable domain are in the same shard
+    domains[50] = "www.site3.com"
+    sources = [write_list(tmp_path / "tranco_a.csv", domains)]
+    everything = list(site_list.iter_sites(sources))
+    shards = [
+        list(site_list.iter_sites(sources, (i, 4), bucket_size)) for i in range(1, 5)
+    ]
+
+    # Every site is in exactly one shard, in the order of the list
+    assert sorted(site for shard in shards for site in shard) == sorted(everything)
+    for shard in shards:
+        assert shard == sorted(shard, key=everything.index)
+    by_domain = collections.defaultdict(set)
+    for i, shard in enumerate(shards):
+        for site in shard:
+            by_domain[site.domain].add(i)
+    if bucket_size == 0:
+        assert by_domain["site3.com"] == {next(iter(by_domain["site3.com"]))}
+    else:
+        # Each bucket of 10 ranks is spread evenly over the shards
+        for shard in shards:
+            per_bucket = collections.Counter((s.rank - 1) // 10 for s in shard)
+            assert all(2 <= per_bucket[b] <= 3 for b in range(9))
+
+    # The assignment is the same when computed again
+    assert shards[1] == list(site_list.iter_sites(sources, (2, 4), bucket_size))
@@ -0,0 +1,117 @@
+import os
+import socket
+import sqlite3
+import time
+
+import pytest
+from multiprocess import Queue
+
+from openwpm import TaskManager
+from openwpm.DataAggregator.BaseAggregator import BaseListener, FlowControl
+from openwpm.DataAggregator.LocalAggregator import LocalAggregator
+from openwpm.SocketInterface import clientsocket, serversocket
+
+pytestmark = pytest.mark.pyonly
+
+
+def test_wait_for_connections():
+    server = serversocket()
+    server.start_accepting()
+    address = server.sock.getsockname()
+
+    ending = clientsocket()
+    ending.connect(*address)
+    breaking = socket.create_connection(address)
+    ending.send(["hello", "world"])
+    start = time.time()
+    while server.open_connections < 2 and time.time() - start < 5:
+        time.sleep(0.01)
+    assert not server.wait_for_connections(timeout=0.1)
+
+    ending.close()
+    breaking.close()
+    assert server.wait_for_connections(timeout=5)
+    assert server.ended_connections == 1
+    assert server.broken_connections == 1
+    assert server.queue.get(timeout=1) == ["hello", "world"]
+    server.close()
+
+
+def test_aggregator_shutdown(tmpdir):
+    manager_params, browser_params = TaskManager.load_default_params(1)
+    manager_params["data_directory"] = str(tmpdir)
+    manager_params["database_name"] = os.path.join(str(tmpdir), "crawl-data.sqlite")
+    aggregator = LocalAggregator(manager_params, browser_params)
+    aggregator.launch()
+
+    sock = clientsocket(serialization="dill")
+    sock.connect(*aggregator.listener_address)
+    for visit_id in range(100):
+        sock.send(
+            (
+                "site_visits",
+                {"visit_id": visit_id, "browser_id": 1, "site_url": "http://a.test"},
+            )
+        )
+    sock.close()
+
+    start = time.time()
+    aggregator.shutdown()
+    # The listener doesn't wait for the drain deadline once all senders
+    # have ended their stream
+    assert time.time() - start < 10
+
+    metrics = dict()
+    for labels, snapshot in aggregator.get_listener_metrics():
+        for name, samples in snapshot.items():
+            for sample_labels, value in samples:
+                metrics[(name, sample_labels.get("status"))] = value
+    assert metrics[("openwpm_connections_closed_total", "ended")] == 1
+    assert metrics[("openwpm_open_connections", None)] == 0
+    assert metrics[("openwpm_records_drained_total", None)] <= 100
+
+    db = sqlite3.connect(manager_params["database_name"])
+    (count,) = db.execute("SELECT COUNT(*) FROM site_visits").fetchone()
+    db.close()
+    assert count == 100
+
+
+class CountingListener(BaseListener):
+    def __init__(self):
+        super(CountingListener, self).__init__(
+            Queue(), Queue(), Queue(), FlowControl(None)
+        )
+        self.records = list()
+
+    def process_record(self, record):
+        self.records.append(record)
+
+    def process_content(self, record):
+        pass
+
+    def run_visit_completion_tasks(self, visit_id, interrupted=False):
+        pass
+
+
+def test_drain_queue_under_backpressure():
+    listener = CountingListener()
+    listener.sock = serversocket(max_queue_bytes=1000)
+    listener.sock.start_accepting()
+    listener.record_queue = listener.sock.queue
+    listener._shutdown_flag = True
+
+    sock = clientsocket(serialization="dill")
+    sock.connect(*listener.sock.sock.getsockname())
+    for i in range(200):
+        sock.send(("javascript", {"visit_id": i, "value": "x" * 100}))
+    sock.close()
+    # The socket thread blocks once the queue is full
+    start = time.time()
+    while listener.record_queue.bytesize() < 1000 and time.time() - start < 5:
+        time.sleep(0.01)
+
+    start = time.time()
+    assert listener.drain_queue(timeout=10) == 200
+    assert time.time() - start < 5
+    assert [data["visit_id"] for _, data in listener.records] == list(range(200))
+    listener.sock.close()
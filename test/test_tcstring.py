@@ -0,0 +1,162 @@
+import base64
+import datetime
+
+import numpy as np
+import pytest
+
+from openwpm.utilities import tcstring
+
+pytestmark = pytest.mark.pyonly
+
+
+def bits(value, length):
+    return format(value, "0%db" % length)
+
+
+def letters(code):
+    return bits(ord(code[0]) - ord("A"), 6) + bits(ord(code[1]) - ord("A"), 6)
+
+
+def bitfield(ids, length):
+    return "".join("1" if i in ids else "0" for i in range(1, length + 1))
+
+
+def ranges(ids):
+    out = bits(len(ids), 12)
+    for entry in ids:
+        if isinstance(entry, tuple):
+            out += "1" + bits(entry[0], 16) + bits(entry[1], 16)
+        else:
+            out += "0" + bits(entry, 16)
+    return out
+
+
+def vendor_section(ids, max_vendor_id=None, use_ranges=False):
+    if use_ranges:
+        return bits(max_vendor_id or 0, 16) + "1" + ranges(ids)
+    max_vendor_id = max(ids, default=0) if max_vendor_id is None else max_vendor_id
+    return bits(max_vendor_id, 16) + "0" + bitfield(set(ids), max_vendor_id)
+
+
+def encode(
+    cmp_id=10,
+    purposes=(1, 2),
+    vendors=(2, 755),
+    vendors_li=(3,),
+    publisher_cc="BE",
+    use_ranges=False,
+    restrictions="",
+    version=2,
+):
+    out = (
+        bits(version, 6)
+        + bits(16000000000, 36)
+        + bits(16000000010, 36)
+        + bits(cmp_id, 12)
+        + bits(4, 12)
+        + bits(1, 6)
+        + letters("EN")
+        + bits(90, 12)
+        + bits(2, 6)
+        + "1"
+        + "0"
+        + bitfield({1}, 12)
+        + bitfield(set(purposes), 24)
+        + bitfield({2, 7}, 24)
+        + "0"
+        + letters(publisher_cc)
+    )
+    if use_ranges:
+        out += vendor_section([(1, 3), 755], 755, use_ranges=True)
+    else:
+        out += vendor_section(vendors)
+    out += vendor_section(vendors_li)
+    out += restrictions or bits(0, 12)
+    out += "0" * (-len(out) % 8)
+    data = int(out, 2).to_bytes(len(out) // 8, "big")
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def test_decode():
+    restriction = bits(1, 12) + bits(3, 6) + bits(1, 2) + ranges([(10, 12)])
+    tc = tcstring.decode(encode(restrictions=restriction) + ".YAAAAAAAAAAA")
+    assert tc.version == 2
+    assert tc.created == datetime.datetime(1970, 1, 1) + datetime.timedelta(
+        seconds=1600000000
+    )
+    assert (tc.cmp_id, tc.cmp_version, tc.vendor_list_version) == (10, 4, 90)
+    assert tc.consent_language == "EN"
+    assert tc.publisher_cc == "BE"
+    assert tc.is_service_specific and not tc.use_non_standard_stacks
+    assert tc.special_feature_opt_ins == {1}
+    assert tc.purpose_consents == {1, 2}
+    assert tc.purpose_legitimate_interests == {2, 7}
+    assert tc.vendor_consents == {2, 755}
+    assert tc.vendor_legitimate_interests == {3}
+    assert tc.publisher_restrictions == (
+        tcstring.PublisherRestriction(3, 1, frozenset({10, 11, 12})),
+    )
+    assert tcstring.decode(encode(use_ranges=True)).vendor_consents == {
+        1,
+        2,
+        3,
+        755,
+    }
+    for invalid in ("", "not base64!", encode(version=1), encode()[:20]):
+        with pytest.raises(ValueError):
+            tcstring.decode(invalid)
+
+
+def test_decode_batch():
+    tc_strings = [
+        encode(),
+        encode(cmp_id=7, purposes=(1,), vendors=(1, 2), publisher_cc="NL"),
+        "",
+        encode(use_ranges=True, vendors_li=()),
+        encode()[:30],
+        encode(vendors=range(1, 1000, 7)),
+    ]
+    batch = tcstring.decode_batch(tc_strings, max_vendor_id=1024, chunk_size=4)
+    assert len(batch) == 6
+    assert batch.valid.tolist() == [True, True, False, True, False, True]
+    assert batch.cmp_id.tolist() == [10, 7, 0, 10, 0, 10]
+    assert batch.publisher_cc.tolist() == ["BE", "NL", "", "BE", "", "BE"]
+    assert batch.consent_language[0] == "EN"
+    assert batch.vendor_consents.shape == (6, 128)
+    assert batch.has_vendor_consent(755).tolist() == [
+        True,
+        False,
+        False,
+        True,
+        False,
+        False,
+    ]
+    assert batch.has_vendor_consent(5000).tolist() == [False] * 6
+    assert batch.has_purpose_consent(2).tolist() == [
+        True,
+        False,
+        False,
+        True,
+        False,
+        True,
+    ]
+    assert batch.has_vendor_legitimate_interest(3).tolist() == [
+        True,
+        True,
+        False,
+        False,
+        False,
+        True,
+    ]
+    # The batch path agrees with the scalar decoder
+    for i in np.flatnonzero(batch.valid):
+        decoded = tcstring.decode(tc_strings[i])
+        expected = sorted(decoded.vendor_consents)
+        row = np.unpackbits(batch.vendor_consents[i])
+        assert (np.flatnonzero(row) + 1).tolist() == expected
+        assert batch.created[i] == 16000000000
+    counts = batch.vendor_consent_counts()
+    assert counts[754] == 2
+    assert counts[1] == 3
+    assert batch.purpose_consent_counts()[0] == 4
+    assert len(tcstring.decode_batch([])) == 0
@@ -0,0 +1,93 @@
+import json
+import os
+import sqlite3
+
+import numpy as np
+import pytest
+
+from openwpm import TaskManager
+from openwpm.DataAggregator.LocalAggregator import LocalAggregator
+from openwpm.SocketInterface import clientsocket
+from openwpm.utilities import tcstring, vendor_list
+from openwpm.utilities.vendor_list import GlobalVendorList
+
+from .test_tcstring import encode
+
+pytestmark = pytest.mark.pyonly
+
+GVL = {
+    "vendorListVersion": 90,
+    "tcfPolicyVersion": 2,
+    "purposes": {"1": {"id": 1, "name": "Store and/or access information"}},
+    "specialFeatures": {"1": {"id": 1, "name": "Use precise geolocation data"}},
+    "vendors": {
+        "2": {"id": 2, "name": "Captify", "purposes": [1], "legIntPurposes": [2]},
+        "755": {"id": 755, "name": "Google", "purposes": [1, 3]},
+        "3": {"id": 3, "name": "Other", "purposes": [], "legIntPurposes": [1]},
+    },
+}
+
+
+def test_global_vendor_list(tmpdir):
+    path = os.path.join(str(tmpdir), "vendor-list.json")
+    with open(path, "w") as f:
+        json.dump(GVL, f)
+    gvl = GlobalVendorList.from_file(path)
+    assert gvl.version == 90
+    assert gvl.max_vendor_id == 755
+    assert gvl.vendor_name(755) == "Google"
+    assert gvl.vendor_name(1) == ""
+    assert gvl.purposes[1] == "Store and/or access information"
+    assert gvl.vendors_for_purpose(1) == [2, 755]
+    assert gvl.vendors_for_purpose(1, legitimate_interest=True) == [3]
+
+    batch = tcstring.decode_batch(
+        [encode(vendors=(2, 755)), encode(vendors=(3,))], max_vendor_id=1024
+    )
+    mask = gvl.vendor_mask(gvl.vendors_for_purpose(1), width=1024)
+    consented = np.unpackbits(batch.vendor_consents & mask, axis=1).sum(axis=1)
+    assert consented.tolist() == [2, 0]
+
+
+def test_cmp_names():
+    assert vendor_list.get_cmp_name(3) == "LiveRamp"
+    assert vendor_list.get_cmp_name("5") == "Usercentrics.com"
+    assert vendor_list.get_cmp_name(None) == ""
+    assert vendor_list.get_cmp_name(4095) == ""
+
+
+def test_cmp_name_without_cmp_list(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    assert vendor_list.get_cmp_name(3) == "LiveRamp"
+    missing = os.path.join(str(tmpdir), "cmplist.json")
+    assert vendor_list.get_cmp_name(3, missing) is None
+
+
+def test_tc_data_record(tmpdir):
+    manager_params, browser_params = TaskManager.load_default_params(1)
+    manager_params["data_directory"] = str(tmpdir)
+    manager_params["database_name"] = os.path.join(str(tmpdir), "crawl-data.sqlite")
+    aggregator = LocalAggregator(manager_params, browser_params)
+    aggregator.launch()
+    sock = clientsocket()
+    sock.connect(*aggregator.listener_address)
+    sock.send(
+        (
+            "tc_data",
+            {
+                "visit_id": 1,
+                "browser_id": 1,
+                "cmp_id": 3,
+                "cmp_name": "LiveRamp",
+                "gdpr_applies": True,
+                "tc_string": encode(),
+            },
+        )
+    )
+    sock.close()
+    aggregator.shutdown()
+
+    db = sqlite3.connect(manager_params["database_name"])
+    (tc_string,) = db.execute("SELECT tc_string FROM tc_data").fetchone()
+    db.close()
+    assert tcstring.decode(tc_string).vendor_consents == {2, 755}